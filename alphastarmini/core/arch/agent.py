@@ -13,6 +13,7 @@ from pysc2.lib import actions as A
 
 from alphastarmini.core.arch.arch_model import ArchModel
 from alphastarmini.core.arch.entity_encoder import EntityEncoder, Entity
+from alphastarmini.core.arch.scalar_encoder import get_scalar_feature_assembler
 
 from alphastarmini.core.rl.action import ArgsAction
 from alphastarmini.core.rl.state import MsState
@@ -26,6 +27,7 @@ from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
 from alphastarmini.lib.hyper_parameters import MiniStar_Arch_Hyper_Parameters as MAHP
 from alphastarmini.lib.hyper_parameters import StarCraft_Hyper_Parameters as SCHP
 from alphastarmini.lib.hyper_parameters import Scalar_Feature_Size as SFS
+from alphastarmini.lib.hyper_parameters import ScalarFeature
 
 from pysc2.lib.units import get_unit_type
 
@@ -92,68 +94,28 @@ class Agent(object):
         return state
 
     def get_scalar_list(self, obs, build_order=None):
-        scalar_list = []
-
-        # implement the agent_statistics
-        player = obs["player"]
-        player_statistics = player[1:]
-        agent_statistics = torch.tensor(player_statistics, dtype=torch.float).reshape(1, -1)
-        print('agent_statistics:', agent_statistics) if debug else None
-
-        # implement the upgrades
-        upgrades = torch.zeros(1, SFS.upgrades)
-        obs_upgrades = obs["upgrades"]
-        print('obs_upgrades:', obs_upgrades) if debug else None
-        for u in obs_upgrades:
-            assert u >= 0 
-            assert u < SFS.upgrades
-            upgrades[0, u] = 1
-
-        # implement the unit_counts_bow
-        unit_counts_bow = L.calculate_unit_counts_bow(obs)
-        print('unit_counts_bow:', unit_counts_bow) if debug else None
-        print('torch.sum(unit_counts_bow):', torch.sum(unit_counts_bow)) if debug else None
+        # the scalar features used by the baselines, from the same assembler as ScalarEncoder
+        assembler = get_scalar_feature_assembler()
+        assembler.assemble(obs, build_order=build_order)
+        all_scalar_list = assembler.to_tensor_list()
 
+        return Agent.get_baseline_scalar_list(all_scalar_list)
+
+    @staticmethod
+    def get_baseline_scalar_list(all_scalar_list):
+        # the scalar features used by the baselines, selected from the 16 scalar features of a state,
+        # so the actor can reuse the statistical_state it already has
         # TODO: implement the units_buildings
         units_buildings = torch.randn(1, SFS.units_buildings)
 
-        # implement the effects
-        effects = torch.zeros(1, SFS.effects)
-        # we now use feature_effects to represent it
-        feature_effects = obs["feature_effects"]
-        print('feature_effects:', feature_effects) if debug else None
-        for effect in feature_effects:
-            e = effect.effect_id
-            assert e >= 0 
-            assert e < SFS.effects
-            effects[0, e] = 1
-        # the raw effects are reserved for use
-        raw_effects = obs["raw_effects"]
-        print('raw_effects:', raw_effects) if debug else None
-
-        # now we simplely make upgrade the same as upgrades
-        upgrade = upgrades
-
-        # implement the build order
-        # TODO: add the pos of buildings
-        beginning_build_order = torch.zeros(1, SCHP.count_beginning_build_order, int(SFS.beginning_build_order / SCHP.count_beginning_build_order))
-        print('beginning_build_order.shape:', beginning_build_order.shape) if debug else None
-        if build_order is not None:
-            # implement the beginning_build_order               
-            for i, bo in enumerate(build_order):
-                if i < 20:
-                    assert bo < SFS.unit_counts_bow
-                    beginning_build_order[0, i, bo] = 1
-            print("beginning_build_order:", beginning_build_order) if debug else None
-            print("sum(beginning_build_order):", torch.sum(beginning_build_order).item()) if debug else None
-
-        scalar_list.append(agent_statistics)
-        scalar_list.append(upgrades)
-        scalar_list.append(unit_counts_bow)
-        scalar_list.append(units_buildings)
-        scalar_list.append(effects)
-        scalar_list.append(upgrade)
-        scalar_list.append(beginning_build_order)
+        scalar_list = [all_scalar_list[ScalarFeature.agent_statistics],
+                       all_scalar_list[ScalarFeature.upgrades],
+                       all_scalar_list[ScalarFeature.unit_counts_bow],
+                       units_buildings,
+                       all_scalar_list[ScalarFeature.effects],
+                       all_scalar_list[ScalarFeature.upgrade],
+                       all_scalar_list[ScalarFeature.beginning_build_order]]
+        print('scalar_list:', scalar_list) if debug else None
 
         return scalar_list
 
@@ -167,7 +129,20 @@ class Agent(object):
 
     @staticmethod
     def preprocess_state_entity_numpy(obs, return_entity_pos=False):
-        # TODO-QUICK: add a qucik verion without Entity()
+        # the quick version without Entity(), which reads the raw_units array directly
+        raw_units = obs["raw_units"]
+        entities_array, entity_pos = ArchModel.preprocess_entity_raw_numpy(raw_units, 
+                                                                           return_entity_pos=True)
+        batch_entities_array = np.expand_dims(entities_array, axis=0) 
+
+        if return_entity_pos:
+            return batch_entities_array, entity_pos
+        return batch_entities_array
+
+    @staticmethod
+    def preprocess_state_entity_numpy_by_entity(obs, return_entity_pos=False):
+        # the original version which builds an Entity() for each raw unit,
+        # kept to check the results of preprocess_state_entity_numpy
 
         raw_units = obs["raw_units"]
         e_list = []
@@ -241,7 +216,7 @@ class Agent(object):
                 break
 
         entities_array, entity_pos = ArchModel.preprocess_entity_numpy(e_list, 
-                                                                       return_entity_pos=return_entity_pos)
+                                                                       return_entity_pos=True)
         batch_entities_array = np.expand_dims(entities_array, axis=0) 
 
         if return_entity_pos:
@@ -445,8 +420,84 @@ class Agent(object):
         return
 
 
+def random_raw_units(unit_num, seed=None):
+    # synthetic raw_units in the format of pysc2 obs["raw_units"], with values in the valid ranges
+    from pysc2.lib import named_array
+    from pysc2.lib.features import FeatureUnit
+    from pysc2.lib.units import Neutral, Protoss, Terran, Zerg
+
+    rng = np.random.RandomState(seed)
+    unit_types = [u.value for race in (Neutral, Protoss, Terran, Zerg) for u in race]
+
+    raw_units = np.zeros((unit_num, len(FeatureUnit)), dtype=np.int64)
+    raw_units[:, FeatureUnit.unit_type] = rng.choice(unit_types, unit_num)
+    raw_units[:, FeatureUnit.alliance] = rng.randint(1, 5, unit_num)
+    raw_units[:, FeatureUnit.health] = rng.randint(0, 2000, unit_num)
+    raw_units[:, FeatureUnit.shield] = rng.randint(0, 1200, unit_num)
+    raw_units[:, FeatureUnit.energy] = rng.randint(0, 250, unit_num)
+    raw_units[:, FeatureUnit.cargo_space_taken] = rng.randint(0, 9, unit_num)
+    raw_units[:, FeatureUnit.build_progress] = rng.randint(0, 101, unit_num)
+    raw_units[:, FeatureUnit.health_ratio] = rng.randint(0, 256, unit_num)
+    raw_units[:, FeatureUnit.shield_ratio] = rng.randint(0, 256, unit_num)
+    raw_units[:, FeatureUnit.energy_ratio] = rng.randint(0, 256, unit_num)
+    raw_units[:, FeatureUnit.display_type] = rng.randint(1, 4, unit_num)
+    raw_units[:, FeatureUnit.x] = rng.randint(0, AHP.minimap_size, unit_num)
+    raw_units[:, FeatureUnit.y] = rng.randint(0, AHP.minimap_size, unit_num)
+    raw_units[:, FeatureUnit.cloak] = rng.randint(0, 4, unit_num)
+    raw_units[:, FeatureUnit.is_selected] = rng.randint(0, 2, unit_num)
+    raw_units[:, FeatureUnit.is_powered] = rng.randint(0, 2, unit_num)
+    raw_units[:, FeatureUnit.mineral_contents] = rng.randint(0, 1900, unit_num)
+    raw_units[:, FeatureUnit.vespene_contents] = rng.randint(0, 2600, unit_num)
+    raw_units[:, FeatureUnit.cargo_space_max] = rng.randint(0, 9, unit_num)
+    raw_units[:, FeatureUnit.assigned_harvesters] = rng.randint(0, 30, unit_num)
+    raw_units[:, FeatureUnit.ideal_harvesters] = rng.randint(0, 17, unit_num)
+    raw_units[:, FeatureUnit.weapon_cooldown] = rng.randint(0, 40, unit_num)
+    raw_units[:, FeatureUnit.order_length] = rng.randint(0, 12, unit_num)
+    raw_units[:, FeatureUnit.order_id_0] = rng.randint(0, SCHP.max_order_ids, unit_num)
+    raw_units[:, FeatureUnit.tag] = 4294967296 + np.arange(unit_num) * 4 + rng.randint(0, 4)
+    raw_units[:, FeatureUnit.hallucination] = rng.randint(0, 2, unit_num)
+    raw_units[:, FeatureUnit.buff_id_0] = rng.randint(0, SCHP.max_buffer_ids, unit_num)
+    raw_units[:, FeatureUnit.buff_id_1] = rng.randint(0, SCHP.max_buffer_ids, unit_num)
+    raw_units[:, FeatureUnit.addon_unit_type] = rng.randint(0, SCHP.max_add_on_type, unit_num)
+    raw_units[:, FeatureUnit.active] = rng.randint(0, 2, unit_num)
+    raw_units[:, FeatureUnit.is_on_screen] = rng.randint(0, 2, unit_num)
+    raw_units[:, FeatureUnit.order_progress_0] = rng.randint(0, 100, unit_num)
+    raw_units[:, FeatureUnit.order_progress_1] = rng.randint(0, 100, unit_num)
+    raw_units[:, FeatureUnit.attack_upgrade_level] = rng.randint(0, 4, unit_num)
+    raw_units[:, FeatureUnit.armor_upgrade_level] = rng.randint(0, 4, unit_num)
+    raw_units[:, FeatureUnit.shield_upgrade_level] = rng.randint(0, 4, unit_num)
+
+    return named_array.NamedNumpyArray(raw_units, [None, FeatureUnit], dtype=np.int64)
+
+
+def test_preprocess_entity(unit_nums=(1, 37, 512, 600), benchmark_num=20):
+    import time
+
+    for unit_num in unit_nums:
+        obs = {"raw_units": random_raw_units(unit_num, seed=unit_num)}
+
+        columnar, columnar_pos = Agent.preprocess_state_entity_numpy(obs, return_entity_pos=True)
+        by_entity, by_entity_pos = Agent.preprocess_state_entity_numpy_by_entity(obs, return_entity_pos=True)
+
+        assert columnar.dtype == by_entity.dtype
+        assert columnar.shape == by_entity.shape
+        assert columnar.tobytes() == by_entity.tobytes()
+        assert columnar_pos == [[int(x), int(y)] for x, y in by_entity_pos]
+
+    # benchmark test
+    obs = {"raw_units": random_raw_units(unit_nums[-2], seed=0)}
+    for preprocess in (Agent.preprocess_state_entity_numpy_by_entity, Agent.preprocess_state_entity_numpy):
+        benchmark_start = time.time()
+        for i in range(benchmark_num):
+            preprocess(obs)
+        elapse_time = (time.time() - benchmark_start) / benchmark_num
+        print("{} per frame: {:.6f}s".format(preprocess.__name__, elapse_time))
+
+
 def test():
 
+    test_preprocess_entity()
+
     agent = Agent()
 
     batch_size = AHP.batch_size * AHP.sequence_length
@@ -84,6 +84,10 @@ class ArchModel(nn.Module):
     def preprocess_entity_numpy(e_list, return_entity_pos=False):
         return EntityEncoder.preprocess_numpy(e_list, return_entity_pos=return_entity_pos)
 
+    @staticmethod
+    def preprocess_entity_raw_numpy(raw_units, return_entity_pos=False):
+        return EntityEncoder.preprocess_raw_units_numpy(raw_units, return_entity_pos=return_entity_pos)
+
     @staticmethod    
     def preprocess_scalar_numpy(obs, build_order=None):
         return ScalarEncoder.preprocess_numpy(obs, build_order=build_order)
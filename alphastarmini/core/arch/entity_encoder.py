@@ -12,6 +12,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from pysc2.lib.units import Protoss, Neutral
+from pysc2.lib.features import FeatureUnit
 
 from alphastarmini.lib.alphastar_transformer import Transformer
 from alphastarmini.lib import utils as L
@@ -715,6 +716,129 @@ class EntityEncoder(nn.Module):
 
         return all_entities_array
 
+    @classmethod
+    def preprocess_raw_units_numpy(cls, raw_units, return_entity_pos=False, debug=False):
+        # add in mAS 1.06
+        # a columnar version of preprocess_numpy. It reads the raw_units array of an observation
+        # directly and fills each field for all the (up to 512) entities at once, instead of
+        # building an Entity for each raw unit and encoding it row by row.
+        # Its output is bit-identical to Agent.preprocess_state_entity_numpy_by_entity, which means
+        # the fields never filled from raw_units keep the default values of Entity().
+        default = Entity()
+
+        raw = np.asarray(raw_units).reshape(-1, len(FeatureUnit))[:cls.max_entities]
+        entity_num = raw.shape[0]
+        print('entity_num:', entity_num) if debug else None
+
+        def column(field):
+            return raw[:, field]
+
+        def constant(value):
+            return np.full(entity_num, value, dtype=np.int64)
+
+        # we use a bias of -1e9 for any of the 512 entries that doesn't refer to an entity.
+        all_entities_array = np.full((cls.max_entities, AHP.embedding_size), cls.bias_value, dtype=np.float32)
+        block = all_entities_array[:entity_num]
+        block[:, :] = 0.
+        writer = _ColumnWriter(block)
+
+        # unit_type: One-hot with maximum cls.max_unit_type (including unknown unit-type)
+        unit_type_index = L.get_unit_type_registry().indexes(column(FeatureUnit.unit_type))
+        assert ((unit_type_index >= 0) & (unit_type_index <= cls.max_unit_type)).all()
+        writer.one_hot(unit_type_index, cls.max_unit_type)
+
+        # unit_attributes: not filled from raw_units, see preprocess_numpy
+        writer.value(np.array(default.unit_attributes, dtype=np.float32).reshape(1, -1))
+
+        writer.one_hot(column(FeatureUnit.alliance), cls.max_alliance)
+        writer.one_hot(column(FeatureUnit.display_type), cls.max_display_type)
+
+        # x_position and y_position: Binary encoding, the same as np.unpackbits in preprocess_numpy
+        writer.value(np.unpackbits(column(FeatureUnit.x).astype(np.uint8).reshape(-1, 1), axis=1))
+        writer.value(np.unpackbits(column(FeatureUnit.y).astype(np.uint8).reshape(-1, 1), axis=1))
+
+        # current_health, current_shields, current_energy: One-hot of sqrt(min(x, max)), rounding down
+        for field, max_value in ((FeatureUnit.health, cls.max_health),
+                                 (FeatureUnit.shield, cls.max_shield),
+                                 (FeatureUnit.energy, cls.max_energy)):
+            sqrt_value = np.sqrt(np.minimum(column(field), max_value)).astype(np.int64)
+            writer.one_hot(sqrt_value, int(max_value ** 0.5) + 1)
+
+        cargo_space_used = column(FeatureUnit.cargo_space_taken)
+        assert ((cargo_space_used >= 0) & (cargo_space_used <= 8)).all()
+        writer.one_hot(cargo_space_used, cls.max_cargo_space_used)
+
+        cargo_space_maximum = column(FeatureUnit.cargo_space_max)
+        assert ((cargo_space_maximum >= 0) & (cargo_space_maximum <= 8)).all()
+        writer.one_hot(cargo_space_maximum, cls.max_cargo_space_maximum)
+
+        # build_progress and the health, shield, energy ratios: Float in [0, 1]
+        writer.value(column(FeatureUnit.build_progress) / 100.)
+        writer.value(column(FeatureUnit.health_ratio) / 255.)
+        writer.value(column(FeatureUnit.shield_ratio) / 255.)
+        writer.value(column(FeatureUnit.energy_ratio) / 255.)
+
+        writer.one_hot(column(FeatureUnit.cloak), cls.max_cloakState)
+        writer.one_hot(column(FeatureUnit.is_powered), cls.max_is_powered)
+        writer.one_hot(column(FeatureUnit.hallucination), cls.max_is_hallucination)
+        writer.one_hot(column(FeatureUnit.active), cls.max_is_active)
+        writer.one_hot(column(FeatureUnit.is_on_screen), cls.max_is_on_screen)
+        writer.one_hot(column(FeatureUnit.is_in_cargo), cls.max_is_in_cargo)
+
+        # current_minerals and current_vespene: One-hot of (x / 100), rounding down
+        writer.one_hot((column(FeatureUnit.mineral_contents) / 100).astype(np.int64), cls.max_current_minerals)
+        writer.one_hot((column(FeatureUnit.vespene_contents) / 100).astype(np.int64), cls.max_current_vespene)
+
+        # mined_minerals and mined_vespene: not filled from raw_units
+        mined_minerals = int(min(default.mined_minerals, cls.max_mined_minerals) ** 0.5)
+        writer.one_hot(constant(mined_minerals), int(cls.max_mined_minerals ** 0.5) + 1)
+        mined_vespene = int(min(default.mined_vespene, cls.max_mined_vespene) ** 0.5)
+        writer.one_hot(constant(mined_vespene), int(cls.max_mined_vespene ** 0.5) + 1)
+
+        writer.one_hot(np.minimum(column(FeatureUnit.assigned_harvesters), 24), cls.max_assigned_harvesters)
+        writer.one_hot(column(FeatureUnit.ideal_harvesters), cls.max_ideal_harvesters)
+        writer.one_hot(np.minimum(column(FeatureUnit.weapon_cooldown).astype(np.int64), 31), cls.max_weapon_cooldown)
+        writer.one_hot(np.minimum(column(FeatureUnit.order_length), 8), cls.max_order_queue_length)
+
+        # order_1 to order_4: not filled from raw_units (Agent set e.order_1, not e.order_id_1)
+        writer.one_hot(constant(default.order_id_1), cls.max_order_ids)
+        if AHP != MAHP:
+            writer.one_hot(constant(default.order_id_2), cls.max_order_ids)
+            writer.one_hot(constant(default.order_id_3), cls.max_order_ids)
+            writer.one_hot(constant(default.order_id_4), cls.max_order_ids)
+
+        writer.one_hot(column(FeatureUnit.buff_id_0), cls.max_buffer_ids)
+        if AHP != MAHP:
+            writer.one_hot(column(FeatureUnit.buff_id_1), cls.max_buffer_ids)
+            writer.one_hot(column(FeatureUnit.addon_unit_type), cls.max_add_on_type)
+
+        # order_progress_1 and order_progress_2: Float of order progress, and one-hot of (x / 10)
+        for field in (FeatureUnit.order_progress_0, FeatureUnit.order_progress_1):
+            order_progress = column(field)
+            writer.value(order_progress / 100.)
+            writer.one_hot((order_progress / 10).astype(np.int64), cls.max_order_progress)
+
+        for field, max_value in ((FeatureUnit.attack_upgrade_level, cls.max_weapon_upgrades),
+                                 (FeatureUnit.armor_upgrade_level, cls.max_armor_upgrades),
+                                 (FeatureUnit.shield_upgrade_level, cls.max_shield_upgrades)):
+            upgrades = column(field)
+            assert ((upgrades >= 0) & (upgrades <= 3)).all()
+            writer.one_hot(upgrades, max_value)
+
+        writer.one_hot(column(FeatureUnit.is_selected), cls.max_was_selected)
+
+        # was_targeted: not filled from raw_units
+        writer.one_hot(constant(int(default.is_targeted)), cls.max_was_targeted)
+
+        assert writer.offset == AHP.embedding_size
+        print('all_entities_array.shape:', all_entities_array.shape) if debug else None
+
+        if return_entity_pos:
+            entity_pos_list = raw[:, [FeatureUnit.x, FeatureUnit.y]].tolist()
+            return all_entities_array, entity_pos_list
+
+        return all_entities_array
+
     def forward(self, x, debug=False):
         # refactor by reference mostly to https://github.com/opendilab/DI-star
         # some mistakes for transformer are fixed
@@ -790,6 +914,34 @@ class EntityEncoder(nn.Module):
         return entity_embeddings, embedded_entity, entity_num
 
 
+class _ColumnWriter(object):
+    '''
+    Writes the fields of all entities into consecutive columns of a preallocated block.
+    '''
+
+    def __init__(self, block):
+        self.block = block
+        self.rows = np.arange(block.shape[0])
+        self.offset = 0
+
+    def one_hot(self, index, nb_classes):
+        # keep the same indexing behaviour as L.np_one_hot, i.e., np.eye(nb_classes)[index]
+        index = np.asarray(index).astype(np.int64).reshape(-1)
+        if index.size and (index.max() >= nb_classes or index.min() < -nb_classes):
+            raise IndexError('index out of bounds for one-hot with {} classes'.format(nb_classes))
+        index = np.where(index < 0, index + nb_classes, index)
+        self.block[self.rows, self.offset + index] = 1.
+        self.offset += nb_classes
+
+    def value(self, value):
+        value = np.asarray(value, dtype=np.float32)
+        if value.ndim == 1:
+            value = value.reshape(-1, 1)
+        width = value.shape[1]
+        self.block[:, self.offset:self.offset + width] = value
+        self.offset += width
+
+
 class Entity(object):
 
     def __init__(self, unit_type=1,
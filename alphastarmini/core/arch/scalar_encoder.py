@@ -3,17 +3,22 @@
 
 " Scalar Encoder."
 
+import threading
+
 import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from pysc2.lib.features import EffectPos
+
 from alphastarmini.lib.alphastar_transformer import Transformer
 
 from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
 from alphastarmini.lib.hyper_parameters import StarCraft_Hyper_Parameters as SCHP
 from alphastarmini.lib.hyper_parameters import Scalar_Feature_Size as SFS
+from alphastarmini.lib.hyper_parameters import ScalarFeature
 
 from alphastarmini.lib import utils as L
 
@@ -75,152 +80,19 @@ class ScalarEncoder(nn.Module):
 
     @classmethod
     def preprocess_tensor(cls, obs, build_order=None):
-        scalar_list = []
-
-        player = obs["player"]
-        print('player:', player) if debug else None
-
-        # The first is player_id, so we don't need it.
-        player_statistics = player[1:]
-        print('player_statistics:', player_statistics) if debug else None
-
-        # player_statistics = np.log(player_statistics + 1)
-        # print('player_statistics:', player_statistics)
-
-        # agent_statistics = torch.ones(1, 10)
-        agent_statistics = torch.tensor(player_statistics, dtype=torch.float).reshape(1, -1)
-        print('player_statistics:', agent_statistics) if debug else None
-
-        home_race = torch.zeros(1, 5)
-        if "home_race_requested" in obs:
-            home_race_requested = obs["home_race_requested"].item()
-            print('home_race_requested:', home_race_requested) if debug else None
-        else:
-            home_race_requested = 0
-        assert home_race_requested >= 0 and home_race_requested <= 4
-        home_race[0, home_race_requested] = 1
-        print('home_race:', home_race) if debug else None
-
-        away_race = torch.zeros(1, 5)
-        if "away_race_requested" in obs:
-            away_race_requested = obs["away_race_requested"].item()
-            print('away_race_requested:', away_race_requested) if debug else None
-        else:
-            away_race_requested = 0
-        assert away_race_requested >= 0 and away_race_requested <= 4
-        away_race[0, away_race_requested] = 1
-        print('away_race:', away_race) if debug else None
-
-        if "action_result" in obs:
-            action_result = obs["action_result"]
-            print('action_result:', action_result) if debug else None
-
-        if "alerts" in obs:
-            alerts = obs["alerts"]
-            print('alerts:', alerts) if debug else None
-
-        # implement the upgrades
-        upgrades = torch.zeros(1, SFS.upgrades)
-        obs_upgrades = obs["upgrades"]
-        print('obs_upgrades:', obs_upgrades) if debug else None
-        for u in obs_upgrades:
-            assert u >= 0 
-            assert u < SFS.upgrades
-            upgrades[0, u] = 1
-
-        # question: how to know enemy's upgrades?
-        enemy_upgrades = torch.zeros(1, SFS.upgrades)
-
-        # time conver to gameloop
-        time = torch.zeros(1, SFS.time)
-        game_loop = obs["game_loop"]
-        print('game_loop:', game_loop) if debug else None
-
-        time_encoding = torch.tensor(L.unpackbits_for_largenumber(game_loop, num_bits=64), dtype = torch.float).reshape(1, -1)
-        print('time_encoding:', time_encoding) if debug else None 
-        # note, we use binary encoding here for time
-        time = time_encoding
-        #time[0, 0] = game_loop
-
-        # implement the available_actions
-        # note: if we use raw action, this key doesn't exist
-        # the_available_actions = obs["available_actions"] 
-        available_actions = torch.zeros(1, SFS.available_actions)
-
-        # implement the unit_counts_bow
-        unit_counts_bow = L.calculate_unit_counts_bow(obs)
-        print('unit_counts_bow:', unit_counts_bow) if debug else None
-        print('torch.sum(unit_counts_bow):', torch.sum(unit_counts_bow)) if debug else None
-
-        # implement the build order
-        beginning_build_order = torch.zeros(1, SCHP.count_beginning_build_order, int(SFS.beginning_build_order / SCHP.count_beginning_build_order))
-        print('beginning_build_order.shape:', beginning_build_order.shape) if debug else None
-        if build_order is not None:
-            # implement the beginning_build_order               
-            for i, bo in enumerate(build_order):
-                if i < 20:
-                    assert bo < SFS.unit_counts_bow
-                    beginning_build_order[0, i, bo] = 1
-            print("beginning_build_order:", beginning_build_order) if debug else None
-            print("sum(beginning_build_order):", torch.sum(beginning_build_order).item()) if debug else None
-
-        mmr = torch.zeros(1, SFS.mmr)
-        units_buildings = torch.zeros(1, SFS.units_buildings)
-
-        # implement the effects
-        effects = torch.zeros(1, SFS.effects)
-        # we now use feature_effects to represent it
-        feature_effects = obs["feature_effects"]
-        print('feature_effects:', feature_effects) if debug else None
-        for effect in feature_effects:
-            e = effect.effect_id
-            assert e >= 0 
-            assert e < SFS.effects
-            effects[0, e] = 1
-        # the raw effects are reserved for use
-        raw_effects = obs["raw_effects"]
-        print('raw_effects:', raw_effects) if debug else None
-
-        # implement the upgrade
-        upgrade = torch.zeros(1, SFS.upgrades)
-        for u in obs_upgrades:
-            assert u >= 0 
-            assert u < SFS.upgrades
-            upgrade[0, u] = 1
-
-        last_delay = torch.zeros(1, SFS.last_delay)
-
-        # implement the last action
-        # note: if we use raw action, this property is always empty
-        last_actions = obs["last_actions"]
-        print('last_actions:', last_actions) if debug else None
-        last_action_type = torch.zeros(1, SFS.last_action_type)
-
-        last_repeat_queued = torch.zeros(1, SFS.last_repeat_queued)
-
-        scalar_list.append(agent_statistics)
-        scalar_list.append(home_race)
-        scalar_list.append(away_race)
-        scalar_list.append(upgrades)
-        scalar_list.append(enemy_upgrades)
-        scalar_list.append(time)
-
-        scalar_list.append(available_actions)
-        scalar_list.append(unit_counts_bow)
-        scalar_list.append(mmr)
-        scalar_list.append(units_buildings)
-        scalar_list.append(effects)
-        scalar_list.append(upgrade)
-
-        scalar_list.append(beginning_build_order)
-        scalar_list.append(last_delay)
-        scalar_list.append(last_action_type)
-        scalar_list.append(last_repeat_queued)
-
-        return scalar_list
+        assembler = get_scalar_feature_assembler()
+        assembler.assemble(obs, build_order=build_order)
+        return assembler.to_tensor_list()
 
     @classmethod
     def preprocess_numpy(cls, obs, build_order=None):
+        assembler = get_scalar_feature_assembler()
+        assembler.assemble(obs, build_order=build_order)
+        return assembler.to_numpy_list()
+
+    @classmethod
+    def preprocess_numpy_by_item(cls, obs, build_order=None):
+        # the original version of preprocess_numpy, kept to check the results of ScalarFeatureAssembler
         scalar_list = []
 
         player = obs["player"]
@@ -504,8 +376,149 @@ class ScalarEncoder(nn.Module):
         return embedded_scalar_out, scalar_context_out
 
 
+class ScalarFeatureAssembler(object):
+    '''
+    Writes the 16 scalar features of an observation into one preallocated buffer with fixed offsets,
+    in the order of ScalarFeature. The buffer is reused by the next call of assemble, so use
+    to_numpy_list or to_tensor_list to get the results, which copy the buffer only once.
+    Note all the features are float32 here.
+    '''
+
+    # the bits of each byte, lowest bit first as in L.unpackbits_for_largenumber
+    byte_bits_table = np.unpackbits(np.arange(256, dtype=np.uint8).reshape(-1, 1), axis=1, 
+                                    bitorder='little').astype(np.float32)
+
+    def __init__(self):
+        self.sizes = [SFS[i] for i in ScalarFeature]
+        self.offsets = np.cumsum([0] + self.sizes).tolist()
+        self.buffer = np.zeros(self.offsets[-1], dtype=np.float32)
+
+        self.shapes = [(1, size) for size in self.sizes]
+        self.shapes[ScalarFeature.beginning_build_order] = (1, SCHP.count_beginning_build_order, 
+                                                            int(SFS.beginning_build_order / SCHP.count_beginning_build_order))
+        self.slices = [(self.offsets[i], self.offsets[i + 1], self.shapes[i]) for i in range(len(self.sizes))]
+
+        # the views of each feature in the buffer, made once
+        self.views = self.split(self.buffer)
+        self.flat_views = [self.buffer[start:end] for start, end, _ in self.slices]
+
+    def segment(self, feature):
+        return self.flat_views[feature]
+
+    def split(self, flat):
+        # works for both a numpy array and a torch tensor
+        return [flat[start:end].reshape(shape) for start, end, shape in self.slices]
+
+    def to_numpy_list(self):
+        return self.split(self.buffer.copy())
+
+    def to_tensor_list(self):
+        return self.split(torch.from_numpy(self.buffer.copy()))
+
+    @staticmethod
+    def encode_build_order(build_order, out):
+        # out: the zeroed beginning_build_order feature, [1 x count_beginning_build_order x unit_counts_bow]
+        build_order = np.asarray(build_order, dtype=np.int64).reshape(-1)[:SCHP.count_beginning_build_order]
+        assert (build_order < SFS.unit_counts_bow).all()
+        out[0, np.arange(len(build_order)), build_order] = 1
+        return out
+
+    def assemble(self, obs, build_order=None):
+        self.buffer[:] = 0.
+
+        # The first is player_id, so we don't need it.
+        player = np.asarray(obs["player"])
+        self.segment(ScalarFeature.agent_statistics)[:] = player[1:]
+
+        for feature, key in ((ScalarFeature.home_race, "home_race_requested"),
+                             (ScalarFeature.away_race, "away_race_requested")):
+            race_requested = obs[key].item() if key in obs else 0
+            assert race_requested >= 0 and race_requested <= 4
+            self.segment(feature)[race_requested] = 1
+
+        # implement the upgrades, and make the upgrade the same as upgrades
+        obs_upgrades = np.asarray(obs["upgrades"], dtype=np.int64).reshape(-1)
+        assert ((obs_upgrades >= 0) & (obs_upgrades < SFS.upgrades)).all()
+        self.segment(ScalarFeature.upgrades)[obs_upgrades] = 1
+        self.segment(ScalarFeature.upgrade)[obs_upgrades] = 1
+
+        # time: binary encoding of the game_loop, looked up byte by byte
+        game_loop = int(np.asarray(obs["game_loop"]).reshape(-1)[0])
+        assert game_loop >= 0
+        game_loop_bytes = np.array([game_loop], dtype='<u8').view(np.uint8)
+        self.segment(ScalarFeature.time)[:] = self.byte_bits_table[game_loop_bytes].reshape(-1)
+
+        # implement the unit_counts_bow
+        L.calculate_unit_counts_bow_numpy(obs, out=self.views[ScalarFeature.unit_counts_bow])
+
+        # implement the effects, we now use feature_effects to represent it
+        feature_effects = np.asarray(obs["feature_effects"], dtype=np.int64).reshape(-1, len(EffectPos))
+        effect_ids = feature_effects[:, EffectPos.effect]
+        assert ((effect_ids >= 0) & (effect_ids < SFS.effects)).all()
+        self.segment(ScalarFeature.effects)[effect_ids] = 1
+
+        # implement the beginning_build_order
+        if build_order is not None:
+            self.encode_build_order(build_order, self.views[ScalarFeature.beginning_build_order])
+
+        # enemy_upgrades, available_actions, mmr, units_buildings, last_delay,
+        # last_action_type and last_repeat_queued are all zeros now
+        return self.buffer
+
+
+_assembler_local = threading.local()
+
+
+def get_scalar_feature_assembler():
+    # each thread (e.g., an actor) has its own assembler, so the buffers are not shared between threads
+    assembler = getattr(_assembler_local, 'assembler', None)
+    if assembler is None:
+        assembler = ScalarFeatureAssembler()
+        _assembler_local.assembler = assembler
+    return assembler
+
+
+def test_preprocess(benchmark_num=200):
+    import time
+    from pysc2.lib import named_array
+    from pysc2.lib.features import Player
+    from pysc2.lib.units import Protoss, Neutral
+
+    obs = {"player": named_array.NamedNumpyArray([1, 50, 0, 12, 15, 0, 12, 0, 0, 0, 0], Player, dtype=np.int32),
+           "home_race_requested": np.array([3], dtype=np.int32),
+           "away_race_requested": np.array([1], dtype=np.int32),
+           "upgrades": np.array([1, 7, 86], dtype=np.int32),
+           "game_loop": np.array([2 ** 20 + 12345], dtype=np.int32),
+           "unit_counts": np.array([[Protoss.Probe.value, 12], [Protoss.Nexus.value, 1], [Neutral.MineralField.value, 8]]),
+           "feature_effects": named_array.NamedNumpyArray(np.zeros((0, len(EffectPos))), [None, EffectPos], dtype=np.int32),
+           "raw_effects": np.zeros((0, len(EffectPos)), dtype=np.int32),
+           "last_actions": np.array([], dtype=np.int32)}
+    build_order = [3, 70, 5, 70] * 6
+
+    by_item = ScalarEncoder.preprocess_numpy_by_item(obs, build_order=build_order)
+    scalar_list = ScalarEncoder.preprocess_numpy(obs, build_order=build_order)
+    tensor_list = ScalarEncoder.preprocess_tensor(obs, build_order=build_order)
+    for x, y, z in zip(by_item, scalar_list, tensor_list):
+        assert x.shape == y.shape == tuple(z.shape)
+        assert np.array_equal(x, y) and np.array_equal(x, z.numpy())
+
+    # the results should not be changed by the next call
+    ScalarEncoder.preprocess_numpy(obs, build_order=None)
+    assert np.array_equal(by_item[ScalarFeature.beginning_build_order], scalar_list[ScalarFeature.beginning_build_order])
+
+    # benchmark test
+    for preprocess in (ScalarEncoder.preprocess_numpy_by_item, ScalarEncoder.preprocess_numpy):
+        benchmark_start = time.time()
+        for i in range(benchmark_num):
+            preprocess(obs, build_order=build_order)
+        elapse_time = (time.time() - benchmark_start) / benchmark_num
+        print("{} per frame: {:.6f}s".format(preprocess.__name__, elapse_time))
+
+
 def test(debug=False):
 
+    test_preprocess()
+
     scalar_encoder = ScalarEncoder()
 
     batch_size = 2
@@ -12,6 +12,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 
+from pysc2.lib.features import MINIMAP_FEATURES
+
 from alphastarmini.core.arch.entity_encoder import EntityEncoder
 from alphastarmini.core.arch.entity_encoder import Entity
 
@@ -37,6 +39,14 @@ class SpatialEncoder(nn.Module):
     '''
     scatter_volume = 4
 
+    # the minimap layers used by get_map_data, with the size of their encoding,
+    # a size of None means the layer is a float of (layer / 255.0), otherwise it is one-hot
+    map_layers = (('camera', 2), ('height_map', None), ('visibility_map', 4), ('creep', 2), 
+                  ('player_relative', 5), ('alerts', 2), ('pathable', 2), ('buildable', 2))
+
+    # the one-hot lookup tables, the value each channel of a one-hot encoding stands for, in the NCHW layout
+    one_hot_tables = {size: np.arange(size).reshape(1, size, 1, 1) for name, size in map_layers if size is not None}
+
     def __init__(self, n_resblocks=4, original_32=AHP.original_32,
                  original_64=AHP.original_64,
                  original_128=AHP.original_128,
@@ -188,6 +198,100 @@ class SpatialEncoder(nn.Module):
         default map_width is 64
         '''
         feature_minimap = obs["feature_minimap"] if "feature_minimap" in obs else obs
+
+        # [1 x len(map_layers) x map_width x map_width]
+        layers = np.stack([np.asarray(feature_minimap[name]).reshape(map_width, map_width) 
+                           for name, _ in cls.map_layers])[np.newaxis]
+
+        entity_pos_lists = [entity_pos_list] if entity_pos_list is not None else None
+        map_data = cls.build_map_data(layers, entity_pos_lists, map_width=map_width)
+        print('map_data.shape:', map_data.shape) if verbose else None
+
+        return map_data
+
+    @classmethod
+    def get_map_data_batch(cls, feature_minimaps, entity_pos_lists=None, map_width=AHP.minimap_size):
+        '''
+        the batched version of get_map_data,
+        feature_minimaps is a stack of obs["feature_minimap"], [batch_size x len(MINIMAP_FEATURES) x H x W],
+        entity_pos_lists is a list (one for each minimap) of the entity_pos_list.
+        '''
+        feature_minimaps = np.asarray(feature_minimaps)
+        batch_size = feature_minimaps.shape[0]
+        layer_index = [getattr(MINIMAP_FEATURES, name).index for name, _ in cls.map_layers]
+        layers = feature_minimaps[:, layer_index].reshape(batch_size, len(layer_index), map_width, map_width)
+
+        return cls.build_map_data(layers, entity_pos_lists, map_width=map_width)
+
+    @classmethod
+    def build_map_data(cls, layers, entity_pos_lists=None, map_width=AHP.minimap_size):
+        '''
+        computes all 24 channels at once, the result is the same as get_map_data_by_loop,
+        layers: [batch_size x len(map_layers) x map_width x map_width], in the order of map_layers
+        return: [batch_size x 24 x map_width x map_width] (NCHW)
+        '''
+        save_type = np.float32
+        batch_size = layers.shape[0]
+        out_channels = cls.scatter_volume + sum(size if size is not None else 1 for _, size in cls.map_layers)
+
+        map_data = np.zeros((batch_size, out_channels, map_width, map_width), dtype=save_type)
+
+        # we consider the most 4 entities in the same position
+        if entity_pos_lists is not None:
+            for b, entity_pos_list in enumerate(entity_pos_lists):
+                cls._scatter_entity_index(map_data[b, :cls.scatter_volume], entity_pos_list, map_width)
+
+        # the values of a one-hot layer must be in [0, size), as L.np_one_hot can not encode others
+        layers_max, layers_min = layers.max(axis=(0, 2, 3)), layers.min(axis=(0, 2, 3))
+        for i, (name, size) in enumerate(cls.map_layers):
+            if size is not None and (layers_max[i] >= size or layers_min[i] < 0):
+                raise IndexError('the value of {} is out of bounds for one-hot with {} classes'.format(name, size))
+
+        offset = cls.scatter_volume
+        for i, (name, size) in enumerate(cls.map_layers):
+            layer = layers[:, i:i + 1]
+            if size is None:
+                map_data[:, offset:offset + 1] = layer / 255.0
+                offset += 1
+            else:
+                map_data[:, offset:offset + size] = (layer == cls.one_hot_tables[size])
+                offset += size
+
+        return map_data
+
+    @classmethod
+    def _scatter_entity_index(cls, scatter_map, entity_pos_list, map_width):
+        # scatter_map: [scatter_volume x map_width x map_width]
+        # make the scatter_map has the index of entity in the entity's position (matrix format),
+        # the j-th entity in a position is put in the j-th channel, like get_map_data_by_loop
+        if len(entity_pos_list) == 0:
+            return
+
+        scale_factor = AAIFP.raw_resolution / map_width
+        pos = np.asarray(entity_pos_list).reshape(-1, 2)
+        x = (pos[:, 0] / scale_factor).astype(np.int64)
+        y = (pos[:, 1] / scale_factor).astype(np.int64)
+
+        # the rank of each entity among the entities in the same position
+        pixel = y * map_width + x
+        order = np.argsort(pixel, kind='stable')
+        sorted_pixel = pixel[order]
+        is_first = np.ones(len(sorted_pixel), dtype=bool)
+        is_first[1:] = sorted_pixel[1:] != sorted_pixel[:-1]
+        first_index = np.maximum.accumulate(np.where(is_first, np.arange(len(sorted_pixel)), 0))
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(sorted_pixel)) - first_index
+
+        keep = rank < cls.scatter_volume
+        entity_index = np.minimum(np.arange(len(pixel)) + 1, AHP.max_entities - 1)
+        scatter_map[rank[keep], y[keep], x[keep]] = entity_index[keep]
+
+    @classmethod
+    def get_map_data_by_loop(cls, obs, entity_pos_list=None, map_width=AHP.minimap_size, verbose=False):
+        '''
+        the original version of get_map_data, kept to check the results of build_map_data
+        '''
+        feature_minimap = obs["feature_minimap"] if "feature_minimap" in obs else obs
         save_type = np.float32
 
         # we consider the most 4 entities in the same position
@@ -374,7 +478,60 @@ class ResBlock1D(nn.Module):
             raise KeyError('unspported normtype!')     
 
 
+def random_feature_minimap(map_width=AHP.minimap_size, seed=None):
+    # synthetic obs["feature_minimap"], each layer is in the valid range of pysc2
+    rng = np.random.RandomState(seed)
+    feature_minimap = np.stack([rng.randint(0, f.scale, size=(map_width, map_width)) for f in MINIMAP_FEATURES])
+
+    from pysc2.lib import named_array
+    return named_array.NamedNumpyArray(feature_minimap, [MINIMAP_FEATURES._fields, None, None], dtype=np.int32)
+
+
+def test_map_data(batch_size=4, benchmark_num=50):
+    import time
+
+    feature_minimaps, entity_pos_lists = [], []
+    for b in range(batch_size):
+        feature_minimaps.append(random_feature_minimap(seed=b))
+
+        # put many entities in few positions, so that some positions have more than 4 entities
+        rng = np.random.RandomState(b)
+        entity_pos_lists.append(rng.randint(0, 8, size=(300 + b * 100, 2)).tolist())
+
+    by_loop_list = []
+    for feature_minimap, entity_pos_list in zip(feature_minimaps, entity_pos_lists):
+        obs = {"feature_minimap": feature_minimap}
+        by_loop = SpatialEncoder.get_map_data_by_loop(obs, entity_pos_list=entity_pos_list)
+        map_data = SpatialEncoder.get_map_data(obs, entity_pos_list=entity_pos_list)
+        assert map_data.dtype == by_loop.dtype and map_data.shape == by_loop.shape
+        assert np.array_equal(map_data, by_loop)
+        by_loop_list.append(by_loop)
+
+    batch_map_data = SpatialEncoder.get_map_data_batch(np.stack(feature_minimaps), entity_pos_lists)
+    assert np.array_equal(batch_map_data, np.concatenate(by_loop_list, axis=0))
+
+    # benchmark test
+    obs = {"feature_minimap": feature_minimaps[0]}
+    entity_pos_list = np.random.RandomState(0).randint(0, AHP.minimap_size, size=(512, 2)).tolist()
+    for get_map_data in (SpatialEncoder.get_map_data_by_loop, SpatialEncoder.get_map_data):
+        benchmark_start = time.time()
+        for i in range(benchmark_num):
+            get_map_data(obs, entity_pos_list=entity_pos_list)
+        elapse_time = (time.time() - benchmark_start) / benchmark_num
+        print("{} per frame: {:.6f}s".format(get_map_data.__name__, elapse_time))
+
+    feature_minimaps = np.stack(feature_minimaps)
+    entity_pos_lists = [entity_pos_list] * batch_size
+    benchmark_start = time.time()
+    for i in range(benchmark_num):
+        SpatialEncoder.get_map_data_batch(feature_minimaps, entity_pos_lists)
+    elapse_time = (time.time() - benchmark_start) / benchmark_num / batch_size
+    print("get_map_data_batch per frame: {:.6f}s".format(elapse_time))
+
+
 def test():
+    test_map_data()
+
     spatial_encoder = SpatialEncoder()
     batch_size = 2
     # dummy map list
@@ -5,21 +5,172 @@
 
 # from AlphaStar pseudo-code
 
+import threading
+import collections
+
 __author__ = "Ruo-Ze Liu"
 
 debug = False
 
+# the most outcomes applied to the payoff as one version
+OUTCOME_BATCH_SIZE = 256
+
 
 class Coordinator:
     """Central worker that maintains payoff matrix and assigns new matches."""
 
-    def __init__(self, league):
+    def __init__(self, league, batch_size=OUTCOME_BATCH_SIZE):
         self.league = league
+        self.batch_size = batch_size
+
+        # the actors append the outcomes without a lock (the append of a deque is atomic), and the thread
+        # which takes the consumer lock applies all the outcomes queued in the batches, the others return
+        self.outcomes = collections.deque()
+        self.consumer_lock = threading.Lock()
+
+        # metrics
+        self.applied_num = 0
+        self.batch_num = 0
 
     def send_outcome(self, home_player, away_player, outcome):
-        self.league.update(home_player, away_player, outcome)
+        self.outcomes.append((home_player, away_player, outcome))
+        self.flush(wait=False)
+
+    def flush(self, wait=True):
+        """Applies the queued outcomes, or returns at once if another thread is applying them and wait is False.
+        Returns the number of the outcomes this call applied."""
+        applied_num = 0
+
+        # the outcomes queued while the consumer releases the lock are applied by the next round
+        while self.outcomes and self.consumer_lock.acquire(blocking=wait):
+            try:
+                while self.outcomes:
+                    batch = []
+                    while self.outcomes and len(batch) < self.batch_size:
+                        batch.append(self.outcomes.popleft())
+                    self.apply(batch)
+                    applied_num += len(batch)
+            finally:
+                self.consumer_lock.release()
+
+        return applied_num
+
+    def apply(self, batch):
+        self.league.update_batch(batch)
+        self.applied_num += len(batch)
+        self.batch_num += 1
+
+        # each home player of the batch is checked once
+        for home_player in dict.fromkeys(home for home, _, _ in batch):
+            if home_player.ready_to_checkpoint():
+                # is the responsibility of the coordinator to add player in the league
+                # actually it is added to to the payoff
+                self.league.add_player(home_player.checkpoint())
+
+        print('coordinator applied', len(batch), 'outcomes, payoff version:', self.league.payoff.version) if debug else None
+
+
+def test(actor_num=8, outcome_num=2000, player_num=12, reader_num=2):
+    import time
+    import random
+
+    import numpy as np
+
+    from alphastarmini.core.ma.payoff import Payoff
+    from alphastarmini.core.ma.league import League
+
+    class FakePlayer(object):
+
+        def ready_to_checkpoint(self):
+            return False
+
+    def make_league(decay):
+        # the league of the synthetic players, without the agents
+        league = League.__new__(League)
+        league._payoff = Payoff()
+        league._payoff._decay = decay
+        league._learning_players = []
+        league._store = None
+        players = [FakePlayer() for _ in range(player_num)]
+        for player in players:
+            league.add_player(player)
+        return league, players
+
+    # the many actors send the random outcomes, the counts (without the decay) are exact
+    league, players = make_league(decay=1.)
+    coordinator = Coordinator(league, batch_size=64)
+    sent = [[] for _ in range(actor_num)]
+    is_running = True
+    versions = [[] for _ in range(reader_num)]
+
+    def actor(outcomes):
+        rng = random.Random(len(outcomes) + id(outcomes))
+        for _ in range(outcome_num):
+            home, away = rng.choice(players), rng.choice(players)
+            outcome = rng.choice(("win", "draw", "loss"))
+            outcomes.append((home, away, outcome))
+            coordinator.send_outcome(home, away, outcome)
+
+    def reader(versions):
+        # the matchmaking reads the win rates of one version, which only grows
+        while is_running:
+            version, win_rates = league.payoff.snapshot(players[0])
+            if np.all((win_rates >= 0) & (win_rates <= 1)) and (not versions or version >= versions[-1]):
+                versions.append(version)
+            else:
+                versions.append(None)
+            time.sleep(0.0001)
+
+    readers = [threading.Thread(target=reader, args=(v,)) for v in versions]
+    actors = [threading.Thread(target=actor, args=(outcomes,)) for outcomes in sent]
+    start = time.time()
+    [thread.start() for thread in readers + actors]
+    [thread.join() for thread in actors]
+    coordinator.flush()
+    ingest_time = time.time() - start
+    is_running = False
+    [thread.join() for thread in readers]
+    assert all(None not in v for v in versions)
+
+    expected = collections.Counter()
+    for home, away, outcome in (o for outcomes in sent for o in outcomes):
+        expected[home, away, outcome] += 1
+    payoff = league.payoff
+    for home in players:
+        for away in players:
+            wins, draws, losses, games = payoff.stats(home, away)
+            n = {o: expected[home, away, o] for o in ("win", "draw", "loss")}
+            r = {o: expected[away, home, o] for o in ("win", "draw", "loss")}
+            if home is away:
+                assert games == 2 * sum(n.values()) and draws == 2 * n["draw"]
+                assert wins == n["win"] + n["loss"]
+            else:
+                assert games == sum(n.values()) + sum(r.values())
+                assert wins == n["win"] + r["loss"] and draws == n["draw"] + r["draw"]
+                assert losses == n["loss"] + r["win"]
+
+    assert coordinator.applied_num == actor_num * outcome_num and not coordinator.outcomes
+    assert payoff.version == coordinator.batch_num
+    print("coordinator: %d actors, %d outcomes in %d batches (%.1f per batch), %.0f outcomes/s, %d reads" % (
+        actor_num, coordinator.applied_num, coordinator.batch_num, coordinator.applied_num / coordinator.batch_num,
+        coordinator.applied_num / ingest_time, sum(len(v) for v in versions)))
+
+    # the batches give the same payoff as the updates one by one, with the decay
+    outcomes = [o for outcomes in sent for o in outcomes]
+    sequential, players_s = make_league(decay=0.99)
+    batched, players_b = make_league(decay=0.99)
+    mapping = dict(zip(players, range(player_num)))
+    start = time.time()
+    for home, away, outcome in outcomes:
+        sequential.update(players_s[mapping[home]], players_s[mapping[away]], outcome)
+    sequential_time = time.time() - start
+
+    start = time.time()
+    for i in range(0, len(outcomes), OUTCOME_BATCH_SIZE):
+        batched.update_batch([(players_b[mapping[h]], players_b[mapping[a]], o)
+                              for h, a, o in outcomes[i:i + OUTCOME_BATCH_SIZE]])
+    batched_time = time.time() - start
 
-        if home_player.ready_to_checkpoint():
-            # is the responsibility of the coordinator to add player in the league
-            # actually it is added to to the payoff
-            self.league.add_player(home_player.checkpoint())
+    assert np.allclose(sequential.payoff[players_s, players_s], batched.payoff[players_b, players_b], atol=1e-4)
+    print("payoff updates: one by one %.1fus, in the batches of %d %.1fus per outcome" % (
+        sequential_time / len(outcomes) * 1e6, OUTCOME_BATCH_SIZE, batched_time / len(outcomes) * 1e6))
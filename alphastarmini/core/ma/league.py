@@ -5,6 +5,8 @@
 
 # modified from AlphaStar pseudo-code
 
+import contextlib
+
 from alphastarmini.core.ma.payoff import Payoff
 
 from alphastarmini.core.ma.player import MainPlayer as MP
@@ -22,8 +24,14 @@ class League(object):
                  initial_agents,
                  main_players=1,
                  main_exploiters=1,
-                 league_exploiters=2):
-        self._payoff = Payoff()
+                 league_exploiters=2,
+                 snapshots=None,
+                 store=None):
+        # the store (a LeagueStore) journals the changes of the league, from which it is resumed
+        if store is not None:
+            snapshots = store.snapshots
+        self._payoff = Payoff(snapshots=snapshots)
+        self._store = None
         self._learning_players = []
 
         for race in initial_agents:
@@ -48,14 +56,39 @@ class League(object):
 
         self._learning_players_num = len(self._learning_players)
 
+        # the players added above are in the first snapshot of the store
+        if store is not None:
+            store.attach(self)
+
+    def _journal(self, kind, *args):
+        # the change is written to the journal after it is applied, in the same order
+        if self._store is None:
+            return contextlib.nullcontext()
+        return self._store.record(kind, *args)
+
     def update(self, home, away, result):
-        return self._payoff.update(home, away, result)
+        with self._journal('update', home, away, result):
+            return self._payoff.update(home, away, result)
+
+    def update_batch(self, outcomes):
+        # the outcomes (home, away, result) are applied as one version of the payoff
+        with self._journal('outcomes', outcomes):
+            return self._payoff.update_batch(outcomes)
+
+    @property
+    def payoff(self):
+        return self._payoff
 
     def get_learning_player(self, idx):
         return self._learning_players[idx]
 
     def add_player(self, player):
-        self._payoff.add_player(player)
+        with self._journal('player', player):
+            self._payoff.add_player(player)
+
+    @property
+    def store(self):
+        return self._store
 
     def get_learning_players_num(self):
         return self._learning_players_num
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" The persistent state of the league: the snapshots of the league, the journal of its changes, and the resume"
+
+import os
+import glob
+import zlib
+import pickle
+import struct
+import threading
+import contextlib
+from time import time, sleep
+
+from alphastarmini.core.ma.league import League
+from alphastarmini.core.ma.payoff import Payoff
+from alphastarmini.core.ma.player import Player, Historical, MainPlayer, MainExploiter, LeagueExploiter
+from alphastarmini.core.ma.snapshot_store import SnapshotStore
+
+from alphastarmini.core.rl.alphastar_agent import AlphaStarAgent
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+# the number of the records in the journal after which a new snapshot of the league is written
+SNAPSHOT_INTERVAL = 1000
+# whether each record is synced to the disk, or only written to the file (kept when the process is killed)
+SYNC = False
+
+# the header of a record: the length and the crc32 of its pickled data
+RECORD_HEADER = struct.Struct('<II')
+
+ROLES = {cls.__name__: cls for cls in (Historical, MainPlayer, MainExploiter, LeagueExploiter)}
+
+
+class LeagueStore(object):
+    '''
+    The league is kept in a directory as one snapshot (the roster, the checkpoint metadata and the payoff)
+    and the journal of the changes after it: the outcomes and the players added, by the ids of the players.
+    Every SNAPSHOT_INTERVAL records a new snapshot is written and the journal starts again,
+    so the resume reads one snapshot and at most SNAPSHOT_INTERVAL records, not the whole run.
+    The weights (of the historical players, and of the learning players when a snapshot is written)
+    are in the snapshot store of the directory, only their keys are in the snapshot and the journal.
+    The records are framed by their length and crc32, so a record torn by a crash is dropped on the resume.
+    '''
+
+    def __init__(self, path, snapshot_interval=SNAPSHOT_INTERVAL, sync=SYNC):
+        super(LeagueStore, self).__init__()
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.sync = sync
+        os.makedirs(path, exist_ok=True)
+        self.snapshots = SnapshotStore(path=os.path.join(path, 'snapshots'))
+
+        self.league = None
+        self.generation = max(self.generations(path), default=-1)
+        self._journal = None
+        self._lock = threading.RLock()
+
+        # metrics
+        self.record_num = 0
+        self.snapshot_num = 0
+        self.replayed_num = 0
+        self.resume_time = 0.
+
+    @staticmethod
+    def generations(path):
+        """Returns the generations of the complete snapshots in the directory."""
+        return sorted(int(os.path.basename(f)[len('league-'):-len('.snapshot')])
+                      for f in glob.glob(os.path.join(path, 'league-*.snapshot')))
+
+    def file(self, generation, ext):
+        return os.path.join(self.path, 'league-%06d%s' % (generation, ext))
+
+    def attach(self, league):
+        """Writes the league as a new snapshot, then journals its changes."""
+        with self._lock:
+            self.league = league
+            league._store = self
+            self.compact()
+
+    @contextlib.contextmanager
+    def record(self, kind, *args):
+        # the change is applied in the body, and journaled when it succeeds
+        with self._lock:
+            yield
+            payoff = self.league.payoff
+            if kind == 'player':
+                data = (kind, self.player_state(args[0], owner=True))
+            elif kind == 'outcomes':
+                data = (kind, [(payoff.index(home), payoff.index(away), result) for home, away, result in args[0]])
+            else:
+                home, away, result = args
+                data = (kind, payoff.index(home), payoff.index(away), result)
+            self._write(data)
+
+    def _write(self, data):
+        data = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        self._journal.write(RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data)
+        self._journal.flush()
+        if self.sync:
+            os.fsync(self._journal.fileno())
+
+        self.record_num += 1
+        if self.record_num >= self.snapshot_interval:
+            self.compact()
+
+    def _read(self, generation):
+        # the records of the journal, until the end or a torn record
+        journal = self.file(generation, '.journal')
+        if not os.path.exists(journal):
+            return
+
+        with open(journal, 'rb') as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                size, crc = RECORD_HEADER.unpack(header)
+                data = f.read(size)
+                if len(data) < size or zlib.crc32(data) != crc:
+                    print('drop the torn record of the journal', journal) if debug else None
+                    return
+                yield pickle.loads(data)
+
+    def _owner(self, agent):
+        # the learning player of the agent (the parent of a historical player)
+        for player in self.league._learning_players:
+            if player.agent is agent:
+                return player
+        return None
+
+    def player_state(self, player, owner=False):
+        """Returns the state of the player by the ids and the keys of the weights.
+        The state of a historical player has the state of its owner (the learning player) when owner is True,
+        as the checkpoint changes the owner (e.g., the exploiter is reset)."""
+        payoff = self.league.payoff
+        state = {'id': payoff.index(player), 'role': type(player).__name__, 'race': player.race, 'name': player.name}
+
+        if isinstance(player, Historical):
+            parent = self._owner(player.parent)
+            state['snapshot'] = player.snapshot
+            state['parent'] = None if parent is None else payoff.index(parent)
+            state['owner'] = self.player_state(parent) if owner and parent is not None else None
+        else:
+            initial_weights = getattr(player, '_initial_weights', None)
+            state['weights'] = self.snapshots.put(player.agent.get_weights())
+            state['initial_weights'] = None if initial_weights is None else self.snapshots.put(initial_weights)
+            state['steps'] = player.agent.steps
+            state['checkpoint_step'] = player._checkpoint_step
+        return state
+
+    def compact(self):
+        """Writes the snapshot of the league as the next generation, and starts its journal."""
+        with self._lock:
+            start = time()
+            league, generation = self.league, self.generation + 1
+            state = {'generation': generation,
+                     'players': [self.player_state(p) for p in league.payoff.players],
+                     'learning': [league.payoff.index(p) for p in league._learning_players],
+                     'payoff': league.payoff.get_state()}
+
+            # the snapshot is complete when it has its name, then the older generations are removed
+            tmp = self.file(generation, '.tmp')
+            with open(tmp, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.file(generation, '.snapshot'))
+
+            if self._journal is not None:
+                self._journal.close()
+            self._journal = open(self.file(generation, '.journal'), 'wb')
+            for old in self.generations(self.path):
+                if old < generation:
+                    os.remove(self.file(old, '.snapshot'))
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self.file(old, '.journal'))
+
+            # the weights superseded (e.g., of the learning players at the older generations) are removed,
+            # those of the players in the new snapshot are kept, and those put after it are in the new journal
+            self.snapshots.retain(s.get(k) for s in state['players'] for k in ('weights', 'initial_weights', 'snapshot'))
+
+            self.generation = generation
+            self.record_num = 0
+            self.snapshot_num += 1
+            print('write the league snapshot', generation, 'in %.3fs' % (time() - start)) if debug else None
+
+    def _make_player(self, state, payoff, players):
+        cls = ROLES[state['role']]
+        player = cls.__new__(cls)
+        player._payoff = payoff
+        player._race = state['race']
+        player.name = state['name']
+        player._actors = []
+
+        if cls is Historical:
+            player._snapshot = state['snapshot']
+            player._parent = None if state['parent'] is None else players[state['parent']].agent
+        else:
+            player.agent = AlphaStarAgent(name=state['name'], race=state['race'],
+                                          initial_weights=self.snapshots.load(state['weights']))
+            self._set_learning(player, state, weights=False)
+
+        players[state['id']] = player
+        return player
+
+    def _set_learning(self, player, state, weights=True):
+        if weights:
+            player.agent.set_weights(self.snapshots.load(state['weights']))
+        if state['initial_weights'] is not None:
+            player._initial_weights = self.snapshots.load(state['initial_weights'])
+        player.agent.steps = state['steps']
+        player._checkpoint_step = state['checkpoint_step']
+
+    def resume(self):
+        """Rebuilds the league from the last snapshot and its journal, then writes it as a new snapshot
+        (the ids of the players in the new payoff may differ) and journals its changes."""
+        with self._lock:
+            start = time()
+            generation = self.generation
+            assert generation >= 0, "no league snapshot in %s" % self.path
+            with open(self.file(generation, '.snapshot'), 'rb') as f:
+                state = pickle.load(f)
+
+            league = League.__new__(League)
+            league._payoff = payoff = Payoff(snapshots=self.snapshots)
+            league._store = None
+
+            # the old id -> player, the learning players are made first as they are the parents
+            players = {}
+            for s in sorted(state['players'], key=lambda s: s['role'] == 'Historical'):
+                self._make_player(s, payoff, players)
+            for s in state['players']:
+                payoff.add_player(players[s['id']])
+            league._learning_players = [players[i] for i in state['learning']]
+            league._learning_players_num = len(league._learning_players)
+            payoff.load_state(state['payoff'])
+
+            def player_of(i):
+                # the players which are not in the league (only in the outcomes) are the new ones
+                if i not in players:
+                    players[i] = Player()
+                return players[i]
+
+            owners = {}
+            for record in self._read(generation):
+                kind = record[0]
+                if kind == 'update':
+                    payoff.update(player_of(record[1]), player_of(record[2]), record[3])
+                elif kind == 'outcomes':
+                    payoff.update_batch([(player_of(h), player_of(a), r) for h, a, r in record[1]])
+                else:
+                    payoff.add_player(self._make_player(record[1], payoff, players))
+                    if record[1].get('owner') is not None:
+                        owners[record[1]['owner']['id']] = record[1]['owner']
+                self.replayed_num += 1
+
+            # only the last state of each owner is loaded
+            for owner in owners.values():
+                self._set_learning(players[owner['id']], owner)
+
+            self.resume_time = time() - start
+            self.attach(league)
+            print('resume the league of generation', generation, 'with', self.replayed_num, 'records') if debug else None
+            return league
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            self.snapshots.close()
+
+    def __str__(self):
+        return "league store: generation %d, snapshots: %d, records: %d, replayed: %d, resume: %.3fs" % (
+            self.generation, self.snapshot_num, self.record_num, self.replayed_num, self.resume_time)
+
+
+def synthetic_run(league, seed, batch_size=16, checkpoint_every=5, update_every=7):
+    """Drives the league by the seed, yields after each change: the batches of the random outcomes,
+    some single updates, and the checkpoints of the learning players (whose weights are changed first)."""
+    import numpy as np
+    import torch
+
+    rng = np.random.RandomState(seed)
+    np.random.seed(seed)
+    results = ("win", "draw", "loss")
+    step = 0
+    while True:
+        step += 1
+        if step % checkpoint_every == 0:
+            player = league.get_learning_player(step // checkpoint_every % league.get_learning_players_num())
+            with torch.no_grad():
+                next(iter(player.agent.get_parameters())).add_(1e-3)
+            player.agent.steps += 1000
+            league.add_player(player.checkpoint())
+            yield
+
+        players = league.payoff.players
+        homes, aways = rng.randint(len(players), size=(2, batch_size))
+        outcomes = [(players[h], players[a], results[r]) for h, a, r in zip(homes, aways, rng.randint(3, size=batch_size))]
+        if step % update_every == 0:
+            league.update(*outcomes[0])
+        else:
+            league.update_batch(outcomes)
+        yield
+
+
+def run_synthetic_league(path, race, initial_weights, seed, snapshot_interval, step_time=0.01):
+    # the process of the league run, which is killed by the test
+    store = LeagueStore(path, snapshot_interval=snapshot_interval)
+    initial_agent = AlphaStarAgent(name="Initial", race=race, initial_weights=store.snapshots.load(initial_weights))
+    league = League({race: initial_agent}, main_players=1, main_exploiters=1, league_exploiters=1, store=store)
+    for _ in synthetic_run(league, seed):
+        sleep(step_time)
+
+
+def test(seed=0, snapshot_interval=20, kill_generation=3):
+    import random
+    import tempfile
+    import multiprocessing as mp
+
+    import torch
+
+    from pysc2.env.sc2_env import Race
+
+    def league_state(league):
+        # the roster, the payoff and the learning players, which are the same after the resume
+        payoff = league.payoff
+        learning = league._learning_players
+        roster = []
+        for p in payoff.players:
+            if isinstance(p, Historical):
+                parent = [i for i, q in enumerate(learning) if q.agent is p.parent]
+                roster.append((type(p).__name__, p.race, p.snapshot, parent))
+            else:
+                roster.append((type(p).__name__, p.race, learning.index(p)))
+        learning_state = [(p.agent.steps, p._checkpoint_step) for p in learning]
+        return roster, learning_state, payoff.get_state()
+
+    def assert_same(league, other):
+        roster, learning, payoff = league_state(league)
+        other_roster, other_learning, other_payoff = league_state(other)
+        assert roster == other_roster and learning == other_learning
+        assert payoff['sequence'] == other_payoff['sequence'] and payoff['decay'] == other_payoff['decay']
+        assert (payoff['stats'] == other_payoff['stats']).all()
+        for p, q in zip(league._learning_players, other._learning_players):
+            weights, other_weights = p.agent.get_weights(), q.agent.get_weights()
+            assert all(torch.equal(weights[k], other_weights[k]) for k in weights)
+
+    race = Race.protoss
+    temp_dir = tempfile.TemporaryDirectory(prefix='league_')
+    path = temp_dir.name
+
+    torch.manual_seed(seed)
+    initial_agent = AlphaStarAgent(name="Initial", race=race)
+    initial_weights = SnapshotStore(path=os.path.join(path, 'snapshots')).put(initial_agent.get_weights())
+
+    # the league run in another process is killed after some snapshots, at a random time
+    ctx = mp.get_context('spawn')
+    process = ctx.Process(target=run_synthetic_league, args=(path, race, initial_weights, seed, snapshot_interval))
+    process.start()
+    while max(LeagueStore.generations(path), default=-1) < kill_generation:
+        assert process.is_alive()
+        sleep(0.05)
+    sleep(random.random() * 0.2)
+    process.kill()
+    process.join()
+
+    # the record being written when the process is killed is torn
+    generation = max(LeagueStore.generations(path))
+    with open(os.path.join(path, 'league-%06d.journal' % generation), 'ab') as f:
+        f.write(RECORD_HEADER.pack(100, 0) + b'torn')
+
+    store = LeagueStore(path, snapshot_interval=snapshot_interval)
+    journal_bytes = os.path.getsize(store.file(store.generation, '.journal'))
+    snapshot_bytes = os.path.getsize(store.file(store.generation, '.snapshot'))
+    league = store.resume()
+    print(store)
+    print("league killed at version %d with %d players, resumed from the snapshot of %.1fKB and the journal of %.1fKB" % (
+        league.payoff.version, league.get_players_num(), snapshot_bytes / 1e3, journal_bytes / 1e3))
+    assert store.replayed_num < snapshot_interval and league.get_learning_players_num() == 3
+
+    # the same run without the store, to the same point, has the same state
+    reference = League({race: initial_agent}, main_players=1, main_exploiters=1, league_exploiters=1)
+    target = (league.payoff.version, league.get_players_num())
+    for _ in synthetic_run(reference, seed):
+        if (reference.payoff.version, reference.get_players_num()) == target:
+            break
+        assert reference.payoff.version <= target[0]
+    assert_same(league, reference)
+
+    # the resumed league is played (its matchmaking uses the registry rebuilt), journaled and resumed again
+    opponent, _ = league.get_learning_player(0).get_match()
+    assert opponent in league.payoff.players
+    for i, _ in enumerate(synthetic_run(league, seed + 1), 1):
+        if i == snapshot_interval + 5:
+            break
+    assert store.snapshot_num == 2
+
+    resumed = LeagueStore(path, snapshot_interval=snapshot_interval).resume()
+    assert_same(resumed, league)
+    assert resumed.store.replayed_num == 5 and len(LeagueStore.generations(path)) == 1
+    assert resumed.get_learning_player(0).checkpoint().snapshot in resumed.payoff.snapshots
+
+    # only the weights of the players of the league stay on the disk, those of the learning player
+    # at the older generations (not checkpointed) are removed
+    def snapshot_state(store):
+        with open(store.file(store.generation, '.snapshot'), 'rb') as f:
+            return pickle.load(f)
+
+    player = resumed.get_learning_player(0)
+    superseded = []
+    for _ in range(3):
+        with torch.no_grad():
+            next(iter(player.agent.get_parameters())).add_(1e-3)
+        resumed.store.compact()
+        superseded.append(snapshot_state(resumed.store)['players'][resumed.payoff.index(player)]['weights'])
+    snapshots = resumed.store.snapshots
+    referenced = set(s.get(k) for s in snapshot_state(resumed.store)['players']
+                     for k in ('weights', 'initial_weights', 'snapshot')) - {None}
+    on_disk = set(os.path.splitext(f)[0] for f in os.listdir(snapshots.path) if f.endswith('.bin'))
+    print("weights on the disk: %d, of the players: %d, removed: %d" % (
+        len(on_disk), len(referenced), snapshots.remove_num))
+    assert on_disk == referenced and superseded[-1] in on_disk and snapshots.remove_num >= 2
+    assert not any(key in snapshots for key in superseded[:-1])
+
+    store.close()
+    resumed.store.close()
+    temp_dir.cleanup()
@@ -5,12 +5,16 @@
 
 # modified from AlphaStar pseudo-code
 
+from time import sleep
+
 from pysc2.env.sc2_env import Race
 
 from alphastarmini.core.rl.rl_utils import get_supervised_agent
 from alphastarmini.core.rl.learner import Learner
 from alphastarmini.core.rl.actor import ActorLoop
+from alphastarmini.core.rl.actor_pool import ActorPool
 
+from alphastarmini.core.ma.league import League
 from alphastarmini.core.ma.coordinator import Coordinator
 
 from alphastarmini.lib.hyper_parameters import Training_Races as TR
@@ -20,8 +24,13 @@ __author__ = "Ruo-Ze Liu"
 
 debug = False
 
+ACTOR_NUMS = 1
+
+# runs the actors of each player in the processes (ActorPool) instead of the threads
+ACTOR_PROCESSES = False
+
 
-def league_train():
+def league_train(actor_nums=ACTOR_NUMS, actor_processes=ACTOR_PROCESSES):
     """Trains the AlphaStar league."""
     league = League(
         initial_agents={
@@ -40,7 +49,10 @@ def league_train():
         player = league.get_learning_player(idx)
         learner = Learner(player)
         learners.append(learner)
-        actors.extend([ActorLoop(player, coordinator) for _ in range(1)])
+        if actor_processes:
+            actors.append(ActorPool(player, coordinator, actor_nums))
+        else:
+            actors.extend([ActorLoop(player, coordinator) for _ in range(actor_nums)])
 
     threads = []
     for l in learners:
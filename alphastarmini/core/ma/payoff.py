@@ -5,33 +5,157 @@
 
 # modified from AlphaStar pseudo-code
 
+import threading
 import collections
+from time import sleep
 
 import numpy as np
 
 from alphastarmini.core.ma.player import Player
+from alphastarmini.core.ma.snapshot_store import SnapshotStore
 
 __author__ = "Ruo-Ze Liu"
 
 debug = False
 
+# the stats of a pair of the players, the losses are the games which are not won or drawn
+GAMES, WINS, DRAWS = range(3)
+
+
+class PlayerGroup(object):
+    '''
+    The players of a role (or a race, or the checkpoints of a parent) in the order they are added to the payoff,
+    with the array of their ids, which the win rate queries use directly.
+    '''
+
+    def __init__(self, players=(), ids=()):
+        super(PlayerGroup, self).__init__()
+        self.players = list(players)
+        self._ids = np.zeros(max(16, len(self.players)), dtype=np.int64)
+        self._ids[:len(self.players)] = ids
+
+    def add(self, player, i):
+        if len(self.players) == len(self._ids):
+            self._ids = np.concatenate([self._ids, np.zeros_like(self._ids)])
+        self._ids[len(self.players)] = i
+        self.players.append(player)
+
+    @property
+    def ids(self):
+        return self._ids[:len(self.players)]
+
+    def __len__(self):
+        return len(self.players)
+
+    def __iter__(self):
+        return iter(self.players)
+
+    def __getitem__(self, i):
+        return self.players[i]
+
+    @staticmethod
+    def merge(groups):
+        # the players of the groups in the order they are added (the order of the ids)
+        ids = np.concatenate([g.ids for g in groups] + [np.zeros(0, dtype=np.int64)])
+        players = [p for g in groups for p in g.players]
+        order = np.argsort(ids, kind='stable')
+        return PlayerGroup([players[i] for i in order], ids[order])
+
 
 class Payoff:
+    '''
+    The dense matrix of the (decayed) games, wins and draws between the players, indexed by the ids
+    of the players (the order in which they are first seen), which grows by a factor when a player is added.
+    A win rate query of a home player against many players is one indexing of its row.
+    The players are also registered by their roles (the classes), races and parents (of the checkpoints),
+    so the matchmaking gets the candidates without scanning all the players.
+    The weights of the historical players are in the snapshot store.
+    There is one writer (e.g., the consumer of the outcomes in the Coordinator) at a time, and the sequence
+    is odd while it writes, so the win rate queries of the other threads retry instead of taking a lock,
+    and the results of a query are of one version (the number of the updates applied).
+    '''
 
-    def __init__(self):
+    GROWTH = 1.5
+
+    def __init__(self, capacity=16, snapshots=None):
         self._players = []
-        self._wins = collections.defaultdict(lambda: 0)
-        self._draws = collections.defaultdict(lambda: 0)
-        self._losses = collections.defaultdict(lambda: 0)
-        self._games = collections.defaultdict(lambda: 0)
+        self._ids = {}
+        self._player_ids = np.zeros(0, dtype=np.int64)
+        self._stats = np.zeros((capacity, capacity, 3), dtype=np.float32)
         self._decay = 0.99
 
-    def _win_rate(self, _home, _away):
-        if self._games[_home, _away] == 0:
-            return 0.5
+        # the registry of the players, the key -> PlayerGroup
+        self._roles = collections.defaultdict(PlayerGroup)
+        self._races = collections.defaultdict(PlayerGroup)
+        self._checkpoints = collections.defaultdict(PlayerGroup)
+
+        self.snapshots = snapshots if snapshots is not None else SnapshotStore()
 
-        return (self._wins[_home, _away]
-                + 0.5 * self._draws[_home, _away]) / self._games[_home, _away]
+        # the writers take the lock, the readers check the sequence
+        self._lock = threading.RLock()
+        self._sequence = 0
+
+    @property
+    def capacity(self):
+        return self._stats.shape[0]
+
+    def _grow(self, size):
+        capacity = max(size, int(self.capacity * self.GROWTH))
+        stats = np.zeros((capacity, capacity, 3), dtype=np.float32)
+        stats[:self.capacity, :self.capacity] = self._stats
+        self._stats = stats
+        print('payoff capacity:', capacity) if debug else None
+
+    @property
+    def version(self):
+        return self._sequence // 2
+
+    def index(self, player):
+        """Returns the id of the player, a new one if the player is not seen before."""
+        i = self._ids.get(player)
+        if i is None:
+            with self._lock:
+                i = self._ids.get(player)
+                if i is None:
+                    if len(self._ids) >= self.capacity:
+                        self._grow(len(self._ids) + 1)
+                    i = self._ids[player] = len(self._ids)
+        return i
+
+    def indices(self, players):
+        if isinstance(players, PlayerGroup):
+            return players.ids
+        try:
+            return np.array([self._ids[p] for p in players], dtype=np.int64)
+        except KeyError:
+            return np.array([self.index(p) for p in players], dtype=np.int64)
+
+    def win_rates(self, home, away=None):
+        """Returns the win rates of the home player against each away player (all the players by default),
+        0.5 if they have not played yet."""
+        return self.snapshot(home, away)[1]
+
+    def snapshot(self, home, away=None):
+        """Returns the version of the payoff and the win rates of the home player in it."""
+        away = self.player_ids if away is None else self.indices(away)
+        version, win_rates = self._win_rates(np.array([self.index(home)]), away)
+        return version, win_rates[0]
+
+    def _win_rates(self, home, away):
+        # home and away are the ids, returns the version and the matrix of the win rates of [len(home), len(away)]
+        while True:
+            sequence = self._sequence
+            if sequence % 2 == 0:
+                stats = self._stats[home[:, None], away[None, :]]
+                if self._sequence == sequence:
+                    break
+            sleep(0)
+
+        games = stats[..., GAMES]
+        played = games > 0
+        win_rates = np.full(games.shape, 0.5)
+        win_rates[played] = (stats[..., WINS][played] + 0.5 * stats[..., DRAWS][played]) / games[played]
+        return sequence // 2, win_rates
 
     def __getitem__(self, match):
         home, away = match
@@ -41,35 +165,247 @@ class Payoff:
         if isinstance(away, Player):
             away = [away]
 
-        win_rates = np.array([[self._win_rate(h, a) for a in away] for h in home])
+        _, win_rates = self._win_rates(self.indices(home), self.indices(away))
         if win_rates.shape[0] == 1 or win_rates.shape[1] == 1:
             win_rates = win_rates.reshape(-1)
 
         return win_rates
 
+    @property
+    def player_ids(self):
+        # the ids of the players in their order, rebuilt after the players are added
+        if len(self._player_ids) != len(self._players):
+            self._player_ids = self.indices(self._players)
+        return self._player_ids
+
     def update(self, home, away, result):
-        for stats in (self._games, self._wins, self._draws, self._losses):
-            stats[home, away] *= self._decay
-            stats[away, home] *= self._decay
-
-        self._games[home, away] += 1
-        self._games[away, home] += 1
-        if result == "win":
-            self._wins[home, away] += 1
-            self._losses[away, home] += 1
-        elif result == "draw":
-            self._draws[home, away] += 1
-            self._draws[away, home] += 1
-        else:
-            self._wins[away, home] += 1
-            self._losses[home, away] += 1
+        with self._lock:
+            h, a = self.index(home), self.index(away)
+            self._sequence += 1
+
+            home_stats, away_stats = self._stats[h, a], self._stats[a, h]
+
+            # all the stats of a pair decay in one step (twice for the self-play, as the pairs are the same)
+            home_stats *= self._decay
+            away_stats *= self._decay
+
+            home_stats[GAMES] += 1
+            away_stats[GAMES] += 1
+            if result == "win":
+                home_stats[WINS] += 1
+            elif result == "draw":
+                home_stats[DRAWS] += 1
+                away_stats[DRAWS] += 1
+            else:
+                away_stats[WINS] += 1
+
+            self._sequence += 1
+
+    def update_batch(self, outcomes):
+        """Applies the outcomes (home, away, result) as one version, the same as the updates one by one:
+        each game of a pair decays its stats once, so a result is added with the decay of the later games
+        of its pair, and each pair decays once by all its games in the batch."""
+        if not len(outcomes):
+            return
+
+        with self._lock:
+            homes = self.indices([o[0] for o in outcomes])
+            aways = self.indices([o[1] for o in outcomes])
+            wins = np.array([o[2] == "win" for o in outcomes])
+            draws = np.array([o[2] == "draw" for o in outcomes])
+            losses = ~wins & ~draws
+
+            # the games of each pair (in both directions), and the games of its pair after each game
+            low, high = np.minimum(homes, aways), np.maximum(homes, aways)
+            pairs, inverse, counts = np.unique(low * self.capacity + high, return_inverse=True, return_counts=True)
+            order = np.argsort(inverse, kind='stable')
+            starts = np.cumsum(counts) - counts
+            later = np.empty(len(outcomes), dtype=np.int64)
+            later[order] = counts[inverse[order]] - 1 - (np.arange(len(outcomes)) - starts[inverse[order]])
+
+            # the self-play decays twice for each game
+            self_play = homes == aways
+            weights = (self._decay ** (later * np.where(self_play, 2, 1))).astype(np.float32)
+
+            # the (row, col, stat, value) of the results added
+            rows = np.concatenate([homes, aways, homes[wins], aways[losses], homes[draws], aways[draws]])
+            cols = np.concatenate([aways, homes, aways[wins], homes[losses], aways[draws], homes[draws]])
+            stats = np.repeat([GAMES, GAMES, WINS, WINS, DRAWS, DRAWS],
+                              [len(homes), len(homes), wins.sum(), losses.sum(), draws.sum(), draws.sum()])
+            values = np.concatenate([weights, weights, weights[wins], weights[losses], weights[draws], weights[draws]])
+
+            pair_low, pair_high = pairs // self.capacity, pairs % self.capacity
+            diagonal = pair_low == pair_high
+            pair_decay = (self._decay ** (counts * np.where(diagonal, 2, 1))).astype(np.float32)[:, None]
+
+            self._sequence += 1
+            self._stats[pair_low, pair_high] *= pair_decay
+            self._stats[pair_high[~diagonal], pair_low[~diagonal]] *= pair_decay[~diagonal]
+            np.add.at(self._stats, (rows, cols, stats), values)
+            self._sequence += 1
+
+    def stats(self, home, away):
+        """Returns the (decayed) wins, draws, losses and games of home against away."""
+        games, wins, draws = self._stats[self.index(home), self.index(away)].tolist()
+        return wins, draws, games - wins - draws, games
+
+    def get_state(self):
+        """Returns the stats between the players (in their order), the version and the decay,
+        from which load_state restores the payoff of the same players."""
+        with self._lock:
+            ids = self.player_ids
+            return {'stats': self._stats[ids[:, None], ids[None, :]], 'sequence': self._sequence,
+                    'decay': self._decay}
+
+    def load_state(self, state):
+        with self._lock:
+            ids = self.player_ids
+            assert state['stats'].shape[:2] == (len(ids), len(ids))
+            self._sequence += 1
+            self._stats[ids[:, None], ids[None, :]] = state['stats']
+            self._decay = state['decay']
+            self._sequence = state['sequence']
 
     def add_player(self, player):
-        self._players.append(player)
+        with self._lock:
+            i = self.index(player)
+
+            for role in type(player).__mro__:
+                if issubclass(role, Player):
+                    self._roles[role].add(player, i)
+            self._races[getattr(player, 'race', None)].add(player, i)
+            if hasattr(player, 'parent'):
+                self._checkpoints[player.parent].add(player, i)
 
-    def get_players_num():
+            # the last, so the readers of the players see the registered ones
+            self._players.append(player)
+
+    def players_of_role(self, role):
+        """Returns the PlayerGroup of the players which are the instances of the role."""
+        return self._roles.get(role) or PlayerGroup()
+
+    def players_of_race(self, race):
+        return self._races.get(race) or PlayerGroup()
+
+    def checkpoints_of(self, parent):
+        """Returns the PlayerGroup of the checkpoints (the historical players) whose parent is the parent."""
+        return self._checkpoints.get(parent) or PlayerGroup()
+
+    def checkpoints_of_any(self, parents):
+        """Returns the PlayerGroup of the checkpoints of all the parents, in the order they are added."""
+        return PlayerGroup.merge([self.checkpoints_of(parent) for parent in parents])
+
+    def get_players_num(self):
         return len(self._players)
 
     @property
     def players(self):
         return self._players
+
+
+def test(sizes=(10, 100, 1000, 10000), games_per_player=5, queries=100, max_dict_size=1000):
+    import time
+    import collections
+
+    class DictPayoff:
+        # the payoff of the AlphaStar pseudo-code, the stats are in the dicts of the pairs of the players
+
+        def __init__(self):
+            self._players = []
+            self._wins = collections.defaultdict(lambda: 0)
+            self._draws = collections.defaultdict(lambda: 0)
+            self._losses = collections.defaultdict(lambda: 0)
+            self._games = collections.defaultdict(lambda: 0)
+            self._decay = 0.99
+
+        def _win_rate(self, _home, _away):
+            if self._games[_home, _away] == 0:
+                return 0.5
+
+            return (self._wins[_home, _away]
+                    + 0.5 * self._draws[_home, _away]) / self._games[_home, _away]
+
+        def __getitem__(self, match):
+            home, away = match
+            win_rates = np.array([[self._win_rate(h, a) for a in away] for h in home])
+            if win_rates.shape[0] == 1 or win_rates.shape[1] == 1:
+                win_rates = win_rates.reshape(-1)
+            return win_rates
+
+        def update(self, home, away, result):
+            for stats in (self._games, self._wins, self._draws, self._losses):
+                stats[home, away] *= self._decay
+                stats[away, home] *= self._decay
+
+            self._games[home, away] += 1
+            self._games[away, home] += 1
+            if result == "win":
+                self._wins[home, away] += 1
+                self._losses[away, home] += 1
+            elif result == "draw":
+                self._draws[home, away] += 1
+                self._draws[away, home] += 1
+            else:
+                self._wins[away, home] += 1
+                self._losses[home, away] += 1
+
+        def add_player(self, player):
+            self._players.append(player)
+
+    rng = np.random.RandomState(0)
+    results = ("win", "draw", "loss")
+
+    # the same win rates as the dicts, and the ids are stable when the matrices grow
+    payoff, reference = Payoff(capacity=2), DictPayoff()
+    players = [object() for _ in range(20)]
+    for p in players:
+        payoff.add_player(p)
+        reference.add_player(p)
+    for _ in range(500):
+        h, a = rng.choice(20, 2, replace=False)
+        result = results[rng.randint(3)]
+        payoff.update(players[h], players[a], result)
+        reference.update(players[h], players[a], result)
+    payoff.update(players[0], players[0], "win")
+    reference.update(players[0], players[0], "win")
+    assert payoff.capacity >= 20 and payoff.index(players[0]) == 0 and payoff.index(players[19]) == 19
+    assert np.allclose(payoff[players[:3], players], reference[players[:3], players], atol=1e-5)
+    assert np.allclose(payoff.win_rates(players[5]), reference[[players[5]], players], atol=1e-5)
+    wins, draws, losses, games = payoff.stats(players[0], players[1])
+    assert abs(losses - reference._losses[players[0], players[1]]) < 1e-4
+
+    # the players not added (yet) have the win rate of 0.5
+    stranger = object()
+    assert payoff[[players[0]], [stranger]][0] == 0.5 and payoff.get_players_num() == 20
+
+    # benchmark test: the win rates of a home player against all the players, as get_match uses
+    for size in sizes:
+        players = [object() for _ in range(size)]
+        homes = rng.randint(size, size=size * games_per_player)
+        aways = (homes + rng.randint(1, size, size=len(homes))) % size
+        outcomes = rng.randint(3, size=len(homes))
+
+        stores = [('dense', Payoff())] + ([('dict', DictPayoff())] if size <= max_dict_size else [])
+        line = "payoff of %d players:" % size
+        for name, store in stores:
+            for p in players:
+                store.add_player(p)
+
+            start = time.time()
+            for h, a, r in zip(homes, aways, outcomes):
+                store.update(players[h], players[a], results[r])
+            update_time = (time.time() - start) / len(homes)
+
+            start = time.time()
+            for h in rng.randint(size, size=queries):
+                store[[players[h]], players]
+            query_time = (time.time() - start) / queries
+
+            line += " %s: update %.1fus, query %.3fms;" % (name, update_time * 1e6, query_time * 1e3)
+
+        payoff = stores[0][1]
+        start = time.time()
+        for h in rng.randint(size, size=queries):
+            payoff.win_rates(players[h])
+        line += " dense against all: %.3fms;" % ((time.time() - start) / queries * 1e3)
+        print(line, "matrix: %.1fMB" % (payoff._stats.nbytes / 1e6))
@@ -52,6 +52,11 @@ class Player(object):
     def checkpoint(self):
         raise NotImplementedError
 
+    @staticmethod
+    def _pfsp_choice(players, win_rates, weighting):
+        # chooses by the index, the players (e.g., a PlayerGroup) are not made into an array
+        return players[np.random.choice(len(players), p=pfsp(win_rates, weighting=weighting))]
+
     def setup(self, obs_spec, action_spec):
         self.agent.setup(obs_spec, action_spec)
 
@@ -63,13 +68,22 @@ class Historical(Player):
 
     def __init__(self, agent, payoff):
         # AlphaStar： self._agent = Agent(agent.race, agent.get_weights())
-        self.agent = AlphaStarAgent(name="Historical", race=agent.race, initial_weights=agent.get_weights())
+        # the weights are written to the snapshot store, and the agent is made from them when it is drawn
+        self._snapshot = payoff.snapshots.put(agent.get_weights())
         self._payoff = payoff
         self._race = agent.race
         self._parent = agent
         self.name = "Historical"
         self._actors = []
 
+    @property
+    def agent(self):
+        return self._payoff.snapshots.agent(self._snapshot, self._race)
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
     @property
     def parent(self):
         return self._parent
@@ -94,13 +108,9 @@ class MainPlayer(Player):
         self._actors = []
 
     def _pfsp_branch(self):
-        historical = [
-            player for player in self._payoff.players
-            if isinstance(player, Historical)
-        ]
+        historical = self._payoff.players_of_role(Historical)
         win_rates = self._payoff[self, historical]
-        return np.random.choice(
-            historical, p=pfsp(win_rates, weighting="squared")), True
+        return self._pfsp_choice(historical, win_rates, "squared"), True
 
     def _selfplay_branch(self, opponent):
         # Play self-play match
@@ -109,40 +119,26 @@ class MainPlayer(Player):
 
         # If opponent is too strong, look for a checkpoint
         # as curriculum
-        historical = [
-            player for player in self._payoff.players
-            if isinstance(player, Historical) and player.parent == opponent
-        ]
+        historical = self._payoff.checkpoints_of(opponent)
         win_rates = self._payoff[self, historical]
-        return np.random.choice(
-            historical, p=pfsp(win_rates, weighting="variance")), True
+        return self._pfsp_choice(historical, win_rates, "variance"), True
 
     def _verification_branch(self, opponent):
         # Check exploitation
-        exploiters = set([
-            player for player in self._payoff.players
-            if isinstance(player, MainExploiter)
-        ])
+        exploiters = self._payoff.players_of_role(MainExploiter)
         # Q: What is the player.parent?
         # A: This is only the property of Historical
-        exp_historical = [
-            player for player in self._payoff.players
-            if isinstance(player, Historical) and player.parent in exploiters
-        ]
+        exp_historical = self._payoff.checkpoints_of_any(exploiters)
         win_rates = self._payoff[self, exp_historical]
         if len(win_rates) and win_rates.min() < 0.3:
-            return np.random.choice(
-                exp_historical, p=pfsp(win_rates, weighting="squared")), True
+            return self._pfsp_choice(exp_historical, win_rates, "squared"), True
 
         # Check forgetting
-        historical = [
-            player for player in self._payoff.players
-            if isinstance(player, Historical) and player.parent == opponent
-        ]
+        historical = self._payoff.checkpoints_of(opponent)
         win_rates = self._payoff[self, historical]
 
         def remove_monotonic_suffix(win_rates, players):
-            if not win_rates:
+            if not len(win_rates):
                 return win_rates, players
 
             for i in range(len(win_rates) - 1, 0, -1):
@@ -153,8 +149,7 @@ class MainPlayer(Player):
 
         win_rates, historical = remove_monotonic_suffix(win_rates, historical)
         if len(win_rates) and win_rates.min() < 0.7:
-            return np.random.choice(
-                historical, p=pfsp(win_rates, weighting="squared")), True
+            return self._pfsp_choice(historical, win_rates, "squared"), True
 
         return None
 
@@ -165,11 +160,8 @@ class MainPlayer(Player):
         if coin_toss < 0.5:
             return self._pfsp_branch()
 
-        main_agents = [
-            player for player in self._payoff.players
-            if isinstance(player, MainPlayer)
-        ]
-        opponent = np.random.choice(main_agents)
+        main_agents = self._payoff.players_of_role(MainPlayer)
+        opponent = main_agents[np.random.choice(len(main_agents))]
 
         # Verify if there are some rare players we omitted
         if coin_toss < 0.5 + 0.15:
@@ -184,10 +176,7 @@ class MainPlayer(Player):
         if steps_passed < 2e9:
             return False
 
-        historical = [
-            player for player in self._payoff.players
-            if isinstance(player, Historical)
-        ]
+        historical = self._payoff.players_of_role(Historical)
         win_rates = self._payoff[self, historical]
         return win_rates.min() > 0.7 or steps_passed > 4e9
 
@@ -208,23 +197,16 @@ class MainExploiter(Player):
         self._actors = []
 
     def get_match(self):
-        main_agents = [
-            player for player in self._payoff.players
-            if isinstance(player, MainPlayer)
-        ]
-        opponent = np.random.choice(main_agents)
+        main_agents = self._payoff.players_of_role(MainPlayer)
+        opponent = main_agents[np.random.choice(len(main_agents))]
 
         if self._payoff[self, opponent] > 0.1:
             return opponent, True
 
-        historical = [
-            player for player in self._payoff.players
-            if isinstance(player, Historical) and player.parent == opponent
-        ]
+        historical = self._payoff.checkpoints_of(opponent)
         win_rates = self._payoff[self, historical]
 
-        return np.random.choice(
-            historical, p=pfsp(win_rates, weighting="variance")), True
+        return self._pfsp_choice(historical, win_rates, "variance"), True
 
     def checkpoint(self):
         self.agent.set_weights(self._initial_weights)
@@ -236,10 +218,7 @@ class MainExploiter(Player):
         if steps_passed < 2e9:
             return False
 
-        main_agents = [
-            player for player in self._payoff.players
-            if isinstance(player, MainPlayer)
-        ]
+        main_agents = self._payoff.players_of_role(MainPlayer)
         win_rates = self._payoff[self, main_agents]
         return win_rates.min() > 0.7 or steps_passed > 4e9
 
@@ -256,14 +235,9 @@ class LeagueExploiter(Player):
         self._actors = []
 
     def get_match(self):
-        historical = [
-            player for player in self._payoff.players 
-            if isinstance(player, Historical)
-        ]
+        historical = self._payoff.players_of_role(Historical)
         win_rates = self._payoff[self, historical]
-        return np.random.choice(
-
-            historical, p=pfsp(win_rates, weighting="linear_capped")), True
+        return self._pfsp_choice(historical, win_rates, "linear_capped"), True
 
     def checkpoint(self):
         if np.random.random() < 0.25:
@@ -275,9 +249,65 @@ class LeagueExploiter(Player):
         steps_passed = self._agent.get_steps() - self._checkpoint_step
         if steps_passed < 2e9:
             return False
-        historical = [
-            player for player in self._payoff.players
-            if isinstance(player, Historical)
-        ]
+        historical = self._payoff.players_of_role(Historical)
         win_rates = self._payoff[self, historical]
         return win_rates.min() > 0.7 or steps_passed > 4e9
+
+
+def test(sizes=(10, 100, 1000, 10000), calls=200, games_per_player=2):
+    import time
+
+    from alphastarmini.core.ma.payoff import Payoff
+
+    rng = np.random.RandomState(0)
+    np.random.seed(0)
+
+    def make(cls, payoff, race, parent=None):
+        # the players of the synthetic league have no agents, which the matchmaking does not use
+        player = cls.__new__(cls)
+        player._payoff = payoff
+        player._race = race
+        player._parent = parent
+        player._actors = []
+        player.name = cls.__name__
+        return player
+
+    for size in sizes:
+        payoff = Payoff()
+        learners = [make(cls, payoff, race) for race in ('protoss', 'terran')
+                    for cls in (MainPlayer, MainExploiter, LeagueExploiter)]
+        for player in learners:
+            payoff.add_player(player)
+        for i in range(size):
+            payoff.add_player(make(Historical, payoff, learners[i % 2 * 3].race, parent=learners[rng.randint(6)]))
+
+        players = payoff.players
+        for _ in range(size * games_per_player):
+            h, a = rng.randint(len(players), size=2)
+            payoff.update(players[h], players[a], ("win", "draw", "loss")[rng.randint(3)])
+
+        # the registry has the same players in the same order as the scans
+        main_player, main_exploiter = learners[0], learners[1]
+        assert payoff.players_of_role(Historical).players == [p for p in players if isinstance(p, Historical)]
+        assert payoff.players_of_role(Player).players == players
+        assert payoff.players_of_race('terran').players == [p for p in players if p.race == 'terran']
+        assert payoff.checkpoints_of(main_player).players == [
+            p for p in players if isinstance(p, Historical) and p.parent == main_player]
+        exploiters = set(p for p in players if isinstance(p, MainExploiter))
+        assert payoff.checkpoints_of_any(payoff.players_of_role(MainExploiter)).players == [
+            p for p in players if isinstance(p, Historical) and p.parent in exploiters]
+
+        # benchmark test: the latency of the matchmaking, and of the scans of all the players it replaces
+        line = "league of %d historical players:" % size
+        for player in learners[:3]:
+            start = time.time()
+            for _ in range(calls):
+                opponent, _ = player.get_match()
+                assert isinstance(opponent, (Historical, MainPlayer))
+            line += " %s %.3fms;" % (player.name, (time.time() - start) / calls * 1e3)
+
+        start = time.time()
+        for _ in range(calls):
+            historical = [p for p in players if isinstance(p, Historical)]
+            main_player._pfsp_choice(historical, payoff[main_player, historical], "squared")
+        print(line, "scan for the pfsp branch: %.3fms" % ((time.time() - start) / calls * 1e3))
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" The store of the weights of the historical players, on the disk and loaded when they are drawn as the opponents"
+
+import os
+import pickle
+import hashlib
+import tempfile
+import threading
+import contextlib
+import collections
+from time import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from alphastarmini.core.rl.alphastar_agent import AlphaStarAgent
+from alphastarmini.core.rl.array_packing import flatten, unflatten, layout
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+# the directory of the snapshots, None for a temporary one removed with the store
+SNAPSHOT_PATH = None
+# the number of the agents (each has one set of the weights) kept in the memory
+MAX_RESIDENT = 8
+
+
+def historical_agent(race, weights):
+    return AlphaStarAgent(name="Historical", race=race, initial_weights=weights)
+
+
+class SnapshotStore(object):
+    '''
+    The weights are written once to the disk by their content hash (the key), so the same weights
+    (e.g., the exploiters reset to the initial weights) are one file. A historical player keeps only the key,
+    and its agent is made from the memory-mapped file when it is drawn, only the MAX_RESIDENT
+    least recently drawn agents stay in the memory.
+    '''
+
+    def __init__(self, path=SNAPSHOT_PATH, max_resident=MAX_RESIDENT, agent_fn=historical_agent):
+        super(SnapshotStore, self).__init__()
+        self._temp_dir = None
+        if path is None:
+            self._temp_dir = tempfile.TemporaryDirectory(prefix='snapshots_')
+            path = self._temp_dir.name
+        self.path = path
+        self.max_resident = max_resident
+        self.agent_fn = agent_fn
+
+        # the key -> (structure, specs) of the snapshots on the disk, and the LRU of (key, race) -> agent
+        self.snapshots = {}
+        self.resident = collections.OrderedDict()
+        # the actor threads draw the opponents and the learner puts the snapshots concurrently, so the lookups
+        # and the inserts are under the lock, while an agent is made out of it: the (key, race) -> future of
+        # the agents being made, which the other draws of the same key wait for, so it is not made twice
+        self.lock = threading.RLock()
+        self.building = {}
+        # the keys put since the last retain, which may be referenced only after it (e.g., a checkpoint being added)
+        self.recent = set()
+
+        # metrics
+        self.put_num = 0
+        self.dedup_num = 0
+        self.remove_num = 0
+        self.hit_num = 0
+        self.miss_num = 0
+        self.load_time = 0.
+
+    @staticmethod
+    def hash(arrays, structure):
+        h = hashlib.sha1(pickle.dumps(structure))
+        for a in arrays:
+            h.update(a.dtype.str.encode())
+            h.update(str(a.shape).encode())
+            h.update(np.ascontiguousarray(a).data)
+        return h.hexdigest()
+
+    def file(self, key, ext='.bin'):
+        return os.path.join(self.path, key + ext)
+
+    def __contains__(self, key):
+        return key in self.snapshots or os.path.exists(self.file(key, '.meta'))
+
+    def put(self, state_dict):
+        """Writes the weights if they are not in the store yet, returns their key."""
+        arrays = []
+        structure = flatten(state_dict, arrays)
+        key = self.hash(arrays, structure)
+        with self.lock:
+            return self._put(key, arrays, structure)
+
+    def _put(self, key, arrays, structure):
+        self.put_num += 1
+        self.recent.add(key)
+        if key in self:
+            self.dedup_num += 1
+            return key
+
+        specs, nbytes = layout(arrays)
+        os.makedirs(self.path, exist_ok=True)
+
+        # the meta file is written last, so a snapshot with it is complete
+        tmp = self.file(key, '.tmp')
+        block = np.memmap(tmp, dtype=np.uint8, mode='w+', shape=(max(nbytes, 1),))
+        for a, (offset, dtype, shape) in zip(arrays, specs):
+            np.ndarray(shape, dtype, block, offset)[...] = a
+        block.flush()
+        del block
+        os.replace(tmp, self.file(key))
+
+        with open(tmp, 'wb') as f:
+            pickle.dump((structure, specs), f)
+        os.replace(tmp, self.file(key, '.meta'))
+
+        self.snapshots[key] = (structure, specs)
+        print('write the snapshot', key, '%.1fMB' % (nbytes / 1e6)) if debug else None
+        return key
+
+    def load(self, key):
+        """Returns the state dict of the snapshot, whose tensors are the (copy-on-write) views of the mapped file,
+        so only the pages read are loaded."""
+        with self.lock:
+            if key not in self.snapshots:
+                with open(self.file(key, '.meta'), 'rb') as f:
+                    self.snapshots[key] = pickle.load(f)
+            structure, specs = self.snapshots[key]
+
+        block = np.memmap(self.file(key), dtype=np.uint8, mode='c')
+        arrays = [np.ndarray(shape, dtype, block, offset) for offset, dtype, shape in specs]
+        return unflatten(structure, arrays)
+
+    def agent(self, key, race):
+        """Returns the agent with the weights of the snapshot, made when it is not resident."""
+        resident_key = (key, race)
+        with self.lock:
+            agent = self.resident.get(resident_key)
+            if agent is not None:
+                self.resident.move_to_end(resident_key)
+                self.hit_num += 1
+                return agent
+
+            future = self.building.get(resident_key)
+            is_builder = future is None
+            if is_builder:
+                future = self.building[resident_key] = Future()
+                self.miss_num += 1
+            else:
+                self.hit_num += 1
+        if not is_builder:
+            # being made by another thread
+            return future.result()
+
+        try:
+            start = time()
+            agent = self.agent_fn(race, self.load(key))
+        except Exception as e:
+            with self.lock:
+                del self.building[resident_key]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.load_time += time() - start
+            del self.building[resident_key]
+            self.resident[resident_key] = agent
+            while len(self.resident) > self.max_resident:
+                self.resident.popitem(last=False)
+        future.set_result(agent)
+        return agent
+
+    def retain(self, keys):
+        """Removes the snapshots on the disk which are not in the keys and not put since the last call,
+        returns the number removed. The agents made from them (and their mapped files) stay valid."""
+        with self.lock:
+            keys = set(keys) | self.recent
+            self.recent = set()
+            removed = set()
+            for f in os.listdir(self.path) if os.path.isdir(self.path) else []:
+                key, ext = os.path.splitext(f)
+                if ext in ('.bin', '.meta') and key not in keys:
+                    removed.add(key)
+
+            for key in removed:
+                # the meta file is removed first, so a snapshot without it is not in the store
+                for ext in ('.meta', '.bin'):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self.file(key, ext))
+                self.snapshots.pop(key, None)
+                for resident_key in [k for k in self.resident if k[0] == key]:
+                    del self.resident[resident_key]
+            self.remove_num += len(removed)
+            print('remove the snapshots', len(removed)) if debug else None
+            return len(removed)
+
+    @property
+    def disk_bytes(self):
+        return sum(os.path.getsize(self.file(key)) for key in self.snapshots)
+
+    def close(self):
+        with self.lock:
+            self.resident.clear()
+        if self._temp_dir is not None:
+            self._temp_dir.cleanup()
+
+    def __str__(self):
+        return ("snapshots: %d, puts: %d, deduplicated: %d, removed: %d, resident: %d/%d, hits: %d, misses: %d, "
+                "load: %.3fs") % (len(self.snapshots), self.put_num, self.dedup_num, self.remove_num,
+                                  len(self.resident), self.max_resident, self.hit_num, self.miss_num, self.load_time)
+
+
+def test(snapshot_num=300, unique_num=200, draws=1000, max_resident=8, size=512):
+    import torch
+
+    def rss():
+        # the resident set size of the process, in bytes
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    class FakeAgent(object):
+        # the agent of a small model, which copies the weights as the AlphaStarAgent does
+
+        def __init__(self, race, weights):
+            self.race = race
+            self.model = torch.nn.Sequential(torch.nn.Linear(size, size), torch.nn.Linear(size, size))
+            self.model.load_state_dict(weights)
+
+        def get_weights(self):
+            return self.model.state_dict()
+
+    model = torch.nn.Sequential(torch.nn.Linear(size, size), torch.nn.Linear(size, size))
+    weights_bytes = sum(v.numel() * v.element_size() for v in model.state_dict().values())
+
+    # a synthetic league: the snapshots of the training model, some are the same (e.g., of the reset exploiters)
+    store = SnapshotStore(max_resident=max_resident, agent_fn=FakeAgent)
+    rss_start = rss()
+    keys, firsts = [], {}
+    for i in range(snapshot_num):
+        torch.manual_seed(i % unique_num)
+        for p in model.parameters():
+            torch.nn.init.normal_(p)
+        keys.append(store.put(model.state_dict()))
+        firsts.setdefault(keys[-1], model.state_dict()['0.weight'][0].clone())
+    assert len(store.snapshots) == unique_num and store.dedup_num == snapshot_num - unique_num
+    assert len(set(keys)) == unique_num and keys[0] == keys[unique_num]
+
+    # the opponents are drawn as the pfsp does, the recent ones more often
+    rng = np.random.RandomState(0)
+    probs = np.arange(1, snapshot_num + 1, dtype=np.float64) ** 2
+    probs /= probs.sum()
+    latencies = {True: [], False: []}
+    for i in rng.choice(snapshot_num, size=draws, p=probs):
+        hit = (keys[i], 'protoss') in store.resident
+        start = time()
+        agent = store.agent(keys[i], 'protoss')
+        latencies[hit].append(time() - start)
+        assert len(store.resident) <= max_resident
+    assert torch.equal(agent.model.state_dict()['0.weight'][0], firsts[keys[i]])
+    del agent
+
+    print(store)
+    print("snapshots: %d, in memory as the agents: %.1fMB, on the disk: %.1fMB, resident: %.1fMB, rss growth: %.1fMB" % (
+        snapshot_num, snapshot_num * weights_bytes / 1e6, store.disk_bytes / 1e6,
+        len(store.resident) * weights_bytes / 1e6, (rss() - rss_start) / 1e6))
+    print("opponent load latency: resident %.3fms, from the disk %.3fms" % (
+        np.mean(latencies[True]) * 1e3, np.mean(latencies[False]) * 1e3))
+
+    # another store on the same directory reads the snapshots written (e.g., after a restart)
+    reopened = SnapshotStore(path=store.path, agent_fn=FakeAgent)
+    assert keys[5] in reopened and torch.equal(reopened.load(keys[5])['0.weight'][0], firsts[keys[5]])
+    assert reopened.put(reopened.load(keys[5])) == keys[5] and reopened.dedup_num == 1
+
+    # the historical players keep only the keys, the checkpoints of the same weights share the agent
+    from alphastarmini.core.ma.payoff import Payoff
+    from alphastarmini.core.ma.player import Historical
+
+    payoff = Payoff(snapshots=store)
+    parent = FakeAgent('terran', model.state_dict())
+    checkpoints = [Historical(parent, payoff) for _ in range(3)]
+    assert len(set(c.snapshot for c in checkpoints)) == 1 and checkpoints[0].snapshot in keys
+    assert checkpoints[0].agent is checkpoints[2].agent and checkpoints[1].agent.race == 'terran'
+
+    # the threads which draw the same opponents concurrently share one agent of each, made once
+    from time import sleep
+    from threading import Thread, Event
+    from concurrent.futures import ThreadPoolExecutor
+
+    builds = []
+
+    def slow_agent(race, weights):
+        builds.append(race)
+        sleep(0.01)
+        return FakeAgent(race, weights)
+
+    concurrent = SnapshotStore(path=store.path, max_resident=max_resident, agent_fn=slow_agent)
+    drawn = keys[:4] * 8
+    with ThreadPoolExecutor(8) as executor:
+        agents = list(executor.map(lambda k: (k, concurrent.agent(k, 'zerg')), drawn))
+    assert len(builds) == concurrent.miss_num == 4 and concurrent.hit_num == len(drawn) - 4
+    assert all(agent is concurrent.agent(k, 'zerg') for k, agent in agents)
+
+    # an agent being made does not block the draws of the resident agents and the puts
+    started, release = Event(), Event()
+
+    def blocked_agent(race, weights):
+        started.set()
+        release.wait()
+        return FakeAgent(race, weights)
+
+    concurrent.agent_fn = blocked_agent
+    blocked = Thread(target=concurrent.agent, args=(keys[10], 'zerg'))
+    blocked.start()
+    started.wait()
+    assert concurrent.agent(keys[0], 'zerg') is agents[0][1]
+    torch.manual_seed(unique_num)
+    for p in model.parameters():
+        torch.nn.init.normal_(p)
+    with ThreadPoolExecutor(8) as executor:
+        put_keys = set(executor.map(lambda _: concurrent.put(model.state_dict()), range(16)))
+    assert len(put_keys) == 1 and concurrent.dedup_num == 15
+    release.set()
+    blocked.join()
+    assert (keys[10], 'zerg') in concurrent.resident and not concurrent.building
+
+    store.close()
+    assert not os.path.exists(store.path)
+
+    # the opponent load latency of the agent of the real model
+    store = SnapshotStore()
+    key = store.put(historical_agent('protoss', None).get_weights())
+    start = time()
+    agent = store.agent(key, 'protoss')
+    print("AlphaStarAgent of %.1fMB from the disk: %.3fs" % (store.disk_bytes / 1e6, time() - start))
+    assert isinstance(agent, AlphaStarAgent)
+    store.close()
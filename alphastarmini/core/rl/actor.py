@@ -14,8 +14,10 @@ from torch.optim import Adam
 from pysc2.env.sc2_env import SC2Env, AgentInterfaceFormat, Agent, Race
 
 from alphastarmini.core.rl.env_utils import SC2Environment, get_env_outcome
-from alphastarmini.core.rl.rl_utils import Trajectory, get_supervised_agent
+from alphastarmini.core.rl.rl_utils import Trajectory, CompactTrajectory, get_supervised_agent
 from alphastarmini.core.rl.learner import Learner
+from alphastarmini.core.rl.actor_inference import ActorInference
+from alphastarmini.core.rl.parameter_store import ParameterPuller
 from alphastarmini.core.rl import rl_utils as U
 
 from alphastarmini.lib import utils as L
@@ -48,12 +50,19 @@ class ActorLoop:
     def __init__(self, player, coordinator, max_time_for_training = 60 * 60 * 24,
                  max_time_per_one_opponent=60 * 60 * 2,
                  max_frames_per_episode=22.4 * 60 * 15, max_frames=22.4 * 60 * 60 * 24, 
-                 max_episodes=MAX_EPISODES):
+                 max_episodes=MAX_EPISODES, env_fn=None, inference_service=None):
 
         self.player = player
         self.player.add_actor(self)
 
-        self.teacher = get_supervised_agent(player.race, model_type="sl")
+        # the actors of the inference service share its teacher of the race
+        teacher_fn = lambda: get_supervised_agent(player.race, model_type="sl")
+        self.teacher = teacher_fn() if inference_service is None else \
+            inference_service.register(('teacher', player.race), teacher_fn)
+
+        # runs the forwards of the player and the opponent together,
+        # or sends them to the inference service shared by the actors
+        self.inference = ActorInference() if inference_service is None else inference_service.client()
 
         # below code is not used because we only can create the env when we know the opponnet information (e.g., race)
         # AlphaStar: self.environment = SC2Environment()
@@ -65,6 +74,15 @@ class ActorLoop:
         self.max_frames = max_frames
         self.max_episodes = max_episodes
 
+        # a function to create the env instead of SC2Env, e.g., the synthetic env for the benchmarks
+        self.env_fn = env_fn
+
+        # the inference runs a local copy of the agent of the player, which pulls the parameters the learner
+        # publishes at the episode and unroll boundaries, instead of reading the agent the learner updates,
+        # the actors of the inference service share one copy
+        self.puller = ParameterPuller(player) if inference_service is None else inference_service.puller(player)
+        self.agent = self.puller.agent
+
         self.thread = threading.Thread(target=self.run, args=())
         self.thread.daemon = True                            # Daemonize thread
 
@@ -89,7 +107,10 @@ class ActorLoop:
 
             while time() - start_time < self.max_time_for_training:
                 self.opponent, _ = self.player.get_match()
-                agents = [self.player, self.opponent]
+
+                # in the self-play, the opponent also runs the local copy
+                opponent_agent = self.agent if self.opponent is self.player else self.opponent.agent
+                agents = [self.agent, opponent_agent]
 
                 with self.create_env(self.player, self.opponent) as env:
 
@@ -116,6 +137,8 @@ class ActorLoop:
                         total_episodes += 1
                         print("total_episodes:", total_episodes)
 
+                        policy_version = self.puller.pull()
+
                         timesteps = env.reset()
                         for a in agents:
                             a.reset()
@@ -123,12 +146,13 @@ class ActorLoop:
                         [home_obs, away_obs] = timesteps
                         is_final = home_obs.last()
 
-                        player_memory = self.player.agent.initial_state()
-                        opponent_memory = self.opponent.agent.initial_state()
+                        player_memory = self.agent.initial_state()
+                        opponent_memory = opponent_agent.initial_state()
                         teacher_memory = self.teacher.initial_state()
 
                         # initial build order
-                        player_bo = []
+                        player_tracker = L.BuildOrderTracker(home_obs.observation)
+                        player_bo = player_tracker.build_order
 
                         episode_frames = 0
                         # default outcome is 0 (means draw)
@@ -144,12 +168,13 @@ class ActorLoop:
                             episode_frames += 1
 
                             # run_loop: actions = [agent.step(timestep) for agent, timestep in zip(agents, timesteps)]
-                            player_step = self.player.agent.step_logits(home_obs, player_memory)
+                            player_step, opponent_step = self.inference.step([self.agent, opponent_agent], 
+                                                                             [home_obs, away_obs], 
+                                                                             [player_memory, opponent_memory])
                             player_function_call, player_action, player_logits, player_new_memory = player_step
 
                             print("player_function_call:", player_function_call) if 0 else None
 
-                            opponent_step = self.opponent.agent.step_logits(away_obs, opponent_memory)
                             opponent_function_call, opponent_action, opponent_logits, opponent_new_memory = opponent_step
 
                             # Q: how to do it ?
@@ -173,19 +198,26 @@ class ActorLoop:
                             print("reward: ", reward) if debug else None
                             is_final = home_next_obs.last()
 
+                            # calculate the unit counts of bag (of home_obs, before the tracker steps to home_next_obs)
+                            player_ucb = player_tracker.unit_counts_list()
+                            print("player unit count of bow:", player_ucb) if debug else None
+
                             # calculate the build order
-                            player_bo = L.calculate_build_order(player_bo, home_obs.observation, home_next_obs.observation)
+                            player_bo = player_tracker.update(home_next_obs.observation)
                             print("player build order:", player_bo) if debug else None
 
-                            # calculate the unit counts of bag
-                            player_ucb = L.calculate_unit_counts_bow(home_obs.observation).reshape(-1).numpy().tolist()
-                            print("player unit count of bow:", player_ucb) if debug else None
+                            # the states preprocessed in the inference are sent, instead of the observations
+                            home_state, away_state = self.inference.states
+                            state, baseline_state, baseline_opponent_state = U.get_compact_inputs(home_state, away_state, 
+                                                                                                  build_order=player_bo)
+                            game_loop = home_obs.observation.game_loop[0]
 
                             # note, original AlphaStar pseudo-code has some mistakes, we modified 
                             # them here
-                            traj_step = Trajectory(
-                                observation=home_obs.observation,
-                                opponent_observation=away_obs.observation,
+                            traj_step = CompactTrajectory(
+                                state=state,
+                                baseline_state=baseline_state,
+                                baseline_opponent_state=baseline_opponent_state,
                                 memory=player_memory,
                                 z=z,
                                 masks=action_masks,
@@ -198,6 +230,8 @@ class ActorLoop:
                                 z_build_order=player_bo,  # change it to the sampled build order
                                 unit_counts=player_ucb,
                                 z_unit_counts=player_ucb,  # change it to the sampled unit counts
+                                game_loop=game_loop,
+                                policy_version=policy_version,
                             )
                             trajectory.append(traj_step)
 
@@ -220,6 +254,8 @@ class ActorLoop:
                                         print("Learner send_trajectory!")
                                         self.player.learner.send_trajectory(trajectories)
                                         trajectory = []
+
+                                        policy_version = self.puller.pull()
                                     else:
                                         print("Learner stops!")
 
@@ -258,6 +294,9 @@ class ActorLoop:
                    step_mul=STEP_MUL, version=None, 
                    map_name="Simple64", random_seed=1):
 
+        if self.env_fn is not None:
+            return self.env_fn()
+
         player_aif = AgentInterfaceFormat(**AAIFP._asdict())
         opponent_aif = AgentInterfaceFormat(**AAIFP._asdict())
         agent_interface_format = [player_aif, opponent_aif]
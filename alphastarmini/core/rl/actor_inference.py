@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"The actor-side inference, which runs the player, opponent and teacher of one game step together."
+
+import time
+
+import torch
+import torch.nn as nn
+
+from pysc2.env import environment as E
+
+from alphastarmini.core.arch.agent import Agent
+from alphastarmini.core.rl.action import ArgsAction, ArgsActionLogits
+from alphastarmini.core.rl.state import MsState
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+
+def can_stack(model):
+    # batchnorm in training mode normalizes with the statistics of the batch,
+    # so stacking other samples into the batch would change the outputs of each one
+    for m in model.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training:
+            return False
+    return True
+
+
+def cat_states(state_list):
+    # note: returns a new MsState, as MsState.to(device) is an in-place operation
+    if len(state_list) == 1:
+        s = state_list[0]
+        return MsState(entity_state=s.entity_state, statistical_state=list(s.statistical_state),
+                       map_state=s.map_state)
+
+    entity_state = torch.cat([s.entity_state for s in state_list], dim=0)
+    statistical_state = [torch.cat(statis, dim=0) for statis in zip(*[s.statistical_state for s in state_list])]
+    map_state = torch.cat([s.map_state for s in state_list], dim=0)
+
+    return MsState(entity_state=entity_state, statistical_state=statistical_state, map_state=map_state)
+
+
+def slice_batch(t, i):
+    return t[i:i + 1] if t is not None else None
+
+
+class ActorInference(object):
+    '''
+    Runs the forwards of the agents in one game step together, e.g., the player, opponent and teacher.
+
+    Each distinct observation is preprocessed only once (e.g., the player and the teacher both see home_obs),
+    the agents sharing the same model are stacked into one batch, and the different models
+    are run back-to-back on the already preprocessed states.
+    '''
+
+    def __init__(self, stack=True):
+        super(ActorInference, self).__init__()
+        self.stack = stack
+
+        # the preprocessed (cpu) states of the requests in the last step,
+        # which the actors can put into the CompactTrajectory
+        self.states = None
+
+        # statistics
+        self.step_num = 0
+        self.preprocess_num = 0
+        self.forward_num = 0
+
+    def preprocess(self, obs_list):
+        # returns the state for each obs, the same obs object is preprocessed only once
+        state_dict = {}
+        state_list = []
+        for obs in obs_list:
+            key = id(obs)
+            if key not in state_dict:
+                state_dict[key] = Agent.preprocess_state_all(obs=obs)
+                self.preprocess_num += 1
+            state_list.append(state_dict[key])
+
+        return state_list
+
+    def group(self, agent_list):
+        # the agents with the same model are in one group, in the order of their first appearance
+        group_dict = {}
+        for i, agent in enumerate(agent_list):
+            model = agent.agent_nn.model
+            key = id(model)
+            if not (self.stack and can_stack(model)):
+                key = (key, i)
+            group_dict.setdefault(key, []).append(i)
+
+        return list(group_dict.values())
+
+    def forward(self, agent_nn, state_list, memory_list):
+        batch_size = len(state_list)
+
+        state = cat_states(state_list)
+        device = agent_nn.device()
+        state.to(device)
+
+        # note the batch size is in the second dim of hidden state
+        hidden_state = tuple(torch.cat(l, dim=1).to(device) for l in zip(*memory_list))
+
+        action_logits, action, new_state, select_units_num = agent_nn.model.forward(state,
+                                                                                    batch_size=batch_size,
+                                                                                    sequence_length=1,
+                                                                                    hidden_state=hidden_state,
+                                                                                    return_logits=True)
+        self.forward_num += 1
+
+        result_list = []
+        for i in range(batch_size):
+            if batch_size == 1:
+                result_list.append((action, action_logits, new_state, select_units_num))
+                continue
+
+            action_i = ArgsAction(*[slice_batch(t, i) for t in action.toList()])
+            action_logits_i = ArgsActionLogits(*[slice_batch(t, i) for t in action_logits.toList()])
+            new_state_i = tuple(h[:, i:i + 1] for h in new_state)
+            select_units_num_i = slice_batch(select_units_num, i)
+
+            result_list.append((action_i, action_logits_i, new_state_i, select_units_num_i))
+
+        return result_list
+
+    def step(self, agent_list, obs_list, memory_list):
+        """Returns the (func_call, action, action_logits, new_state) of each agent,
+        the same as what AlphaStarAgent.step_logits returns.
+
+        agent_list: the AlphaStarAgent of each request, e.g., [player, opponent, teacher];
+        obs_list: the observation (or timestep) of each request, the same object for the same observation;
+        memory_list: the lstm hidden state of each request.
+        """
+        self.step_num += 1
+
+        # note someimes obs is timestep
+        obs_list = [obs.observation if isinstance(obs, E.TimeStep) else obs for obs in obs_list]
+        state_list = self.preprocess(obs_list)
+        self.states = state_list
+
+        results = [None] * len(agent_list)
+        for index_list in self.group(agent_list):
+            agent_nn = agent_list[index_list[0]].agent_nn
+            group_results = self.forward(agent_nn, [state_list[i] for i in index_list],
+                                         [memory_list[i] for i in index_list])
+
+            for i, (action, action_logits, new_state, select_units_num) in zip(index_list, group_results):
+                agent = agent_list[i]
+                func_call = agent.agent_nn.action_to_func_call(action, select_units_num, agent.action_spec)
+                results[i] = (func_call, action, action_logits, new_state)
+
+        print('results:', results) if debug else None
+        return results
+
+    def __str__(self):
+        return "steps: %d, preprocess: %d, forward: %d" % (self.step_num, self.preprocess_num, self.forward_num)
+
+
+class RecordedObsEnv(object):
+    '''
+    A stand-in of the two-player SC2 env for benchmarks, which emits recorded observations in a loop.
+    '''
+
+    def __init__(self, home_obs_list, away_obs_list, episode_steps=None):
+        super(RecordedObsEnv, self).__init__()
+        self.home_obs_list = home_obs_list
+        self.away_obs_list = away_obs_list
+        self.episode_steps = episode_steps if episode_steps is not None else len(home_obs_list)
+        self.steps = 0
+
+    def timesteps(self, step_type):
+        i = self.steps % len(self.home_obs_list)
+        return [E.TimeStep(step_type=step_type, reward=0, discount=1., observation=obs)
+                for obs in (self.home_obs_list[i], self.away_obs_list[i])]
+
+    def reset(self):
+        self.steps = 0
+        return self.timesteps(E.StepType.FIRST)
+
+    def step(self, actions):
+        self.steps += 1
+        last = self.steps >= self.episode_steps
+        return self.timesteps(E.StepType.LAST if last else E.StepType.MID)
+
+
+def run_actor_loop(player, opponent, teacher, env, inference=None):
+    # the inference part of the loop in actor_plus_z.py, returns the steps per second
+    [home_obs, away_obs] = env.reset()
+    is_final = home_obs.last()
+
+    player_memory = player.initial_state()
+    opponent_memory = opponent.initial_state()
+    teacher_memory = teacher.initial_state()
+
+    start_time = time.time()
+    steps = 0
+    while not is_final:
+        steps += 1
+
+        if inference is not None:
+            player_step, opponent_step, teacher_step = inference.step([player, opponent, teacher],
+                                                                      [home_obs, away_obs, home_obs],
+                                                                      [player_memory, opponent_memory, teacher_memory])
+        else:
+            player_step = player.step_logits(home_obs, player_memory)
+            opponent_step = opponent.step_logits(away_obs, opponent_memory)
+            teacher_step = teacher.step_logits(home_obs, teacher_memory)
+
+        player_function_call, player_action, player_logits, player_new_memory = player_step
+        opponent_function_call, opponent_action, opponent_logits, opponent_new_memory = opponent_step
+        teacher_function_call, teacher_action, teacher_logits, teacher_new_memory = teacher_step
+
+        [home_obs, away_obs] = env.step([player_function_call, opponent_function_call])
+        is_final = home_obs.last()
+
+        player_memory = tuple(h.detach() for h in player_new_memory)
+        opponent_memory = tuple(h.detach() for h in opponent_new_memory)
+        teacher_memory = tuple(h.detach() for h in teacher_new_memory)
+
+    return steps / (time.time() - start_time)
+
+
+def test(step_num=4):
+    from pysc2.lib import features, point
+    from pysc2.env.sc2_env import AgentInterfaceFormat
+
+    from alphastarmini.core.rl.alphastar_agent import AlphaStarAgent
+    from alphastarmini.core.sl.load_pickle import random_pickle_step
+    from alphastarmini.lib.hyper_parameters import AlphaStar_Agent_Interface_Format_Params as AAIFP
+
+    def recorded_obs(seed):
+        obs = random_pickle_step(seed=seed)
+        obs.pop('func_call')
+        return obs
+
+    feat = features.Features(AgentInterfaceFormat(**AAIFP._asdict()), map_size=point.Point(64, 64))
+    action_spec = feat.action_spec()
+
+    player = AlphaStarAgent(name='player')
+    teacher = AlphaStarAgent(name='teacher')
+    for a in (player, teacher):
+        a.setup(None, action_spec)
+        a.agent_nn.model.eval()
+
+    # self-play, the opponent shares the model with the player
+    opponent = player
+
+    home_obs = recorded_obs(seed=0)
+    away_obs = recorded_obs(seed=1)
+    player_memory = player.initial_state()
+    teacher_memory = tuple(torch.randn_like(h) for h in teacher.initial_state())
+
+    inference = ActorInference()
+    with torch.no_grad():
+        results = inference.step([player, opponent, teacher], [home_obs, away_obs, home_obs],
+                                 [player_memory, player_memory, teacher_memory])
+        singles = [player.step_logits(home_obs, player_memory), opponent.step_logits(away_obs, player_memory),
+                   teacher.step_logits(home_obs, teacher_memory)]
+    print('inference:', inference)
+    assert inference.preprocess_num == 2 and inference.forward_num == 2
+
+    for (_, _, logits, new_state), (_, _, single_logits, single_new_state) in zip(results, singles):
+        # the later heads depend on the sampled action type, so only the first head is compared
+        assert torch.allclose(logits.action_type, single_logits.action_type, atol=1e-5)
+        for h, single_h in zip(new_state, single_new_state):
+            assert torch.allclose(h, single_h, atol=1e-5)
+
+    # benchmark test
+    env = RecordedObsEnv([recorded_obs(seed=i) for i in range(step_num)],
+                         [recorded_obs(seed=i + step_num) for i in range(step_num)])
+    with torch.no_grad():
+        steps_per_second = run_actor_loop(player, opponent, teacher, env)
+        print("step_logits steps/sec: {:.3f}".format(steps_per_second))
+
+        steps_per_second = run_actor_loop(player, opponent, teacher, env, inference=ActorInference())
+        print("ActorInference steps/sec: {:.3f}".format(steps_per_second))
@@ -14,8 +14,10 @@ from torch.optim import Adam
 from pysc2.env.sc2_env import SC2Env, AgentInterfaceFormat, Agent, Race
 
 from alphastarmini.core.rl.env_utils import SC2Environment, get_env_outcome
-from alphastarmini.core.rl.rl_utils import Trajectory, get_supervised_agent
+from alphastarmini.core.rl.rl_utils import Trajectory, CompactTrajectory, get_supervised_agent
 from alphastarmini.core.rl.learner import Learner
+from alphastarmini.core.rl.actor_inference import ActorInference
+from alphastarmini.core.rl.parameter_store import ParameterPuller
 from alphastarmini.core.rl import rl_utils as U
 
 from alphastarmini.lib import utils as L
@@ -28,14 +30,6 @@ from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
 from alphastarmini.lib.hyper_parameters import Training_Races as TR
 from alphastarmini.lib.hyper_parameters import AlphaStar_Agent_Interface_Format_Params as AAIFP
 
-# for replay reward
-import os
-import random
-from pysc2.lib import point
-from pysc2.lib import features as F
-from pysc2 import run_configs
-from s2clientprotocol import sc2api_pb2 as sc_pb
-
 
 __author__ = "Ruo-Ze Liu"
 
@@ -63,18 +57,25 @@ class ActorLoopPlusZ:
     def __init__(self, player, coordinator, max_time_for_training = 60 * 60 * 24,
                  max_time_per_one_opponent=60 * 60 * 2,
                  max_frames_per_episode=22.4 * 60 * 15, max_frames=22.4 * 60 * 60 * 24, 
-                 max_episodes=MAX_EPISODES, use_replay_expert_reward=True,
-                 replay_path="data/Replays/filtered_replays_1/", replay_version='3.16.1'):
+                 max_episodes=MAX_EPISODES, use_replay_expert_reward=True, z_library=None,
+                 inference_service=None):
 
         self.player = player
         self.player.add_actor(self)
         if ON_GPU:
             self.player.agent.agent_nn.to(DEVICE)
 
-        self.teacher = get_supervised_agent(player.race, model_type="sl")
+        # the actors of the inference service share its teacher of the race, whose forwards are batched
+        teacher_fn = lambda: get_supervised_agent(player.race, model_type="sl")
+        self.teacher = teacher_fn() if inference_service is None else \
+            inference_service.register(('teacher', player.race), teacher_fn)
         if ON_GPU:
             self.teacher.agent_nn.to(DEVICE)
 
+        # runs the forwards of the player, the opponent and the teacher together,
+        # or sends them to the inference service shared by the actors
+        self.inference = ActorInference() if inference_service is None else inference_service.client()
+
         # below code is not used because we only can create the env when we know the opponnet information (e.g., race)
         # AlphaStar: self.environment = SC2Environment()
 
@@ -85,15 +86,22 @@ class ActorLoopPlusZ:
         self.max_frames = max_frames
         self.max_episodes = max_episodes
 
+        # the inference runs a local copy of the agent of the player, which pulls the parameters the learner
+        # publishes at the episode and unroll boundaries, instead of reading the agent the learner updates,
+        # the actors of the inference service share one copy
+        self.puller = ParameterPuller(player) if inference_service is None else inference_service.puller(player)
+        self.agent = self.puller.agent
+
         self.thread = threading.Thread(target=self.run, args=())
         self.thread.daemon = True                            # Daemonize thread
 
         self.is_running = True
         self.is_start = False
 
+        # the expert z-statistics are drawn from the ZLibrary (shared by the actors), instead of
+        # running a replay in lockstep with the game, if None, the player's own statistics are used
         self.use_replay_expert_reward = use_replay_expert_reward
-        self.replay_path = replay_path
-        self.replay_version = replay_version
+        self.z_library = z_library if use_replay_expert_reward else None
 
     def start(self):
         self.is_start = True
@@ -113,10 +121,10 @@ class ActorLoopPlusZ:
 
             while time() - start_time < self.max_time_for_training:
                 self.opponent, _ = self.player.get_match()
-                agents = [self.player, self.opponent]
 
-                # if self.use_replay_expert_reward:
-                run_config = run_configs.get(version=self.replay_version)  # the replays released by blizzard are all 3.16.1 version
+                # in the self-play, the opponent also runs the local copy
+                opponent_agent = self.agent if self.opponent is self.player else self.opponent.agent
+                agents = [self.agent, opponent_agent]
 
                 with self.create_env(self.player, self.opponent) as env:
 
@@ -127,7 +135,7 @@ class ActorLoopPlusZ:
                     for agent, obs_spec, act_spec in zip(agents, observation_spec, action_spec):
                         agent.setup(obs_spec, act_spec)
 
-                    self.teacher.setup(self.player.agent.obs_spec, self.player.agent.action_spec)
+                    self.teacher.setup(self.agent.obs_spec, self.agent.action_spec)
 
                     print('player:', self.player) if debug else None
                     print('opponent:', self.opponent) if debug else None
@@ -146,234 +154,179 @@ class ActorLoopPlusZ:
                         total_episodes += 1
                         print("total_episodes:", total_episodes)
 
+                        policy_version = self.puller.pull()
+
                         timesteps = env.reset()
                         for a in agents:
                             a.reset()
 
-                        # check the condition that the replay is over but the game is not
-                        with run_config.start(full_screen=False) as controller:
-                            # here we must use the with ... as ... statement, or it will cause an error
-                            #controller = run_config.start(full_screen=False)
-
-                            # start replay reward
-                            raw_affects_selection = False
-                            raw_crop_to_playable_area = False
-                            screen_resolution = point.Point(64, 64)
-                            minimap_resolution = point.Point(64, 64)
-                            camera_width = 24
-
-                            interface = sc_pb.InterfaceOptions(
-                                raw=True, 
-                                score=True,
-                                # Omit to disable.
-                                feature_layer=sc_pb.SpatialCameraSetup(width=camera_width),  
-                                # Omit to disable.
-                                render=None,  
-                                # By default cloaked units are completely hidden. This shows some details.
-                                show_cloaked=False, 
-                                # By default burrowed units are completely hidden. This shows some details for those that produce a shadow.
-                                show_burrowed_shadows=False,       
-                                # Return placeholder units (buildings to be constructed), both for raw and feature layers.
-                                show_placeholders=False, 
-                                # see below
-                                raw_affects_selection=raw_affects_selection,
-                                # see below
-                                raw_crop_to_playable_area=raw_crop_to_playable_area
+                        # the z-statistics of a replay, which are drawn from the library instead of running the replay
+                        z_timeline = self.z_library.sample() if self.z_library is not None else None
+                        print('z timeline:', z_timeline) if debug else None
+
+                        [home_obs, away_obs] = timesteps
+                        is_final = home_obs.last()
+
+                        player_memory = self.agent.initial_state()
+                        opponent_memory = opponent_agent.initial_state()
+                        teacher_memory = self.teacher.initial_state()
+
+                        # initial build order
+                        player_tracker = L.BuildOrderTracker(home_obs.observation)
+                        player_bo = player_tracker.build_order
+
+                        episode_frames = 0
+                        # default outcome is 0 (means draw)
+                        outcome = 0
+
+                        # in one episode (game)
+                        # 
+                        start_episode_time = time()  # in seconds.
+                        print("start_episode_time before is_final:", strftime("%Y-%m-%d %H:%M:%S", localtime(start_episode_time)))
+
+                        while not is_final:
+                            total_frames += 1
+                            episode_frames += 1
+
+                            # run_loop: actions = [agent.step(timestep) for agent, timestep in zip(agents, timesteps)]
+                            # note: home_obs is preprocessed only once for the player and the teacher
+                            agent_steps = self.inference.step([self.agent, opponent_agent, self.teacher], 
+                                                              [home_obs, away_obs, home_obs], 
+                                                              [player_memory, opponent_memory, teacher_memory])
+                            player_step, opponent_step, teacher_step = agent_steps
+
+                            player_function_call, player_action, player_logits, player_new_memory = player_step
+                            print("player_function_call:", player_function_call) if debug else None
+
+                            opponent_function_call, opponent_action, opponent_logits, opponent_new_memory = opponent_step
+
+                            # Q: how to do it ?
+                            # teacher_logits = self.teacher(home_obs, player_action, teacher_memory)
+                            # may change implemention of teacher_logits
+                            teacher_function_call, teacher_action, teacher_logits, teacher_new_memory = teacher_step
+                            print("teacher_function_call:", teacher_function_call) if debug else None
+
+                            env_actions = [player_function_call, opponent_function_call]
+
+                            player_action_spec = action_spec[0]
+                            action_masks = U.get_mask(player_action, player_action_spec)
+                            z = None
+
+                            timesteps = env.step(env_actions)
+                            [home_next_obs, away_next_obs] = timesteps
+
+                            # print the observation of the agent
+                            # print("home_obs.observation:", home_obs.observation)
+
+                            reward = home_next_obs.reward
+                            print("reward: ", reward) if debug else None
+                            is_final = home_next_obs.last()
+
+                            # calculate the unit counts of bag (of home_obs, before the tracker steps to home_next_obs)
+                            player_ucb = player_tracker.unit_counts_list()
+                            print("player unit count of bow:", sum(player_ucb)) if debug else None
+
+                            # calculate the build order
+                            player_bo = player_tracker.update(home_next_obs.observation)
+                            print("player build order:", player_bo) if debug else None
+
+                            game_loop = home_obs.observation.game_loop[0]
+                            print("game_loop", game_loop)
+
+                            # start replay_reward
+                            # the replay is at the same game loop as the game, the unit counts are of the replay observation of home_obs,
+                            # and the build order is of the one of home_next_obs, the same as the player
+                            if z_timeline is not None:
+                                replay_ucb = z_timeline.unit_counts_list(game_loop)
+                                replay_bo = z_timeline.build_order(home_next_obs.observation.game_loop[0])
+                            else:
+                                replay_ucb, replay_bo = player_ucb, player_bo
+                            print("replay unit count of bow:", sum(replay_ucb)) if debug else None
+                            print("replay build order:", replay_bo) if debug else None
+                            # end replay_reward
+
+                            # the states preprocessed in the inference are sent, instead of the observations
+                            home_state, away_state, _ = self.inference.states
+                            compact_inputs = U.get_compact_inputs(home_state, away_state, build_order=player_bo)
+                            state, baseline_state, baseline_opponent_state = compact_inputs
+
+                            # note, original AlphaStar pseudo-code has some mistakes, we modified 
+                            # them here
+                            traj_step = CompactTrajectory(
+                                state=state,
+                                baseline_state=baseline_state,
+                                baseline_opponent_state=baseline_opponent_state,
+                                memory=player_memory,
+                                z=z,
+                                masks=action_masks,
+                                action=player_action,
+                                behavior_logits=player_logits,
+                                teacher_logits=teacher_logits,      
+                                is_final=is_final,                                          
+                                reward=reward,
+                                build_order=player_bo,
+                                z_build_order=replay_bo,  # we change it to the sampled build order
+                                unit_counts=player_ucb,
+                                z_unit_counts=replay_ucb,  # we change it to the sampled unit counts
+                                game_loop=game_loop,
+                                policy_version=policy_version,
                             )
+                            trajectory.append(traj_step)
 
-                            screen_resolution.assign_to(interface.feature_layer.resolution)
-                            minimap_resolution.assign_to(interface.feature_layer.minimap_resolution)
+                            player_memory = tuple(h.detach() for h in player_new_memory)
+                            opponent_memory = tuple(h.detach() for h in opponent_new_memory)
 
-                            replay_files = os.listdir(self.replay_path)
+                            teacher_memory = tuple(h.detach() for h in teacher_new_memory)
 
-                            # random select a replay file from the candidate replays
-                            random.shuffle(replay_files)
+                            home_obs = home_next_obs
+                            away_obs = away_next_obs
 
-                            replay_path = self.replay_path + replay_files[0]
-                            print('replay_path:', replay_path)
-                            replay_data = run_config.replay_data(replay_path)
+                            if is_final:
+                                outcome = reward
+                                print("outcome: ", outcome) if debug else None
+                                results[outcome + 1] += 1
 
-                            start_replay = sc_pb.RequestStartReplay(
-                                replay_data=replay_data,
-                                options=interface,
-                                disable_fog=False,  # FLAGS.disable_fog
-                                observed_player_id=1,  # FLAGS.observed_player
-                                map_data=None,
-                                realtime=False
-                            )
+                            if len(trajectory) >= AHP.sequence_length:                    
+                                trajectories = U.stack_namedtuple(trajectory)
 
-                            controller.start_replay(start_replay)
-                            feat = F.features_from_game_info(game_info=controller.game_info(), 
-                                                             use_feature_units=True, use_raw_units=True,
-                                                             use_unit_counts=True, use_raw_actions=True,
-                                                             show_cloaked=True, show_burrowed_shadows=True, 
-                                                             show_placeholders=True) 
-                            replay_obs = None
-                            replay_bo = []
-
-                            replay_o = controller.observe()
-                            replay_obs = feat.transform_obs(replay_o)
-                            # end replay reward
-
-                            [home_obs, away_obs] = timesteps
-                            is_final = home_obs.last()
-
-                            player_memory = self.player.agent.initial_state()
-                            opponent_memory = self.opponent.agent.initial_state()
-                            teacher_memory = self.teacher.initial_state()
-
-                            # initial build order
-                            player_bo = []
-
-                            episode_frames = 0
-                            # default outcome is 0 (means draw)
-                            outcome = 0
-
-                            # in one episode (game)
-                            # 
-                            start_episode_time = time()  # in seconds.
-                            print("start_episode_time before is_final:", strftime("%Y-%m-%d %H:%M:%S", localtime(start_episode_time)))
-
-                            while not is_final:
-                                total_frames += 1
-                                episode_frames += 1
-
-                                # run_loop: actions = [agent.step(timestep) for agent, timestep in zip(agents, timesteps)]
-                                player_step = self.player.agent.step_logits(home_obs, player_memory)
-                                player_function_call, player_action, player_logits, player_new_memory = player_step
-                                print("player_function_call:", player_function_call) if debug else None
-
-                                opponent_step = self.opponent.agent.step_logits(away_obs, opponent_memory)
-                                opponent_function_call, opponent_action, opponent_logits, opponent_new_memory = opponent_step
-
-                                # Q: how to do it ?
-                                # teacher_logits = self.teacher(home_obs, player_action, teacher_memory)
-                                # may change implemention of teacher_logits
-                                teacher_step = self.teacher.step_logits(home_obs, teacher_memory)
-                                teacher_function_call, teacher_action, teacher_logits, teacher_new_memory = teacher_step
-                                print("teacher_function_call:", teacher_function_call) if debug else None
-
-                                env_actions = [player_function_call, opponent_function_call]
-
-                                player_action_spec = action_spec[0]
-                                action_masks = U.get_mask(player_action, player_action_spec)
-                                z = None
-
-                                timesteps = env.step(env_actions)
-                                [home_next_obs, away_next_obs] = timesteps
-
-                                # print the observation of the agent
-                                # print("home_obs.observation:", home_obs.observation)
-
-                                reward = home_next_obs.reward
-                                print("reward: ", reward) if debug else None
-                                is_final = home_next_obs.last()
-
-                                # calculate the build order
-                                player_bo = L.calculate_build_order(player_bo, home_obs.observation, home_next_obs.observation)
-                                print("player build order:", player_bo) if debug else None
-
-                                # calculate the unit counts of bag
-                                player_ucb = L.calculate_unit_counts_bow(home_obs.observation).reshape(-1).numpy().tolist()
-                                print("player unit count of bow:", sum(player_ucb)) if debug else None
-
-                                # start replay_reward
-                                # note the controller should step the same steps as with the rl actor (keep the time as the same)
-                                controller.step(STEP_MUL)
-
-                                replay_next_o = controller.observe()
-                                replay_next_obs = feat.transform_obs(replay_next_o)
-
-                                # calculate the build order for replay
-                                replay_bo = L.calculate_build_order(replay_bo, replay_obs, replay_next_obs)
-                                print("replay build order:", player_bo) if debug else None
-
-                                # calculate the unit counts of bag for replay
-                                replay_ucb = L.calculate_unit_counts_bow(replay_obs).reshape(-1).numpy().tolist()
-                                print("replay unit count of bow:", sum(replay_ucb)) if debug else None            
-                                # end replay_reward
-
-                                game_loop = home_obs.observation.game_loop[0]
-                                print("game_loop", game_loop)
-
-                                # note, original AlphaStar pseudo-code has some mistakes, we modified 
-                                # them here
-                                traj_step = Trajectory(
-                                    observation=home_obs.observation,
-                                    opponent_observation=away_obs.observation,
-                                    memory=player_memory,
-                                    z=z,
-                                    masks=action_masks,
-                                    action=player_action,
-                                    behavior_logits=player_logits,
-                                    teacher_logits=teacher_logits,      
-                                    is_final=is_final,                                          
-                                    reward=reward,
-                                    build_order=player_bo,
-                                    z_build_order=replay_bo,  # we change it to the sampled build order
-                                    unit_counts=player_ucb,
-                                    z_unit_counts=replay_ucb,  # we change it to the sampled unit counts
-                                    game_loop=game_loop,
-                                )
-                                trajectory.append(traj_step)
-
-                                player_memory = tuple(h.detach() for h in player_new_memory)
-                                opponent_memory = tuple(h.detach() for h in opponent_new_memory)
-
-                                teacher_memory = tuple(h.detach() for h in teacher_new_memory)
-
-                                home_obs = home_next_obs
-                                away_obs = away_next_obs
-
-                                # for replay reward
-                                replay_obs = replay_next_obs
-                                replay_o = replay_next_o
-
-                                if is_final:
-                                    outcome = reward
-                                    print("outcome: ", outcome) if debug else None
-                                    results[outcome + 1] += 1
-
-                                if len(trajectory) >= AHP.sequence_length:                    
-                                    trajectories = U.stack_namedtuple(trajectory)
-
-                                    if self.player.learner is not None:
-                                        if self.player.learner.is_running:
-                                            print("Learner send_trajectory!")
-                                            self.player.learner.send_trajectory(trajectories)
-                                            trajectory = []
-                                        else:
-                                            print("Learner stops!")
-
-                                            print("Actor also stops!")
-                                            return
-
-                                # use max_frames to end the loop
-                                # whether to stop the run
-                                if self.max_frames and total_frames >= self.max_frames:
-                                    print("Beyond the max_frames, return!")
-                                    return
-
-                                # use max_frames_per_episode to end the episode
-                                if self.max_frames_per_episode and episode_frames >= self.max_frames_per_episode:
-                                    print("Beyond the max_frames_per_episode, break!")
-                                    break
-
-                                # end of replay
-                                if replay_o.player_result:  
-                                    print(replay_o.player_result)
-                                    break
-
-                            self.coordinator.send_outcome(self.player, self.opponent, outcome)
+                                if self.player.learner is not None:
+                                    if self.player.learner.is_running:
+                                        print("Learner send_trajectory!")
+                                        self.player.learner.send_trajectory(trajectories)
+                                        trajectory = []
 
-                            # use max_frames_per_episode to end the episode
-                            if self.max_episodes and total_episodes >= self.max_episodes:
-                                print("Beyond the max_episodes, return!")
-                                print("results: ", results) if debug else None
-                                print("win rate: ", results[2] / (1e-8 + sum(results))) if debug else None
+                                        policy_version = self.puller.pull()
+                                    else:
+                                        print("Learner stops!")
+
+                                        print("Actor also stops!")
+                                        return
+
+                            # use max_frames to end the loop
+                            # whether to stop the run
+                            if self.max_frames and total_frames >= self.max_frames:
+                                print("Beyond the max_frames, return!")
                                 return
 
-                    # close the replays
+                            # use max_frames_per_episode to end the episode
+                            if self.max_frames_per_episode and episode_frames >= self.max_frames_per_episode:
+                                print("Beyond the max_frames_per_episode, break!")
+                                break
+
+                            # end of replay
+                            if z_timeline is not None and game_loop >= z_timeline.max_game_loop:
+                                print("end of replay:", z_timeline.name)
+                                break
+
+                        self.coordinator.send_outcome(self.player, self.opponent, outcome)
+
+                        # use max_frames_per_episode to end the episode
+                        if self.max_episodes and total_episodes >= self.max_episodes:
+                            print("Beyond the max_episodes, return!")
+                            print("results: ", results) if debug else None
+                            print("win rate: ", results[2] / (1e-8 + sum(results))) if debug else None
+                            return
+
 
         except Exception as e:
             print("ActorLoop.run() Exception cause return, Detials of the Exception:", e)
@@ -0,0 +1,645 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" The actors in the processes, which send the trajectories to the learner through the shared memory slots"
+
+import queue
+import threading
+import traceback
+import collections
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from time import time
+
+import numpy as np
+
+import torch
+
+from absl import flags
+
+from alphastarmini.core.rl.actor import ActorLoop
+from alphastarmini.core.rl.alphastar_agent import AlphaStarAgent
+from alphastarmini.core.rl.array_packing import flatten, unflatten, layout, write_arrays, read_arrays
+from alphastarmini.core.rl.parameter_store import SharedParameterStore
+from alphastarmini.core.ma.player import Historical
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+# the processes do not inherit the threads (the learner) and the torch state of the main process
+START_METHOD = 'spawn'
+
+# the bytes of each trajectory slot, a trajectory larger than it raises an error
+SLOT_BYTES = 16 * 1024 * 1024
+
+# the actor processes are the parallelism, so each one uses one torch thread
+TORCH_THREADS = 1
+
+# seconds, the waits of the actors and the pool threads check the stop in this interval
+WAIT_TIMEOUT = 1.
+
+# the most shared memory blocks of the weights of the opponents, the least recently matched one
+# which is not the current opponent of an actor is unlinked (at least one more than the actors are kept)
+MAX_OPPONENT_STORES = 8
+
+# the messages from the pool to the actors (control channel)
+START = 'start'
+STOP = 'stop'
+MATCH = 'match'  # the reply of a match request: the key of the opponent (None for the player itself), race, parameters
+
+# the messages from the actors to the pool
+READY = 'ready'
+OUTCOME = 'outcome'
+DONE = 'done'
+
+
+class SharedTrajectoryBuffer(object):
+    '''
+    The preallocated slots in one shared memory block, which the actor processes write the trajectories into,
+    only the slot index and the small structure of a trajectory go through the queue instead of the pickled arrays.
+    A slot is free again after the learner side copies the trajectory out, so the actors wait for a free slot
+    when the learner falls behind, the same backpressure as the blocking TrajectoryQueue.
+    '''
+
+    def __init__(self, slot_num, slot_bytes=SLOT_BYTES, ctx=None):
+        super(SharedTrajectoryBuffer, self).__init__()
+        ctx = ctx if ctx is not None else mp.get_context(START_METHOD)
+
+        self.slot_num = slot_num
+        self.slot_bytes = slot_bytes
+        self.shm = shared_memory.SharedMemory(create=True, size=slot_num * slot_bytes)
+        self.name = self.shm.name
+
+        self.free_slots = ctx.Queue()
+        for slot in range(slot_num):
+            self.free_slots.put(slot)
+        self.full_slots = ctx.Queue()
+
+        # metrics of the side which gets
+        self.get_num = 0
+        self.get_bytes = 0
+
+    def __getstate__(self):
+        # only through the process arguments, the processes attach the block by the name
+        state = self.__dict__.copy()
+        state['shm'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=self.name)
+
+    def put(self, trajectory, timeout=None):
+        """Returns True if the trajectory is in a slot, False on timeout (no free slot)."""
+        arrays = []
+        structure = flatten(trajectory, arrays)
+        specs, nbytes = layout(arrays)
+        if nbytes > self.slot_bytes:
+            raise ValueError('the trajectory of %d bytes is larger than the slot of %d bytes' % (nbytes, self.slot_bytes))
+
+        try:
+            slot = self.free_slots.get(timeout=timeout)
+        except queue.Empty:
+            return False
+
+        write_arrays(self.shm.buf, slot * self.slot_bytes, arrays, specs)
+        self.full_slots.put((slot, structure, specs))
+
+        return True
+
+    def get(self, timeout=None):
+        """Returns the next trajectory, None on timeout."""
+        try:
+            slot, structure, specs = self.full_slots.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        arrays = read_arrays(self.shm.buf, slot * self.slot_bytes, specs)
+        self.free_slots.put(slot)
+
+        self.get_num += 1
+        self.get_bytes += sum(a.nbytes for a in arrays)
+
+        return unflatten(structure, arrays)
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+    def __str__(self):
+        return "slots: %d x %d bytes, get: %d, bytes: %d" % (self.slot_num, self.slot_bytes,
+                                                           self.get_num, self.get_bytes)
+
+
+class ActorClient(object):
+    '''
+    The actor process side of the pool: the control channel, the trajectory slots and the parameters.
+    It takes the places of the learner and the coordinator of the ActorLoop in the process,
+    the ParameterPuller of the actor pulls the parameters of the player from the shared store.
+    '''
+
+    def __init__(self, actor_id, buffer, parameters, control_queue, event_queue):
+        super(ActorClient, self).__init__()
+        self.actor_id = actor_id
+        self.buffer = buffer
+        self.control_queue = control_queue
+        self.event_queue = event_queue
+
+        # the learner interface for the ActorLoop
+        self.is_running = True
+        self.parameters = parameters
+
+        self.replies = []
+
+        # the opponent which is not the player, only the last one is kept
+        self.opponent_key = None
+        self.opponent_agent = None
+        self.opponent_parameters = None
+        self.opponent_version = -1
+
+    def handle(self, message):
+        kind = message[0]
+        if kind == STOP:
+            self.is_running = False
+        else:
+            self.replies.append(message)
+
+    def poll(self):
+        while True:
+            try:
+                self.handle(self.control_queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def wait_for(self, kind):
+        """Returns the reply of the kind, None if stopped before it."""
+        while True:
+            for i, message in enumerate(self.replies):
+                if message[0] == kind:
+                    return self.replies.pop(i)
+            if not self.is_running:
+                return None
+            try:
+                self.handle(self.control_queue.get(timeout=WAIT_TIMEOUT))
+            except queue.Empty:
+                pass
+
+    def send_trajectory(self, trajectory):
+        while self.is_running:
+            is_put = self.buffer.put(trajectory, timeout=WAIT_TIMEOUT)
+            self.poll()
+            if is_put:
+                return True
+        return False
+
+    def get_match(self, player):
+        self.poll()
+        self.event_queue.put((MATCH, self.actor_id))
+        reply = self.wait_for(MATCH)
+        if reply is None:
+            raise RuntimeError('the actor %d is stopped while waiting for a match' % self.actor_id)
+
+        _, key, race, parameters = reply
+        if key is None:
+            return player, False
+
+        if key != self.opponent_key or race != self.opponent_agent.race:
+            if self.opponent_parameters is not None:
+                self.opponent_parameters.close()
+            self.opponent_key, self.opponent_parameters = key, parameters
+            self.opponent_agent = AlphaStarAgent(name="Opponent", race=race)
+            self.opponent_version = -1
+        else:
+            parameters.close()
+
+        if self.opponent_parameters.version != self.opponent_version:
+            self.opponent_version, state_dict = self.opponent_parameters.load()
+            self.opponent_agent.set_weights(state_dict)
+
+        return ProcessPlayer(key, race, self.opponent_agent, None), True
+
+    def send_outcome(self, home_player, away_player, outcome):
+        self.event_queue.put((OUTCOME, self.actor_id, away_player.key, outcome))
+
+    def close(self):
+        self.buffer.close()
+        self.parameters.close()
+        if self.opponent_parameters is not None:
+            self.opponent_parameters.close()
+
+
+class ProcessPlayer(object):
+    '''
+    The player in the actor process, with the local copy of the agent,
+    its match and learner are served by the pool in the main process.
+    '''
+
+    def __init__(self, key, race, agent, client):
+        super(ProcessPlayer, self).__init__()
+        self.key = key
+        self.name = agent.name
+        self._race = race
+        self.agent = agent
+        self.client = client
+        self._actors = []
+
+    @property
+    def race(self):
+        return self._race
+
+    @property
+    def learner(self):
+        return self.client
+
+    def add_actor(self, actor):
+        self._actors.append(actor)
+
+    def get_match(self):
+        return self.client.get_match(self)
+
+    def setup(self, obs_spec, action_spec):
+        self.agent.setup(obs_spec, action_spec)
+
+    def reset(self):
+        self.agent.reset()
+
+
+class ProcessCoordinator(object):
+
+    def __init__(self, client):
+        super(ProcessCoordinator, self).__init__()
+        self.client = client
+
+    def send_outcome(self, home_player, away_player, outcome):
+        self.client.send_outcome(home_player, away_player, outcome)
+
+
+def run_actor_process(actor_id, actor_class, race, buffer, parameters, control_queue, event_queue,
+                      torch_threads, actor_kwargs):
+    torch.set_num_threads(torch_threads)
+
+    # the processes do not get the flags parsed in the main process, the env uses their defaults
+    if not flags.FLAGS.is_parsed():
+        flags.FLAGS.mark_as_parsed()
+
+    client = ActorClient(actor_id, buffer, parameters, control_queue, event_queue)
+    frames, elapsed_time, error = 0, 0., None
+    try:
+        # the actor pulls the published parameters into its copy of the agent
+        player = ProcessPlayer(None, race, AlphaStarAgent(name="Actor", race=race), client)
+        actor = actor_class(player, ProcessCoordinator(client), **actor_kwargs)
+
+        event_queue.put((READY, actor_id))
+        if client.wait_for(START) is not None:
+            start_time = time()
+            actor.run()
+            elapsed_time = time() - start_time
+            frames = actor.inference.step_num
+
+    except Exception:
+        error = traceback.format_exc()
+
+    finally:
+        event_queue.put((DONE, actor_id, frames, elapsed_time, error))
+        client.close()
+
+
+class ActorProcess(object):
+    # the handle of an actor process in the main process, with the is_start and is_running the learner checks,
+    # is_running is False after the trajectories of all the actors are received
+
+    def __init__(self, actor_id, process, control_queue):
+        super(ActorProcess, self).__init__()
+        self.actor_id = actor_id
+        self.process = process
+        self.control_queue = control_queue
+
+        self.is_start = False
+        self.is_running = False
+        self.is_ready = False
+        self.is_done = False
+        self.frames = 0
+        self.elapsed_time = 0.
+        self.error = None
+
+        # the key of the last opponent (not the player itself), whose parameters the actor has attached
+        self.opponent_key = None
+
+
+class ActorPool(object):
+    '''
+    Runs the actor loops of a player in the processes, as the threads of the actors are serialized by the GIL.
+    The trajectories come through the SharedTrajectoryBuffer to the learner of the player,
+    the control channel of each actor handles the start, stop and the matches, the parameters the learner
+    publishes are mirrored to a SharedParameterStore with the same versions, which the actors pull,
+    and the outcomes are sent to the coordinator as the actors in the threads do.
+    '''
+
+    def __init__(self, player, coordinator, actor_num, actor_class=ActorLoop, slot_num=None,
+                 slot_bytes=SLOT_BYTES, torch_threads=TORCH_THREADS, start_method=START_METHOD,
+                 max_opponents=MAX_OPPONENT_STORES, **actor_kwargs):
+        super(ActorPool, self).__init__()
+        self.ctx = mp.get_context(start_method)
+        self.player = player
+        self.coordinator = coordinator
+
+        self.buffer = SharedTrajectoryBuffer(slot_num if slot_num else 2 * actor_num, slot_bytes, self.ctx)
+        self.parameters = SharedParameterStore(player.agent.get_weights())
+        self.parameters_version = 0
+
+        # the LRU of the key (id) of the opponents -> SharedParameterStore, and the key -> player of the outcomes
+        self.opponents = collections.OrderedDict()
+        self.opponent_players = {}
+        self.max_opponents = max(max_opponents, actor_num + 1)
+
+        self.event_queue = self.ctx.Queue()
+        self.actors = []
+        for actor_id in range(actor_num):
+            control_queue = self.ctx.Queue()
+            process = self.ctx.Process(target=run_actor_process,
+                                       args=(actor_id, actor_class, player.race, self.buffer, self.parameters,
+                                             control_queue, self.event_queue, torch_threads, actor_kwargs))
+            process.daemon = True
+            actor = ActorProcess(actor_id, process, control_queue)
+            self.actors.append(actor)
+            self.player.add_actor(actor)
+
+        # the thread serves the events, and ends after all the actors are done
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.receive_thread = threading.Thread(target=self.receive, args=())
+        self.receive_thread.daemon = True
+
+        self.is_running = False
+        self.start_time = None
+        self.results = [0, 0, 0]
+
+    def start(self):
+        self.is_running = True
+        for actor in self.actors:
+            actor.is_start = True
+            actor.is_running = True
+            actor.process.start()
+        self.thread.start()
+        self.receive_thread.start()
+
+    def stop(self):
+        for actor in self.actors:
+            actor.control_queue.put((STOP,))
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    def publish_parameters(self):
+        # mirrors the newer version the learner publishes, the actors pull it at their next episode or unroll
+        store = getattr(self.player.learner, 'parameters', None)
+        if store is not None and store.version > self.parameters_version:
+            version, state_dict = store.load()
+            self.parameters_version = self.parameters.publish(state_dict, version=version)
+        return self.parameters_version
+
+    def match(self, actor):
+        opponent, _ = self.player.get_match()
+        if opponent is self.player:
+            actor.control_queue.put((MATCH, None, None, None))
+            return
+
+        key = id(opponent)
+        if key not in self.opponents:
+            self.opponents[key] = SharedParameterStore(opponent.agent.get_weights())
+            self.opponent_players[key] = opponent
+        elif not isinstance(opponent, Historical):
+            # the weights of a learning player change, the historical ones are frozen
+            self.opponents[key].publish(opponent.agent.get_weights())
+        self.opponents.move_to_end(key)
+        actor.opponent_key = key
+
+        actor.control_queue.put((MATCH, key, opponent.race, self.opponents[key]))
+        self.evict_opponents()
+
+    def evict_opponents(self):
+        # the actors which have attached a block keep it mapped after it is unlinked, but the current opponent
+        # of an actor is kept, as the actor reuses its block when the same opponent is matched again
+        in_use = set(actor.opponent_key for actor in self.actors)
+        for key in list(self.opponents):
+            if len(self.opponents) <= self.max_opponents:
+                break
+            if key not in in_use:
+                parameters = self.opponents.pop(key)
+                parameters.close()
+                parameters.unlink()
+
+    def handle(self, event):
+        kind, actor = event[0], self.actors[event[1]]
+        if kind == READY:
+            actor.is_ready = True
+            if all(a.is_ready or a.is_done for a in self.actors):
+                # starts together, so the frames per second is of all the actors
+                self.start_time = time()
+                for a in self.actors:
+                    a.control_queue.put((START,))
+        elif kind == MATCH:
+            self.match(actor)
+        elif kind == OUTCOME:
+            _, _, key, outcome = event
+            opponent = self.player if key is None else self.opponent_players[key]
+            self.results[outcome + 1] += 1
+            if self.coordinator is not None:
+                self.coordinator.send_outcome(self.player, opponent, outcome)
+        elif kind == DONE:
+            _, _, actor.frames, actor.elapsed_time, actor.error = event
+            actor.is_done = True
+            if actor.error is not None:
+                print("actor process", actor.actor_id, "error:", actor.error)
+
+    def run(self):
+        try:
+            while not all(actor.is_done for actor in self.actors):
+                # the actor processes which exit without the done event
+                for actor in self.actors:
+                    if not actor.is_done and not actor.process.is_alive() and self.event_queue.empty():
+                        actor.is_done = True
+                        actor.error = 'exit code %s' % actor.process.exitcode
+
+                self.publish_parameters()
+
+                try:
+                    self.handle(self.event_queue.get(timeout=WAIT_TIMEOUT))
+                except queue.Empty:
+                    pass
+
+        except Exception as e:
+            print("ActorPool.run() Exception cause return, Detials of the Exception:", e)
+            print(traceback.format_exc())
+            self.stop()
+
+        finally:
+            for actor in self.actors:
+                actor.process.join(WAIT_TIMEOUT)
+
+            # the trajectories left in the slots are still sent to the learner
+            self.is_running = False
+            self.receive_thread.join()
+            for actor in self.actors:
+                actor.is_running = False
+            self.close()
+
+    def receive(self):
+        # moves the trajectories from the slots to the queue of the learner
+        while True:
+            trajectory = self.buffer.get(timeout=WAIT_TIMEOUT if self.is_running else 0.1)
+            if trajectory is None:
+                if not self.is_running:
+                    return
+            elif self.player.learner is not None:
+                self.player.learner.send_trajectory(trajectory)
+
+    def close(self):
+        self.buffer.close()
+        self.buffer.unlink()
+        for parameters in [self.parameters] + list(self.opponents.values()):
+            parameters.close()
+            parameters.unlink()
+        self.opponents.clear()
+
+    def stats(self):
+        frames = sum(actor.frames for actor in self.actors)
+        elapsed_time = max([actor.elapsed_time for actor in self.actors] + [1e-9])
+        return {'actor_num': len(self.actors),
+                'frames': frames,
+                'elapsed_time': elapsed_time,
+                'fps': frames / elapsed_time,
+                'trajectories': self.buffer.get_num,
+                'parameters_version': self.parameters_version,
+                'results': list(self.results)}
+
+    def __str__(self):
+        s = self.stats()
+        return "actors: %d, frames: %d in %.3fs, %.3f fps, trajectories: %d, parameters version: %d, results: %s" % (
+            s['actor_num'], s['frames'], s['elapsed_time'], s['fps'], s['trajectories'], s['parameters_version'],
+            s['results'])
+
+
+def test(actor_nums=(1, 2), max_frames=24):
+    import functools
+
+    from pysc2.env.sc2_env import Race
+
+    from alphastarmini.core.rl import rl_utils as U
+    from alphastarmini.core.rl.learner import Learner
+    from alphastarmini.core.rl.rl_utils import get_supervised_agent
+    from alphastarmini.core.rl.synthetic_env import SyntheticSC2Env, DEFAULT_PARAMS, STEP_MUL
+    from alphastarmini.core.ma.league import League
+    from alphastarmini.core.ma.coordinator import Coordinator
+
+    # the round trip of a nested trajectory through the slots
+    buffer = SharedTrajectoryBuffer(slot_num=2, slot_bytes=1024 * 1024)
+    trajectory = U.stack_namedtuple([U.Trajectory(observation={'a': np.arange(6).reshape(2, 3)},
+                                                  opponent_observation=None,
+                                                  memory=(torch.randn(1, 1, 4), torch.randn(1, 1, 4)),
+                                                  z=None, is_final=i == 1, masks=torch.ones(3, dtype=torch.bool),
+                                                  action=torch.tensor([i]), behavior_logits=[torch.randn(2)],
+                                                  teacher_logits=[torch.randn(2)], reward=float(i),
+                                                  build_order=[1, 2, i], z_build_order=[], unit_counts=[0] * 5,
+                                                  z_unit_counts=[], game_loop=np.int32(i * 8),
+                                                  policy_version=i) for i in range(2)])
+    for _ in range(3):
+        assert buffer.put(trajectory, timeout=WAIT_TIMEOUT)
+        received = buffer.get(timeout=WAIT_TIMEOUT)
+        for x, y in zip(flatten(trajectory, [])[2], flatten(received, [])[2]):
+            assert x[0] == y[0]
+        assert torch.equal(received.memory[1][0], trajectory.memory[1][0])
+        assert np.array_equal(received.observation[0]['a'], trajectory.observation[0]['a'])
+        assert received.build_order == trajectory.build_order and received.is_final == trajectory.is_final
+        assert received.policy_version == trajectory.policy_version
+    assert buffer.get(timeout=0) is None
+    buffer.close()
+    buffer.unlink()
+
+    # the blocks of the opponents are bounded, the evicted ones are unlinked, the current ones of the actors kept
+    class FakeAgent(object):
+
+        def __init__(self, i):
+            self.model = torch.nn.Linear(4, 4)
+            torch.nn.init.constant_(self.model.weight, float(i))
+
+        def get_weights(self):
+            return self.model.state_dict()
+
+    class FakeHistorical(Historical):
+
+        def __init__(self, i):
+            self._race = Race.terran
+            self.fake_agent = FakeAgent(i)
+
+        @property
+        def agent(self):
+            return self.fake_agent
+
+    class FakePlayer(object):
+
+        def __init__(self, i):
+            self.agent = FakeAgent(i)
+            self.race = Race.protoss
+            self.opponents = [FakeHistorical(j) for j in range(20)]
+            self.draws = iter(self.opponents)
+
+        def get_match(self):
+            return next(self.draws), True
+
+    pool = ActorPool.__new__(ActorPool)
+    pool.player, pool.coordinator, pool.results = FakePlayer(0), None, [0, 0, 0]
+    pool.opponents, pool.opponent_players, pool.max_opponents = collections.OrderedDict(), {}, 4
+    pool.actors = [ActorProcess(i, None, queue.Queue()) for i in range(2)]
+    names = []
+    for i in range(len(pool.player.opponents)):
+        pool.match(pool.actors[i % 2])
+        names.append(pool.actors[i % 2].control_queue.get()[3].name)
+        assert len(pool.opponents) <= pool.max_opponents
+    for actor in pool.actors:
+        assert actor.opponent_key in pool.opponents
+        _, state_dict = pool.opponents[actor.opponent_key].load()
+        assert torch.equal(state_dict['weight'], pool.opponent_players[actor.opponent_key].agent.model.weight)
+    try:
+        shared_memory.SharedMemory(name=names[0])
+        assert False, "the evicted block is not unlinked"
+    except FileNotFoundError:
+        pass
+    # the outcomes against the evicted opponents still find their players
+    pool.handle((OUTCOME, 0, id(pool.player.opponents[0]), 1))
+    assert pool.results == [0, 0, 1]
+    for parameters in pool.opponents.values():
+        parameters.close()
+        parameters.unlink()
+
+    # the frames per second of the actor processes on the synthetic env
+    params = DEFAULT_PARAMS._replace(episode_loops=(STEP_MUL * 10, STEP_MUL * 2))
+    fps_list = []
+    for actor_num in actor_nums:
+        league = League(initial_agents={race: get_supervised_agent(race, restore=False) for race in [Race.protoss]},
+                        main_players=1, main_exploiters=0, league_exploiters=0)
+        coordinator = Coordinator(league)
+        player = league.get_learning_player(0)
+        learner = Learner(player, max_time_for_training=60 * 10)
+
+        pool = ActorPool(player, coordinator, actor_num, max_frames=max_frames,
+                         env_fn=functools.partial(SyntheticSC2Env, params=params))
+        learner.start()
+        pool.start()
+        pool.join()
+        learner.thread.join()
+
+        print("actor pool:", pool)
+        print("learner trajectory queue:", learner.trajectories)
+        assert all(actor.error is None for actor in pool.actors)
+        assert pool.stats()['frames'] == actor_num * max_frames
+        assert pool.buffer.get_num == learner.trajectories.put_num > 0
+        # each trajectory records the version of the parameters the actor pulled
+        assert learner.policy_lag_num == learner.trajectories.put_num
+        fps_list.append(pool.stats()['fps'])
+
+    for actor_num, fps in zip(actor_nums, fps_list):
+        print("actors: %d, fps: %.3f, speedup: %.2fx" % (actor_num, fps, fps / fps_list[0]))
@@ -15,6 +15,8 @@ from pysc2.env import environment as E
 
 from alphastarmini.core.arch.agent import Agent
 from alphastarmini.core.rl.state import MsState
+from alphastarmini.core.rl.compact_state import CompactState
+from alphastarmini.core.rl.trajectory_buffer import TrajectoryBatch
 
 from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
 
@@ -215,12 +217,26 @@ class AlphaStarAgent(RandomAgent):
 
         baseline_state_traj = []
         baseline_state_op_traj = []
-        for i, traj in enumerate(trajectories):
+
+        # the batch of the columns of the compact trajectories, the steps are read as the views of the columns
+        is_columns = isinstance(trajectories, TrajectoryBatch) and 'state' in trajectories.trajectory_type._fields
+        if is_columns:
+            initial_memory_list = trajectories.steps('memory', t=0)
+            state_traj = trajectories.steps('state')
+
+        for i, traj in enumerate(trajectories if not is_columns else []):
             # add the initial memory state          
             memory_seq = traj.memory
             initial_memory = memory_seq[0]
             initial_memory_list.append(initial_memory)
 
+            # the compact trajectory already has the preprocessed states made by the actor
+            if hasattr(traj, 'state'):
+                state_traj.extend(traj.state)
+                baseline_state_traj.extend(traj.baseline_state)
+                baseline_state_op_traj.extend(traj.baseline_opponent_state)
+                continue
+
             # add the state
             home_obs_seq = traj.observation
             bo_seq = traj.build_order
@@ -234,19 +250,24 @@ class AlphaStarAgent(RandomAgent):
                 baseline_state_traj.append(state)
                 baseline_state_op_traj.append(op_state)
 
-        entity_state_list = []
-        statistical_state_list = []
-        map_state_list = []
-        for s in state_traj:
-            entity_state_list.append(s.entity_state)
-            statistical_state_list.append(s.statistical_state)
-            map_state_list.append(s.map_state)
+        if all(isinstance(s, CompactState) for s in state_traj):
+            state_all = CompactState.stack(state_traj)
+        else:
+            state_traj = [s.to_state() if isinstance(s, CompactState) else s for s in state_traj]
+
+            entity_state_list = []
+            statistical_state_list = []
+            map_state_list = []
+            for s in state_traj:
+                entity_state_list.append(s.entity_state)
+                statistical_state_list.append(s.statistical_state)
+                map_state_list.append(s.map_state)
 
-        entity_state_all = torch.cat(entity_state_list, dim=0)
-        statistical_state_all = [torch.cat(statis, dim=0) for statis in zip(*statistical_state_list)]
-        map_state_all = torch.cat(map_state_list, dim=0)
+            entity_state_all = torch.cat(entity_state_list, dim=0)
+            statistical_state_all = [torch.cat(statis, dim=0) for statis in zip(*statistical_state_list)]
+            map_state_all = torch.cat(map_state_list, dim=0)
 
-        state_all = MsState(entity_state=entity_state_all, statistical_state=statistical_state_all, map_state=map_state_all)
+            state_all = MsState(entity_state=entity_state_all, statistical_state=statistical_state_all, map_state=map_state_all)
 
         device = self.agent_nn.device()
         print("unroll device:", device)
@@ -255,9 +276,13 @@ class AlphaStarAgent(RandomAgent):
         # note the bacth size is in the second dim of hidden state
         initial_memory_state = [torch.cat(l, dim=1) for l in zip(*initial_memory_list)]
 
-        baseline_state_all = [torch.cat(statis, dim=0) for statis in zip(*baseline_state_traj)]
+        if is_columns:
+            baseline_state_all = trajectories.cat('baseline_state')
+            baseline_state_op_all = trajectories.cat('baseline_opponent_state')
+        else:
+            baseline_state_all = [torch.cat(statis, dim=0) for statis in zip(*baseline_state_traj)]
+            baseline_state_op_all = [torch.cat(statis, dim=0) for statis in zip(*baseline_state_op_traj)]
         print("baseline_state_all.shape:", baseline_state_all[0].shape) if debug else None
-        baseline_state_op_all = [torch.cat(statis, dim=0) for statis in zip(*baseline_state_op_traj)]
 
         # change to device
         state_all.to(device)  # note: MsStata.to(device) in place operation
@@ -266,7 +291,7 @@ class AlphaStarAgent(RandomAgent):
         baseline_state_op_all = [l.to(device) for l in baseline_state_op_all]
 
         # shape [batch_seq_size, embedding_size]
-        baseline_list, policy_logits = self.agent_nn.unroll_traj(state_all=state_all, 
+        baseline_list, policy_logits, _ = self.agent_nn.unroll_traj(state_all=state_all, 
                                                                  initial_state=initial_memory_state, 
                                                                  baseline_state=baseline_state_all, 
                                                                  baseline_opponent_state=baseline_state_op_all)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" Packs the arrays of a nested object into a shared memory block, with only a small structure left to pickle"
+
+import numpy as np
+
+import torch
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+ALIGNMENT = 64
+
+# the kinds of the nodes in the structure of a flattened object
+TENSOR, ARRAY, NAMEDTUPLE, TUPLE, LIST, DICT, OBJECT, VALUE = range(8)
+
+
+def flatten(x, arrays):
+    """Returns the structure of x, in which the tensors and arrays are replaced by their indexes in arrays
+    (appended as numpy arrays), so only the small structure needs to be pickled."""
+    if isinstance(x, torch.Tensor):
+        arrays.append(x.detach().cpu().numpy())
+        return (TENSOR, len(arrays) - 1)
+    if isinstance(x, np.ndarray) and not x.dtype.hasobject:
+        arrays.append(np.asarray(x))
+        return (ARRAY, len(arrays) - 1)
+    if isinstance(x, tuple) and hasattr(x, '_fields'):
+        return (NAMEDTUPLE, type(x), [flatten(v, arrays) for v in x])
+    if isinstance(x, tuple):
+        return (TUPLE, [flatten(v, arrays) for v in x])
+    if isinstance(x, list):
+        return (LIST, [flatten(v, arrays) for v in x])
+    if isinstance(x, dict):
+        return (DICT, type(x), [(k, flatten(v, arrays)) for k, v in x.items()])
+    if hasattr(x, '__dict__') and not isinstance(x, type):
+        return (OBJECT, type(x), [(k, flatten(v, arrays)) for k, v in vars(x).items()])
+    return (VALUE, x)
+
+
+def unflatten(structure, arrays):
+    kind = structure[0]
+    if kind == TENSOR:
+        return torch.from_numpy(arrays[structure[1]])
+    if kind == ARRAY:
+        return arrays[structure[1]]
+    if kind == NAMEDTUPLE:
+        return structure[1]._make([unflatten(s, arrays) for s in structure[2]])
+    if kind == TUPLE:
+        return tuple(unflatten(s, arrays) for s in structure[1])
+    if kind == LIST:
+        return [unflatten(s, arrays) for s in structure[1]]
+    if kind == DICT:
+        return structure[1]((k, unflatten(s, arrays)) for k, s in structure[2])
+    if kind == OBJECT:
+        obj = structure[1].__new__(structure[1])
+        obj.__dict__.update((k, unflatten(s, arrays)) for k, s in structure[2])
+        return obj
+    return structure[1]
+
+
+def layout(arrays):
+    # the (offset, dtype, shape) of each array in a block, and the bytes of the block
+    specs = []
+    offset = 0
+    for a in arrays:
+        specs.append((offset, a.dtype.str, a.shape))
+        offset += (a.nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    return specs, offset
+
+
+def write_arrays(buf, base, arrays, specs):
+    for a, (offset, dtype, shape) in zip(arrays, specs):
+        np.ndarray(shape, dtype, buf, base + offset)[...] = a
+
+
+def read_arrays(buf, base, specs):
+    # copies, so the block can be written again
+    return [np.array(np.ndarray(shape, dtype, buf, base + offset)) for offset, dtype, shape in specs]
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" The compact form of the preprocessed state, which the actors send to the learner instead of the raw observations"
+
+import numpy as np
+
+import torch
+
+from alphastarmini.core.arch.entity_encoder import EntityEncoder
+from alphastarmini.core.arch.spatial_encoder import SpatialEncoder
+from alphastarmini.core.rl.state import MsState
+
+from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+
+# the scale of each map channel, the channels of the minimap layers without one-hot are divided by 255,
+# others (scattered entity index and one-hot) are integers
+MAP_SCALE = np.concatenate([np.ones(SpatialEncoder.scatter_volume)] +
+                           [np.full(1, 255.) if size is None else np.ones(size)
+                            for _, size in SpatialEncoder.map_layers]).reshape(1, -1, 1, 1)
+
+MAP_CODE_DTYPE = np.int16
+ENTITY_INDEX_DTYPE = np.int32
+
+
+class CompactState(object):
+    '''
+    The lossless compact form of a MsState with batch size 1:
+    entity_state keeps only the non-zero values of the rows of the real entities (the padding rows are all the bias),
+    map_state is kept in int16 codes (the value multiplied by its channel scale),
+    and statistical_state is kept as it is.
+    '''
+
+    def __init__(self, entity_num, entity_index, entity_value, statistical_state, map_code):
+        super(CompactState, self).__init__()
+        self.entity_num = entity_num
+        self.entity_index = entity_index
+        self.entity_value = entity_value
+        self.statistical_state = statistical_state
+        self.map_code = map_code
+
+    @classmethod
+    def from_state(cls, state):
+        entity_state = state.entity_state.cpu().numpy().reshape(AHP.max_entities, -1)
+        entity_num = int((entity_state[:, 0] > EntityEncoder.bias_value + 1e3).sum())
+        entities = entity_state[:entity_num].reshape(-1)
+        entity_index = np.flatnonzero(entities).astype(ENTITY_INDEX_DTYPE)
+        entity_value = entities[entity_index]
+
+        map_code = np.rint(state.map_state.cpu().numpy() * MAP_SCALE).astype(MAP_CODE_DTYPE)
+
+        return cls(entity_num, entity_index, entity_value, list(state.statistical_state), map_code)
+
+    def entity_numpy(self):
+        entity_size = AHP.embedding_size
+        entity_state = np.full(AHP.max_entities * entity_size, EntityEncoder.bias_value, dtype=np.float32)
+        entity_state[:self.entity_num * entity_size] = 0.
+        entity_state[self.entity_index] = self.entity_value
+        return entity_state.reshape(1, AHP.max_entities, entity_size)
+
+    def map_numpy(self):
+        # note: the division is in float64, the same as the map_data is made
+        return (self.map_code / MAP_SCALE).astype(np.float32)
+
+    def to_state(self):
+        return MsState(entity_state=torch.tensor(self.entity_numpy()),
+                       statistical_state=list(self.statistical_state),
+                       map_state=torch.tensor(self.map_numpy()))
+
+    @staticmethod
+    def stack(compact_state_list):
+        # the MsState of the batch of all the compact states
+        entity_state = torch.tensor(np.concatenate([s.entity_numpy() for s in compact_state_list], axis=0))
+        statistical_state = [torch.cat(statis, dim=0) for statis in zip(*[s.statistical_state for s in compact_state_list])]
+        map_state = torch.tensor(np.concatenate([s.map_numpy() for s in compact_state_list], axis=0))
+
+        return MsState(entity_state=entity_state, statistical_state=statistical_state, map_state=map_state)
+
+    @property
+    def nbytes(self):
+        return (self.entity_index.nbytes + self.entity_value.nbytes + self.map_code.nbytes +
+                sum(s.numel() * s.element_size() for s in self.statistical_state))
+
+    def __str__(self):
+        return "entity_num: %d, entity values: %d, map_code: %s, bytes: %d" % (self.entity_num, len(self.entity_value),
+                                                                               self.map_code.shape, self.nbytes)
+
+
+def test_unroll():
+    import time
+    from alphastarmini.core.arch.agent import Agent
+    from alphastarmini.core.rl.alphastar_agent import AlphaStarAgent
+    from alphastarmini.core.rl import rl_utils as U
+    from alphastarmini.core.sl.load_pickle import random_pickle_step
+
+    agent = AlphaStarAgent(name='learner')
+    agent.agent_nn.model.eval()
+    rng = np.random.RandomState(0)
+
+    def step_fields(traj_type, **kwargs):
+        fields = dict.fromkeys(traj_type._fields)
+        fields.update(kwargs)
+        return traj_type(**fields)
+
+    old_trajectories, new_trajectories = [], []
+    old_bytes, new_bytes = 0, 0
+    for i in range(AHP.batch_size):
+        old_trajectory, new_trajectory = [], []
+        for j in range(AHP.sequence_length):
+            home_obs = random_pickle_step(seed=i * 100 + j)
+            away_obs = random_pickle_step(seed=i * 100 + j + 50)
+            memory = agent.initial_state()
+            build_order = rng.randint(0, 259, rng.randint(0, 25)).tolist()
+
+            old_trajectory.append(step_fields(U.Trajectory, observation=home_obs, opponent_observation=away_obs, 
+                                              memory=memory, build_order=build_order))
+            old_bytes += sum(v.nbytes for obs in (home_obs, away_obs) for v in obs.values() if isinstance(v, np.ndarray))
+
+            # what the actor does, the states are from the inference
+            home_state = Agent.preprocess_state_all(obs=home_obs)
+            away_state = Agent.preprocess_state_all(obs=away_obs)
+            state, baseline_state, baseline_opponent_state = U.get_compact_inputs(home_state, away_state, build_order)
+            new_trajectory.append(step_fields(U.CompactTrajectory, state=state, baseline_state=baseline_state, 
+                                              baseline_opponent_state=baseline_opponent_state,
+                                              memory=memory, build_order=build_order))
+            # the baseline lists share most tensors with the state
+            tensors = {id(t): t for t in state.statistical_state + baseline_state + baseline_opponent_state}
+            new_bytes += state.nbytes - sum(s.numel() * s.element_size() for s in state.statistical_state) + \
+                sum(t.numel() * t.element_size() for t in tensors.values())
+
+            if j == 0:
+                # the learner gets the same inputs from the both
+                old_state = Agent.preprocess_state_all(obs=home_obs, build_order=build_order)
+                new_state = state.to_state()
+                assert torch.equal(old_state.entity_state, new_state.entity_state)
+                assert torch.equal(old_state.map_state, new_state.map_state)
+                assert all(torch.equal(x, y) for x, y in zip(old_state.statistical_state, new_state.statistical_state))
+
+                # note the units_buildings (index 3) is random now
+                old_baseline, old_baseline_op = agent.agent_nn.preprocess_baseline_state(home_obs, away_obs, build_order)
+                for x, y in zip(old_baseline + old_baseline_op, baseline_state + baseline_opponent_state):
+                    assert x.shape == y.shape
+                    assert torch.equal(x, y) or x is old_baseline[3] or x is old_baseline_op[3]
+
+        old_trajectories.append(U.stack_namedtuple(old_trajectory))
+        new_trajectories.append(U.stack_namedtuple(new_trajectory))
+
+    print("trajectory bytes per step: raw observations %d, compact %d" % (old_bytes / (AHP.batch_size * AHP.sequence_length),
+                                                                          new_bytes / (AHP.batch_size * AHP.sequence_length)))
+
+    with torch.no_grad():
+        for name, trajectories in (('raw observations', old_trajectories), ('compact', new_trajectories)):
+            start_time = time.time()
+            policy_logits, baselines = agent.unroll(trajectories)
+            print("unroll time on {}: {:.3f}s".format(name, time.time() - start_time))
+
+            if name == 'raw observations':
+                old_action_type_logits = policy_logits.action_type
+            else:
+                assert torch.allclose(old_action_type_logits, policy_logits.action_type, atol=1e-5)
+
+
+def test():
+    from alphastarmini.core.arch.agent import Agent
+    from alphastarmini.core.sl.load_pickle import random_pickle_step
+
+    state_list = []
+    for seed in range(4):
+        obs = random_pickle_step(seed=seed)
+        state = Agent.preprocess_state_all(obs=obs)
+        compact = CompactState.from_state(state)
+        print('compact state:', compact) if debug else None
+
+        new_state = compact.to_state()
+        assert torch.equal(state.entity_state, new_state.entity_state)
+        assert torch.equal(state.map_state, new_state.map_state)
+        assert all(torch.equal(x, y) for x, y in zip(state.statistical_state, new_state.statistical_state))
+
+        state_list.append((state, compact))
+
+    batch_state = CompactState.stack([compact for _, compact in state_list])
+    assert torch.equal(batch_state.entity_state, torch.cat([s.entity_state for s, _ in state_list], dim=0))
+    assert torch.equal(batch_state.map_state, torch.cat([s.map_state for s, _ in state_list], dim=0))
+
+    state, compact = state_list[0]
+    dense_bytes = (state.entity_state.numel() + state.map_state.numel()) * 4 + \
+        sum(s.numel() * s.element_size() for s in state.statistical_state)
+    print("state bytes: dense %d, compact %d" % (dense_bytes, compact.nbytes))
+
+    test_unroll()
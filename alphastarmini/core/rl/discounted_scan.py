@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"The discounted scan along the time axis, used by the V-trace, lambda returns and UPGO in rl_loss."
+
+from typing import List
+
+import numpy as np
+
+import torch
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+
+# for sequences shorter than this, the scripted loop is faster than the doubling scan,
+# see test() for the speed of both
+DOUBLING_MIN_LENGTH = 16
+
+
+def scan_by_doubling(sequence, decay, initial_value):
+    """The reverse discounted sum by the doubling (Hillis-Steele) scan, with log2(T) batched ops.
+
+    Each step t is the map y -> sequence[t] + decay[t] * y, which is composed with the map of step t + k
+    for k = 1, 2, 4, ..., after that, step t holds the composition of the steps from t to the last.
+    """
+    T = sequence.shape[0]
+    k = 1
+    while k < T:
+        # the steps after the last one are the identity map, i.e., sequence 0 and decay 1
+        sequence = torch.cat([sequence[:T - k] + decay[:T - k] * sequence[k:], sequence[T - k:]], dim=0)
+        decay = torch.cat([decay[:T - k] * decay[k:], decay[T - k:]], dim=0)
+        k *= 2
+
+    return sequence + decay * initial_value.unsqueeze(0)
+
+
+@torch.jit.script
+def scan_by_script(sequence, decay, initial_value):
+    """The reverse discounted sum by a loop in TorchScript, with no Python overhead for each step."""
+    result: List[torch.Tensor] = []
+    acc = initial_value
+    for t in range(sequence.shape[0] - 1, -1, -1):
+        acc = sequence[t] + decay[t] * acc
+        result.append(acc)
+    result.reverse()
+    return torch.stack(result)
+
+
+def discounted_scan(sequence, discounts, initial_value, reverse=True,
+                    traces=None, clip_traces=None, is_final=None, method=None):
+    """Evaluates a cumulative discounted sum along dimension 0 of tensors of shape [T, B, ...].
+      ```python
+      decay[t] = discounts[t] * min(traces[t], clip_traces) * (1 - is_final[t])
+      if reverse = True:
+        result[last] = sequence[last] + decay[last] * initial_value
+        result[k] = sequence[k] + decay[k] * result[k + 1]
+      if reverse = False:
+        result[0] = sequence[0] + decay[0] * initial_value
+        result[k] = sequence[k] + decay[k] * result[k - 1]
+      ```
+    Args:
+      sequence: Tensor of shape [T, B, ...] containing values to be summed.
+      discounts: Tensor of shape [T, B, ...] containing per-step discounts.
+      initial_value: Tensor of shape [B, ...].
+      traces: (optional) Tensor of shape [T, B, ...] multiplied to the discounts, e.g., the c_t of V-trace.
+      clip_traces: (optional) the max value of the traces.
+      is_final: (optional) bool Tensor of shape [T, B, ...], the sum is reset at the final steps,
+        i.e., result[t] = sequence[t] if is_final[t].
+      method: 'doubling' or 'script', by default chosen by the length T.
+    Returns:
+      Tensor of the same shape as sequence.
+    """
+    decay = discounts
+    if traces is not None:
+        if clip_traces is not None:
+            traces = torch.clamp(traces, max=clip_traces)
+        decay = decay * traces
+    if is_final is not None:
+        decay = decay * (~is_final.bool()).to(decay.dtype)
+
+    decay = decay.to(sequence.dtype).expand_as(sequence)
+    initial_value = initial_value.to(sequence.dtype)
+
+    if not reverse:
+        sequence, decay = torch.flip(sequence, [0]), torch.flip(decay, [0])
+
+    if method is None:
+        method = 'doubling' if sequence.shape[0] >= DOUBLING_MIN_LENGTH else 'script'
+
+    if method == 'doubling':
+        result = scan_by_doubling(sequence, decay, initial_value)
+    elif method == 'script':
+        result = scan_by_script(sequence, decay, initial_value)
+    else:
+        raise ValueError('unknown scan method: %s' % method)
+
+    print("discounted_scan result:", result) if debug else None
+
+    if not reverse:
+        result = torch.flip(result, [0])
+
+    return result
+
+
+def scan_by_loop(sequence, decay, initial_value):
+    # the reverse discounted sum stepped in Python, as tf.scan in the pseudocode, for test
+    result = np.zeros_like(sequence)
+    acc = initial_value
+    for t in reversed(range(len(sequence))):
+        acc = sequence[t] + decay[t] * acc
+        result[t] = acc
+    return result
+
+
+def scan_by_torch_loop(sequence, decay, initial_value):
+    # the per-step loop on tensors, as the old scan in rl_loss, for benchmark
+    result = []
+    acc = initial_value
+    for t in reversed(range(sequence.shape[0])):
+        acc = sequence[t] + decay[t] * acc
+        result.append(acc.unsqueeze(0))
+    result.reverse()
+    return torch.cat(result, dim=0)
+
+
+def test_returns(rng, T=16, B=8):
+    # the returns in rl_loss against the loops of the pseudocode (tf.scan, trfl multistep_forward_view)
+    from alphastarmini.core.rl import rl_loss as RL
+
+    values = rng.randn(T, B).astype(np.float32)
+    rewards = rng.randn(T, B).astype(np.float32)
+    discounts = (rng.rand(T, B) > 0.1).astype(np.float32)
+    bootstrap = rng.randn(B).astype(np.float32)
+    rhos = (rng.rand(T, B) * 2).astype(np.float32)
+    next_values = np.concatenate([values[1:], bootstrap[None]], axis=0)
+
+    def lambda_returns_by_loop(values_tp1, lambdas):
+        result = np.zeros_like(rewards)
+        acc = values_tp1[-1]
+        for t in reversed(range(T)):
+            acc = rewards[t] + discounts[t] * ((1 - lambdas[t]) * values_tp1[t] + lambdas[t] * acc)
+            result[t] = acc
+        return result
+
+    returns = RL.lambda_returns(torch.tensor(next_values), torch.tensor(rewards), torch.tensor(discounts), lambdas=0.8)
+    assert np.allclose(returns.numpy(), lambda_returns_by_loop(next_values, np.full_like(rewards, 0.8)), atol=1e-4)
+
+    lambdas = (rewards + discounts * next_values >= values).astype(np.float32)
+    lambdas = np.concatenate([lambdas[1:], np.ones_like(lambdas[-1:])], axis=0)
+    returns = RL.upgo_returns(torch.tensor(values), torch.tensor(rewards), torch.tensor(discounts), torch.tensor(bootstrap))
+    assert np.allclose(returns.numpy(), lambda_returns_by_loop(next_values, lambdas), atol=1e-4)
+
+    returns = RL.generalized_lambda_returns(torch.tensor(rewards), torch.tensor(discounts), torch.tensor(values),
+                                            torch.tensor(bootstrap), lambda_=1)
+    assert np.allclose(returns.numpy(), scan_by_loop(rewards, discounts, bootstrap), atol=1e-4)
+
+    clipped_rhos = np.minimum(rhos, 1.)
+    deltas = clipped_rhos * (rewards + discounts * next_values - values)
+    vs = scan_by_loop(deltas, discounts * np.minimum(rhos, 1.), np.zeros_like(bootstrap)) + values
+    vs_tp1 = np.concatenate([vs[1:], bootstrap[None]], axis=0)
+    pg_advantages = clipped_rhos * (rewards + discounts * vs_tp1 - values)
+    vtrace_returns = RL.vtrace_from_importance_weights(torch.tensor(rhos), torch.tensor(discounts), torch.tensor(rewards),
+                                                       torch.tensor(values), torch.tensor(bootstrap))
+    assert np.allclose(vtrace_returns.vs.numpy(), vs, atol=1e-4)
+    assert np.allclose(vtrace_returns.pg_advantages.numpy(), pg_advantages, atol=1e-4)
+
+
+def test(lengths=(8, 64, 256, 1024), batch_size=32, benchmark_num=20):
+    import time
+
+    rng = np.random.RandomState(0)
+
+    for T in (1, 2, 7, 64, 200):
+        sequence = rng.randn(T, 5).astype(np.float32)
+        decay = rng.rand(T, 5).astype(np.float32)
+        decay[rng.rand(T, 5) < 0.2] = 0.
+        initial_value = rng.randn(5).astype(np.float32)
+        traces = rng.rand(T, 5).astype(np.float32) * 2
+        is_final = rng.rand(T, 5) < 0.1
+
+        expected = scan_by_loop(sequence, decay, initial_value)
+        for method in ('doubling', 'script'):
+            result = discounted_scan(torch.tensor(sequence), torch.tensor(decay), torch.tensor(initial_value),
+                                     method=method)
+            assert np.allclose(result.numpy(), expected, atol=1e-5), method
+
+        # not reverse
+        expected = scan_by_loop(sequence[::-1], decay[::-1], initial_value)[::-1]
+        result = discounted_scan(torch.tensor(sequence), torch.tensor(decay), torch.tensor(initial_value), reverse=False)
+        assert np.allclose(result.numpy(), expected, atol=1e-5)
+
+        # clipped traces and reset on the final steps
+        expected = scan_by_loop(sequence, decay * np.minimum(traces, 1.) * ~is_final, initial_value)
+        result = discounted_scan(torch.tensor(sequence), torch.tensor(decay), torch.tensor(initial_value),
+                                 traces=torch.tensor(traces), clip_traces=1., is_final=torch.tensor(is_final))
+        assert np.allclose(result.numpy(), expected, atol=1e-5)
+
+    # the gradients are the same as the loop
+    sequence = torch.randn(16, 4, requires_grad=True)
+    decay = torch.rand(16, 4, requires_grad=True)
+    grads = []
+    for method in ('doubling', 'script'):
+        discounted_scan(sequence, decay, torch.ones(4), method=method).sum().backward()
+        grads.append((sequence.grad.clone(), decay.grad.clone()))
+        sequence.grad, decay.grad = None, None
+    assert all(torch.allclose(x, y, atol=1e-4) for x, y in zip(*grads))
+
+    test_returns(rng)
+
+    # benchmark test
+    for T in lengths:
+        sequence = torch.randn(T, batch_size)
+        decay = torch.rand(T, batch_size)
+        initial_value = torch.randn(batch_size)
+
+        costs = []
+        for name, f in (('torch loop', lambda: scan_by_torch_loop(sequence, decay, initial_value)),
+                        ('doubling', lambda: discounted_scan(sequence, decay, initial_value, method='doubling')),
+                        ('script', lambda: discounted_scan(sequence, decay, initial_value, method='script'))):
+            f()
+            benchmark_start = time.time()
+            for i in range(benchmark_num):
+                f()
+            costs.append((name, (time.time() - benchmark_start) / benchmark_num))
+
+        print("T={}: ".format(T) + ", ".join("{} {:.6f}s ({:.1f}x)".format(name, cost, costs[0][1] / cost)
+                                            for name, cost in costs))
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"The central inference service, which batches the forwards of the requests from many actors."
+
+import time
+import threading
+import contextlib
+import collections
+
+import numpy as np
+
+from pysc2.env import environment as E
+
+from alphastarmini.core.rl.actor_inference import ActorInference, can_stack
+from alphastarmini.core.rl.parameter_store import ParameterPuller
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+# the max number of the requests in one batch
+MAX_BATCH_SIZE = 32
+
+# seconds, the max time the first request of a batch waits for the others
+MAX_WAIT = 0.005
+
+# the number of the latest latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+
+
+class InferenceRequest(object):
+    # one forward of an agent (the model of the key), the actor waits on it for the result
+
+    def __init__(self, key, agent_nn, state, memory):
+        super(InferenceRequest, self).__init__()
+        self.key = key
+        self.agent_nn = agent_nn
+        self.state = state
+        self.memory = memory
+
+        self.submit_time = time.time()
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+    def set_result(self, output=None, error=None):
+        self.output = output
+        self.error = error
+        self.done.set()
+
+    def result(self, timeout=None):
+        """Returns the (action, action_logits, new_state, select_units_num) of the forward."""
+        if not self.done.wait(timeout):
+            raise TimeoutError('the inference request is not served in %s seconds' % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+
+class InferenceService(object):
+    '''
+    Serves the forwards of the actors in one thread: the pending requests are collected until
+    max_batch_size of them or the max_wait deadline of the first one, then the requests of each model
+    (the player, opponent and teacher route to their own models) are run in one ArchModel forward,
+    and each actor gets its action and hidden state.
+    The service holds the models shared by the actors by their keys (e.g., one teacher of a race for all the
+    actors, see register), and the requests are routed by the key, so the forwards of the different actors
+    are batched. The agents not registered (e.g., the historical opponents) are keyed by their models.
+    '''
+
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT, stack=True):
+        super(InferenceService, self).__init__()
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stack = stack
+
+        # runs the batched forwards
+        self.inference = ActorInference(stack=stack)
+
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+
+        # the key -> the registered agent (and the lock of its forwards), and the id of the agent -> its key
+        self.models = {}
+        self.model_locks = {}
+        self.model_keys = {}
+        self.register_lock = threading.RLock()
+
+        # the player -> the ParameterPuller shared by its actors
+        self.pullers = {}
+
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.is_running = False
+
+        # statistics
+        self.start_time = None
+        self.request_num = 0
+        self.batch_num = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        self.is_running = True
+        self.start_time = time.time()
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.is_running = False
+            self.not_empty.notify_all()
+        self.thread.join()
+
+    def client(self):
+        return InferenceClient(self)
+
+    def register(self, key, agent_fn, lock=None):
+        """Returns the agent of the key, which agent_fn makes when the key is new,
+        e.g., the teacher of the race, which all the actors use instead of making their own.
+        The registered agents only run the forwards of the actors, in the eval mode (the batchnorm uses its
+        running statistics instead of the ones of the batch), so the requests of the actors are stacked."""
+        with self.register_lock:
+            if key not in self.models:
+                agent = agent_fn()
+                agent.agent_nn.model.eval()
+                self.model_keys[id(agent)] = key
+                self.models[key] = agent
+                if lock is not None:
+                    self.model_locks[key] = lock
+            return self.models[key]
+
+    def puller(self, player):
+        """Returns the ParameterPuller of the player shared by the actors, one copy of the agent
+        which the service runs for all of them, the pulls and the forwards take the lock of the puller."""
+        with self.register_lock:
+            puller = self.pullers.get(player)
+            if puller is None:
+                puller = self.pullers[player] = ParameterPuller(player)
+                self.register(('player', id(player)), lambda: puller.agent, lock=puller.lock)
+            return puller
+
+    def key(self, agent):
+        # the registered agents are kept, so their ids are not reused by the others
+        return self.model_keys.get(id(agent), ('model', id(agent.agent_nn.model)))
+
+    def submit(self, agent, state, memory):
+        request = InferenceRequest(self.key(agent), agent.agent_nn, state, memory)
+        with self.lock:
+            if not self.is_running:
+                raise RuntimeError('the inference service is not running')
+            self.pending.append(request)
+            self.not_empty.notify()
+        return request
+
+    def take_batch(self):
+        # waits for the first request, then for a full batch until the deadline of the first one
+        with self.lock:
+            self.not_empty.wait_for(lambda: self.pending or not self.is_running)
+            if not self.pending:
+                return None
+
+            deadline = self.pending[0].submit_time + self.max_wait
+            while self.is_running and len(self.pending) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.not_empty.wait(remaining)
+
+            return [self.pending.popleft() for _ in range(min(len(self.pending), self.max_batch_size))]
+
+    def route(self, batch):
+        # the requests of the same key are in one group, unless the model can not stack the samples
+        group_dict = {}
+        for i, request in enumerate(batch):
+            key = request.key
+            if not (self.stack and can_stack(request.agent_nn.model)):
+                key = (key, i)
+            group_dict.setdefault(key, []).append(request)
+
+        return list(group_dict.values())
+
+    def serve(self, batch):
+        for group in self.route(batch):
+            try:
+                with self.model_locks.get(group[0].key, contextlib.nullcontext()):
+                    outputs = self.inference.forward(group[0].agent_nn, [r.state for r in group],
+                                                     [r.memory for r in group])
+            except Exception as e:
+                for request in group:
+                    request.set_result(error=e)
+                continue
+
+            now = time.time()
+            for request, output in zip(group, outputs):
+                self.latencies.append(now - request.submit_time)
+                request.set_result(output)
+
+        self.request_num += len(batch)
+        self.batch_num += 1
+
+    def run(self):
+        try:
+            while True:
+                batch = self.take_batch()
+                if batch is None:
+                    break
+                self.serve(batch)
+
+        finally:
+            # the actors waiting on the requests left are released
+            with self.lock:
+                self.is_running = False
+                left = list(self.pending)
+                self.pending.clear()
+            for request in left:
+                request.set_result(error=RuntimeError('the inference service is stopped'))
+
+    def stats(self):
+        latencies = np.array(self.latencies) if len(self.latencies) else np.zeros(1)
+        elapsed_time = time.time() - self.start_time if self.start_time is not None else 0.
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        return {'request_num': self.request_num,
+                'batch_num': self.batch_num,
+                'forward_num': self.inference.forward_num,
+                'mean_batch_size': self.request_num / max(self.batch_num, 1),
+                'throughput': self.request_num / max(elapsed_time, 1e-9),
+                'latency_p50': p50,
+                'latency_p90': p90,
+                'latency_p99': p99}
+
+    def __str__(self):
+        s = self.stats()
+        return ("requests: %d, batches: %d, forwards: %d, mean batch: %.2f, throughput: %.2f/s, "
+                "latency p50: %.1fms, p90: %.1fms, p99: %.1fms") % (s['request_num'], s['batch_num'], s['forward_num'],
+                                                                   s['mean_batch_size'], s['throughput'],
+                                                                   s['latency_p50'] * 1e3, s['latency_p90'] * 1e3,
+                                                                   s['latency_p99'] * 1e3)
+
+
+class InferenceClient(ActorInference):
+    '''
+    The actor side of the InferenceService, with the same step as ActorInference:
+    the observations are preprocessed in the actor, and the forwards are sent to the service together.
+    '''
+
+    def __init__(self, service):
+        super(InferenceClient, self).__init__(stack=service.stack)
+        self.service = service
+
+    def step(self, agent_list, obs_list, memory_list):
+        self.step_num += 1
+
+        # note someimes obs is timestep
+        obs_list = [obs.observation if isinstance(obs, E.TimeStep) else obs for obs in obs_list]
+        state_list = self.preprocess(obs_list)
+        self.states = state_list
+
+        requests = [self.service.submit(agent, state, memory)
+                    for agent, state, memory in zip(agent_list, state_list, memory_list)]
+
+        results = []
+        for agent, request in zip(agent_list, requests):
+            action, action_logits, new_state, select_units_num = request.result()
+            func_call = agent.agent_nn.action_to_func_call(action, select_units_num, agent.action_spec)
+            results.append((func_call, action, action_logits, new_state))
+
+        print('results:', results) if debug else None
+        return results
+
+
+def run_actors(player, opponent, teacher, env_list, inference_list):
+    # runs the actor loops in the threads, returns the total steps per second
+    from alphastarmini.core.rl.actor_inference import run_actor_loop
+
+    steps_per_second = [0.] * len(env_list)
+
+    def actor(i):
+        steps_per_second[i] = run_actor_loop(player, opponent, teacher, env_list[i], inference=inference_list[i])
+
+    threads = [threading.Thread(target=actor, args=(i,)) for i in range(len(env_list))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return sum(steps_per_second)
+
+
+def test_actors(actor_num=2, max_frames=8, max_wait=0.2):
+    # the actor loops in the threads share one service, on the synthetic env
+    from pysc2.env.sc2_env import Race
+
+    from alphastarmini.core.rl.actor import ActorLoop
+    from alphastarmini.core.rl.rl_vs_computer_wo_replay import ActorVSComputer
+    from alphastarmini.core.rl.learner import Learner
+    from alphastarmini.core.rl.rl_utils import get_supervised_agent
+    from alphastarmini.core.rl.synthetic_env import SyntheticSC2Env, DEFAULT_PARAMS, STEP_MUL
+    from alphastarmini.core.ma.league import League
+    from alphastarmini.core.ma.coordinator import Coordinator
+
+    params = DEFAULT_PARAMS._replace(episode_loops=(STEP_MUL * 10, STEP_MUL * 2))
+    league = League(initial_agents={race: get_supervised_agent(race, restore=False) for race in [Race.protoss]},
+                    main_players=1, main_exploiters=0, league_exploiters=0)
+    coordinator = Coordinator(league)
+    player = league.get_learning_player(0)
+    learner = Learner(player, max_time_for_training=60 * 5)
+
+    # the actors of the player share the pulled copy of its agent, so their requests are batched
+    service = InferenceService(max_batch_size=2 * actor_num, max_wait=max_wait)
+    service.start()
+    actors = [ActorLoop(player, coordinator, max_frames=max_frames, inference_service=service,
+                        env_fn=lambda: SyntheticSC2Env(params=params)) for _ in range(actor_num)]
+    assert all(actor.agent is actors[0].agent and actor.puller is actors[0].puller for actor in actors)
+    learner.start()
+    for actor in actors:
+        actor.start()
+    for actor in actors:
+        actor.thread.join()
+    learner.thread.join()
+    service.stop()
+
+    print("actor loops:", actor_num, "service:", service)
+    assert service.request_num == 2 * actor_num * max_frames
+    assert service.inference.forward_num < service.request_num
+
+    # the actors against the computer have their own players, but one teacher of the service,
+    # so the forwards of the teacher are batched across the actors
+    service = InferenceService(max_batch_size=2 * actor_num, max_wait=max_wait)
+    service.start()
+    actors = [ActorVSComputer(player, coordinator, max_frames=max_frames, inference_service=service,
+                              env_fn=lambda: SyntheticSC2Env(num_players=1, params=params)) for _ in range(actor_num)]
+    assert all(actor.teacher is actors[0].teacher for actor in actors)
+    learner = Learner(player, max_time_for_training=60 * 5)
+    learner.start()
+    for actor in actors:
+        actor.start()
+    for actor in actors:
+        actor.thread.join()
+    learner.thread.join()
+    service.stop()
+
+    print("actors vs computer:", actor_num, "service:", service)
+    assert 0 < service.inference.forward_num < service.request_num
+
+
+def test(actor_nums=(1, 4), max_waits=(0., 0.005, 0.02), step_num=4):
+    import torch
+
+    from pysc2.lib import features, point
+    from pysc2.env.sc2_env import AgentInterfaceFormat
+
+    from alphastarmini.core.rl.actor_inference import RecordedObsEnv
+    from alphastarmini.core.rl.alphastar_agent import AlphaStarAgent
+    from alphastarmini.core.sl.load_pickle import random_pickle_step
+    from alphastarmini.lib.hyper_parameters import AlphaStar_Agent_Interface_Format_Params as AAIFP
+
+    def recorded_obs(seed):
+        obs = random_pickle_step(seed=seed)
+        obs.pop('func_call')
+        return obs
+
+    feat = features.Features(AgentInterfaceFormat(**AAIFP._asdict()), map_size=point.Point(64, 64))
+    action_spec = feat.action_spec()
+
+    player = AlphaStarAgent(name='player')
+    teacher = AlphaStarAgent(name='teacher')
+    for a in (player, teacher):
+        a.setup(None, action_spec)
+        a.agent_nn.model.eval()
+    opponent = player
+
+    # the same outputs as the ActorInference, with the requests of two actors in one batch
+    home_obs, away_obs = recorded_obs(seed=0), recorded_obs(seed=1)
+    memory = player.initial_state()
+    teacher_memory = tuple(torch.randn_like(h) for h in teacher.initial_state())
+    agent_list, obs_list = [player, opponent, teacher], [home_obs, away_obs, home_obs]
+    memory_list = [memory, memory, teacher_memory]
+
+    service = InferenceService(max_batch_size=6, max_wait=1.)
+    service.start()
+    outputs = [None, None]
+
+    def actor(i):
+        outputs[i] = service.client().step(agent_list, obs_list, memory_list)
+
+    threads = [threading.Thread(target=actor, args=(i,)) for i in range(2)]
+    with torch.no_grad():
+        expected = ActorInference().step(agent_list, obs_list, memory_list)
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    service.stop()
+    print('service:', service)
+    assert service.batch_num == 1 and service.inference.forward_num == 2
+
+    for results in outputs:
+        for (_, _, logits, new_state), (_, _, expected_logits, expected_new_state) in zip(results, expected):
+            # the later heads depend on the sampled action type, so only the first head is compared
+            assert torch.allclose(logits.action_type, expected_logits.action_type, atol=1e-5)
+            for h, expected_h in zip(new_state, expected_new_state):
+                assert torch.allclose(h, expected_h, atol=1e-5)
+
+    test_actors()
+
+    # benchmark test
+    def env_list(actor_num):
+        return [RecordedObsEnv([recorded_obs(seed=j * 100 + i) for i in range(step_num)],
+                               [recorded_obs(seed=j * 100 + i + step_num) for i in range(step_num)])
+                for j in range(actor_num)]
+
+    for actor_num in actor_nums:
+        steps_per_second = run_actors(player, opponent, teacher, env_list(actor_num),
+                                      [ActorInference() for _ in range(actor_num)])
+        print("actors: {}, ActorInference per actor, steps/sec: {:.3f}".format(actor_num, steps_per_second))
+
+        for max_wait in max_waits:
+            service = InferenceService(max_wait=max_wait)
+            service.start()
+            steps_per_second = run_actors(player, opponent, teacher, env_list(actor_num),
+                                          [service.client() for _ in range(actor_num)])
+            service.stop()
+            print("actors: {}, max_wait: {}s, InferenceService steps/sec: {:.3f}, {}".format(
+                actor_num, max_wait, steps_per_second, service))
@@ -14,6 +14,9 @@ import torch
 from torch.optim import Adam, RMSprop
 
 from alphastarmini.core.rl.rl_loss import loss_function
+from alphastarmini.core.rl.trajectory_queue import TrajectoryQueue, BLOCK
+from alphastarmini.core.rl.trajectory_buffer import ColumnarTrajectoryQueue
+from alphastarmini.core.rl.parameter_store import ParameterStore
 
 from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
 from alphastarmini.lib.hyper_parameters import RL_Training_Hyper_Parameters as THP
@@ -30,15 +33,40 @@ if not os.path.exists(MODEL_PATH):
     os.mkdir(MODEL_PATH)
 SAVE_PATH = os.path.join(MODEL_PATH, MODEL + "_" + strftime("%y-%m-%d_%H-%M-%S", localtime()))
 
+# the trajectory queue
+QUEUE_CAPACITY = 4 * AHP.batch_size
+OVERFLOW_POLICY = BLOCK
+# the trajectories are written into the columns when they are put, and the batches are the views of them,
+# off as the copy of the puts costs more than the batch assembly saves (see trajectory_buffer.test)
+COLUMNAR = False
+# the learner wakes up at least once in this time to check whether the actors are still running
+WAIT_TIMEOUT = 1
+# the trajectories made by the parameters older than this number of versions are dropped, None keeps all
+MAX_POLICY_LAG = None
+
 
 class Learner:
     """Learner worker that updates agent parameters based on trajectories."""
 
-    def __init__(self, player, max_time_for_training=60 * 3):
+    def __init__(self, player, max_time_for_training=60 * 3,
+                 queue_capacity=QUEUE_CAPACITY, overflow_policy=OVERFLOW_POLICY, max_policy_lag=MAX_POLICY_LAG,
+                 columnar=COLUMNAR):
         self.player = player
+
+        # the versioned snapshots of the parameters, which the actors pull
+        self.parameters = ParameterStore(self.player.agent.get_weights())
         self.player.set_learner(self)
 
-        self.trajectories = []
+        if columnar:
+            self.trajectories = ColumnarTrajectoryQueue(capacity=queue_capacity, overflow_policy=overflow_policy)
+        else:
+            self.trajectories = TrajectoryQueue(capacity=queue_capacity, overflow_policy=overflow_policy)
+
+        # the off-policy staleness of the received trajectories, in versions
+        self.max_policy_lag = max_policy_lag
+        self.stale_num = 0
+        self.policy_lag_sum = 0
+        self.policy_lag_num = 0
 
         # AlphaStar code
         #self.optimizer = AdamOptimizer(learning_rate=3e-5, beta1=0, beta2=0.99, epsilon=1e-5)
@@ -55,16 +83,37 @@ class Learner:
         self.is_running = False
 
         self.is_rl_training = True
+        self.update_num = 0
 
     def get_parameters(self):
         return self.player.agent.get_parameters()
 
+    def policy_lag(self, trajectory):
+        # the versions between the oldest step of the trajectory and the latest parameters, None if not recorded
+        versions = [v for v in getattr(trajectory, 'policy_version', ()) if v is not None]
+        if not versions:
+            return None
+        return self.parameters.version - min(versions)
+
     def send_trajectory(self, trajectory):
-        self.trajectories.append(trajectory)
+        lag = self.policy_lag(trajectory)
+        if lag is not None:
+            self.policy_lag_sum += lag
+            self.policy_lag_num += 1
+            if self.max_policy_lag is not None and lag > self.max_policy_lag:
+                self.stale_num += 1
+                print("drop the trajectory of policy lag", lag) if debug else None
+                return False
+
+        # note: with the block policy, this waits when the queue is full
+        return self.trajectories.put(trajectory)
+
+    def publish_parameters(self):
+        # the actors pull the new version at their next episode or unroll
+        return self.parameters.publish(self.player.agent.get_weights())
 
-    def update_parameters(self):
-        trajectories = self.trajectories[:AHP.batch_size]
-        self.trajectories = self.trajectories[AHP.batch_size:]
+    def update_parameters(self, trajectories):
+        self.update_num += 1
 
         if 0 and self.is_rl_training:
             agent = self.player.agent
@@ -93,6 +142,8 @@ class Learner:
             agent.steps += AHP.batch_size * AHP.sequence_length  # num_steps(trajectories)
             # self.player.agent.set_weights(self.optimizer.minimize(loss))
 
+        self.publish_parameters()
+
     def start(self):
         self.thread.start()
 
@@ -115,14 +166,14 @@ class Learner:
                         else:
                             actor_is_running = actor_is_running | 1
 
-                    if actor_is_running:
-                        print('learner trajectories size:', len(self.trajectories))
+                    # the full batches sent before the actors stop are still used
+                    if actor_is_running or len(self.trajectories) >= AHP.batch_size:
+                        trajectories = self.trajectories.get(AHP.batch_size, timeout=WAIT_TIMEOUT)
 
-                        if len(self.trajectories) >= AHP.batch_size:
+                        if trajectories is not None:
                             print("learner begin to update parameters")
-                            self.update_parameters()
-
-                        sleep(1)
+                            print('learner trajectory queue:', self.trajectories)
+                            self.update_parameters(trajectories)
                     else:
                         print("Actor stops!")
 
@@ -140,6 +191,94 @@ class Learner:
         finally:
             self.is_running = False
 
+            # release the actors which wait on the full queue
+            self.trajectories.close()
+
+
+def test(on_server=False, actor_num=3, batch_num=4):
+    import random
+
+    from alphastarmini.core.rl.rl_utils import Trajectory, TRAJECTORY_FIELDS
+
+    class FakeAgent(object):
+
+        def __init__(self):
+            self.model = torch.nn.Linear(2, 2)
+
+        def get_parameters(self):
+            return self.model.parameters()
+
+        def get_weights(self):
+            return self.model.state_dict()
+
+    class FakePlayer(object):
+
+        def __init__(self):
+            self.agent = FakeAgent()
+            self.actors = []
+            self.learner = None
+
+        def set_learner(self, learner):
+            self.learner = learner
+
+    class FakeActor(object):
+        # pushes synthetic trajectories, faster than the learner takes them
+
+        def __init__(self, player, index):
+            self.player = player
+            self.player.actors.append(self)
+            self.index = index
+            self.is_start = True
+            self.is_running = True
+            self.sent_num = 0
+
+        def run(self):
+            for i in range(batch_num * AHP.batch_size):
+                trajectory = Trajectory._make([(self.index, i)] * len(TRAJECTORY_FIELDS))
+                trajectory = trajectory._replace(policy_version=(self.player.learner.parameters.version,) * 2)
+                if self.player.learner.send_trajectory(trajectory):
+                    self.sent_num += 1
+                sleep(random.random() * 0.001)
+            self.is_running = False
 
-def test(on_server):
-    pass
+    for policy in (BLOCK, 'drop_oldest', 'drop_newest'):
+        player = FakePlayer()
+        learner = Learner(player, max_time_for_training=60, queue_capacity=AHP.batch_size, overflow_policy=policy)
+        actors = [FakeActor(player, i) for i in range(actor_num)]
+        threads = [threading.Thread(target=actor.run) for actor in actors]
+
+        learner.is_running = True
+        learner.start()
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        learner.thread.join()
+
+        stats = learner.trajectories.stats()
+        print(policy, 'updates:', learner.update_num, 'queue:', learner.trajectories)
+
+        # drop_oldest drops the trajectories already in the queue, drop_newest drops the ones being sent
+        dropped_in_queue = stats['drop_num'] if policy == 'drop_oldest' else 0
+        dropped_on_send = stats['drop_num'] if policy == 'drop_newest' else 0
+
+        assert stats['put_num'] == sum(actor.sent_num for actor in actors)
+        assert stats['put_num'] + dropped_on_send == actor_num * batch_num * AHP.batch_size
+        assert stats['get_num'] == learner.update_num * AHP.batch_size
+        assert stats['depth'] == stats['put_num'] - dropped_in_queue - stats['get_num'] < AHP.batch_size
+        if policy == BLOCK:
+            assert stats['drop_num'] == 0
+        assert learner.parameters.version == learner.update_num
+
+    # each update publishes a new version, and the trajectories of the too old versions are dropped
+    player = FakePlayer()
+    learner = Learner(player, max_policy_lag=1)
+    assert learner.parameters.version == 0
+    learner.update_parameters(None)
+    learner.update_parameters(None)
+    assert learner.parameters.version == learner.update_num == 2
+
+    trajectory = Trajectory._make([(None, None)] * len(TRAJECTORY_FIELDS))
+    assert learner.send_trajectory(trajectory._replace(policy_version=(1, 2)))
+    assert not learner.send_trajectory(trajectory._replace(policy_version=(0, 1)))
+    assert learner.send_trajectory(trajectory._replace(policy_version=(None, None)))
+    assert learner.stale_num == 1 and len(learner.trajectories) == 2
+    print('policy lag: mean', learner.policy_lag_sum / learner.policy_lag_num, 'stale:', learner.stale_num)
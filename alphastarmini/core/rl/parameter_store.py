@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" The versioned parameters which the learner publishes and the actors pull, for the threads and the processes"
+
+import copy
+import threading
+import collections
+from multiprocessing import shared_memory
+from time import time, sleep
+
+import numpy as np
+
+import torch
+
+from alphastarmini.core.rl.array_packing import ALIGNMENT, flatten, unflatten, layout, write_arrays, read_arrays
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+
+ParameterSnapshot = collections.namedtuple('ParameterSnapshot', ['version', 'state_dict', 'publish_time'])
+
+
+class ParameterStore(object):
+    '''
+    The parameters for the actors in the threads. Each publish makes an immutable snapshot (a copy of
+    the state dict) with the next version, and replaces the latest one by a single reference assignment,
+    so the actors read the version and the snapshot without locks, and never see a half-updated model.
+    Only one side (the learner) publishes.
+    '''
+
+    def __init__(self, state_dict):
+        super(ParameterStore, self).__init__()
+        self.latest = ParameterSnapshot(0, self.copy(state_dict), time())
+
+    @staticmethod
+    def copy(state_dict):
+        return collections.OrderedDict((k, v.detach().clone()) for k, v in state_dict.items())
+
+    @property
+    def version(self):
+        return self.latest.version
+
+    def publish(self, state_dict, version=None):
+        """Returns the version of the new snapshot, the next one by default."""
+        version = self.latest.version + 1 if version is None else version
+        assert version > self.latest.version, 'the version %d is not newer than %d' % (version, self.latest.version)
+        self.latest = ParameterSnapshot(version, self.copy(state_dict), time())
+        return version
+
+    def load(self):
+        """Returns the version and the state dict of the latest snapshot, which should not be changed."""
+        snapshot = self.latest
+        return snapshot.version, snapshot.state_dict
+
+
+class SharedParameterStore(object):
+    '''
+    The parameters for the actors in the processes, the state dict is in one shared memory block with
+    the version in the header. The header is odd while the arrays are written (a seqlock), so a load
+    retries when the header is odd or changed during the copy, and the readers take no lock.
+    Only one side publishes, the others attach the block by the name (it can go through the queues).
+    '''
+
+    HEADER_BYTES = ALIGNMENT
+
+    def __init__(self, state_dict):
+        super(SharedParameterStore, self).__init__()
+        arrays = []
+        self.structure = flatten(state_dict, arrays)
+        self.specs, nbytes = layout(arrays)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.HEADER_BYTES + nbytes)
+        self.name = self.shm.name
+
+        self.set_sequence(0)
+        write_arrays(self.shm.buf, self.HEADER_BYTES, arrays, self.specs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=self.name)
+
+    def get_sequence(self):
+        return int(np.ndarray((1,), np.int64, self.shm.buf)[0])
+
+    def set_sequence(self, sequence):
+        np.ndarray((1,), np.int64, self.shm.buf)[0] = sequence
+
+    @property
+    def version(self):
+        return self.get_sequence() // 2
+
+    def publish(self, state_dict, version=None):
+        """Writes the state dict (of the same model), returns the new version, the next one by default."""
+        current_version = self.version
+        version = current_version + 1 if version is None else version
+        assert version > current_version, 'the version %d is not newer than %d' % (version, current_version)
+
+        arrays = []
+        flatten(state_dict, arrays)
+
+        self.set_sequence(2 * version - 1)
+        write_arrays(self.shm.buf, self.HEADER_BYTES, arrays, self.specs)
+        self.set_sequence(2 * version)
+
+        return version
+
+    def load(self):
+        """Returns the version and a consistent copy of the state dict."""
+        while True:
+            sequence = self.get_sequence()
+            if sequence % 2 == 0:
+                arrays = read_arrays(self.shm.buf, self.HEADER_BYTES, self.specs)
+                if self.get_sequence() == sequence:
+                    return sequence // 2, unflatten(self.structure, arrays)
+            sleep(0.001)
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class ParameterPuller(object):
+    '''
+    The actor side: a local copy of the agent of the player, which the actor runs instead of the agent
+    the learner updates. At the episode or unroll boundaries, pull() loads the newest parameters the learner
+    of the player publishes (only a version comparison if there are none), and returns their version,
+    which the actor records in the trajectories.
+    The actors of an inference service share one puller of the player (see InferenceService.puller),
+    so their forwards are batched, and the service runs the forwards with the lock, which a pull takes
+    to load the weights. Then a trajectory may have the steps of a newer version pulled by another actor.
+    '''
+
+    def __init__(self, player):
+        super(ParameterPuller, self).__init__()
+        self.player = player
+        self.agent = copy.deepcopy(player.agent)
+
+        # None before the first pull, the agent is copied from the player
+        self.version = None
+        self.pull_num = 0
+        self.lock = threading.Lock()
+
+    def pull(self):
+        # the players without a learner (yet) raise the AttributeError
+        learner = getattr(self.player, 'learner', None)
+        store = getattr(learner, 'parameters', None)
+        if store is not None and (self.version is None or store.version > self.version):
+            with self.lock:
+                if self.version is None or store.version > self.version:
+                    self.version, state_dict = store.load()
+                    self.agent.set_weights(state_dict)
+                    self.pull_num += 1
+                    print("pull the parameters of version", self.version) if debug else None
+
+        return self.version
+
+
+def test():
+    import threading
+
+    model = torch.nn.Linear(3, 2)
+
+    for store in (ParameterStore(model.state_dict()), SharedParameterStore(model.state_dict())):
+        assert store.version == 0
+        torch.nn.init.zeros_(model.weight)
+        assert store.publish(model.state_dict()) == 1
+        assert store.publish(model.state_dict(), version=5) == 5
+
+        # the published snapshot does not change with the model
+        version, state_dict = store.load()
+        torch.nn.init.ones_(model.weight)
+        assert version == 5 and torch.equal(state_dict['weight'], torch.zeros(2, 3))
+
+        # the readers in the threads never see a half-written version
+        torn = []
+
+        def reader():
+            for _ in range(200):
+                version, state_dict = store.load()
+                if not torch.all(state_dict['weight'] == state_dict['weight'][0, 0]):
+                    torn.append(version)
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        for i in range(200):
+            torch.nn.init.constant_(model.weight, float(i))
+            store.publish(model.state_dict())
+        thread.join()
+        print(type(store).__name__, "version:", store.version, "torn loads:", len(torn))
+        assert not torn and store.version == 205
+
+        if isinstance(store, SharedParameterStore):
+            store.close()
+            store.unlink()
+
+    # the puller loads a newer version only
+    class FakeAgent(object):
+
+        def __init__(self):
+            self.model = torch.nn.Linear(3, 2)
+
+        def set_weights(self, state_dict):
+            self.model.load_state_dict(state_dict)
+
+    class FakeLearner(object):
+
+        def __init__(self, agent):
+            self.parameters = ParameterStore(agent.model.state_dict())
+
+    class FakePlayer(object):
+
+        def __init__(self):
+            self.agent = FakeAgent()
+            self.learner = FakeLearner(self.agent)
+
+    player = FakePlayer()
+    puller = ParameterPuller(player)
+    assert puller.pull() == 0 and puller.pull() == 0 and puller.pull_num == 1
+
+    torch.nn.init.zeros_(player.agent.model.weight)
+    assert not torch.equal(puller.agent.model.weight, player.agent.model.weight)
+    player.learner.parameters.publish(player.agent.model.state_dict())
+    assert puller.pull() == 1 and puller.pull_num == 2
+    assert torch.equal(puller.agent.model.weight, player.agent.model.weight)
@@ -88,6 +88,159 @@ def time_decay_scale(game_loop):
     return scale
 
 
+def time_decay_scales(game_loops):
+    # the vectorized version of time_decay_scale for an array of game loops
+    time_minutes = (np.asarray(game_loops) / 22.4).astype(np.int64) // 60
+
+    return np.select([time_minutes > 24, time_minutes > 16, time_minutes > 8], [0., 0.25, 0.5], default=1.)
+
+
+class BuildOrderDistance(object):
+    '''
+    The Levenshtein distances between a batch of build orders and their target (z) build orders.
+
+    For each pair, the last row of the edit distance matrix (the agent's build order against the whole z) is kept,
+    so when the build order is appended by a new entry, only one row is computed instead of the whole matrix.
+    The rows of the batch are computed together by numpy.
+    '''
+
+    def __init__(self, batch_size):
+        super(BuildOrderDistance, self).__init__()
+        self.batch_size = batch_size
+
+        self.bo_list = [[] for _ in range(batch_size)]
+        self.z_bo_list = [None] * batch_size
+
+        # z padded by -1 (never equal to a unit type), and the length of each z
+        self.z_array = np.zeros((batch_size, 0), dtype=np.int64)
+        self.z_len = np.zeros(batch_size, dtype=np.int64)
+
+        # rows[b, j] is the distance between bo_list[b] and z_bo_list[b][:j]
+        self.rows = np.zeros((batch_size, 1), dtype=np.int64)
+
+    def reset_z(self, reset_index, z_bo_list):
+        max_len = max([len(z) for z in z_bo_list] + [self.z_array.shape[1]])
+        if max_len > self.z_array.shape[1]:
+            pad = max_len - self.z_array.shape[1]
+            # the columns after z_len do not change the columns before, so any value is fine
+            self.z_array = np.pad(self.z_array, ((0, 0), (0, pad)), constant_values=-1)
+            self.rows = np.pad(self.rows, ((0, 0), (0, pad)))
+
+        for b in reset_index:
+            z = z_bo_list[b]
+            self.z_bo_list[b] = list(z)
+            self.z_len[b] = len(z)
+            self.z_array[b] = -1
+            self.z_array[b, :len(z)] = np.array(z, dtype=np.int64)
+
+    def update(self, bo_list, z_bo_list):
+        """Returns the distances (np.array of shape [B]) after the build orders change to bo_list,
+        it is incremental when bo_list[b] appends the last one of bo_list[b], else it is from the start."""
+        z_reset = [b for b, z in enumerate(z_bo_list) if self.z_bo_list[b] is None or list(z) != self.z_bo_list[b]]
+        if z_reset:
+            self.reset_z(z_reset, z_bo_list)
+
+        z_reset = set(z_reset)
+        new_entries = []
+        for b, bo in enumerate(bo_list):
+            last_bo = self.bo_list[b]
+            bo = list(bo)
+            if b in z_reset or len(bo) < len(last_bo) or bo[:len(last_bo)] != last_bo:
+                # from the start, the row of the empty build order is [0, 1, 2, ...]
+                self.rows[b] = np.arange(self.rows.shape[1])
+                last_bo = []
+            new_entries.append(bo[len(last_bo):])
+            self.bo_list[b] = bo
+
+        columns = np.arange(self.rows.shape[1])
+        max_new = max(len(e) for e in new_entries)
+        for k in range(max_new):
+            index = np.array([b for b, e in enumerate(new_entries) if len(e) > k])
+            x = np.array([int(new_entries[b][k]) for b in index], dtype=np.int64)
+            # the row number i of the entry in the matrix
+            i = np.array([len(self.bo_list[b]) - len(new_entries[b]) + k + 1 for b in index])
+
+            last_row = self.rows[index]
+            cost = (self.z_array[index] != x[:, None]).astype(np.int64)
+
+            # deletion and substitution
+            row = np.minimum(last_row[:, 1:] + 1, last_row[:, :-1] + cost)
+            row = np.concatenate([i[:, None], row], axis=1)
+
+            # insertion: row[j] = min_{k <= j} (row[k] + j - k)
+            self.rows[index] = np.minimum.accumulate(row - columns, axis=1) + columns
+
+        return self.rows[np.arange(self.batch_size), self.z_len]
+
+
+def build_order_distances(bo_seq, z_bo_seq):
+    # the Levenshtein distances of the [T, B] build orders, incremental along T
+    distance = BuildOrderDistance(len(bo_seq[0]))
+
+    return np.stack([distance.update(bo_list, z_bo_list) for bo_list, z_bo_list in zip(bo_seq, z_bo_seq)])
+
+
+def unit_counts_distances(ucb_seq, z_ucb_seq):
+    # the Hamming distances of the [T, B] unit counts, note the counts are compared as int the same as list2str
+    ucb = np.asarray(ucb_seq).astype(np.int64)
+    z_ucb = np.asarray(z_ucb_seq).astype(np.int64)
+    assert ucb.shape == z_ucb.shape
+
+    return (ucb != z_ucb).sum(axis=-1)
+
+
+def pseudo_rewards(bo_seq, z_bo_seq, ucb_seq, z_ucb_seq, gl_seq):
+    """Returns the rewards by build order and by unit counts of the [T, B] trajectories,
+    the same as reward_by_build_order and reward_by_unit_counts for each step."""
+    dist = build_order_distances(bo_seq, z_bo_seq)
+    reward_bo = -(np.minimum(dist * dist, 50) / 50.0 * 0.8)
+
+    dist = unit_counts_distances(ucb_seq, z_ucb_seq)
+    reward_ucb = -dist * time_decay_scales(gl_seq)
+
+    return reward_bo, reward_ucb
+
+
+def test_pseudo_rewards(T=32, B=16, seed=0):
+    rng = np.random.RandomState(seed)
+
+    # the z changes at the middle, and the build orders are appended, aliased or restarted
+    bo_seq, z_bo_seq, ucb_seq, z_ucb_seq = [], [], [], []
+    bo_list = [[] for _ in range(B)]
+    z_bo_list = [rng.randint(0, 20, rng.randint(0, 20)).tolist() for _ in range(B)]
+    for t in range(T):
+        if t == T // 2:
+            z_bo_list = [z if rng.rand() < 0.5 else rng.randint(0, 20, rng.randint(0, 30)).tolist() for z in z_bo_list]
+        for b in range(B):
+            p = rng.rand()
+            if p < 0.4:
+                bo_list[b] = bo_list[b] + rng.randint(0, 20, rng.randint(1, 3)).tolist()
+            elif p < 0.45:
+                bo_list[b] = rng.randint(0, 20, rng.randint(0, 10)).tolist()
+            elif p < 0.5:
+                bo_list[b].append(rng.randint(0, 20))
+        bo_seq.append(list(bo_list))
+        z_bo_seq.append(list(z_bo_list))
+        ucb_seq.append(rng.randint(0, 3, (B, SCHP.max_unit_type)).astype(np.float32).tolist())
+        z_ucb_seq.append(rng.randint(0, 3, (B, SCHP.max_unit_type)).astype(np.float32).tolist())
+    gl_seq = rng.randint(0, 22.4 * 60 * 30, (T, B)).tolist()
+
+    start = time.time()
+    reward_bo, reward_ucb = pseudo_rewards(bo_seq, z_bo_seq, ucb_seq, z_ucb_seq, gl_seq)
+    batch_time = time.time() - start
+
+    start = time.time()
+    old_reward_bo = [[reward_by_build_order(b1, b2, b5) for b1, b2, b5 in zip(t1, t2, t5)]
+                     for t1, t2, t5 in zip(bo_seq, z_bo_seq, gl_seq)]
+    old_reward_ucb = [[reward_by_unit_counts(b1, b2, b5) for b1, b2, b5 in zip(t1, t2, t5)]
+                      for t1, t2, t5 in zip(ucb_seq, z_ucb_seq, gl_seq)]
+    loop_time = time.time() - start
+
+    assert np.array_equal(reward_bo, np.array(old_reward_bo))
+    assert np.array_equal(reward_ucb, np.array(old_reward_ucb))
+    print("pseudo rewards of [T={}, B={}], loop: {:.4f}s, batch: {:.4f}s".format(T, B, loop_time, batch_time))
+
+
 def test():
     levenshtein = ED.levenshtein_recur
     hammingDist = ED.hammingDist
@@ -124,6 +277,8 @@ def test():
 
     print("hamming distance between 'l_1', 'l_2'", Levenshtein.hamming(s_1, s_2))  
 
+    test_pseudo_rewards()
+
     return
 
 
@@ -18,6 +18,8 @@ from alphastarmini.core.rl.action import ArgsActionLogits
 
 from alphastarmini.core.rl import rl_utils as U
 from alphastarmini.core.rl import pseudo_reward as PR
+from alphastarmini.core.rl import discounted_scan as DS
+from alphastarmini.core.rl.trajectory_buffer import TrajectoryBatch, is_columnar, map_columns
 
 from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
 from alphastarmini.lib.hyper_parameters import StarCraft_Hyper_Parameters as SCHP
@@ -139,6 +141,10 @@ def filter_by_for_lists(action_fields, target_list):
       A tensor corresponding to a subset of `target`, with only the tensors relevant
       to `action_fields`.
     """
+    if not isinstance(target_list, (list, tuple)):
+        # the columns of a TrajectoryBatch, [T x B x 1 x S]
+        return getattr(target_list, action_fields).flatten(0, 2)
+
     return torch.cat([getattr(b, action_fields) for a in target_list for b in a], dim=0)
 
 
@@ -158,12 +164,20 @@ def filter_by_for_masks(action_fields, target_mask):
     index_list = ['action_type', 'delay', 'queue', 'units', 'target_unit', 'target_location']
     index = index_list.index(action_fields)
 
-    mask = torch.tensor(target_mask, device=device)
+    mask = torch.as_tensor(target_mask, device=device)
     mask = mask[:, :, index]
 
     return mask
 
 
+def remove_last_step(trajectories):
+    """Removes the last timestep of each field of the time-major trajectories."""
+    if is_columnar(trajectories):
+        return map_columns(lambda c: c[:-1], trajectories)
+
+    return type(trajectories)._make(item[:-1] for item in trajectories)
+
+
 def compute_over_actions(f, *args):
     """Runs f over all elements in the lists composing *args.
 
@@ -238,7 +252,7 @@ def entropy_loss_for_all_arguments(policy_logits, masks):
     """
 
     index_list = ['action_type', 'delay', 'queue', 'units', 'target_unit', 'target_location']
-    masks = torch.tensor(masks, device=device)
+    masks = torch.as_tensor(masks, device=device)
 
     entropy_list = []
     for x in index_list:     
@@ -378,64 +392,12 @@ def scan_discounted_sum(sequence, decay, initial_value, reverse=False,
     if sequence_lengths is not None:
         raise NotImplementedError
 
-    elems = [sequence, decay]
-
-    print("initial_value", initial_value) if debug else None
-    print("initial_value.shape", initial_value) if debug else None
-
-    if reverse:
-        elems = [_reverse_seq(s, sequence_lengths) for s in elems]
-
-    print("sequence", elems[0]) if debug else None
-    print("sequence.shape", elems[0].shape) if debug else None
-
-    print("decay", elems[1]) if debug else None
-    print("decay.shape", elems[1].shape) if debug else None
-
-    elems = [s.unsqueeze(0) for s in elems]
-
-    elems = torch.cat(elems, dim=0) 
-    print("elems", elems) if debug else None
-    print("elems.shape", elems.shape) if debug else None
+    # note: the old per-step loop here did not carry the first step of the scan into the later steps,
+    # now it is the same as tf.scan (the reference), see discounted_scan.test()
+    summed = DS.discounted_scan(sequence, decay, initial_value.detach(), reverse=reverse)
 
-    elems = torch.transpose(elems, 0, 1)
-    print("elems", elems) if debug else None
-    print("elems.shape", elems.shape) if debug else None
-
-    # we change it to a pytorch version
-    def scan(foo, x, initial_value):
-        res = []
-        a_ = initial_value.clone().detach()
-        print("a_", a_) if debug else None
-        print("a_.shape", a_.shape) if debug else None
-
-        res.append(foo(a_, x[0]).unsqueeze(0))
-        print("res", res) if debug else None
-        print("len(x)", len(x)) if debug else None
-
-        for i in range(1, len(x)):
-            print("i", i) if debug else None
-            res.append(foo(a_, x[i]).unsqueeze(0))
-            print("res", res) if debug else None
-
-            a_ = foo(a_, x[i])
-            print("a_", a_) if debug else None
-            print("a_.shape", a_.shape) if debug else None
-
-        return torch.cat(res)
-
-    # summed = tf.scan(lambda a, x: x[0] + x[1] * a,
-    #                 elems,
-    #                 initializer=tf.convert_to_tensor(initial_value),
-    #                 parallel_iterations=1,
-    #                 back_prop=back_prop)    
-    summed = scan(lambda a, x: x[0] + x[1] * a, elems, initial_value=initial_value)
-
-    print("summed", summed) if debug else None
-    print("summed.shape", summed.shape) if debug else None   
-
-    if reverse:
-        summed = _reverse_seq(summed, sequence_lengths)
+    if not back_prop:
+        summed = summed.detach()
 
     print("summed", summed) if debug else None
 
@@ -740,56 +702,12 @@ def vtrace_from_importance_weights(
     print("deltas:", deltas) if debug else None
     print("deltas.shape:", deltas.shape) if debug else None
 
-    # Note that all sequences are reversed, computation starts from the back.
-    '''
-    Note this code is wrong, we should use zip to concat
-    sequences = (
-        torch.flip(discounts, dims=[0]),
-        torch.flip(cs, dims=[0]),
-        torch.flip(deltas, dims=[0]),
-    )
-    '''
-
-    flip_discounts = torch.flip(discounts, dims=[0])
-    flip_cs = torch.flip(cs, dims=[0])
-    flip_deltas = torch.flip(deltas, dims=[0])
-
-    sequences = [item for item in zip(flip_discounts, flip_cs, flip_deltas)]
-
-    # V-trace vs are calculated through a 
+    # V-trace vs are calculated through a
     # scan from the back to the beginning
     # of the given trajectory.
-
-    def scanfunc(acc, sequence_item):
-        print("sequence_item", sequence_item) if debug else None
-        discount_t, c_t, delta_t = sequence_item
-        return delta_t + discount_t * c_t * acc
-
+    # i.e., acc = delta_t + discount_t * c_t * acc, with the initial acc of zeros
     initial_values = torch.zeros_like(bootstrap_value, device=device)
-
-    # our implemented scan function for pytorch
-    def scan(foo, x, initial_value):
-        res = []
-        a_ = initial_value.clone().detach()
-        print("a_", a_) if debug else None
-        print("a_.shape", a_.shape) if debug else None
-
-        res.append(foo(a_, x[0]).unsqueeze(0))
-        print("res", res) if debug else None
-        print("len(x)", len(x)) if debug else None
-
-        for i in range(1, len(x)):
-            print("i", i) if debug else None
-            res.append(foo(a_, x[i]).unsqueeze(0))
-            print("res", res) if debug else None
-
-            a_ = foo(a_, x[i])
-            print("a_", a_) if debug else None
-            print("a_.shape", a_.shape) if debug else None
-
-        return torch.cat(res)
-
-    vs_minus_v_xs = scan(foo=scanfunc, x=sequences, initial_value=initial_values)
+    vs_minus_v_xs = DS.discounted_scan(deltas, discounts, initial_values, reverse=True, traces=cs)
 
     '''
     # the original tensorflow code
@@ -801,9 +719,6 @@ def vtrace_from_importance_weights(
         back_prop=False)
         '''
 
-    # Reverse the results back to original order.
-    vs_minus_v_xs = torch.flip(vs_minus_v_xs, dims=[0])
-
     # Add V(x_s) to get v_s.
     vs = torch.add(vs_minus_v_xs, values)
 
@@ -910,7 +825,7 @@ def vtrace_pg_loss(target_logits, baselines, rewards, trajectories,
     # 
     print("action_fields", action_fields) if debug else None
 
-    trajectories = Trajectory(*tuple(item[:-1] for item in trajectories))
+    trajectories = remove_last_step(trajectories)
     print("trajectories.reward", trajectories.reward) if debug else None
 
     rewards = rewards[:-1]
@@ -1120,7 +1035,7 @@ def split_upgo_loss(target_logits, baselines, trajectories):
     See Methods for details on UPGO.
     """
     # Remove last timestep from trajectories and baselines.
-    trajectories = Trajectory(*tuple(t[:-1] for t in trajectories))
+    trajectories = remove_last_step(trajectories)
     print("trajectories.reward", trajectories.reward) if debug else None
 
     values = baselines[:-1]
@@ -1255,9 +1170,12 @@ def upgo_loss_like_vtrace(target_logits, values, trajectories, returns, action_f
     return result
 
 
-def compute_pseudoreward(trajectories, reward_name):
+def compute_pseudoreward(trajectories, reward_name, pseudo_rewards=None):
     """Computes the relevant pseudoreward from trajectories.
 
+    pseudo_rewards: (optional) the (reward_bo, reward_ucb) from PR.pseudo_rewards, which can be
+    shared by the calls for the different reward names.
+
     See Methods and detailed_architecture.txt for details.
 
     Paper description:
@@ -1341,7 +1259,7 @@ def compute_pseudoreward(trajectories, reward_name):
 
     # add to use reward_name to judge to use the win loss reward
     if reward_name == 'winloss_baseline':
-        rewards_tensor = torch.tensor(trajectories.reward, dtype=torch.float32, device=device)
+        rewards_tensor = torch.as_tensor(trajectories.reward, dtype=torch.float32, device=device)
         return rewards_tensor
 
     # if we don't use replays to generate reward, just return the result reward
@@ -1386,33 +1304,16 @@ def compute_pseudoreward(trajectories, reward_name):
         weight_hamming = 0.0
         weight_leven = 0.0
 
-    rewards_traj = []
-    for t1, t2, t3, t4, t5 in zip(trajectories.build_order, trajectories.z_build_order,
-                                  trajectories.unit_counts, trajectories.z_unit_counts,
-                                  trajectories.game_loop):
-        # Calculate the Levenshtein distance,
-        leven_batch = []
-        for b1, b2, b5 in zip(t1, t2, t5):
-            r = PR.reward_by_build_order(b1, b2, b5)
-            leven_batch.append(r)
-        print('leven_batch:', leven_batch) if debug else None
-
-        # Calculate the Hamming distance,
-        hamming_batch = []
-        for b1, b2, b5 in zip(t3, t4, t5):
-            r = PR.reward_by_unit_counts(b1, b2, b5)
-            hamming_batch.append(r)
-        print('hamming_batch:', hamming_batch) if debug else None
-
-        reward_batch = []
-        for r1, r2 in zip(leven_batch, hamming_batch):
-            reward_batch.append(weight_leven * r1 + weight_hamming * r2)
-        print('reward_batch:', reward_batch) if debug else None
-
-        rewards_traj.append(reward_batch)
-
-    print('rewards_traj:', rewards_traj) if debug else None 
-    rewards_numpy = np.array(rewards_traj)
+    if pseudo_rewards is None:
+        pseudo_rewards = PR.pseudo_rewards(trajectories.build_order, trajectories.z_build_order,
+                                           trajectories.unit_counts, trajectories.z_unit_counts,
+                                           trajectories.game_loop)
+
+    # Calculate the Levenshtein distance and the Hamming distance of all the steps together,
+    reward_bo, reward_ucb = pseudo_rewards
+    rewards_numpy = weight_leven * reward_bo + weight_hamming * reward_ucb
+    print('rewards_numpy:', rewards_numpy) if debug else None
+
     rewards_tensor = torch.tensor(rewards_numpy, dtype=torch.float32, device=device)
 
     return rewards_tensor
@@ -1470,12 +1371,16 @@ def loss_function(agent, trajectories):
     # note, we change the structure of the trajectories
     # note, the size is all list
     # shape: [batch_size x dict_name x seq_size]
-    trajectories = U.stack_namedtuple(trajectories) 
-    # shape: [dict_name x batch_size x seq_size]
-    print("trajectories.reward", trajectories.reward) if debug else None   
+    if isinstance(trajectories, TrajectoryBatch):
+        # the columns are already [dict_name x batch_size x seq_size], so only the views are transposed
+        trajectories = trajectories.time_major()
+    else:
+        trajectories = U.stack_namedtuple(trajectories) 
+        # shape: [dict_name x batch_size x seq_size]
+        print("trajectories.reward", trajectories.reward) if debug else None   
 
-    # shape: [dict_name x batch_size x seq_size]
-    trajectories = U.namedtuple_zip(trajectories) 
+        # shape: [dict_name x batch_size x seq_size]
+        trajectories = U.namedtuple_zip(trajectories) 
     # shape: [dict_name x seq_size x batch_size]
     print("trajectories.reward", trajectories.reward) if debug else None   
 
@@ -1486,6 +1391,11 @@ def loss_function(agent, trajectories):
     # See the paper methods and detailed_architecture.txt for more details.
     BASELINE_COSTS_AND_REWARDS = get_baseline_hyperparameters()
 
+    # the pseudo rewards are computed once for all the reward names
+    pseudo_rewards = PR.pseudo_rewards(trajectories.build_order, trajectories.z_build_order,
+                                       trajectories.unit_counts, trajectories.z_unit_counts,
+                                       trajectories.game_loop)
+
     reward_index = 1
     for baseline, costs_and_rewards in zip(baselines, BASELINE_COSTS_AND_REWARDS):
         # baseline is for caluculation in td_lambda and vtrace_pg
@@ -1498,7 +1408,7 @@ def loss_function(agent, trajectories):
             pg_cost, baseline_cost, reward_name = costs_and_rewards
 
             print("reward_name:", reward_name) if debug else None
-            rewards = compute_pseudoreward(trajectories, reward_name)
+            rewards = compute_pseudoreward(trajectories, reward_name, pseudo_rewards)
 
             # The action_type argument, delay, and all other arguments are separately updated 
             # using a separate ("split") VTrace Actor-Critic losses. The weighting of these 
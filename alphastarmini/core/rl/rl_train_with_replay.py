@@ -14,6 +14,7 @@ from pysc2.env.sc2_env import Race
 from alphastarmini.core.rl.rl_utils import get_supervised_agent
 from alphastarmini.core.rl.learner import Learner
 from alphastarmini.core.rl.actor_plus_z import ActorLoopPlusZ
+from alphastarmini.core.rl import z_library as Z
 
 # below packages are for test
 from alphastarmini.core.ma.league import League
@@ -25,7 +26,7 @@ __author__ = "Ruo-Ze Liu"
 debug = False
 
 
-def test(on_server=False, replay_path=None):
+def test(on_server=False, replay_path=None, z_library_path=Z.Z_LIBRARY_PATH):
     # model path
     MODEL_TYPE = "sl"
     MODEL_PATH = "./model/"
@@ -41,6 +42,10 @@ def test(on_server=False, replay_path=None):
         league_exploiters=0)
 
     coordinator = Coordinator(league)
+
+    # the expert z-statistics of the replays, shared by all the actors
+    z_library = Z.get_z_library(replay_path=replay_path, library_path=z_library_path)
+
     learners = []
     actors = []
 
@@ -48,7 +53,7 @@ def test(on_server=False, replay_path=None):
         player = league.get_learning_player(idx)
         learner = Learner(player, max_time_for_training=60 * 60 * 24)
         learners.append(learner)
-        actors.extend([ActorLoopPlusZ(player, coordinator, replay_path=replay_path) for _ in range(ACTOR_NUMS)])
+        actors.extend([ActorLoopPlusZ(player, coordinator, z_library=z_library) for _ in range(ACTOR_NUMS)])
 
     threads = []
     for l in learners:
@@ -7,10 +7,16 @@
 import os
 import torch
 import traceback
+import itertools
 import collections
 
 from alphastarmini.lib.utils import load_latest_model, initial_model_state_dict
+from alphastarmini.core.arch.agent import Agent
+from alphastarmini.core.arch.scalar_encoder import ScalarFeatureAssembler
 from alphastarmini.core.rl.alphastar_agent import AlphaStarAgent
+from alphastarmini.core.rl.compact_state import CompactState
+
+from alphastarmini.lib.hyper_parameters import ScalarFeature
 
 __author__ = "Ruo-Ze Liu"
 
@@ -34,10 +40,41 @@ TRAJECTORY_FIELDS = [
     'unit_counts',  # unit_counts
     'z_unit_counts',  # the unit_counts for the sampled replay
     'game_loop',  # seconds = int(game_loop / 22.4) 
+    'policy_version',  # the version of the published parameters which made the step, None if not published
 ]
 
 Trajectory = collections.namedtuple('Trajectory', TRAJECTORY_FIELDS)
 
+# the trajectory with the already preprocessed inputs of the learner instead of the raw observations,
+# so the learner does not need to preprocess them again
+COMPACT_TRAJECTORY_FIELDS = [
+    'state',  # CompactState of the player observation, with the build order.
+    'baseline_state',  # Scalar list of the player, used for value network.
+    'baseline_opponent_state',  # Scalar list of the opponent, used for value network.
+] + TRAJECTORY_FIELDS[2:]
+
+CompactTrajectory = collections.namedtuple('CompactTrajectory', COMPACT_TRAJECTORY_FIELDS)
+
+
+def get_compact_inputs(home_state, away_state, build_order=None):
+    """Returns the state, baseline_state and baseline_opponent_state of a CompactTrajectory, which are 
+    the same as what AlphaStarAgent.unroll makes from the observations, using the states the actor has computed."""
+
+    # the actor makes the state without the build order, which only affects the beginning_build_order
+    statistical_state = list(home_state.statistical_state)
+    if build_order is not None:
+        beginning_build_order = torch.zeros_like(statistical_state[ScalarFeature.beginning_build_order])
+        ScalarFeatureAssembler.encode_build_order(build_order, beginning_build_order.numpy())
+        statistical_state[ScalarFeature.beginning_build_order] = beginning_build_order
+
+    state = CompactState.from_state(home_state)
+    state.statistical_state = statistical_state
+
+    baseline_state = Agent.get_baseline_scalar_list(statistical_state)
+    baseline_opponent_state = Agent.get_baseline_scalar_list(away_state.statistical_state)
+
+    return state, baseline_state, baseline_opponent_state
+
 
 def get_supervised_agent(race, path="./model/", model_type="sl", restore=True):
     as_agent = AlphaStarAgent(name='supervised', race=race, initial_weights=None)
@@ -55,7 +92,7 @@ def namedtuple_one_list(trajectory_list):
     try:           
         d = [list(itertools.chain(*l)) for l in zip(*trajectory_list)]
         #print('len(d):', len(d))
-        new = Trajectory._make(d)
+        new = type(trajectory_list[0])._make(d)
 
     except Exception as e:
         print("stack_namedtuple Exception cause return, Detials of the Exception:", e)
@@ -70,7 +107,7 @@ def stack_namedtuple(trajectory):
     try:           
         d = list(zip(*trajectory))
         #print('len(d):', len(d))
-        new = Trajectory._make(d)
+        new = type(trajectory[0])._make(d)
 
     except Exception as e:
         print("stack_namedtuple Exception cause return, Detials of the Exception:", e)
@@ -84,7 +121,7 @@ def stack_namedtuple(trajectory):
 def namedtuple_zip(trajectory):
     try: 
         d = [list(zip(*z)) for z in trajectory]
-        new = Trajectory._make(d)
+        new = type(trajectory)._make(d)
 
     except Exception as e:
         print("namedtuple_zip Exception cause return, Detials of the Exception:", e)
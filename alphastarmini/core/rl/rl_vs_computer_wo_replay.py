@@ -14,8 +14,11 @@ import torch
 from pysc2.env.sc2_env import SC2Env, AgentInterfaceFormat, Agent, Race, Bot, Difficulty, BotBuild
 from pysc2.lib import actions as sc2_actions
 
-from alphastarmini.core.rl.rl_utils import Trajectory, get_supervised_agent
+from alphastarmini.core.rl.rl_utils import Trajectory, CompactTrajectory, get_supervised_agent
 from alphastarmini.core.rl.learner import Learner
+from alphastarmini.core.rl.actor_inference import ActorInference
+from alphastarmini.core.rl.parameter_store import ParameterPuller
+from alphastarmini.core.rl.actor_pool import ActorPool
 from alphastarmini.core.rl import rl_utils as RU
 
 from alphastarmini.lib import utils as L
@@ -46,6 +49,9 @@ VERSION = '4.10.0'
 
 RESTORE = False
 
+# runs the actors in the processes (ActorPool) instead of the threads
+ACTOR_PROCESSES = False
+
 # gpu setting
 ON_GPU = torch.cuda.is_available()
 DEVICE = torch.device("cuda:0" if ON_GPU else "cpu")
@@ -68,7 +74,8 @@ class ActorVSComputer:
     def __init__(self, player, coordinator, max_time_for_training = 60 * 60 * 24,
                  max_time_per_one_opponent=60 * 60 * 4,
                  max_frames_per_episode=22.4 * 60 * 15, max_frames=22.4 * 60 * 60 * 24, 
-                 max_episodes=MAX_EPISODES, is_training=IS_TRAINING):
+                 max_episodes=MAX_EPISODES, is_training=IS_TRAINING, env_fn=None,
+                 inference_service=None):
         self.player = player
 
         print('initialed player')
@@ -77,11 +84,18 @@ class ActorVSComputer:
         if ON_GPU:
             self.player.agent.agent_nn.to(DEVICE)
 
-        self.teacher = get_supervised_agent(player.race, model_type="sl", restore=RESTORE)
+        # the actors of the inference service share its teacher of the race, whose forwards are batched
+        teacher_fn = lambda: get_supervised_agent(player.race, model_type="sl", restore=RESTORE)
+        self.teacher = teacher_fn() if inference_service is None else \
+            inference_service.register(('teacher', player.race), teacher_fn)
         print('initialed teacher')
         if ON_GPU:
             self.teacher.agent_nn.to(DEVICE)
 
+        # runs the forwards of the player and the teacher together,
+        # or sends them to the inference service shared by the actors
+        self.inference = ActorInference() if inference_service is None else inference_service.client()
+
         self.coordinator = coordinator
         self.max_time_for_training = max_time_for_training
         self.max_time_per_one_opponent = max_time_per_one_opponent
@@ -90,6 +104,15 @@ class ActorVSComputer:
         self.max_episodes = max_episodes
         self.is_training = is_training
 
+        # a function to create the env instead of SC2Env, e.g., the synthetic env for the benchmarks
+        self.env_fn = env_fn
+
+        # the inference runs a local copy of the agent of the player, which pulls the parameters the learner
+        # publishes at the episode and unroll boundaries, instead of reading the agent the learner updates,
+        # the actors of the inference service share one copy
+        self.puller = ParameterPuller(player) if inference_service is None else inference_service.puller(player)
+        self.agent = self.puller.agent
+
         self.thread = threading.Thread(target=self.run, args=())
 
         self.thread.daemon = True                            # Daemonize thread
@@ -117,7 +140,7 @@ class ActorVSComputer:
 
             # use max_episodes to end the loop
             while time() - start_time < self.max_time_for_training:
-                agents = [self.player]
+                agents = [self.agent]
 
                 with self.create_env_one_player(self.player) as env:
 
@@ -128,7 +151,7 @@ class ActorVSComputer:
                     for agent, obs_spec, act_spec in zip(agents, observation_spec, action_spec):
                         agent.setup(obs_spec, act_spec)
 
-                    self.teacher.setup(self.player.agent.obs_spec, self.player.agent.action_spec)
+                    self.teacher.setup(self.agent.obs_spec, self.agent.action_spec)
 
                     print('player:', self.player) if debug else None
                     print('opponent:', "Computer bot") if debug else None
@@ -145,6 +168,8 @@ class ActorVSComputer:
                         total_episodes += 1
                         print("total_episodes:", total_episodes)
 
+                        policy_version = self.puller.pull()
+
                         timesteps = env.reset()
                         for a in agents:
                             a.reset()
@@ -152,11 +177,12 @@ class ActorVSComputer:
                         [home_obs] = timesteps
                         is_final = home_obs.last()
 
-                        player_memory = self.player.agent.initial_state()
+                        player_memory = self.agent.initial_state()
                         teacher_memory = self.teacher.initial_state()
 
                         # initial build order
-                        player_bo = []
+                        player_tracker = L.BuildOrderTracker(home_obs.observation)
+                        player_bo = player_tracker.build_order
 
                         episode_frames = 0
                         # default outcome is 0 (means draw)
@@ -171,7 +197,10 @@ class ActorVSComputer:
                             total_frames += 1
                             episode_frames += 1
 
-                            player_step = self.player.agent.step_logits(home_obs, player_memory)
+                            # note: home_obs is preprocessed only once for the player and the teacher
+                            player_step, teacher_step = self.inference.step([self.agent, self.teacher], 
+                                                                            [home_obs, home_obs], 
+                                                                            [player_memory, teacher_memory])
                             player_function_call, player_action, player_logits, player_new_memory = player_step
                             print("player_function_call:", player_function_call) if debug else None
 
@@ -182,7 +211,6 @@ class ActorVSComputer:
                             # may change implemention of teacher_logits
                             # teacher_logits = self.teacher(home_obs, player_action, teacher_memory)
 
-                            teacher_step = self.teacher.step_logits(home_obs, teacher_memory)
                             teacher_function_call, teacher_action, teacher_logits, teacher_new_memory = teacher_step
                             print("teacher_function_call:", teacher_function_call) if debug else None
 
@@ -204,22 +232,29 @@ class ActorVSComputer:
 
                             is_final = home_next_obs.last()
 
+                            # calculate the unit counts of bag (of home_obs, before the tracker steps to home_next_obs)
+                            player_ucb = player_tracker.unit_counts_list()
+                            print("player unit count of bow:", sum(player_ucb)) if debug else None
+
                             # calculate the build order
-                            player_bo = L.calculate_build_order(player_bo, home_obs.observation, home_next_obs.observation)
+                            player_bo = player_tracker.update(home_next_obs.observation)
                             print("player build order:", player_bo) if debug else None
 
-                            # calculate the unit counts of bag
-                            player_ucb = L.calculate_unit_counts_bow(home_obs.observation).reshape(-1).numpy().tolist()
-                            print("player unit count of bow:", sum(player_ucb)) if debug else None
-
                             game_loop = home_obs.observation.game_loop[0]
                             print("game_loop", game_loop)
 
+                            # the states preprocessed in the inference are sent, instead of the observations,
+                            # note there is no opponent agent here, so the home state is also used for the opponent
+                            home_state, _ = self.inference.states
+                            state, baseline_state, baseline_opponent_state = RU.get_compact_inputs(home_state, home_state, 
+                                                                                                   build_order=player_bo)
+
                             # note, original AlphaStar pseudo-code has some mistakes, we modified 
                             # them here
-                            traj_step = Trajectory(
-                                observation=home_obs.observation,
-                                opponent_observation=home_obs.observation,
+                            traj_step = CompactTrajectory(
+                                state=state,
+                                baseline_state=baseline_state,
+                                baseline_opponent_state=baseline_opponent_state,
                                 memory=player_memory,
                                 z=z,
                                 masks=action_masks,
@@ -234,6 +269,7 @@ class ActorVSComputer:
                                 unit_counts=player_ucb,
                                 z_unit_counts=player_ucb,  # we change it to the sampled unit counts
                                 game_loop=game_loop,
+                                policy_version=policy_version,
                             )
                             trajectory.append(traj_step)
 
@@ -256,6 +292,8 @@ class ActorVSComputer:
 
                                             self.player.learner.send_trajectory(trajectories)
                                             trajectory = []
+
+                                            policy_version = self.puller.pull()
                                     else:
                                         print("Learner stops!")
 
@@ -295,6 +333,9 @@ class ActorVSComputer:
                               step_mul=STEP_MUL, version=VERSION, 
                               map_name=MAP_NAME, random_seed=RANDOM_SEED):
 
+        if self.env_fn is not None:
+            return self.env_fn()
+
         player_aif = AgentInterfaceFormat(**AAIFP._asdict())
         agent_interface_format = [player_aif]
 
@@ -526,7 +567,10 @@ def test(on_server=False, replay_path=None):
         player = league.get_learning_player(idx)
         learner = Learner(player, max_time_for_training=60 * 60 * 24)
         learners.append(learner)
-        actors.extend([ActorVSComputer(player, coordinator) for _ in range(ACTOR_NUMS)])
+        if ACTOR_PROCESSES:
+            actors.append(ActorPool(player, coordinator, ACTOR_NUMS, actor_class=ActorVSComputer))
+        else:
+            actors.extend([ActorVSComputer(player, coordinator) for _ in range(ACTOR_NUMS)])
 
     threads = []
     for l in learners:
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" The synthetic stand-in of the SC2 environment, for the throughput benchmarks of the actors without the game"
+
+import time
+import collections
+
+import numpy as np
+
+from s2clientprotocol import sc2api_pb2 as sc_pb
+
+from pysc2.env import environment as E
+from pysc2.env.sc2_env import AgentInterfaceFormat
+from pysc2.lib import features, named_array, point
+from pysc2.lib.features import FeatureUnit, Player, EffectPos, MINIMAP_FEATURES
+
+from alphastarmini.core.arch.agent import random_raw_units
+from alphastarmini.core.arch.spatial_encoder import random_feature_minimap
+
+from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
+from alphastarmini.lib.hyper_parameters import AlphaStar_Agent_Interface_Format_Params as AAIFP
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+STEP_MUL = 8
+GAME_STEPS_PER_EPISODE = 18000
+LOOPS_PER_MINUTE = 22.4 * 60
+
+# the distributions of the synthetic observations, use _replace to change some of them
+SyntheticEnvParams = collections.namedtuple('SyntheticEnvParams', [
+    'episode_loops',    # (mean, std) of the game loops of an episode
+    'unit_num',         # (start, growth per minute, std) of the number of the raw units
+    'self_unit_ratio',  # the ratio of the units of the player (alliance 1), the others are neutral or enemy
+    'move_ratio',       # the ratio of the units which move one pixel in each step
+    'minimap_change',   # the ratio of the pixels of each minimap layer which change in each step
+    'minerals',         # (start, growth per minute, std) of the minerals, the same for the vespene
+    'food_cap',         # (start, growth per minute, max)
+    'outcome_probs',    # the probabilities of the [loss, draw, win] of the home player
+    'step_cost',        # the seconds which the game takes in each step (slept), 0 for none
+])
+
+DEFAULT_PARAMS = SyntheticEnvParams(episode_loops=(LOOPS_PER_MINUTE * 12, LOOPS_PER_MINUTE * 4),
+                                    unit_num=(40, 15, 5),
+                                    self_unit_ratio=0.5,
+                                    move_ratio=0.2,
+                                    minimap_change=0.01,
+                                    minerals=(50, 400, 100),
+                                    food_cap=(15, 12, 200),
+                                    outcome_probs=(0.4, 0.2, 0.4),
+                                    step_cost=0.)
+
+
+class SyntheticPlayerState(object):
+    '''
+    The state of the game from the view of one player, which changes a little in each step,
+    so the observations are like the ones in a game (the units stay, appear and die).
+    '''
+
+    def __init__(self, params, rng):
+        super(SyntheticPlayerState, self).__init__()
+        self.params = params
+        self.rng = rng
+        self.next_tag = 0
+        self.raw_units = np.zeros((0, len(FeatureUnit)), dtype=np.int64)
+        self.feature_minimap = random_feature_minimap(seed=rng.randint(2 ** 31))
+        self.scales = np.array([f.scale for f in MINIMAP_FEATURES]).reshape(-1, 1)
+
+    def new_units(self, unit_num):
+        units = np.asarray(random_raw_units(unit_num, seed=self.rng.randint(2 ** 31)))
+        units[:, FeatureUnit.alliance] = np.where(self.rng.rand(unit_num) < self.params.self_unit_ratio, 1,
+                                                  self.rng.choice([3, 4], unit_num))
+        units[:, FeatureUnit.tag] = 4294967296 + (self.next_tag + np.arange(unit_num)) * 4
+        self.next_tag += unit_num
+        return units
+
+    def step(self, game_loop):
+        start, growth, std = self.params.unit_num
+        minutes = game_loop / LOOPS_PER_MINUTE
+        unit_num = int(np.clip(start + growth * minutes + self.rng.randn() * std, 1, AHP.max_entities))
+
+        # the units appear or die
+        diff = unit_num - len(self.raw_units)
+        if diff > 0:
+            self.raw_units = np.concatenate([self.raw_units, self.new_units(diff)])
+        elif diff < 0:
+            self.raw_units = np.delete(self.raw_units, self.rng.choice(len(self.raw_units), -diff, replace=False), 0)
+
+        # the units move
+        moved = self.rng.rand(len(self.raw_units)) < self.params.move_ratio
+        for c in (FeatureUnit.x, FeatureUnit.y):
+            self.raw_units[moved, c] = np.clip(self.raw_units[moved, c] + self.rng.randint(-1, 2, moved.sum()),
+                                               0, AHP.minimap_size - 1)
+
+        # the minimap layers change
+        layers = self.feature_minimap.reshape(len(MINIMAP_FEATURES), -1)
+        change_num = int(layers.shape[1] * self.params.minimap_change)
+        index = self.rng.randint(0, layers.shape[1], (len(MINIMAP_FEATURES), change_num))
+        np.put_along_axis(layers, index, (self.rng.rand(len(MINIMAP_FEATURES), change_num) * self.scales).astype(layers.dtype),
+                          axis=1)
+
+        return self.observation(game_loop, minutes)
+
+    def observation(self, game_loop, minutes):
+        raw_units = named_array.NamedNumpyArray(self.raw_units.copy(), [None, FeatureUnit], dtype=np.int64)
+
+        self_units = self.raw_units[self.raw_units[:, FeatureUnit.alliance] == 1]
+        unit_types, counts = np.unique(self_units[:, FeatureUnit.unit_type], return_counts=True)
+
+        start, growth, std = self.params.minerals
+        minerals = max(int(start + growth * minutes + self.rng.randn() * std), 0)
+        start, growth, max_cap = self.params.food_cap
+        food_cap = int(min(start + growth * minutes, max_cap))
+        player = np.zeros(len(Player), dtype=np.int64)
+        player[Player.player_id] = 1
+        player[Player.minerals] = minerals
+        player[Player.vespene] = minerals // 3
+        player[Player.food_cap] = food_cap
+        player[Player.food_used] = min(len(self_units), food_cap)
+        player[Player.food_workers] = player[Player.food_used] // 2
+        player[Player.food_army] = player[Player.food_used] - player[Player.food_workers]
+        player[Player.army_count] = player[Player.food_army]
+
+        return named_array.NamedDict({
+            'raw_units': raw_units,
+            'feature_minimap': named_array.NamedNumpyArray(self.feature_minimap.copy(),
+                                                           [MINIMAP_FEATURES._fields, None, None], dtype=np.int32),
+            'player': named_array.NamedNumpyArray(player, Player, dtype=np.int64),
+            'unit_counts': np.stack([unit_types, counts], axis=1).astype(np.int64).reshape(-1, 2),
+            'game_loop': np.array([game_loop], dtype=np.int32),
+            'upgrades': np.array([], dtype=np.int32),
+            'last_actions': np.array([], dtype=np.int32),
+            'available_actions': np.array([0], dtype=np.int32),
+            'action_result': np.array([], dtype=np.int32),
+            'alerts': np.array([], dtype=np.int32),
+            'home_race_requested': np.array([1], dtype=np.int32),
+            'away_race_requested': np.array([1], dtype=np.int32),
+            'feature_effects': np.zeros((0, len(EffectPos)), dtype=np.int32),
+            'raw_effects': np.zeros((0, len(EffectPos)), dtype=np.int32),
+        })
+
+
+class SyntheticSC2Env(object):
+    '''
+    A deterministic (by the seed) stand-in of pysc2 SC2Env with the same reset/step/observation_spec/action_spec,
+    which returns the pysc2-shaped timesteps, and accepts the raw function calls (or the sc_pb.Action),
+    the function calls are transformed by the pysc2 features as in the real env.
+    '''
+
+    def __init__(self, num_players=2, params=DEFAULT_PARAMS, step_mul=STEP_MUL,
+                 game_steps_per_episode=GAME_STEPS_PER_EPISODE, seed=0, map_size=AHP.minimap_size):
+        super(SyntheticSC2Env, self).__init__()
+        self.num_players = num_players
+        self.params = params
+        self.step_mul = step_mul
+        self.game_steps_per_episode = game_steps_per_episode
+        self.rng = np.random.RandomState(seed)
+
+        # the same features as the real env makes for the agent interface format of mAS
+        self._features = [features.Features(AgentInterfaceFormat(**AAIFP._asdict()),
+                                            map_size=point.Point(map_size, map_size))
+                          for _ in range(num_players)]
+
+        self.states = None
+        self.game_loop = 0
+        self.episode_loops = 0
+
+        # statistics
+        self.episode_num = 0
+        self.step_num = 0
+        self.action_num = 0
+        self.env_time = 0.
+
+    def observation_spec(self):
+        return tuple(f.observation_spec() for f in self._features)
+
+    def action_spec(self):
+        return tuple(f.action_spec() for f in self._features)
+
+    def timesteps(self, step_type, outcome=0):
+        obs_list = [state.step(self.game_loop) for state in self.states]
+
+        # the tags of the unit indexes in the raw actions, the same as the features does in transform_obs
+        for f, obs in zip(self._features, obs_list):
+            f._raw_tags = obs['raw_units'][:, FeatureUnit.tag]
+
+        discount = 0. if step_type == E.StepType.LAST else 1.
+        rewards = [outcome, -outcome]
+        self.last_obs_list = obs_list
+
+        return tuple(E.TimeStep(step_type=step_type, reward=rewards[i], discount=discount, observation=obs)
+                     for i, obs in enumerate(obs_list))
+
+    def reset(self):
+        start_time = time.time()
+
+        self.episode_num += 1
+        self.game_loop = 0
+        mean, std = self.params.episode_loops
+        self.episode_loops = int(np.clip(self.rng.randn() * std + mean, self.step_mul, None))
+        if self.game_steps_per_episode:
+            self.episode_loops = min(self.episode_loops, self.game_steps_per_episode)
+        self.states = [SyntheticPlayerState(self.params, np.random.RandomState(self.rng.randint(2 ** 31)))
+                       for _ in range(self.num_players)]
+
+        timesteps = self.timesteps(E.StepType.FIRST)
+        self.env_time += time.time() - start_time
+
+        return timesteps
+
+    def step(self, actions):
+        start_time = time.time()
+        assert len(actions) == self.num_players, 'expect %d actions, got %d' % (self.num_players, len(actions))
+
+        # raises ValueError for the invalid function calls, as the real env
+        for f, obs, action in zip(self._features, self.last_obs_list, actions):
+            if not isinstance(action, sc_pb.Action):
+                f.transform_action(obs, action, skip_available=True)
+            self.action_num += 1
+
+        if self.params.step_cost:
+            time.sleep(self.params.step_cost)
+
+        self.step_num += 1
+        self.game_loop += self.step_mul
+        if self.game_loop >= self.episode_loops:
+            outcome = self.rng.choice([-1, 0, 1], p=self.params.outcome_probs)
+            timesteps = self.timesteps(E.StepType.LAST, outcome)
+        else:
+            timesteps = self.timesteps(E.StepType.MID)
+        self.env_time += time.time() - start_time
+
+        return timesteps
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def stats(self):
+        return {'episode_num': self.episode_num,
+                'step_num': self.step_num,
+                'action_num': self.action_num,
+                'env_time': self.env_time,
+                'step_time': self.env_time / max(self.step_num, 1)}
+
+    def __str__(self):
+        s = self.stats()
+        return "episodes: %d, steps: %d, env time: %.3fs, env time per step: %.6fs" % (
+            s['episode_num'], s['step_num'], s['env_time'], s['step_time'])
+
+
+def run_actor(actor, env):
+    # runs the actor and the learner of its player in the threads as in training, returns the frames per second
+    learner = actor.player.learner
+    learner.start()
+    start_time = time.time()
+    actor.start()
+    actor.thread.join()
+    elapsed_time = time.time() - start_time
+    learner.thread.join()
+
+    print("{}: {} frames in {:.3f}s, {:.3f} fps, learner updates: {}, env: {}".format(
+        type(actor).__name__, env.step_num, elapsed_time, env.step_num / elapsed_time, learner.update_num, env))
+    return env.step_num / elapsed_time
+
+
+def test(max_frames=16):
+    from pysc2.env.sc2_env import Race
+
+    from alphastarmini.core.rl.alphastar_agent import AlphaStarAgent
+    from alphastarmini.core.rl.env_run_loop import run_loop
+    from alphastarmini.core.rl.rl_utils import get_supervised_agent
+    from alphastarmini.core.rl.actor import ActorLoop
+    from alphastarmini.core.rl.learner import Learner
+    from alphastarmini.core.rl.rl_vs_computer_wo_replay import ActorVSComputer
+    from alphastarmini.core.ma.league import League
+    from alphastarmini.core.ma.coordinator import Coordinator
+
+    params = DEFAULT_PARAMS._replace(episode_loops=(STEP_MUL * 10, STEP_MUL * 2))
+
+    # deterministic by the seed
+    env_1, env_2 = SyntheticSC2Env(params=params, seed=1), SyntheticSC2Env(params=params, seed=1)
+    for t1, t2 in zip(env_1.reset() + env_1.step([sc_pb.Action()] * 2), env_2.reset() + env_2.step([sc_pb.Action()] * 2)):
+        assert np.array_equal(t1.observation['raw_units'], t2.observation['raw_units'])
+        assert np.array_equal(t1.observation['feature_minimap'], t2.observation['feature_minimap'])
+
+    # the observations can be preprocessed and the actions of the agents can be transformed
+    with SyntheticSC2Env(params=params) as env:
+        agents = [AlphaStarAgent(name) for name in ('home', 'away')]
+        run_loop(agents, env, max_frames=max_frames)
+        print("run_loop env:", env)
+        assert env.step_num > 0
+
+    league = League(initial_agents={race: get_supervised_agent(race, restore=False) for race in [Race.protoss]},
+                    main_players=1, main_exploiters=0, league_exploiters=0)
+    coordinator = Coordinator(league)
+    player = league.get_learning_player(0)
+
+    env = SyntheticSC2Env(params=params)
+    Learner(player, max_time_for_training=60 * 5)
+    actor = ActorLoop(player, coordinator, max_frames=max_frames, env_fn=lambda: env)
+    run_actor(actor, env)
+    assert env.step_num > 0
+
+    env = SyntheticSC2Env(num_players=1, params=params)
+    Learner(player, max_time_for_training=60 * 5)
+    actor = ActorVSComputer(player, coordinator, max_frames=max_frames, env_fn=lambda: env)
+    run_actor(actor, env)
+    assert env.step_num > 0
@@ -0,0 +1,689 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" The columnar ring buffer of the trajectories, which gives the learner the batches as the views of the columns"
+
+import copy
+import numbers
+import threading
+import collections
+
+import numpy as np
+
+import torch
+
+from alphastarmini.core.rl.trajectory_queue import TrajectoryQueue, BLOCK
+
+from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+# the fields of the variable sizes (the observations, the compact states with the entities, the build orders),
+# which are kept as the objects instead of the columns
+OBJECT_FIELDS = ('observation', 'opponent_observation', 'state', 'build_order', 'z_build_order')
+
+# the kinds of the nodes in the layout of a step
+TENSOR, ARRAY, NUMBER, NUMBERS, NAMEDTUPLE, TUPLE, LIST, OBJECT, CONST = range(9)
+
+
+class LayoutError(Exception):
+    # the value does not fit the layout of the columns
+    pass
+
+
+def is_number(x):
+    return isinstance(x, (numbers.Real, np.number, np.bool_))
+
+
+def number_dtype(x):
+    if isinstance(x, (bool, np.bool_)):
+        return torch.bool
+    if isinstance(x, (numbers.Integral, np.integer)):
+        return torch.int64
+    return torch.float32
+
+
+def fits(x, dtype):
+    # whether the number can be written in the column of the dtype without a loss
+    x_dtype = number_dtype(x)
+    return x_dtype == dtype or (x_dtype == torch.int64 and dtype == torch.float32)
+
+
+def make_layout(x, leaves, in_object=False):
+    """Returns the layout of a step value x, the (shape, dtype) of each column of it is appended to leaves.
+    The numbers in the objects (e.g., the sizes in ArgsAction) are kept in the layout as the constants."""
+    if isinstance(x, torch.Tensor):
+        leaves.append((tuple(x.shape), x.dtype))
+        return (TENSOR, len(leaves) - 1)
+    if isinstance(x, np.ndarray) and not x.dtype.hasobject:
+        try:
+            dtype = torch.from_numpy(np.empty(0, dtype=x.dtype)).dtype
+        except TypeError:
+            raise LayoutError('no column for the dtype %s' % x.dtype)
+        leaves.append((x.shape, dtype))
+        return (ARRAY, len(leaves) - 1)
+    if is_number(x) and not in_object:
+        leaves.append(((), number_dtype(x)))
+        return (NUMBER, len(leaves) - 1)
+    if isinstance(x, tuple) and hasattr(x, '_fields'):
+        return (NAMEDTUPLE, type(x), [make_layout(v, leaves, in_object) for v in x])
+    if isinstance(x, (list, tuple)):
+        if len(x) and not in_object and all(is_number(v) for v in x):
+            # e.g., the masks and the unit counts are one column
+            dtypes = set(number_dtype(v) for v in x)
+            dtype = dtypes.pop() if len(dtypes) == 1 else torch.float32
+            leaves.append(((len(x),), dtype))
+            return (NUMBERS, len(leaves) - 1, type(x))
+        return (TUPLE if isinstance(x, tuple) else LIST, type(x), [make_layout(v, leaves, in_object) for v in x])
+    if x is None or isinstance(x, str) or is_number(x):
+        return (CONST, x)
+    if hasattr(x, '__dict__') and not isinstance(x, type):
+        return (OBJECT, type(x), [(k, make_layout(v, leaves, True)) for k, v in vars(x).items()])
+    raise LayoutError('no column for the type %s' % type(x))
+
+
+def write_layout(layout, x, columns, index):
+    """Writes x into the columns at the index (slot, t), raises LayoutError if x does not fit the layout."""
+    kind = layout[0]
+    if kind in (TENSOR, ARRAY):
+        column = columns[layout[1]]
+        if kind == TENSOR and isinstance(x, torch.Tensor):
+            x = x.detach()
+        elif kind == ARRAY and isinstance(x, np.ndarray):
+            x = torch.from_numpy(np.ascontiguousarray(x))
+        else:
+            raise LayoutError('%s is not a %s' % (type(x), 'tensor' if kind == TENSOR else 'array'))
+        if x.shape != column.shape[2:] or x.dtype != column.dtype:
+            raise LayoutError('%s %s does not fit the column of %s %s' % (tuple(x.shape), x.dtype,
+                                                                          tuple(column.shape[2:]), column.dtype))
+        column[index].copy_(x)
+    elif kind == NUMBER:
+        column = columns[layout[1]]
+        if not is_number(x) or not fits(x, column.dtype):
+            raise LayoutError('%r does not fit the column of %s' % (x, column.dtype))
+        column[index] = x
+    elif kind == NUMBERS:
+        column = columns[layout[1]]
+        if type(x) is not layout[2] or len(x) != column.shape[-1]:
+            raise LayoutError('%s does not fit the column of %s' % (type(x), tuple(column.shape[2:])))
+        array = np.asarray(x)
+        if array.dtype.kind not in {torch.bool: 'b', torch.int64: 'iu'}.get(column.dtype, 'biuf'):
+            raise LayoutError('%s does not fit the column of %s' % (array.dtype, column.dtype))
+        column[index].copy_(torch.from_numpy(array))
+    elif kind in (NAMEDTUPLE, TUPLE, LIST):
+        if type(x) is not layout[1] or len(x) != len(layout[2]):
+            raise LayoutError('%s does not fit the layout of %s' % (type(x), layout[1]))
+        for child, v in zip(layout[2], x):
+            write_layout(child, v, columns, index)
+    elif kind == OBJECT:
+        attributes = vars(x) if type(x) is layout[1] else {}
+        if len(attributes) != len(layout[2]) or any(k not in attributes for k, _ in layout[2]):
+            raise LayoutError('%s does not fit the layout of %s' % (type(x), layout[1]))
+        for k, child in layout[2]:
+            write_layout(child, attributes[k], columns, index)
+    else:
+        c = layout[1]
+        if not (x is c or (type(x) is type(c) and x == c)):
+            raise LayoutError('%r is not the constant %r' % (x, c))
+
+
+def read_layout(layout, columns, index, step=False):
+    """Returns the value of the layout with the columns at the index, of the views of the columns
+    (e.g., of [B, T, ...] for a slice of the slots), or a copy of one step in its own types if step is True."""
+    kind = layout[0]
+    if kind in (TENSOR, ARRAY, NUMBER, NUMBERS):
+        c = columns[layout[1]][index]
+        if not step:
+            return c
+        if kind == ARRAY:
+            return c.numpy().copy()
+        if kind == NUMBER:
+            return c.item()
+        if kind == NUMBERS:
+            return layout[2](c.tolist())
+        return c.clone()
+    if kind == NAMEDTUPLE:
+        return layout[1]._make(read_layout(child, columns, index, step) for child in layout[2])
+    if kind in (TUPLE, LIST):
+        return layout[1](read_layout(child, columns, index, step) for child in layout[2])
+    if kind == OBJECT:
+        x = layout[1].__new__(layout[1])
+        x.__dict__.update((k, read_layout(child, columns, index, step)) for k, child in layout[2])
+        return x
+    return layout[1]
+
+
+def map_columns(fn, x):
+    """Applies fn to each column (tensor or array) in x, keeping the structure."""
+    if isinstance(x, (torch.Tensor, np.ndarray)):
+        return fn(x)
+    if isinstance(x, tuple) and hasattr(x, '_fields'):
+        return type(x)._make(map_columns(fn, v) for v in x)
+    if isinstance(x, (tuple, list)):
+        return type(x)(map_columns(fn, v) for v in x)
+    if hasattr(x, '__dict__') and not isinstance(x, type):
+        y = copy.copy(x)
+        y.__dict__.update((k, map_columns(fn, v)) for k, v in vars(x).items())
+        return y
+    return x
+
+
+def cat_steps(steps):
+    # concatenates the tensors of the steps along the first dim, keeping the structure
+    first = steps[0]
+    if isinstance(first, torch.Tensor):
+        return torch.cat(steps, dim=0)
+    if isinstance(first, tuple) and hasattr(first, '_fields'):
+        return type(first)._make(cat_steps(list(v)) for v in zip(*steps))
+    if isinstance(first, (tuple, list)):
+        return type(first)(cat_steps(list(v)) for v in zip(*steps))
+    return steps
+
+
+class Columns(object):
+    # the mixin of the trajectory types whose fields are the columns (the tensors of [B, T, ...] or [T, B, ...]
+    # and the object arrays), instead of the tuples of the steps
+    __slots__ = ()
+
+
+_columnar_types = {}
+
+
+def columnar_type(trajectory_type):
+    if trajectory_type not in _columnar_types:
+        _columnar_types[trajectory_type] = type('Columnar' + trajectory_type.__name__,
+                                                (trajectory_type, Columns), {'__slots__': ()})
+    return _columnar_types[trajectory_type]
+
+
+def is_columnar(trajectories):
+    return isinstance(trajectories, Columns)
+
+
+class TrajectoryBatch(object):
+    '''
+    The batch of B sequences of the TrajectoryBuffer: data is the trajectory of the columns of [B, T, ...]
+    (the tensors, and the object arrays for the fields not in the columns), which are the views of the buffer
+    when is_view is True, so they are valid until the slots are reused.
+    The sequences are in the order of the list of the trajectories which the TrajectoryQueue gets.
+    '''
+
+    def __init__(self, trajectory_type, data, lengths, is_final, is_view):
+        super(TrajectoryBatch, self).__init__()
+        self.trajectory_type = trajectory_type
+        self.data = data
+        self.is_view = is_view
+
+        # the boundaries: the steps written of each sequence, and the steps which start a new episode in it
+        self.lengths = lengths
+        self.is_final = is_final
+        self.first = np.zeros_like(is_final)
+        self.first[:, 1:] = is_final[:, :-1]
+
+    @property
+    def batch_size(self):
+        return self.is_final.shape[0]
+
+    @property
+    def sequence_length(self):
+        return self.is_final.shape[1]
+
+    def __len__(self):
+        return self.batch_size
+
+    def time_major(self):
+        """Returns the trajectory of the columns of [T, B, ...], which is what stack_namedtuple and namedtuple_zip
+        make from the list of the trajectories (the loss functions use), without the transposes of the steps."""
+        return map_columns(lambda c: c.transpose(0, 1) if isinstance(c, torch.Tensor) else c.swapaxes(0, 1), self.data)
+
+    def steps(self, name, t=None):
+        """Returns the list of the steps (the views) of a field, sequence by sequence, or the step t of each sequence."""
+        field = getattr(self.data, name)
+        ts = range(self.sequence_length) if t is None else [t]
+        return [map_columns(lambda c: c[b, i], field) for b in range(self.batch_size) for i in ts]
+
+    def cat(self, name):
+        """Returns a field of all the steps concatenated along the first dim (the batch dim of a step),
+        sequence by sequence, which is a view of the columns."""
+        field = getattr(self.data, name)
+        if isinstance(field, np.ndarray):
+            return cat_steps(list(field.reshape(-1)))
+        return map_columns(lambda c: c.flatten(0, 2) if c.dim() > 2 else c.flatten(0, 1), field)
+
+    def __iter__(self):
+        # the sequences as the trajectories of the steps, e.g., what the actors send
+        for b in range(self.batch_size):
+            steps = [map_columns(lambda c: c[b, t], self.data) for t in range(self.lengths[b])]
+            yield self.trajectory_type._make(zip(*steps))
+
+    def __str__(self):
+        return "batch: %d x %d, view: %s" % (self.batch_size, self.sequence_length, self.is_view)
+
+
+class TrajectoryBuffer(object):
+    '''
+    The struct-of-arrays store of the trajectories: each field of the steps is kept in the preallocated columns
+    of [slot_num, T, ...] (one tensor for each tensor, array or number in the field, laid out by the first step),
+    a slot holds a sequence of up to T steps, and the batch of the contiguous slots is a view of the columns.
+    The fields which do not fit the columns (of the variable sizes) are kept in the object arrays of [slot_num, T].
+    It is not thread-safe, the ColumnarTrajectoryQueue locks it, except write_sequence into the slots reserved.
+    '''
+
+    def __init__(self, slot_num, sequence_length=AHP.sequence_length, object_fields=OBJECT_FIELDS):
+        super(TrajectoryBuffer, self).__init__()
+        self.slot_num = slot_num
+        self.sequence_length = sequence_length
+        self.object_fields = object_fields
+
+        # set by the first step
+        self.trajectory_type = None
+        self.final_index = None
+
+        # the field -> its layout and the list of its column tensors, or None and the object array
+        self.layouts = {}
+        self.columns = {}
+
+        # the bookkeeping of the sequences
+        self.free_slots = collections.deque(range(slot_num))
+        self.lengths = np.zeros(slot_num, dtype=np.int64)
+        self.is_final = np.zeros((slot_num, sequence_length), dtype=bool)
+        self.open_slot = None
+
+        # metrics
+        self.step_num = 0
+        self.view_num = 0
+        self.gather_num = 0
+
+    def setup(self, trajectory_type, step):
+        self.trajectory_type = trajectory_type
+        fields = trajectory_type._fields
+        self.final_index = fields.index('is_final') if 'is_final' in fields else None
+
+        for name, x in zip(fields, step):
+            layout, leaves = None, []
+            if name not in self.object_fields:
+                try:
+                    layout = make_layout(x, leaves)
+                except LayoutError:
+                    layout = None
+
+            self.layouts[name] = layout
+            if layout is None:
+                self.columns[name] = np.empty((self.slot_num, self.sequence_length), dtype=object)
+            else:
+                self.columns[name] = [torch.zeros((self.slot_num, self.sequence_length) + shape, dtype=dtype)
+                                      for shape, dtype in leaves]
+
+        print('trajectory buffer layouts:', {k: v is not None for k, v in self.layouts.items()}) if debug else None
+
+    def to_objects(self, name):
+        # the field does not fit its columns any more, so the steps written are moved to an object array
+        layout, columns = self.layouts[name], self.columns[name]
+        objects = np.empty((self.slot_num, self.sequence_length), dtype=object)
+        for slot in range(self.slot_num):
+            for t in range(self.lengths[slot]):
+                objects[slot, t] = read_layout(layout, columns, (slot, t), step=True)
+
+        self.layouts[name] = None
+        self.columns[name] = objects
+        print('trajectory buffer: the field', name, 'is kept as objects') if debug else None
+
+    def write(self, slot, t, step, strict=False):
+        # the field which does not fit its layout is moved to the objects, or raises LayoutError if strict
+        for name, x in zip(self.trajectory_type._fields, step):
+            layout = self.layouts[name]
+            if layout is not None:
+                try:
+                    write_layout(layout, x, self.columns[name], (slot, t))
+                    continue
+                except LayoutError:
+                    if strict:
+                        raise
+                    self.to_objects(name)
+            self.columns[name][slot, t] = x
+
+        if self.final_index is not None:
+            self.is_final[slot, t] = bool(step[self.final_index])
+
+    def alloc(self):
+        if not self.free_slots:
+            raise RuntimeError('no free slot in the trajectory buffer of %d slots' % self.slot_num)
+        slot = self.free_slots.popleft()
+        self.lengths[slot] = 0
+        self.is_final[slot] = False
+        return slot
+
+    def free(self, slots):
+        self.free_slots.extend(slots)
+
+    def append(self, step):
+        """Writes a step (a trajectory namedtuple of one step) to the open sequence in O(1),
+        returns the slot of the sequence when it has T steps, else None."""
+        if self.trajectory_type is None:
+            self.setup(type(step), step)
+        if type(step) is not self.trajectory_type:
+            raise ValueError('the step of %s is not a %s' % (type(step), self.trajectory_type))
+
+        if self.open_slot is None:
+            self.open_slot = self.alloc()
+        slot = self.open_slot
+        t = self.lengths[slot]
+        self.write(slot, t, step)
+        self.lengths[slot] = t + 1
+        self.step_num += 1
+
+        if t + 1 == self.sequence_length:
+            return self.end_sequence()
+        return None
+
+    def end_sequence(self):
+        """Closes the open sequence (which may be shorter than T), returns its slot, None if it has no step."""
+        slot, self.open_slot = self.open_slot, None
+        return slot
+
+    def check(self, trajectory):
+        """Raises ValueError if the trajectory (the steps of each field) can not be a sequence of the buffer,
+        sets up the layouts by its first step if they are not yet, returns its length."""
+        lengths = set(len(steps) for steps in trajectory)
+        if len(lengths) != 1 or not 0 < min(lengths) <= self.sequence_length:
+            raise ValueError('the fields of the trajectory should have the same number (1 to %d) of steps'
+                             % self.sequence_length)
+        if self.trajectory_type is None:
+            self.setup(type(trajectory), type(trajectory)._make(steps[0] for steps in trajectory))
+        if type(trajectory) is not self.trajectory_type:
+            raise ValueError('the trajectory of %s is not a %s' % (type(trajectory), self.trajectory_type))
+        return lengths.pop()
+
+    def write_sequence(self, slot, trajectory, strict=False):
+        """Writes a checked trajectory into a slot allocated, which only touches the slot unless a field is moved
+        to the objects (raises LayoutError instead if strict)."""
+        length = 0
+        for t, step in enumerate(zip(*trajectory)):
+            self.write(slot, t, step, strict)
+            length = t + 1
+        self.lengths[slot] = length
+
+    def extend(self, trajectory):
+        """Writes a trajectory (the steps of each field, e.g., made by stack_namedtuple) as a sequence,
+        returns its slot."""
+        self.check(trajectory)
+        assert self.open_slot is None
+
+        try:
+            slot = None
+            for step in zip(*trajectory):
+                slot = self.append(type(trajectory)._make(step))
+            return slot if slot is not None else self.end_sequence()
+
+        except Exception:
+            if self.open_slot is not None:
+                self.free([self.end_sequence()])
+            raise
+
+    def batch(self, slots):
+        """Returns the TrajectoryBatch of the sequences in the slots, which are the views of the columns
+        if the slots are contiguous, else gathered (copied)."""
+        slots = list(slots)
+        is_view = slots == list(range(slots[0], slots[0] + len(slots)))
+        if is_view:
+            index = object_index = slice(slots[0], slots[0] + len(slots))
+            self.view_num += 1
+        else:
+            index, object_index = torch.tensor(slots), np.array(slots)
+            self.gather_num += 1
+
+        fields = []
+        for name in self.trajectory_type._fields:
+            layout = self.layouts[name]
+            if layout is None:
+                fields.append(self.columns[name][object_index])
+            else:
+                fields.append(read_layout(layout, self.columns[name], index))
+
+        data = columnar_type(self.trajectory_type)._make(fields)
+        return TrajectoryBatch(self.trajectory_type, data, self.lengths[slots], self.is_final[slots], is_view)
+
+    @property
+    def nbytes(self):
+        return sum(c.numel() * c.element_size() for columns in self.columns.values()
+                   if isinstance(columns, list) for c in columns)
+
+    def __str__(self):
+        return "slots: %d x %d, free: %d, columns: %.1fMB, steps: %d, views: %d, gathers: %d" % (
+            self.slot_num, self.sequence_length, len(self.free_slots), self.nbytes / 1e6, self.step_num,
+            self.view_num, self.gather_num)
+
+
+class ColumnarTrajectoryQueue(TrajectoryQueue):
+    '''
+    The TrajectoryQueue which writes the trajectories into a TrajectoryBuffer when they are put,
+    and gets a batch as a TrajectoryBatch of the columns instead of the list of the trajectories.
+    The slots of a batch are kept until the next get, so its views are valid while the learner uses it,
+    and the buffer has the slots for the capacity and one batch.
+    A slot is reserved under the lock of the queue and the trajectory is copied into it out of the lock,
+    only a field which no longer fits its layout is moved to the objects under the lock, when no copy is running.
+    '''
+
+    def __init__(self, capacity, overflow_policy=BLOCK, batch_size=AHP.batch_size,
+                 sequence_length=AHP.sequence_length, object_fields=OBJECT_FIELDS):
+        super(ColumnarTrajectoryQueue, self).__init__(capacity, overflow_policy)
+        self.batch_size = batch_size
+        self.buffer = TrajectoryBuffer(capacity + batch_size, sequence_length, object_fields)
+        self.taken_slots = []
+
+        # the copies running out of the lock, and whether the layouts are being changed (no new copy starts)
+        self.writing = 0
+        self.relayout = 0
+        self.not_writing = threading.Condition(self.lock)
+
+    def can_reserve(self):
+        return not self.relayout
+
+    def reserve(self, trajectory):
+        self.buffer.check(trajectory)
+        slot = self.buffer.alloc()
+        self.writing += 1
+        return slot
+
+    def store(self, slot, trajectory):
+        try:
+            self.buffer.write_sequence(slot, trajectory, strict=True)
+        except LayoutError:
+            with self.lock:
+                # the columns of the field are replaced, so the other copies finish first
+                self.relayout += 1
+                self.writing -= 1
+                self.not_writing.notify_all()
+                self.not_writing.wait_for(lambda: self.writing == 0)
+                try:
+                    self.buffer.write_sequence(slot, trajectory)
+                except Exception:
+                    self.buffer.free([slot])
+                    raise
+                finally:
+                    self.relayout -= 1
+                    self.not_full.notify_all()
+                self.buffer.step_num += self.buffer.lengths[slot]
+                return slot
+        except Exception:
+            with self.lock:
+                self.writing -= 1
+                self.buffer.free([slot])
+                self.not_writing.notify_all()
+            raise
+
+        with self.lock:
+            self.writing -= 1
+            self.buffer.step_num += self.buffer.lengths[slot]
+            self.not_writing.notify_all()
+        return slot
+
+    def discard(self, slot):
+        self.buffer.free([slot])
+
+    def collect(self, slots):
+        assert len(slots) <= self.batch_size, 'the batch is larger than %d' % self.batch_size
+        self.buffer.free(self.taken_slots)
+        self.taken_slots = slots
+        return self.buffer.batch(slots)
+
+
+def random_trajectory(rng, sequence_length, world_size=64):
+    # a trajectory with the fields of the same kinds (and mostly the same shapes) as the ones the actors make
+    from alphastarmini.core.rl.action import ArgsAction, ArgsActionLogits
+    from alphastarmini.core.rl.compact_state import CompactState
+    from alphastarmini.core.rl.rl_utils import CompactTrajectory
+
+    def logits():
+        return ArgsActionLogits(torch.randn(1, 564), torch.randn(1, 128), torch.randn(1, 2), torch.randn(1, 3, 512),
+                                torch.randn(1, 1, 512), torch.randn(1, world_size, world_size))
+
+    steps = []
+    for t in range(sequence_length):
+        entity_num = rng.randint(1, 50)
+        state = CompactState(entity_num, np.arange(entity_num * 4, dtype=np.int32),
+                             rng.rand(entity_num * 4).astype(np.float32),
+                             [torch.randn(1, 10), torch.randn(1, 320)], np.zeros((1, 4, 8, 8), dtype=np.int16))
+        baseline_state = [torch.randn(1, 10), torch.randn(1, 320), torch.randn(1, 259), torch.randn(1, 20, 259)]
+        action = ArgsAction(torch.randint(564, (1, 1)), torch.randint(128, (1, 1)), torch.randint(2, (1, 1)),
+                            torch.randint(512, (1, 3, 1)), torch.randint(512, (1, 1, 1)),
+                            torch.randint(world_size, (1, 2)))
+        steps.append(CompactTrajectory(state=state, baseline_state=baseline_state,
+                                       baseline_opponent_state=[torch.randn_like(s) for s in baseline_state],
+                                       memory=(torch.randn(1, 1, 128), torch.randn(1, 1, 128)), z=None,
+                                       is_final=bool(rng.rand() < 0.2),
+                                       masks=[int(m) for m in rng.randint(0, 2, 6)], action=action,
+                                       behavior_logits=logits(), teacher_logits=logits(),
+                                       reward=int(rng.randint(-1, 2)),
+                                       build_order=rng.randint(0, 259, rng.randint(0, 10)).tolist(),
+                                       z_build_order=rng.randint(0, 259, 5).tolist(),
+                                       unit_counts=rng.randint(0, 3, 259).astype(np.float32).tolist(),
+                                       z_unit_counts=[0.] * 259, game_loop=np.int32(t * 8), policy_version=t))
+
+    from alphastarmini.core.rl.rl_utils import stack_namedtuple
+    return stack_namedtuple(steps)
+
+
+def test(batch_size=8, sequence_length=4, repeat=20):
+    import time
+
+    from alphastarmini.core.rl import rl_utils as U
+    from alphastarmini.core.rl import rl_loss as RL
+
+    rng = np.random.RandomState(0)
+
+    # the round trip, the fields of the variable sizes and the ones change are kept as the objects
+    buffer = TrajectoryBuffer(slot_num=4, sequence_length=sequence_length)
+    trajectories = [random_trajectory(rng, sequence_length) for _ in range(3)]
+    slots = [buffer.extend(trajectory) for trajectory in trajectories[:2]]
+    changed = trajectories[2]._replace(reward=(0.5,) * sequence_length)
+    slots.append(buffer.extend(changed))
+    trajectories[2] = changed
+    print('trajectory buffer:', buffer)
+    assert buffer.layouts['reward'] is None and buffer.layouts['state'] is None
+    assert buffer.layouts['behavior_logits'] is not None and buffer.layouts['unit_counts'] is not None
+
+    batch = buffer.batch(slots)
+    assert batch.is_view and buffer.batch(slots[::-1]).is_view is False
+    for trajectory, received in zip(trajectories, batch):
+        assert received.reward == trajectory.reward and received.build_order == trajectory.build_order
+        assert all(torch.equal(x.target_location, y.target_location)
+                   for x, y in zip(received.behavior_logits, trajectory.behavior_logits))
+        assert [m.tolist() for m in received.masks] == list(trajectory.masks)
+        assert np.array_equal(batch.first[0, 1:], [s for s in trajectories[0].is_final[:-1]])
+
+    # the batch views are the same as the transposes of the lists of the trajectories, which the losses use
+    def assemble_lists(trajectories):
+        memory = [torch.cat(h, dim=1) for h in zip(*[t.memory[0] for t in trajectories])]
+        baseline_state = [torch.cat(s, dim=0) for s in zip(*[s for t in trajectories for s in t.baseline_state])]
+        trajectories = U.namedtuple_zip(U.stack_namedtuple(trajectories))
+        return assemble(memory, baseline_state, trajectories)
+
+    def assemble_batch(batch):
+        memory = [torch.cat(h, dim=1) for h in zip(*batch.steps('memory', t=0))]
+        return assemble(memory, batch.cat('baseline_state'), batch.time_major())
+
+    def assemble(memory, baseline_state, trajectories):
+        outputs = memory + baseline_state
+        for f in ('action_type', 'delay', 'queue', 'units', 'target_unit', 'target_location'):
+            outputs.append(RL.filter_by_for_lists(f, trajectories.behavior_logits))
+            outputs.append(RL.filter_by_for_lists(f, trajectories.teacher_logits))
+            outputs.append(RL.filter_by_for_lists(f, trajectories.action))
+            outputs.append(RL.filter_by_for_masks(f, trajectories.masks))
+        outputs.append(torch.as_tensor(np.array(trajectories.reward), dtype=torch.float32))
+        outputs.append(torch.as_tensor(~np.array(trajectories.is_final)))
+        outputs.append(torch.as_tensor(np.asarray(trajectories.unit_counts)))
+        return outputs
+
+    trajectories = [random_trajectory(rng, sequence_length) for _ in range(batch_size)]
+    list_queue = TrajectoryQueue(capacity=2 * batch_size)
+    columnar_queue = ColumnarTrajectoryQueue(capacity=2 * batch_size, batch_size=batch_size,
+                                             sequence_length=sequence_length)
+    for trajectory in trajectories:
+        list_queue.put(trajectory)
+        columnar_queue.put(trajectory)
+    batch = columnar_queue.get(batch_size)
+    for x, y in zip(assemble_lists(list_queue.get(batch_size)), assemble_batch(batch)):
+        assert torch.equal(x, y)
+
+    # the steps are also appended one by one
+    step_buffer = TrajectoryBuffer(slot_num=1, sequence_length=sequence_length)
+    for step in zip(*trajectories[0]):
+        slot = step_buffer.append(type(trajectories[0])._make(step))
+    assert slot == 0 and torch.equal(step_buffer.batch([0]).data.memory[0], batch.data.memory[0][:1])
+
+    # the copy of a trajectory is out of the lock, so the other actors and the learner do not wait for it
+    class SlowQueue(ColumnarTrajectoryQueue):
+
+        def store(self, slot, trajectory):
+            if trajectory is trajectories[0]:
+                started.set()
+                release.wait()
+            return super(SlowQueue, self).store(slot, trajectory)
+
+    started, release = threading.Event(), threading.Event()
+    queue = SlowQueue(capacity=4, batch_size=2, sequence_length=sequence_length)
+    slow = threading.Thread(target=queue.put, args=(trajectories[0],))
+    slow.start()
+    started.wait()
+    assert queue.put(trajectories[1], timeout=1) and queue.put(trajectories[2], timeout=1)
+    received = queue.get(2, timeout=1)
+    assert received is not None and torch.equal(received.data.memory[0][1, 0], trajectories[2].memory[0][0])
+    release.set()
+    slow.join()
+    assert torch.equal(queue.get(1, timeout=1).data.memory[0][0, 0], trajectories[0].memory[0][0])
+
+    # a field which no longer fits its columns is moved to the objects under the lock, while the others copy
+    threads = [threading.Thread(target=queue.put, args=(trajectory,)) for trajectory in trajectories[3:6]]
+    for thread in threads:
+        thread.start()
+    assert queue.put(trajectories[6]._replace(reward=(0.5,) * sequence_length), timeout=1)
+    for thread in threads:
+        thread.join()
+    received = [queue.get(1, timeout=1) for _ in range(4)]
+    assert queue.buffer.layouts['reward'] is None and queue.writing == 0 and queue.reserved == 0
+    assert sorted(tuple(next(iter(b)).reward) for b in received) == sorted(
+        [tuple(t.reward) for t in trajectories[3:6]] + [(0.5,) * sequence_length])
+
+    # benchmark test: the time to assemble a batch for the learner, from the queue
+    put_time, get_time = {}, {}
+    for name, queue, assemble_fn in (('lists', list_queue, assemble_lists), ('columns', columnar_queue, assemble_batch)):
+        put_time[name] = get_time[name] = 0.
+        for _ in range(repeat):
+            start = time.time()
+            for trajectory in trajectories:
+                queue.put(trajectory)
+            put_time[name] += time.time() - start
+
+            start = time.time()
+            assemble_fn(queue.get(batch_size))
+            get_time[name] += time.time() - start
+
+        print("batch %d x %d, %s: put %.3fms, batch assembly %.3fms, put and assembly %.3fms per batch" % (
+            batch_size, sequence_length, name, put_time[name] / repeat * 1e3, get_time[name] / repeat * 1e3,
+            (put_time[name] + get_time[name]) / repeat * 1e3))
+
+    print("batch assembly speedup: %.2fx, buffer: %s" % (get_time['lists'] / get_time['columns'], columnar_queue.buffer))
+    assert columnar_queue.buffer.gather_num == 0
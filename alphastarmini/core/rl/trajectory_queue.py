@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" The bounded queue which transports the trajectories from the actors to the learner"
+
+import threading
+import collections
+from time import time
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+
+# what to do when an actor sends a trajectory to a full queue
+BLOCK = 'block'  # wait until the learner takes a batch (backpressure on the actors)
+DROP_OLDEST = 'drop_oldest'  # drop the oldest trajectory in the queue to make room for the new one
+DROP_NEWEST = 'drop_newest'  # drop the new trajectory
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class TrajectoryQueue(object):
+    '''
+    A bounded FIFO of trajectories with a condition variable,
+    so the learner wakes up as soon as a full batch is ready instead of polling.
+    '''
+
+    def __init__(self, capacity, overflow_policy=BLOCK):
+        super(TrajectoryQueue, self).__init__()
+        assert capacity > 0
+        assert overflow_policy in OVERFLOW_POLICIES, 'unknown overflow policy: %s' % overflow_policy
+
+        self.capacity = capacity
+        self.overflow_policy = overflow_policy
+
+        # items are (enqueue_time, trajectory), and the number of the items being stored, which take the room
+        self.queue = collections.deque()
+        self.reserved = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.closed = False
+
+        # metrics
+        self.put_num = 0
+        self.drop_num = 0
+        self.get_num = 0
+        self.max_depth = 0
+        self.block_time = 0.
+        self.staleness_sum = 0.
+        self.max_staleness = 0.
+
+    def __len__(self):
+        with self.lock:
+            return len(self.queue)
+
+    def put(self, trajectory, timeout=None):
+        """Returns True if the trajectory is in the queue, False if it is dropped, timeout or the queue is closed.
+        The room is reserved under the lock, the trajectory is stored out of it (so the other actors and the learner
+        do not wait for the copy), and it is published under the lock again."""
+        with self.lock:
+            if self.closed:
+                return False
+
+            if self.overflow_policy == BLOCK:
+                start_time = time()
+                ready = self.not_full.wait_for(lambda: self.closed or (not self.is_full() and self.can_reserve()),
+                                               timeout)
+                self.block_time += time() - start_time
+                if self.closed or not ready:
+                    return False
+            else:
+                ready = self.not_full.wait_for(lambda: self.closed or self.can_reserve(), timeout)
+                if self.closed or not ready:
+                    return False
+                if self.is_full():
+                    if self.overflow_policy == DROP_NEWEST or not self.queue:
+                        self.drop_num += 1
+                        return False
+                    self.discard(self.queue.popleft()[1])
+                    self.drop_num += 1
+
+            token = self.reserve(trajectory)
+            self.reserved += 1
+
+        try:
+            item = self.store(token, trajectory)
+        except Exception:
+            with self.lock:
+                self.reserved -= 1
+                self.not_full.notify_all()
+            raise
+
+        with self.lock:
+            self.reserved -= 1
+            self.queue.append((time(), item))
+            self.put_num += 1
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.not_empty.notify()
+
+            return True
+
+    def get(self, batch_size, timeout=None):
+        """Waits until batch_size trajectories are ready and returns them in order.
+        Returns None on timeout or when the queue is closed."""
+        with self.lock:
+            ready = self.not_empty.wait_for(lambda: self.closed or len(self.queue) >= batch_size, timeout)
+            if self.closed or not ready:
+                return None
+
+            now = time()
+            trajectories = []
+            for _ in range(batch_size):
+                enqueue_time, trajectory = self.queue.popleft()
+                staleness = now - enqueue_time
+                self.staleness_sum += staleness
+                self.max_staleness = max(self.max_staleness, staleness)
+                trajectories.append(trajectory)
+            self.get_num += batch_size
+            self.not_full.notify_all()
+
+            print('trajectory queue:', self) if debug else None
+            return self.collect(trajectories)
+
+    def is_full(self):
+        return len(self.queue) + self.reserved >= self.capacity
+
+    # the storage of the items, the subclasses can keep the trajectories elsewhere (e.g., in the columns):
+    # can_reserve and reserve are called under the lock, store out of it
+    def can_reserve(self):
+        return True
+
+    def reserve(self, trajectory):
+        return None
+
+    def store(self, token, trajectory):
+        return trajectory
+
+    def discard(self, item):
+        pass
+
+    def collect(self, items):
+        return items
+
+    def close(self):
+        # wakes up all the waiting actors and the learner
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def stats(self):
+        with self.lock:
+            return {'depth': len(self.queue),
+                    'max_depth': self.max_depth,
+                    'put_num': self.put_num,
+                    'drop_num': self.drop_num,
+                    'get_num': self.get_num,
+                    'block_time': self.block_time,
+                    'mean_staleness': self.staleness_sum / max(self.get_num, 1),
+                    'max_staleness': self.max_staleness}
+
+    def __str__(self):
+        s = self.stats()
+        return ("depth: %d/%d, max depth: %d, put: %d, drop: %d, get: %d, block: %.3fs, "
+                "staleness mean: %.3fs, max: %.3fs") % (s['depth'], self.capacity, s['max_depth'],
+                                                         s['put_num'], s['drop_num'], s['get_num'], s['block_time'],
+                                                         s['mean_staleness'], s['max_staleness'])
+
+
+def test():
+    # the policies on a full queue
+    for policy, kept in ((BLOCK, [0, 1, 2]), (DROP_OLDEST, [2, 3, 4]), (DROP_NEWEST, [0, 1, 2])):
+        queue = TrajectoryQueue(capacity=3, overflow_policy=policy)
+        for i in range(5):
+            queue.put(i, timeout=0.01)
+        assert queue.get(3, timeout=0) == kept
+        assert queue.get(1, timeout=0) is None
+        print(policy, queue)
+
+    # the learner wakes up as soon as the batch is ready
+    queue = TrajectoryQueue(capacity=4)
+    wakeup_time = []
+
+    def learner():
+        queue.get(2)
+        wakeup_time.append(time())
+
+    thread = threading.Thread(target=learner)
+    thread.start()
+    queue.put(0)
+    queue.put(1)
+    put_time = time()
+    thread.join()
+    print('wakeup latency: %.6fs' % (wakeup_time[0] - put_time))
+    assert wakeup_time[0] - put_time < 0.5
+
+    # close releases the blocked actors
+    queue = TrajectoryQueue(capacity=1)
+    queue.put(0)
+    thread = threading.Thread(target=lambda: wakeup_time.append(queue.put(1)))
+    thread.start()
+    queue.close()
+    thread.join()
+    assert wakeup_time[-1] is False
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" The library of the expert z-statistics (build order and unit counts) extracted from the replays once, for the actors using Z"
+
+import os
+import time
+import random
+
+import numpy as np
+
+from alphastarmini.lib import utils as L
+from alphastarmini.lib.hyper_parameters import Scalar_Feature_Size as SFS
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+STEP_MUL = 8
+REPLAY_PATH = "data/Replays/filtered_replays_1/"
+REPLAY_VERSION = '3.16.1'
+Z_LIBRARY_PATH = "data/z_library.npz"
+
+UNIT_COUNTS_DTYPE = np.int16
+UNIT_TYPE_DTYPE = np.int16
+
+
+class ZTimeline(object):
+    '''
+    The z-statistics of one replay along the game loops:
+    the unit counts (bag of words) are kept only at the game loops where they change,
+    and each entry of the build order is kept with the game loop it appears at,
+    so the value at any game loop is found by a binary search.
+    '''
+
+    def __init__(self, name, max_game_loop, ucb_loops, ucb_values, bo_loops, bo_units):
+        super(ZTimeline, self).__init__()
+        self.name = name
+        self.max_game_loop = int(max_game_loop)
+        self.ucb_loops = ucb_loops
+        self.ucb_values = ucb_values
+        self.bo_loops = bo_loops
+        self.bo_units = bo_units
+
+    def unit_counts(self, game_loop):
+        # the unit counts of the last change not after game_loop (the first one if game_loop is before it)
+        i = max(np.searchsorted(self.ucb_loops, game_loop, side='right') - 1, 0)
+        return self.ucb_values[i]
+
+    def unit_counts_list(self, game_loop):
+        # the same as BuildOrderTracker.unit_counts_list() of the replay observation at game_loop
+        return self.unit_counts(game_loop).astype(np.float32).tolist()
+
+    def build_order(self, game_loop):
+        # the build order of the units appearing not after game_loop
+        i = np.searchsorted(self.bo_loops, game_loop, side='right')
+        return [np.int64(u) for u in self.bo_units[:i]]
+
+    def __len__(self):
+        return len(self.ucb_loops)
+
+    def __str__(self):
+        return "%s: max game loop: %d, unit counts changes: %d, build order length: %d" % (
+            self.name, self.max_game_loop, len(self.ucb_loops), len(self.bo_units))
+
+
+class ZTimelineRecorder(object):
+    '''
+    Records the ZTimeline of a replay from its observations in order, by a BuildOrderTracker.
+    '''
+
+    def __init__(self, name):
+        super(ZTimelineRecorder, self).__init__()
+        self.name = name
+        self.tracker = L.BuildOrderTracker()
+        self.game_loop = 0
+        self.ucb_loops, self.ucb_values = [], []
+        self.bo_loops = []
+
+    def record(self, obs):
+        self.game_loop = int(obs["game_loop"][0])
+        change_num = self.tracker.change_num
+
+        if self.tracker.unit_counts is None:
+            self.tracker.reset(obs)
+        else:
+            self.tracker.update(obs)
+
+        if self.tracker.change_num > change_num:
+            self.ucb_loops.append(self.game_loop)
+            self.ucb_values.append(self.tracker.unit_counts_bow.reshape(-1))
+
+        self.bo_loops.extend([self.game_loop] * (len(self.tracker.build_order) - len(self.bo_loops)))
+
+    def timeline(self):
+        if not self.ucb_values:
+            self.ucb_loops.append(self.game_loop)
+            self.ucb_values.append(np.zeros(SFS.unit_counts_bow, dtype=np.float32))
+
+        return ZTimeline(self.name, self.game_loop,
+                         ucb_loops=np.array(self.ucb_loops, dtype=np.int64),
+                         ucb_values=np.stack(self.ucb_values).astype(UNIT_COUNTS_DTYPE),
+                         bo_loops=np.array(self.bo_loops, dtype=np.int64),
+                         bo_units=np.array(self.tracker.build_order, dtype=UNIT_TYPE_DTYPE))
+
+
+def sparse_unit_counts(ucb_values):
+    # the (row, column, value) of the entries which differ from the last row (the first row is compared with zeros)
+    last_values = np.concatenate([np.zeros_like(ucb_values[:1]), ucb_values[:-1]])
+    rows, columns = np.nonzero(ucb_values != last_values)
+    return rows, columns, ucb_values[rows, columns]
+
+
+def dense_unit_counts(row_num, rows, columns, values):
+    # the inverse of sparse_unit_counts, each entry holds the value of its last change
+    last_change = np.full((row_num, SFS.unit_counts_bow), -1, dtype=np.int64)
+    last_change[rows, columns] = np.arange(len(rows))
+    last_change = np.maximum.accumulate(last_change, axis=0)
+
+    # the unit counts which never change from zero have no values
+    if not len(values):
+        return np.zeros(last_change.shape, dtype=UNIT_COUNTS_DTYPE)
+    return np.where(last_change >= 0, values[np.maximum(last_change, 0)], 0).astype(UNIT_COUNTS_DTYPE)
+
+
+class ZLibrary(object):
+    '''
+    The ZTimelines of many replays, which are saved in one npz file:
+    the arrays of all the timelines are concatenated, and indexed by the offsets of each timeline.
+    In the file, the unit counts keep only the entries which change.
+    '''
+
+    def __init__(self, timelines):
+        super(ZLibrary, self).__init__()
+        self.timelines = timelines
+
+    def __len__(self):
+        return len(self.timelines)
+
+    def __getitem__(self, i):
+        return self.timelines[i]
+
+    def sample(self, rng=random):
+        return self.timelines[rng.randrange(len(self.timelines))]
+
+    def save(self, path):
+        def offsets(arrays):
+            return np.cumsum([0] + [len(a) for a in arrays]).astype(np.int64)
+
+        t_list = self.timelines
+        if not t_list:
+            raise ValueError("the z library to save has no timelines")
+
+        sparse_list = [sparse_unit_counts(t.ucb_values) for t in t_list]
+        np.savez(path,
+                 names=np.array([t.name for t in t_list]),
+                 max_game_loops=np.array([t.max_game_loop for t in t_list], dtype=np.int64),
+                 ucb_offsets=offsets([t.ucb_loops for t in t_list]),
+                 ucb_loops=np.concatenate([t.ucb_loops for t in t_list]),
+                 change_offsets=offsets([rows for rows, _, _ in sparse_list]),
+                 change_rows=np.concatenate([rows for rows, _, _ in sparse_list]).astype(np.int32),
+                 change_columns=np.concatenate([columns for _, columns, _ in sparse_list]).astype(np.int16),
+                 change_values=np.concatenate([values for _, _, values in sparse_list]),
+                 bo_offsets=offsets([t.bo_loops for t in t_list]),
+                 bo_loops=np.concatenate([t.bo_loops for t in t_list]),
+                 bo_units=np.concatenate([t.bo_units for t in t_list]))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            data = dict(data)
+
+        # the timelines are views of the concatenated arrays, except the unit counts
+        ucb, bo, change = data['ucb_offsets'], data['bo_offsets'], data['change_offsets']
+
+        def ucb_values(i):
+            return dense_unit_counts(ucb[i + 1] - ucb[i], *[data[k][change[i]:change[i + 1]]
+                                                            for k in ('change_rows', 'change_columns', 'change_values')])
+
+        timelines = [ZTimeline(str(name), max_game_loop,
+                               ucb_loops=data['ucb_loops'][ucb[i]:ucb[i + 1]],
+                               ucb_values=ucb_values(i),
+                               bo_loops=data['bo_loops'][bo[i]:bo[i + 1]],
+                               bo_units=data['bo_units'][bo[i]:bo[i + 1]])
+                     for i, (name, max_game_loop) in enumerate(zip(data['names'], data['max_game_loops']))]
+
+        return cls(timelines)
+
+    def __str__(self):
+        return "timelines: %d, game loops: %d" % (len(self.timelines), sum(t.max_game_loop for t in self.timelines))
+
+
+def extract_replay_timeline(run_config, replay_path, step_mul=STEP_MUL, observed_player_id=1):
+    # steps through the replay once, the same as the actor used to do in lockstep with the game
+    from pysc2.lib import point
+    from pysc2.lib import features as F
+    from s2clientprotocol import sc2api_pb2 as sc_pb
+
+    interface = sc_pb.InterfaceOptions(raw=True, score=True,
+                                       feature_layer=sc_pb.SpatialCameraSetup(width=24))
+    point.Point(64, 64).assign_to(interface.feature_layer.resolution)
+    point.Point(64, 64).assign_to(interface.feature_layer.minimap_resolution)
+
+    with run_config.start(full_screen=False) as controller:
+        replay_data = run_config.replay_data(replay_path)
+        controller.start_replay(sc_pb.RequestStartReplay(replay_data=replay_data,
+                                                         options=interface,
+                                                         disable_fog=False,
+                                                         observed_player_id=observed_player_id,
+                                                         realtime=False))
+        feat = F.features_from_game_info(game_info=controller.game_info(),
+                                         use_feature_units=True, use_raw_units=True,
+                                         use_unit_counts=True, use_raw_actions=True,
+                                         show_cloaked=True, show_burrowed_shadows=True,
+                                         show_placeholders=True)
+
+        recorder = ZTimelineRecorder(os.path.basename(replay_path))
+        while True:
+            o = controller.observe()
+            recorder.record(feat.transform_obs(o))
+            if o.player_result:
+                break
+            controller.step(step_mul)
+
+    return recorder.timeline()
+
+
+def build_library(replay_path=REPLAY_PATH, library_path=Z_LIBRARY_PATH, replay_version=REPLAY_VERSION,
+                  step_mul=STEP_MUL):
+    from pysc2 import run_configs
+
+    run_config = run_configs.get(version=replay_version)
+
+    timelines = []
+    for replay_file in sorted(os.listdir(replay_path)):
+        try:
+            timeline = extract_replay_timeline(run_config, os.path.join(replay_path, replay_file), step_mul)
+            print(timeline)
+            timelines.append(timeline)
+        except Exception as e:
+            print("extract z-statistics of {} failed: {}".format(replay_file, e))
+
+    if not timelines:
+        raise ValueError("no z-statistics are extracted from the replays in {}".format(replay_path))
+
+    library = ZLibrary(timelines)
+    library.save(library_path)
+    print("save z library:", library)
+
+    return library
+
+
+def get_z_library(replay_path=REPLAY_PATH, library_path=Z_LIBRARY_PATH, replay_version=REPLAY_VERSION):
+    # the library is extracted from the replays only once
+    if os.path.isfile(library_path):
+        library = ZLibrary.load(library_path)
+        print("load z library:", library)
+        return library
+
+    return build_library(replay_path or REPLAY_PATH, library_path, replay_version)
+
+
+def random_obs_list(seed, max_game_loop=22.4 * 60 * 15, step_mul=STEP_MUL):
+    # the stand-in of the replay observations, which have only the unit_counts and the game_loop
+    registry = L.get_unit_type_registry()
+    rng = np.random.RandomState(seed)
+
+    type_index = list(rng.randint(0, min(registry.unit_type_size, SFS.unit_counts_bow), size=30)) + \
+        L.WORKER_TYPE_LIST + L.SUPPLY_TYPE_LIST
+    unit_types = registry.unit_types(type_index)
+    counts = dict.fromkeys(unit_types[:8], 1)
+
+    obs_list = []
+    for game_loop in range(0, int(max_game_loop), step_mul):
+        p = rng.rand()
+        if p < 0.1:
+            t = unit_types[rng.randint(len(unit_types))]
+            counts[t] = counts.get(t, 0) + 1
+        elif p < 0.12:
+            t = list(counts)[rng.randint(len(counts))]
+            counts[t] = max(counts[t] - 1, 0)
+        obs_list.append({"unit_counts": np.array([[t, c] for t, c in counts.items() if c > 0], dtype=np.int64),
+                         "game_loop": np.array([game_loop])})
+
+    return obs_list
+
+
+def random_timeline(seed, max_game_loop=22.4 * 60 * 15, step_mul=STEP_MUL):
+    # the stand-in timeline generator for test
+    recorder = ZTimelineRecorder("random_%d" % seed)
+    for obs in random_obs_list(seed, max_game_loop, step_mul):
+        recorder.record(obs)
+
+    return recorder.timeline()
+
+
+def test(timeline_num=200, library_path="/tmp/z_library_test.npz"):
+    # the library gives the same z as stepping the replay in lockstep with the tracker
+    obs_list = random_obs_list(seed=0)
+    timeline = random_timeline(seed=0)
+    print(timeline)
+
+    tracker = L.BuildOrderTracker(obs_list[0])
+    for obs, next_obs in zip(obs_list[:-1], obs_list[1:]):
+        replay_ucb = tracker.unit_counts_list()
+        replay_bo = tracker.update(next_obs)
+        assert timeline.unit_counts_list(obs["game_loop"][0]) == replay_ucb
+        assert timeline.build_order(next_obs["game_loop"][0]) == replay_bo
+
+    library = ZLibrary([timeline] + [random_timeline(seed=i) for i in range(1, timeline_num)])
+    library.save(library_path)
+
+    benchmark_start = time.time()
+    loaded = ZLibrary.load(library_path)
+    load_time = time.time() - benchmark_start
+    print("z library: {}, file bytes: {}, load time: {:.4f}s".format(loaded, os.path.getsize(library_path), load_time))
+
+    assert len(loaded) == timeline_num
+    for t, loaded_t in zip(library.timelines, loaded.timelines):
+        assert t.name == loaded_t.name and t.max_game_loop == loaded_t.max_game_loop
+        assert np.array_equal(t.ucb_values, loaded_t.ucb_values) and np.array_equal(t.bo_units, loaded_t.bo_units)
+
+    # the timeline of the unit counts never changed from zero (the empty one of the recorder)
+    empty = ZTimelineRecorder("empty").timeline()
+    ZLibrary([empty, timeline]).save(library_path)
+    loaded_empty = ZLibrary.load(library_path)
+    assert not loaded_empty[0].ucb_values.any() and np.array_equal(loaded_empty[1].ucb_values, timeline.ucb_values)
+    ZLibrary([empty]).save(library_path)
+    assert not ZLibrary.load(library_path)[0].ucb_values.any()
+
+    # a library without the timelines (e.g., all the replays failed) is not saved
+    try:
+        ZLibrary([]).save(library_path)
+        assert False, "the empty library is saved"
+    except ValueError:
+        pass
+
+    # the cost of the z of each actor step
+    query_num = 10000
+    rng = np.random.RandomState(0)
+    game_loops = rng.randint(0, library[0].max_game_loop, query_num)
+    benchmark_start = time.time()
+    for game_loop in game_loops:
+        timeline = loaded.sample()
+        timeline.unit_counts_list(game_loop)
+        timeline.build_order(game_loop + STEP_MUL)
+    print("z query time per step: {:.6f}s".format((time.time() - benchmark_start) / query_num))
+
+    os.remove(library_path)
+
+
+if __name__ == '__main__':
+    build_library()
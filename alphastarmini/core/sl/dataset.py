@@ -5,11 +5,15 @@
 
 import os
 import time
+import json
+import bisect
 import traceback
 from typing import Tuple
 
 from tqdm import tqdm
 
+import numpy as np
+
 import torch
 from torch import Tensor
 from torch.utils.data import DataLoader, Dataset, TensorDataset, ConcatDataset
@@ -21,6 +25,12 @@ __author__ = "Ruo-Ze Liu"
 
 debug = False
 
+# the header file of the shards, which records the shard files and where each replay is
+SHARD_INDEX_FILE = "index.json"
+
+# the max rows (steps) of one shard, a replay is never split into two shards
+SHARD_ROWS = 20000
+
 
 class SC2ReplayData(object):
     '''
@@ -193,5 +203,197 @@ class ReplayTensorDataset(TensorDataset):
         return self.tensors[0].size(0) - self.seq_len + 1
 
 
+class ReplayShardDataset(Dataset):
+    '''
+        The same windows as ConcatDataset([ReplayTensorDataset(features, labels), ...]), 
+        but read from the memory-mapped shards made by pack_tensor_to_shards, so the 
+        replays are not loaded into the memory.
+    '''
+
+    def __init__(self, shard_path, from_index=0, end_index=None, seq_len=AHP.sequence_length):
+        super().__init__()
+
+        with open(os.path.join(shard_path, SHARD_INDEX_FILE), 'r') as f:
+            index = json.load(f)
+
+        self.shard_path = shard_path
+        self.seq_len = seq_len
+        self.shard_list = index['shards']
+
+        # the replays are sorted by the file names, like the .pt files in getReplayData
+        self.replay_list = index['replays'][from_index:end_index]
+
+        # like ReplayTensorDataset, a window does not cross two replays
+        self.cumulative_sizes = []
+        size = 0
+        for replay in self.replay_list:
+            size += max(replay['length'] - seq_len + 1, 0)
+            self.cumulative_sizes.append(size)
+
+        # the shards are mapped when first used, in each process of the DataLoader
+        self.shards = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def get_shard(self, shard_id):
+        shard = self.shards.get(shard_id)
+        if shard is None:
+            shard_info = self.shard_list[shard_id]
+            features = np.load(os.path.join(self.shard_path, shard_info['features']), mmap_mode='r')
+            labels = np.load(os.path.join(self.shard_path, shard_info['labels']), mmap_mode='r')
+            shard = (features, labels)
+            self.shards[shard_id] = shard
+        return shard
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+
+        replay_id = bisect.bisect_right(self.cumulative_sizes, index)
+        if replay_id > 0:
+            index -= self.cumulative_sizes[replay_id - 1]
+
+        replay = self.replay_list[replay_id]
+        features, labels = self.get_shard(replay['shard'])
+
+        begin = replay['offset'] + index
+        end = begin + self.seq_len
+
+        # copy the window out of the mapped pages
+        return torch.from_numpy(np.array(features[begin:end])), torch.from_numpy(np.array(labels[begin:end]))
+
+    def __len__(self):
+        return self.cumulative_sizes[-1] if self.cumulative_sizes else 0
+
+
+def save_npy_atomic(file_name, array):
+    tmp_file_name = file_name + '.tmp'
+    with open(tmp_file_name, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_file_name, file_name)
+
+
+def pack_tensor_to_shards(tensor_path, shard_path, shard_rows=SHARD_ROWS, from_index=0, end_index=None):
+    # pack the .pt files of (features, labels) to the shards used by ReplayShardDataset
+    replay_files = [f for f in os.listdir(tensor_path) if f.endswith('.pt')]
+    print('length of replay_files:', len(replay_files))
+    replay_files.sort()
+
+    if not os.path.exists(shard_path):
+        os.makedirs(shard_path)
+
+    index = {'shards': [], 'replays': []}
+    feature_list, label_list = [], []
+    shard_size = 0
+
+    def write_shard():
+        shard_id = len(index['shards'])
+        features = np.concatenate(feature_list, axis=0)
+        labels = np.concatenate(label_list, axis=0)
+
+        shard_info = {'features': 'shard_%05d_features.npy' % shard_id,
+                      'labels': 'shard_%05d_labels.npy' % shard_id,
+                      'rows': features.shape[0]}
+        save_npy_atomic(os.path.join(shard_path, shard_info['features']), features)
+        save_npy_atomic(os.path.join(shard_path, shard_info['labels']), labels)
+        index['shards'].append(shard_info)
+
+        print('write shard', shard_id, 'rows', shard_info['rows']) if debug else None
+        feature_list.clear()
+        label_list.clear()
+
+    for i, replay_file in enumerate(tqdm(replay_files)):
+        try:
+            if i < from_index or (end_index is not None and i >= end_index):
+                continue
+
+            features, labels = torch.load(os.path.join(tensor_path, replay_file))
+            assert features.shape[0] == labels.shape[0]
+            length = features.shape[0]
+
+            if shard_size > 0 and shard_size + length > shard_rows:
+                write_shard()
+                shard_size = 0
+
+            index['replays'].append({'name': replay_file, 'shard': len(index['shards']), 
+                                     'offset': shard_size, 'length': length})
+            feature_list.append(features.numpy())
+            label_list.append(labels.numpy())
+            shard_size += length
+
+        except Exception as e:
+            traceback.print_exc()
+
+    if shard_size > 0:
+        write_shard()
+
+    # write the index at last, so a shard path with the index file is always complete
+    tmp_file_name = os.path.join(shard_path, SHARD_INDEX_FILE + '.tmp')
+    with open(tmp_file_name, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_file_name, os.path.join(shard_path, SHARD_INDEX_FILE))
+
+    print("end")
+    print("shards:", len(index['shards']), "replays:", len(index['replays']))
+
+
+def test_shard_dataset(replay_num=7, seq_len=AHP.sequence_length):
+    import pickle
+    import tempfile
+
+    rng = np.random.default_rng(1)
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        tensor_path = os.path.join(tmp_path, 'tensor')
+        shard_path = os.path.join(tmp_path, 'shard')
+        os.makedirs(tensor_path)
+
+        replay_list = []
+        for i in range(replay_num):
+            # include a replay shorter than seq_len
+            length = seq_len - 1 if i == 3 else int(rng.integers(seq_len, 5 * seq_len))
+            features = torch.tensor(rng.random((length, 13)))
+            labels = torch.tensor(rng.integers(-1, 100, size=(length, 5)), dtype=torch.int16)
+            torch.save((features, labels), os.path.join(tensor_path, 'replay_%02d.pt' % i))
+            replay_list.append((features, labels))
+
+        pack_tensor_to_shards(tensor_path, shard_path, shard_rows=3 * seq_len)
+
+        t = time.time()
+        for replay_file in sorted(os.listdir(tensor_path)):
+            torch.load(os.path.join(tensor_path, replay_file))
+        print('load .pt files time: %.4fs' % (time.time() - t))
+
+        t = time.time()
+        ReplayShardDataset(shard_path, seq_len=seq_len)
+        print('open shards time: %.4fs' % (time.time() - t))
+
+        for from_index, end_index in [(0, None), (2, 5)]:
+            tensor_set = ConcatDataset([ReplayTensorDataset(*r, seq_len=seq_len) 
+                                        for r in replay_list[from_index:end_index] if r[0].shape[0] >= seq_len])
+            shard_set = ReplayShardDataset(shard_path, from_index=from_index, end_index=end_index, seq_len=seq_len)
+            assert len(shard_set) == len(tensor_set)
+
+            for j in range(len(shard_set)):
+                for x, y in zip(shard_set[j], tensor_set[j]):
+                    assert torch.equal(x, y)
+
+        # the dataset is sent to the DataLoader workers without the mapped shards
+        shard_set = pickle.loads(pickle.dumps(shard_set))
+        assert len(shard_set.shards) == 0
+        assert torch.equal(shard_set[-1][0], tensor_set[-1][0])
+
+        loader = DataLoader(shard_set, batch_size=4, shuffle=True, num_workers=1)
+        for features, labels in loader:
+            assert features.shape[1:] == (seq_len, 13)
+
+        del shard_set, loader
+
+    print('test_shard_dataset over')
+
+
 def test():
-    pass
+    test_shard_dataset()
@@ -8,6 +8,7 @@ import time
 import traceback
 import pickle
 import random
+from collections import OrderedDict
 
 from tqdm import tqdm
 
@@ -28,6 +29,10 @@ __author__ = "Ruo-Ze Liu"
 
 debug = False
 
+# the default max bytes of the in-memory frame cache, 0 turns it off (opt-in). Note the budget is 
+# per process: each DataLoader worker has its own cache, so the memory used is up to num_workers times it
+CACHE_BYTES = 0
+
 
 class OneReplayDataset(Dataset):
 
@@ -175,13 +180,111 @@ class AllReplayDataset(Dataset):
         return trajs[0:training_size + val_size + test_size]
 
 
+class FrameFeatureCache(object):
+    '''
+    The cache of the (feature, label) of each frame, shared by the overlapping windows. 
+    It has an in-memory LRU bounded by max_bytes (in each DataLoader worker, 0 for no LRU), and optionally 
+    a directory on the disk which keeps every computed frame, so the frames are not computed again by the other
+    DataLoader workers, by the later epochs or after they are evicted from the memory.
+    Note the files on the disk should be removed if the feature code is changed.
+    '''
+
+    def __init__(self, max_bytes=CACHE_BYTES, cache_path=None):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.cache_path = cache_path
+
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+
+        self.hit_num = 0
+        self.disk_hit_num = 0
+        self.miss_num = 0
+
+    def __getstate__(self):
+        # a new worker process starts with an empty memory
+        state = self.__dict__.copy()
+        state['memory'] = OrderedDict()
+        state['memory_bytes'] = 0
+        return state
+
+    def get(self, name, compute_func):
+        item = self.memory.get(name)
+        if item is not None:
+            self.memory.move_to_end(name)
+            self.hit_num += 1
+            return item
+
+        item = self.load(name)
+        if item is not None:
+            self.disk_hit_num += 1
+        else:
+            item = compute_func()
+            self.miss_num += 1
+            self.save(name, item)
+
+        self.put(name, item)
+        return item
+
+    def put(self, name, item):
+        size = sum(x.nbytes for x in item)
+        if size > self.max_bytes:
+            return
+
+        self.memory[name] = item
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_bytes:
+            _, old_item = self.memory.popitem(last=False)
+            self.memory_bytes -= sum(x.nbytes for x in old_item)
+
+    def get_file_name(self, name):
+        return os.path.join(self.cache_path, name + '.npz')
+
+    def load(self, name):
+        if self.cache_path is None:
+            return None
+
+        file_name = self.get_file_name(name)
+        if not os.path.exists(file_name):
+            return None
+
+        with np.load(file_name) as data:
+            return data['feature'], data['label']
+
+    def save(self, name, item):
+        if self.cache_path is None:
+            return
+
+        file_name = self.get_file_name(name)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+
+        # the workers may write the same frame at the same time, so each one 
+        # writes its own temporary file and then replaces the target atomically
+        tmp_file_name = file_name + '.%d.tmp' % os.getpid()
+        with open(tmp_file_name, 'wb') as f:
+            np.savez(f, feature=item[0], label=item[1])
+        os.replace(tmp_file_name, file_name)
+
+    def hit_rate(self):
+        all_num = self.hit_num + self.disk_hit_num + self.miss_num
+        return (self.hit_num + self.disk_hit_num) / (all_num + 1e-9)
+
+    def __str__(self):
+        return "hit: %d, disk_hit: %d, miss: %d, hit_rate: %.3f, memory_bytes: %d" % (
+            self.hit_num, self.disk_hit_num, self.miss_num, self.hit_rate(), self.memory_bytes)
+
+
 class FullDataset(Dataset):
 
-    def __init__(self, replay_data_path, val=False, max_file_size=None, shuffle=False, seq_length=AHP.sequence_length):
+    def __init__(self, replay_data_path, val=False, max_file_size=None, shuffle=False, seq_length=AHP.sequence_length,
+                 cache_bytes=CACHE_BYTES, cache_path=None):
         super().__init__()
 
         self.seq_len = seq_length
 
+        # each frame is featurized once and then shared by all the windows containing it
+        self.frame_cache = FrameFeatureCache(max_bytes=cache_bytes, cache_path=cache_path)
+
         replay_files = os.listdir(replay_data_path)
         print('length of replay_files:', len(replay_files)) if debug else None
         replay_files.sort()
@@ -204,6 +307,9 @@ class FullDataset(Dataset):
         obs_index = 0
         self.final_index_list = []
 
+        # the names of the frames used by the frame cache, e.g., "replay_name/step"
+        self.frame_name_list = []
+
         for i, replay_file in enumerate(tqdm(replay_files)):
             try:
                 replay_path = replay_data_path + replay_file
@@ -220,6 +326,7 @@ class FullDataset(Dataset):
                         # self.feature_list.append(feature)
                         # self.label_list.append(label)
                         self.obs_list.append(value)
+                        self.frame_name_list.append(replay_file.replace('.pickle', '') + '/' + str(key))
                         obs_index = obs_index + 1
 
                     self.final_index_list.append(obs_index - 1)
@@ -234,13 +341,17 @@ class FullDataset(Dataset):
 
         return result
 
+    def get_frame(self, obs_index):
+        return self.frame_cache.get(self.frame_name_list[obs_index], 
+                                    lambda: SU.obs2feature_numpy(self.obs_list[obs_index]))
+
     def get_array_item(self, index):
-        obs = self.obs_list[index:index + self.seq_len]
+        obs_index_list = range(index, min(index + self.seq_len, len(self.obs_list)))
 
         feature_list = []
         label_list = []
-        for value in obs:
-            feature, label = SU.obs2feature_numpy(value)
+        for obs_index in obs_index_list:
+            feature, label = self.get_frame(obs_index)
             feature_list.append(feature)
             label_list.append(label)
 
@@ -330,5 +441,56 @@ class FullDataset(Dataset):
         return len(self.obs_list) - self.seq_len + 1
 
 
+def test_frame_cache(replay_num=3, step_num=12, seq_len=4):
+    import tempfile
+    from alphastarmini.core.sl.load_pickle import random_pickle_step
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        replay_data_path = os.path.join(tmp_path, 'pickle') + '/'
+        os.mkdir(replay_data_path)
+
+        for i in range(replay_num):
+            step_dict = {j: random_pickle_step(seed=i * step_num + j) for j in range(step_num)}
+            with open(replay_data_path + 'replay_%02d.pickle' % i, 'wb') as handle:
+                pickle.dump(step_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+        no_cache_set = FullDataset(replay_data_path, max_file_size=replay_num, seq_length=seq_len, cache_bytes=0)
+        cache_set = FullDataset(replay_data_path, max_file_size=replay_num, seq_length=seq_len,
+                                cache_bytes=256 * 1024 ** 2)
+        index_list = list(range(len(cache_set)))
+        random.Random(1).shuffle(index_list)
+
+        result_list = []
+        for dataset in (no_cache_set, cache_set):
+            t = time.time()
+            result_list.append([dataset[index] for index in index_list])
+            used_time = time.time() - t
+            print('cache_bytes: %d, samples/sec: %.2f, cache: %s' % (dataset.frame_cache.max_bytes, 
+                                                                    len(index_list) / used_time, dataset.frame_cache))
+
+        for x, y in zip(*result_list):
+            assert np.array_equal(x, y)
+
+        # each frame is only computed once in an epoch, and the cache is off by default
+        assert cache_set.frame_cache.miss_num == len(cache_set.obs_list)
+        assert no_cache_set.frame_cache.memory_bytes == 0 and CACHE_BYTES == 0
+
+        # the frames on the disk are shared by the DataLoader workers and the next epoch
+        cache_path = os.path.join(tmp_path, 'cache')
+        disk_set = FullDataset(replay_data_path, max_file_size=replay_num, seq_length=seq_len, 
+                               cache_bytes=0, cache_path=cache_path)
+        loader = DataLoader(disk_set, batch_size=2, shuffle=True, num_workers=1)
+        for one_traj in loader:
+            assert one_traj.shape[1] == seq_len
+
+        assert disk_set.frame_cache.miss_num == 0
+        disk_result = [disk_set[index] for index in index_list]
+        assert disk_set.frame_cache.miss_num == 0
+        print('disk cache:', disk_set.frame_cache)
+
+        for x, y in zip(disk_result, result_list[0]):
+            assert np.array_equal(x, y)
+
+
 def test():
-    pass
+    test_frame_cache()
@@ -13,11 +13,18 @@ from alphastarmini.lib.hyper_parameters import StarCraft_Hyper_Parameters as SCH
 from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
 from alphastarmini.lib.hyper_parameters import Label_Size as LS
 from alphastarmini.lib.hyper_parameters import LabelIndex
+from alphastarmini.lib.hyper_parameters import Compact_Label_Size as CLS
+from alphastarmini.lib.hyper_parameters import CompactLabelIndex
 
 __author__ = "Ruo-Ze Liu"
 
 debug = False
 
+# all the values in the compact label are small indexes (the largest one is the action type id), 
+# so int16 is enough for them
+COMPACT_LABEL_DTYPE = np.int16
+COMPACT_LABEL_TENSOR_DTYPE = torch.int16
+
 
 class Label(object):
     '''
@@ -112,6 +119,137 @@ class Label(object):
         label = np.concatenate(action.toList(), axis=1)
         return label
 
+    @staticmethod    
+    def getCompactSize():
+        last_index = 0
+        for i in CompactLabelIndex:
+            last_index += CLS[i]
+        return last_index
+
+    @staticmethod    
+    def getCompactSlice(index):
+        last_index = 0
+        for i in CompactLabelIndex:
+            if i == index:
+                return slice(last_index, last_index + CLS[i])
+            last_index += CLS[i]
+
+    @staticmethod
+    def action2compact_numpy(action):
+        ''' 
+        input: args action (numpy), e.g., the output of ArgsAction.toArray()
+        outoput: [batch_size x compact_label_size]
+        '''
+        # the compact label only stores the indexes of the arguments, 
+        # e.g., 2 numbers for the target location instead of the 256 x 256 one-hot, 
+        # -1 means the argument is not used, the same as in toArray()
+        batch_size = action.action_type.shape[0]
+
+        # the last entity index is the padding of the one-hot label (the not used units, and the units
+        # beyond the max entities clamped by toArray()), so it is stored as -1 and not counted
+        units = action.units.reshape(batch_size, CLS.select_units)
+        units = np.where(units == AHP.max_entities - 1, -1, units)
+        units_num = np.sum(units >= 0, axis=1, keepdims=True)
+
+        compact_list = [action.action_type.reshape(batch_size, CLS.action_type),
+                        action.delay.reshape(batch_size, CLS.delay),
+                        action.queue.reshape(batch_size, CLS.queue),
+                        units_num.reshape(batch_size, CLS.select_units_num),
+                        units,
+                        action.target_unit.reshape(batch_size, CLS.target_unit),
+                        action.target_location.reshape(batch_size, CLS.target_location)]
+
+        label = np.concatenate(compact_list, axis=1).astype(COMPACT_LABEL_DTYPE)
+        return label
+
+    @staticmethod
+    def compact2action(compact):
+        ''' 
+        input: [batch_size x compact_label_size] (tensor)
+        outoput: args action (tensor), which has the indexes of the arguments
+        '''
+        # note, the not used argument (-1) is turned to the last index, which 
+        # is the same as the one-hot label made by np_one_hot
+        compact = compact.long()
+        batch_size = compact.shape[0]
+
+        def get_field(index, size):
+            return compact[:, Label.getCompactSlice(index)] % size
+
+        action_type = get_field(CompactLabelIndex.action_type, LS.action_type_encoding).reshape(batch_size, 1)
+        delay = get_field(CompactLabelIndex.delay, LS.delay_encoding).reshape(batch_size, 1)
+        queue = get_field(CompactLabelIndex.queue, LS.queue_encoding).reshape(batch_size, 1)
+        units = get_field(CompactLabelIndex.select_units, AHP.max_entities).reshape(batch_size, AHP.max_selected, 1)
+        target_unit = get_field(CompactLabelIndex.target_unit, AHP.max_entities).reshape(batch_size, 1, 1)
+        target_location = get_field(CompactLabelIndex.target_location, SCHP.world_size).reshape(batch_size, 2)
+
+        action = ArgsAction(action_type, delay, queue, units, target_unit, target_location)
+        return action
+
+    @staticmethod
+    def compact2label(compact, dtype=torch.float32):
+        ''' 
+        input: [batch_size x compact_label_size] (tensor)
+        outoput: [batch_size x label_feature_size], the same as action2label
+        '''
+        action = Label.compact2action(compact)
+        batch_size = compact.shape[0]
+        device = compact.device
+
+        # the offset of each one-hot encoding in the label
+        offset_list = []
+        last_index = 0
+        for i in LabelIndex:
+            offset_list.append(last_index)
+            last_index += LS[i]
+
+        units_offset = torch.arange(AHP.max_selected, device=device) * AHP.max_entities
+        x, y = action.target_location[:, 0], action.target_location[:, 1]
+
+        # note the x, y axis are opposiate to row, col!
+        hot_list = [action.action_type.reshape(batch_size, 1) + offset_list[LabelIndex.action_type_encoding],
+                    action.delay.reshape(batch_size, 1) + offset_list[LabelIndex.delay_encoding],
+                    action.queue.reshape(batch_size, 1) + offset_list[LabelIndex.queue_encoding],
+                    action.units.reshape(batch_size, AHP.max_selected) + units_offset + offset_list[LabelIndex.select_units_encoding],
+                    action.target_unit.reshape(batch_size, 1) + offset_list[LabelIndex.target_unit_encoding],
+                    (y * SCHP.world_size + x).reshape(batch_size, 1) + offset_list[LabelIndex.target_location_encoding]]
+        hot_index = torch.cat(hot_list, dim=1)
+
+        label = torch.zeros(batch_size, last_index, dtype=dtype, device=device)
+        label.scatter_(1, hot_index, 1)
+        return label
+
+    @staticmethod
+    def label2compact(label):
+        ''' 
+        input: [batch_size x label_feature_size] (tensor)
+        outoput: [batch_size x compact_label_size]
+        '''
+        # used to convert the old saved labels. The not used argument 
+        # is kept as the last index, which makes the same one-hot label.
+        batch_size = label.shape[0]
+        action = Label.label2action(label)
+
+        # the padding is -1, the same as action2compact_numpy
+        units = action.units.argmax(dim=-1).reshape(batch_size, CLS.select_units)
+        units = torch.where(units == AHP.max_entities - 1, -1, units)
+        units_num = torch.sum(units >= 0, dim=1, keepdim=True)
+
+        location = action.target_location.reshape(batch_size, -1).argmax(dim=-1)
+        y = torch.div(location, SCHP.world_size, rounding_mode='floor')
+        x = location - y * SCHP.world_size
+
+        compact_list = [action.action_type.argmax(dim=-1).reshape(batch_size, CLS.action_type),
+                        action.delay.argmax(dim=-1).reshape(batch_size, CLS.delay),
+                        action.queue.argmax(dim=-1).reshape(batch_size, CLS.queue),
+                        units_num.reshape(batch_size, CLS.select_units_num),
+                        units,
+                        action.target_unit.argmax(dim=-1).reshape(batch_size, CLS.target_unit),
+                        torch.stack([x, y], dim=1)]
+
+        compact = torch.cat(compact_list, dim=1).to(COMPACT_LABEL_TENSOR_DTYPE)
+        return compact
+
     @staticmethod
     def label2action(label):
         ''' 
@@ -174,3 +312,75 @@ class Label(object):
 
         action = action_list
         return action
+
+
+def random_action(rng):
+    # a random action with some arguments not used, like the ones in the replays
+    action_type = int(rng.integers(LS.action_type_encoding))
+    delay = int(rng.integers(LS.delay_encoding))
+    queue = int(rng.integers(LS.queue_encoding)) if rng.random() < 0.5 else None
+
+    units = None
+    if rng.random() < 0.5:
+        units = rng.integers(AHP.max_entities + 10, size=rng.integers(1, AHP.max_selected + 5)).tolist()
+
+    target_unit = int(rng.integers(AHP.max_entities)) if rng.random() < 0.3 else None
+    target_location = rng.integers(SCHP.world_size, size=2).tolist() if rng.random() < 0.5 else None
+
+    return ArgsAction(action_type, delay, queue, units, target_unit, target_location)
+
+
+def test_compact_label(step_num=500, batch_size=64):
+    import time
+
+    rng = np.random.default_rng(1)
+
+    dense_list, compact_list = [], []
+    dense_time, compact_time = 0., 0.
+    for _ in range(step_num):
+        action_array = random_action(rng).toArray()
+
+        t = time.perf_counter()
+        compact_list.append(Label.action2compact_numpy(action_array))
+        compact_time += time.perf_counter() - t
+
+        t = time.perf_counter()
+        dense_list.append(Label.action2label_numpy(action_array.toLogits_numpy()))
+        dense_time += time.perf_counter() - t
+
+    dense = torch.tensor(np.concatenate(dense_list, axis=0))
+    compact = torch.tensor(np.concatenate(compact_list, axis=0))
+
+    assert compact.shape == (step_num, Label.getCompactSize())
+    assert torch.equal(Label.compact2label(compact, dtype=dense.dtype), dense)
+
+    # the converted labels make the same one-hot labels
+    converted = Label.label2compact(dense)
+    assert torch.equal(Label.compact2label(converted, dtype=dense.dtype), dense)
+    assert torch.equal(Label.compact2action(converted).units, Label.compact2action(compact).units)
+
+    # the selection of the last entity index has the same units on the two paths
+    units_slice = slice(Label.getCompactSlice(CompactLabelIndex.select_units_num).start,
+                        Label.getCompactSlice(CompactLabelIndex.select_units).stop)
+    action_array = ArgsAction(0, 0, None, [3, AHP.max_entities - 1, AHP.max_entities + 5], None, None).toArray()
+    last = torch.tensor(Label.action2compact_numpy(action_array))
+    last_dense = torch.tensor(Label.action2label_numpy(action_array.toLogits_numpy()))
+    assert last[0, units_slice][0] == 1
+    assert torch.equal(Label.label2compact(last_dense)[:, units_slice], last[:, units_slice])
+    assert torch.equal(Label.compact2label(last, dtype=last_dense.dtype), last_dense)
+    assert torch.equal(converted[:, units_slice], compact[:, units_slice])
+
+    print('label bytes per step: dense float32 %d, dense float64 (saved .pt) %d, compact %d' % (
+        Label.getSize() * 4, dense.element_size() * Label.getSize(), compact.element_size() * Label.getCompactSize()))
+    print('label write time per step: dense %.1fus, compact %.1fus' % (dense_time / step_num * 1e6, 
+                                                                       compact_time / step_num * 1e6))
+
+    batch = compact[:batch_size]
+    t = time.perf_counter()
+    for _ in range(10):
+        Label.compact2label(batch)
+    print('compact2label time per batch of %d: %.2fms' % (batch_size, (time.perf_counter() - t) / 10 * 1e3))
+
+
+def test():
+    test_compact_label()
@@ -5,6 +5,8 @@
 
 import os
 import sys
+import time
+import tempfile
 import traceback
 import pickle
 
@@ -14,6 +16,8 @@ import torch
 
 from torch.utils.data import TensorDataset
 
+import torch.multiprocessing as mp
+
 from absl import flags
 from absl import app
 from tqdm import tqdm
@@ -30,6 +34,9 @@ debug = False
 FLAGS = flags.FLAGS
 flags.DEFINE_string("replay_data_path", "./data/replay_data/", "path to replays_save replay data")
 flags.DEFINE_string("save_tensor_path", "./data/replay_data_tensor/", "path to replays_save replay data tensor")
+flags.DEFINE_string("save_compact_tensor_path", "./data/replay_data_tensor_compact/", "path to replays_save replay data tensor with compact labels")
+flags.DEFINE_bool("save_compact_label", False, "save the compact (index) labels instead of the one-hot labels")
+flags.DEFINE_integer("pickle_workers", 1, "number of processes to transform the pickles to tensors")
 FLAGS(sys.argv)
 
 ON_SERVER = False
@@ -43,7 +50,7 @@ def print_tensor_list(tensor_list):
             print(l.shape)
 
 
-def from_pickle_to_tensor(pickle_path, tensor_path, from_index=0, end_index=None):
+def from_pickle_to_tensor(pickle_path, tensor_path, from_index=0, end_index=None, compact_label=False):
     replay_files = os.listdir(pickle_path)
     print('length of replay_files:', len(replay_files))
     replay_files.sort()
@@ -75,7 +82,7 @@ def from_pickle_to_tensor(pickle_path, tensor_path, from_index=0, end_index=None
                 for key, value in traj_dict.items():
                     # if j > 10:
                     #     break
-                    feature, label = SU.obs2feature_numpy(value)
+                    feature, label = SU.obs2feature_numpy(value, compact_label=compact_label)
                     feature_list.append(feature)
                     label_list.append(label)
                     del value, feature, label
@@ -108,5 +115,218 @@ def from_pickle_to_tensor(pickle_path, tensor_path, from_index=0, end_index=None
     print("replay_length_list:", replay_length_list)
 
 
+def pickle_to_tensor_file(replay_path, file_name, compact_label=False):
+    # the same as one replay in from_pickle_to_tensor, but the steps are popped from the 
+    # loaded dict and written to the pre-allocated arrays, so a replay is only in memory once
+    with open(replay_path, 'rb') as handle:
+        traj_dict = pickle.load(handle)
+
+    step_num = len(traj_dict)
+    features, labels = None, None
+    for j, key in enumerate(list(traj_dict.keys())):
+        value = traj_dict.pop(key)
+        feature, label = SU.obs2feature_numpy(value, compact_label=compact_label)
+        del value
+
+        if features is None:
+            features = np.empty((step_num, ) + feature.shape[1:], dtype=feature.dtype)
+            labels = np.empty((step_num, ) + label.shape[1:], dtype=label.dtype)
+
+        # keep the same dtype as np.concatenate in from_pickle_to_tensor
+        if feature.dtype != features.dtype:
+            features = features.astype(np.result_type(features, feature))
+        if label.dtype != labels.dtype:
+            labels = labels.astype(np.result_type(labels, label))
+
+        features[j] = feature[0]
+        labels[j] = label[0]
+        del feature, label
+
+    m = (torch.from_numpy(features), torch.from_numpy(labels))
+
+    # torch.save names the records in the file by the file name, so the temporary 
+    # file has the same name in another directory, then the result is the same as the serial one.
+    # the directory is beside the tensor path (not in it, which is listed by the training), 
+    # and it is removed with a partial file when the save fails
+    dir_name, base_name = os.path.split(file_name)
+    parent_dir = os.path.dirname(os.path.normpath(dir_name))
+    with tempfile.TemporaryDirectory(prefix='.tmp_', dir=parent_dir or None) as tmp_dir:
+        tmp_file_name = os.path.join(tmp_dir, base_name)
+        torch.save(m, tmp_file_name)
+        os.replace(tmp_file_name, file_name)
+
+    return step_num
+
+
+def pickle_to_tensor_worker(task):
+    replay_path, file_name, compact_label = task
+    try:
+        step_num = pickle_to_tensor_file(replay_path, file_name, compact_label=compact_label)
+        return replay_path, step_num
+    except Exception as e:
+        traceback.print_exc()
+        return replay_path, None
+
+
+def from_pickle_to_tensor_parallel(pickle_path, tensor_path, from_index=0, end_index=None, compact_label=False,
+                                   num_workers=4, max_tasks_per_worker=1):
+    # the multi-process version of from_pickle_to_tensor, each replay is a task, and a worker 
+    # is replaced after max_tasks_per_worker replays to give back its memory
+    replay_files = os.listdir(pickle_path)
+    print('length of replay_files:', len(replay_files))
+    replay_files.sort()
+
+    task_list = []
+    for i, replay_file in enumerate(replay_files):
+        if i < from_index or (end_index is not None and i >= end_index):
+            continue
+        file_name = tensor_path + replay_file.replace('.pickle', '') + '.pt'
+        task_list.append((pickle_path + replay_file, file_name, compact_label))
+
+    if not os.path.exists(tensor_path):
+        os.mkdir(tensor_path)
+
+    replay_length_list = []
+    start_time = time.time()
+    with mp.Pool(processes=num_workers, maxtasksperchild=max_tasks_per_worker) as pool:
+        for i, (replay_path, step_num) in enumerate(pool.imap_unordered(pickle_to_tensor_worker, task_list)):
+            replay_length_list.append(step_num)
+
+            used_time = time.time() - start_time
+            eta = used_time / (i + 1) * (len(task_list) - i - 1)
+            print('[%d/%d] replay_path: %s, steps: %s, time: %.1fs, eta: %.1fs' % (i + 1, len(task_list), replay_path, 
+                                                                                  step_num, used_time, eta))
+
+    print("end")
+    print("replay_length_list:", replay_length_list)
+
+
+def from_tensor_to_compact(tensor_path, compact_path, from_index=0, end_index=None):
+    # convert the saved .pt files which have one-hot labels to the ones with compact labels
+    replay_files = [f for f in os.listdir(tensor_path) if f.endswith('.pt')]
+    print('length of replay_files:', len(replay_files))
+    replay_files.sort()
+
+    old_size, new_size = 0, 0
+    for i, replay_file in enumerate(replay_files):
+        try:
+            do_write = False
+            if i >= from_index:
+                if end_index is None:
+                    do_write = True
+                elif end_index is not None and i < end_index:
+                    do_write = True
+
+            if not do_write:
+                continue    
+
+            replay_path = tensor_path + replay_file
+            print('replay_path:', replay_path)
+
+            features, labels = torch.load(replay_path)
+            print("labels.shape:", labels.shape) if debug else None
+
+            if labels.shape[-1] == Label.getCompactSize():
+                compact_labels = labels
+            else:
+                compact_labels = Label.label2compact(labels)
+            print("compact_labels.shape:", compact_labels.shape) if debug else None
+
+            old_size += labels.nelement() * labels.element_size()
+            new_size += compact_labels.nelement() * compact_labels.element_size()
+
+            m = (features, compact_labels)
+            del labels
+
+            if not os.path.exists(compact_path):
+                os.mkdir(compact_path)
+            file_name = compact_path + replay_file
+            torch.save(m, file_name)
+
+        except Exception as e:
+            traceback.print_exc()    
+
+    print("end")
+    print("label bytes: before %d, after %d" % (old_size, new_size))
+
+
+def random_pickle_step(seed=None):
+    # a synthetic step in the format of the dict saved by transform_replay_data.getObsAndFunc
+    from pysc2.lib import named_array
+    from pysc2.lib import actions as A
+    from pysc2.lib.features import Player, EffectPos, MINIMAP_FEATURES
+
+    from alphastarmini.core.arch.agent import random_raw_units
+    from alphastarmini.core.arch.spatial_encoder import random_feature_minimap
+
+    rng = np.random.RandomState(seed)
+    feature_minimap = random_feature_minimap(seed=seed)
+
+    if rng.rand() < 0.5:
+        func_call = A.FunctionCall.init_with_validation("Smart_pt", [[0], rng.randint(0, 50, 3).tolist(), 
+                                                                     rng.randint(0, 64, 2).tolist()], raw=True)
+    else:
+        func_call = A.FunctionCall.init_with_validation("no_op", [], raw=True)
+
+    step_dict = {'raw_units': random_raw_units(rng.randint(1, 50), seed=seed),
+                 'player': named_array.NamedNumpyArray(rng.randint(0, 200, len(Player)), Player, dtype=np.int32),
+                 'last_actions': np.array([], dtype=np.int32),
+                 'upgrades': np.array([1, 7], dtype=np.int32),
+                 'unit_counts': np.array([[84, 12], [59, 1]]),
+                 'feature_effects': np.zeros((0, len(EffectPos)), dtype=np.int32),
+                 'raw_effects': np.zeros((0, len(EffectPos)), dtype=np.int32),
+                 'game_loop': np.array([rng.randint(0, 20000)], dtype=np.int32),
+                 'masked_bo': np.array([]),
+                 'masked_bu': np.zeros(10),
+                 'func_call': func_call}
+
+    for name in MINIMAP_FEATURES._fields:
+        step_dict[name] = feature_minimap[name]
+
+    return step_dict
+
+
+def test_parallel(replay_num=4, step_num=5, num_workers=2):
+    import filecmp
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        pickle_path = os.path.join(tmp_path, 'pickle') + '/'
+        os.mkdir(pickle_path)
+
+        for i in range(replay_num):
+            step_dict = {j: random_pickle_step(seed=i * step_num + j) for j in range(step_num)}
+            with open(pickle_path + 'replay_%02d.pickle' % i, 'wb') as handle:
+                pickle.dump(step_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+        for compact_label in (False, True):
+            serial_path = os.path.join(tmp_path, 'serial_%d' % compact_label) + '/'
+            parallel_path = os.path.join(tmp_path, 'parallel_%d' % compact_label) + '/'
+
+            t = time.time()
+            from_pickle_to_tensor(pickle_path, serial_path, compact_label=compact_label)
+            serial_time = time.time() - t
+
+            t = time.time()
+            from_pickle_to_tensor_parallel(pickle_path, parallel_path, compact_label=compact_label, 
+                                           num_workers=num_workers)
+            parallel_time = time.time() - t
+
+            for replay_file in os.listdir(serial_path):
+                assert filecmp.cmp(serial_path + replay_file, parallel_path + replay_file, shallow=False)
+
+            # only the .pt files are in the tensor path, and no temporary directory is left beside it
+            assert sorted(os.listdir(parallel_path)) == sorted(os.listdir(serial_path))
+            assert not [f for f in os.listdir(tmp_path) if f.startswith('.tmp')]
+
+            print('from_pickle_to_tensor time: %.2fs, from_pickle_to_tensor_parallel time: %.2fs' % (serial_time, 
+                                                                                                     parallel_time))
+
+
 def test(on_server=False):
-    from_pickle_to_tensor(FLAGS.replay_data_path, FLAGS.save_tensor_path, 15, 20)
+    if FLAGS.pickle_workers > 1:
+        from_pickle_to_tensor_parallel(FLAGS.replay_data_path, FLAGS.save_tensor_path, 15, 20, 
+                                       compact_label=FLAGS.save_compact_label, num_workers=FLAGS.pickle_workers)
+    else:
+        from_pickle_to_tensor(FLAGS.replay_data_path, FLAGS.save_tensor_path, 15, 20, 
+                              compact_label=FLAGS.save_compact_label)
@@ -16,6 +16,8 @@ from alphastarmini.core.sl.feature import Feature
 from alphastarmini.core.sl.label import Label
 from alphastarmini.core.sl import sl_utils as SU
 
+from alphastarmini.lib.hyper_parameters import StarCraft_Hyper_Parameters as SCHP
+
 
 __author__ = "Ruo-Ze Liu"
 
@@ -80,6 +82,33 @@ def cross_entropy(soft_targets, pred, mask=None, debug=False, outlier_remove=Tru
     return x_4
 
 
+# the same as cross_entropy, but the target is the class index, not the one-hot embedding, 
+# so it can be used for the compact label without making the large (e.g., 256 x 256) one-hot
+def cross_entropy_index(target_index, pred, mask=None, outlier_remove=True):
+    # class is always in the last dim
+    logsoftmax = nn.LogSoftmax(dim=-1)
+    x_2 = - logsoftmax(pred).gather(-1, target_index.unsqueeze(-1)).squeeze(-1)
+    print('x_2:', x_2) if debug else None
+    print('x_2.shape:', x_2.shape) if debug else None
+
+    # This mask is for each item's mask
+    if mask is not None:
+        x_2 = x_2 * mask
+
+        if outlier_remove:
+            outlier_mask = (x_2 >= 1e6)
+            x_2 = x_2 * ~outlier_mask
+        else:
+            outlier_mask = (x_2 >= 1e6)
+            if outlier_mask.any() > 0:
+                stop()
+
+    x_4 = torch.mean(x_2)
+    print('x_4:', x_4) if debug else None
+
+    return x_4
+
+
 def get_sl_loss(traj_batch, model, use_mask=True, use_eval=False):
     criterion = cross_entropy
 
@@ -140,6 +169,13 @@ def get_sl_loss_for_tensor(features, labels, model, decrease_smart_opertaion=Fal
                            return_important=False, only_consider_small=False,
                            ):
 
+    # the labels may be saved in the compact format
+    if labels.shape[-1] == Label.getCompactSize():
+        return get_sl_loss_for_compact_tensor(features, labels, model, 
+                                              decrease_smart_opertaion=decrease_smart_opertaion,
+                                              return_important=return_important, 
+                                              only_consider_small=only_consider_small)
+
     criterion = cross_entropy
 
     batch_size = features.shape[0]
@@ -209,6 +245,139 @@ def get_sl_loss_for_tensor(features, labels, model, decrease_smart_opertaion=Fal
     return loss, loss_list, acc_num_list
 
 
+def get_sl_loss_for_compact_tensor(features, labels, model, decrease_smart_opertaion=False,
+                                   return_important=False, only_consider_small=False):
+
+    criterion = cross_entropy_index
+
+    batch_size = features.shape[0]
+    seq_len = features.shape[1]
+
+    assert batch_size == labels.shape[0]
+    assert seq_len == labels.shape[1]
+
+    features = features.reshape(batch_size * seq_len, -1)
+    labels = labels.reshape(batch_size * seq_len, -1)
+
+    state = Feature.feature2state(features)
+    print('state:', state) if debug else None
+
+    # the ground truth are the indexes of the arguments
+    action_gt = Label.compact2action(labels)
+    print('action_gt:', action_gt) if debug else None
+
+    device = next(model.parameters()).device
+    print("model.device:", device) if debug else None
+
+    action_pred, units, target_unit, target_location, action_type_logits, \
+        delay_logits, queue_logits, \
+        units_logits, target_unit_logits, \
+        target_location_logits, select_units_num = model.forward(state, 
+                                                                 batch_size=batch_size, 
+                                                                 sequence_length=seq_len, 
+                                                                 multi_gpu_supvised_learning=True)
+
+    print('action_pred.shape', action_pred.shape) if debug else None   
+    print('select_units_num', select_units_num) if debug else None 
+
+    loss, loss_list = get_masked_classify_loss_by_index(action_gt, action_pred, action_type_logits,
+                                                        delay_logits, queue_logits, units_logits,
+                                                        target_unit_logits, target_location_logits, 
+                                                        select_units_num, criterion, device, 
+                                                        decrease_smart_opertaion=decrease_smart_opertaion,
+                                                        only_consider_small=only_consider_small)  
+
+    action_type_gt = action_gt.action_type.reshape(-1)
+    acc_num_list, action_equal_mask = SU.get_accuracy_by_index(action_type_gt, action_pred, 
+                                                               device, return_important=return_important)
+
+    location_acc = SU.get_location_accuracy_by_index(get_location_index(action_gt.target_location), target_location, 
+                                                     action_equal_mask, device, strict_comparsion=True)
+    selected_acc = SU.get_selected_units_accuracy_by_index(action_gt.units.squeeze(-1), units, select_units_num, 
+                                                           action_equal_mask, device, strict_comparsion=True)
+    targeted_acc = SU.get_target_unit_accuracy_by_index(action_gt.target_unit.reshape(-1), target_unit, 
+                                                        action_equal_mask, device, strict_comparsion=True)
+
+    acc_num_list.extend(location_acc)
+    acc_num_list.extend(selected_acc)
+    acc_num_list.extend(targeted_acc)
+
+    print('loss', loss) if debug else None
+
+    return loss, loss_list, acc_num_list
+
+
+def get_location_index(target_location):
+    # from [batch_size x 2] (x, y) to the flatten index, note the x, y axis are opposiate to row, col!
+    return target_location[:, 1] * SCHP.world_size + target_location[:, 0]
+
+
+def get_masked_classify_loss_by_index(action_gt, action_pred, action_type, delay, queue, units,
+                                      target_unit, target_location, select_units_num,
+                                      criterion, device, 
+                                      decrease_smart_opertaion=False,
+                                      only_consider_small=False):
+    # the same as get_masked_classify_loss_for_multi_gpu, but the action_gt has the 
+    # indexes of the arguments (see Label.compact2action), and the criterion is cross_entropy_index
+    loss = 0.
+
+    action_type_gt = action_gt.action_type.reshape(-1)
+
+    # consider using move camera weight
+    move_camera_weight = SU.get_move_camera_weight_in_SL_by_index(action_type_gt, 
+                                                                  action_pred, 
+                                                                  device, 
+                                                                  decrease_smart_opertaion=decrease_smart_opertaion,
+                                                                  only_consider_small=only_consider_small).reshape(-1)
+    action_type_loss = criterion(action_type_gt, action_type, mask=move_camera_weight)
+    loss += action_type_loss
+
+    mask_tensor = SU.get_two_way_mask_in_SL_by_index(action_type_gt, action_pred, device, strict_comparsion=True)
+
+    # we don't consider delay loss now
+    delay_loss = criterion(action_gt.delay.reshape(-1), delay)
+    loss += delay_loss * 0
+
+    queue_loss = criterion(action_gt.queue.reshape(-1), queue, mask=mask_tensor[:, 2].reshape(-1))
+    loss += queue_loss
+
+    batch_size = action_gt.units.shape[0]
+    select_size = action_gt.units.shape[1]
+    units_size = units.shape[-1]
+
+    units_mask = mask_tensor[:, 3]  # selected units is in the fourth position of units_mask
+    units_mask = units_mask.unsqueeze(1).repeat(1, select_size)
+    units_mask = units_mask.reshape(-1)
+
+    selected_mask = torch.arange(select_size, device=device).float()
+    selected_mask = selected_mask.repeat(batch_size, 1)
+    selected_mask = selected_mask < select_units_num.unsqueeze(dim=1)
+    selected_mask = selected_mask.reshape(-1)
+
+    # the last index is the None index
+    units_gt = action_gt.units.reshape(-1)
+    gt_units_mask = (units_gt != units_size - 1)
+
+    all_units_mask = units_mask * selected_mask * gt_units_mask
+    print('all_units_mask', all_units_mask) if debug else None
+
+    selected_units_weight = 10.
+    units_loss = selected_units_weight * criterion(units_gt, units.reshape(-1, units_size), mask=all_units_mask)
+    loss += units_loss
+
+    target_unit_weight = 5.
+    target_unit_loss = target_unit_weight * criterion(action_gt.target_unit.reshape(-1), target_unit.squeeze(-2), 
+                                                      mask=mask_tensor[:, 4].reshape(-1), outlier_remove=True)
+    loss += target_unit_loss
+
+    location_weight = 1.
+    target_location_loss = location_weight * criterion(get_location_index(action_gt.target_location),
+                                                       target_location.reshape(batch_size, -1), mask=mask_tensor[:, 5].reshape(-1))
+    loss += target_location_loss
+
+    return loss, [action_type_loss.item(), delay_loss.item(), queue_loss.item(), units_loss.item(), target_unit_loss.item(), target_location_loss.item()]
+
+
 def get_masked_classify_loss_for_multi_gpu(action_gt, action_pred, action_type, delay, queue, units,
                                            target_unit, target_location, select_units_num,
                                            criterion, device, 
@@ -281,3 +450,46 @@ def get_masked_classify_loss_for_multi_gpu(action_gt, action_pred, action_type,
     loss += target_location_loss
 
     return loss, [action_type_loss.item(), delay_loss.item(), queue_loss.item(), units_loss.item(), target_unit_loss.item(), target_location_loss.item()]
+
+
+def test():
+    from alphastarmini.core.sl.label import random_action
+    from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
+    from alphastarmini.lib.hyper_parameters import Label_Size as LS
+
+    batch_size = 32
+    device = torch.device("cpu")
+
+    rng = np.random.default_rng(1)
+    compact = torch.tensor(np.concatenate([Label.action2compact_numpy(random_action(rng).toArray()) 
+                                           for _ in range(batch_size)], axis=0))
+    action_gt_index = Label.compact2action(compact)
+    action_gt_dense = Label.label2action(Label.compact2label(compact))
+
+    # let half of the predicted action types be right, so the masks of arguments are used
+    action_pred = action_gt_index.action_type.reshape(-1).clone()
+    action_pred[::2] = torch.randint(LS.action_type_encoding, (batch_size // 2, ))
+
+    action_type = torch.randn(batch_size, LS.action_type_encoding)
+    delay = torch.randn(batch_size, LS.delay_encoding)
+    queue = torch.randn(batch_size, LS.queue_encoding)
+    units = torch.randn(batch_size, AHP.max_selected, AHP.max_entities)
+    target_unit = torch.randn(batch_size, 1, AHP.max_entities)
+    target_location = torch.randn(batch_size, SCHP.world_size, SCHP.world_size)
+    select_units_num = torch.randint(AHP.max_selected + 1, (batch_size, ))
+
+    _, loss_list = get_masked_classify_loss_for_multi_gpu(action_gt_dense, action_pred, action_type, delay, queue, 
+                                                          units, target_unit, target_location, select_units_num, 
+                                                          cross_entropy, device)
+    _, loss_list_index = get_masked_classify_loss_by_index(action_gt_index, action_pred, action_type, delay, queue, 
+                                                           units, target_unit, target_location, select_units_num, 
+                                                           cross_entropy_index, device)
+    print('loss_list', loss_list)
+    print('loss_list_index', loss_list_index)
+    assert np.allclose(loss_list, loss_list_index, rtol=1e-5)
+
+    action_equal_mask = (action_gt_index.action_type.reshape(-1) == action_pred)
+    location_pred = torch.randint(SCHP.world_size, (batch_size, 2))
+    assert SU.get_location_accuracy(action_gt_dense.target_location, location_pred, action_equal_mask, device) == \
+        SU.get_location_accuracy_by_index(get_location_index(action_gt_index.target_location), location_pred, 
+                                          action_equal_mask, device)
@@ -40,7 +40,7 @@ from alphastarmini.core.arch.arch_model import ArchModel
 from alphastarmini.core.sl.feature import Feature
 from alphastarmini.core.sl.label import Label
 from alphastarmini.core.sl import sl_loss_multi_gpu as Loss
-from alphastarmini.core.sl.dataset_pickle import OneReplayDataset, AllReplayDataset, FullDataset
+from alphastarmini.core.sl.dataset_pickle import OneReplayDataset, AllReplayDataset, FullDataset, CACHE_BYTES
 from alphastarmini.core.sl import sl_utils as SU
 
 from alphastarmini.lib.utils import load_latest_model, initial_model_state_dict
@@ -56,6 +56,10 @@ parser.add_argument("-p", "--path", default="./data/replay_data/", help="The pat
 parser.add_argument("-m", "--model", choices=["sl", "rl"], default="sl", help="Choose model type")
 parser.add_argument("-r", "--restore", action="store_true", default=True, help="whether to restore model or not")
 parser.add_argument('--num_workers', type=int, default=2, help='')
+parser.add_argument('--cache_path', default=None, help='The path to keep the features of frames, shared by the workers')
+parser.add_argument('--cache_bytes', type=int, default=CACHE_BYTES,
+                    help='The max bytes of the in-memory cache of the features of frames, 0 turns it off. '
+                         'The budget is per worker, so up to num_workers times it is used')
 
 # multi-gpu parameters
 parser.add_argument('--gpu', default=None, type=int, help='GPU id to use.')
@@ -131,8 +135,10 @@ def main_worker(gpu, ngpus_per_node, args):
 
     print('==> Preparing data..')
 
-    train_set = FullDataset(replay_data_path=PATH, max_file_size=FILE_SIZE, shuffle=False)
-    val_set = FullDataset(replay_data_path=PATH, val=True, max_file_size=FILE_SIZE, shuffle=False)
+    train_set = FullDataset(replay_data_path=PATH, max_file_size=FILE_SIZE, shuffle=False, cache_path=args.cache_path,
+                            cache_bytes=args.cache_bytes)
+    val_set = FullDataset(replay_data_path=PATH, val=True, max_file_size=FILE_SIZE, shuffle=False, cache_path=args.cache_path,
+                          cache_bytes=args.cache_bytes)
 
     print('len(train_set)', len(train_set))
     print('len(val_set)', len(val_set))
@@ -40,7 +40,7 @@ from alphastarmini.core.arch.arch_model import ArchModel
 from alphastarmini.core.sl.feature import Feature
 from alphastarmini.core.sl.label import Label
 from alphastarmini.core.sl import sl_loss_multi_gpu as Loss
-from alphastarmini.core.sl.dataset import ReplayTensorDataset
+from alphastarmini.core.sl.dataset import ReplayTensorDataset, ReplayShardDataset, SHARD_INDEX_FILE
 from alphastarmini.core.sl import sl_utils as SU
 
 from alphastarmini.lib.utils import load_latest_model, initial_model_state_dict
@@ -160,12 +160,20 @@ def main_worker(gpu, ngpus_per_node, args):
 
     print('==> Preparing data..')
 
-    replay_files = os.listdir(PATH)
-    print('length of replay_files:', len(replay_files)) if debug else None
-    replay_files.sort()
+    if os.path.exists(os.path.join(PATH, SHARD_INDEX_FILE)):
+        # each rank maps the same shards, instead of loading all the replays into its memory
+        train_set = ReplayShardDataset(PATH, from_index=0, end_index=1)
+        val_set = ReplayShardDataset(PATH, from_index=1, end_index=2)
+    else:
+        replay_files = [f for f in os.listdir(PATH) if f.endswith('.pt')]
+        print('length of replay_files:', len(replay_files)) if debug else None
+        replay_files.sort()
 
-    train_list = getReplayData(PATH, replay_files, from_index=0, end_index=1)
-    val_list = getReplayData(PATH, replay_files, from_index=1, end_index=2)
+        train_list = getReplayData(PATH, replay_files, from_index=0, end_index=1)
+        val_list = getReplayData(PATH, replay_files, from_index=1, end_index=2)
+
+        train_set = ConcatDataset(train_list)
+        val_set = ConcatDataset(val_list)
 
     print('len(train_set)', len(train_set))
     print('len(val_set)', len(val_set))
@@ -30,7 +30,7 @@ from alphastarmini.core.arch.arch_model import ArchModel
 from alphastarmini.core.sl.feature import Feature
 from alphastarmini.core.sl.label import Label
 from alphastarmini.core.sl import sl_loss_multi_gpu as Loss
-from alphastarmini.core.sl.dataset import ReplayTensorDataset
+from alphastarmini.core.sl.dataset import ReplayTensorDataset, ReplayShardDataset, SHARD_INDEX_FILE
 from alphastarmini.core.sl import sl_utils as SU
 
 from alphastarmini.lib.utils import load_latest_model, initial_model_state_dict
@@ -149,15 +149,20 @@ def main_worker(device):
 
     print('==> Preparing data..')
 
-    replay_files = os.listdir(PATH)
-    print('length of replay_files:', len(replay_files)) if debug else None
-    replay_files.sort()
+    if os.path.exists(os.path.join(PATH, SHARD_INDEX_FILE)):
+        # the shards made by dataset.pack_tensor_to_shards, which are memory-mapped
+        train_set = ReplayShardDataset(PATH, from_index=TRAIN_FROM, end_index=TRAIN_FROM + TRAIN_NUM)
+        val_set = ReplayShardDataset(PATH, from_index=VAL_FROM, end_index=VAL_FROM + VAL_NUM)
+    else:
+        replay_files = [f for f in os.listdir(PATH) if f.endswith('.pt')]
+        print('length of replay_files:', len(replay_files)) if debug else None
+        replay_files.sort()
 
-    train_list = getReplayData(PATH, replay_files, from_index=TRAIN_FROM, end_index=TRAIN_FROM + TRAIN_NUM)
-    val_list = getReplayData(PATH, replay_files, from_index=VAL_FROM, end_index=VAL_FROM + VAL_NUM)
+        train_list = getReplayData(PATH, replay_files, from_index=TRAIN_FROM, end_index=TRAIN_FROM + TRAIN_NUM)
+        val_list = getReplayData(PATH, replay_files, from_index=VAL_FROM, end_index=VAL_FROM + VAL_NUM)
 
-    train_set = ConcatDataset(train_list)
-    val_set = ConcatDataset(val_list)
+        train_set = ConcatDataset(train_list)
+        val_set = ConcatDataset(val_list)
 
     print('len(train_set)', len(train_set))
     print('len(val_set)', len(val_set))
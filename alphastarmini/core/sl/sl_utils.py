@@ -46,7 +46,7 @@ def obs2feature(obs):
     return feature, label
 
 
-def obs2feature_numpy(obs):
+def obs2feature_numpy(obs, compact_label=False):
     s = Agent.get_state_and_action_from_pickle_numpy(obs)
     feature = Feature.state2feature_numpy(s)
     print("feature:", feature) if debug else None
@@ -58,6 +58,11 @@ def obs2feature_numpy(obs):
     #tag_list = agent.get_tag_list(obs)
     print('action.get_shape:', action.get_shape()) if debug else None
 
+    if compact_label:
+        label = Label.action2compact_numpy(action)
+        print("label:", label) if debug else None
+        return feature, label
+
     logits = action.toLogits_numpy()
     print('logits.shape:', logits) if debug else None
     label = Label.action2label_numpy(logits)
@@ -144,6 +149,13 @@ def get_one_way_mask_in_SL(action_type_gt, device):
 def get_two_way_mask_in_SL(action_type_gt, action_pred, device, strict_comparsion=True):
     # consider the ground truth and the predicted
     ground_truth_raw_action_id = torch.nonzero(action_type_gt, as_tuple=True)[-1]
+
+    return get_two_way_mask_in_SL_by_index(ground_truth_raw_action_id, action_pred, device, 
+                                           strict_comparsion=strict_comparsion)
+
+
+def get_two_way_mask_in_SL_by_index(ground_truth_raw_action_id, action_pred, device, strict_comparsion=True):
+    # the ground truth is the action type ids, not the one-hot embedding
     action_pred = action_pred.reshape(-1)
 
     mask_list = [] 
@@ -188,6 +200,15 @@ def get_move_camera_weight_in_SL(action_type_gt, action_pred, device,
                                  decrease_smart_opertaion=False, only_consider_small=False):
     # consider the ground truth and the predicted
     ground_truth_raw_action_id = torch.nonzero(action_type_gt, as_tuple=True)[-1]
+
+    return get_move_camera_weight_in_SL_by_index(ground_truth_raw_action_id, action_pred, device, 
+                                                 decrease_smart_opertaion=decrease_smart_opertaion,
+                                                 only_consider_small=only_consider_small)
+
+
+def get_move_camera_weight_in_SL_by_index(ground_truth_raw_action_id, action_pred, device, 
+                                          decrease_smart_opertaion=False, only_consider_small=False):
+    # the ground truth is the action type ids, not the one-hot embedding
     mask_list = [] 
 
     MOVE_CAMERA_ID = F.raw_move_camera.id
@@ -261,6 +282,17 @@ def get_move_camera_weight_in_SL(action_type_gt, action_pred, device,
 
 def get_selected_units_accuracy(ground_truth, predict, select_units_num, action_equal_mask, 
                                 device, strict_comparsion=True, use_strict_order=False):
+    # each selected unit of the ground truth is a one-hot embedding
+    ground_truth = ground_truth.argmax(dim=-1)
+
+    return get_selected_units_accuracy_by_index(ground_truth, predict, select_units_num, action_equal_mask, 
+                                                device, strict_comparsion=strict_comparsion, 
+                                                use_strict_order=use_strict_order)
+
+
+def get_selected_units_accuracy_by_index(ground_truth, predict, select_units_num, action_equal_mask, 
+                                         device, strict_comparsion=True, use_strict_order=False):
+    # the ground truth is the unit indexes, shape: [batch_size x max_selected]
     all_num, correct_num, gt_num, pred_num = 0, 0, 1, 0
     if strict_comparsion:
         action_equal_index = action_equal_mask.nonzero(as_tuple=True)[0]
@@ -272,9 +304,7 @@ def get_selected_units_accuracy(ground_truth, predict, select_units_num, action_
         NONE_INDEX = AHP.max_entities - 1
 
         for i in range(size):
-            ground_truth_sample = ground_truth[i]
-            ground_truth_new = torch.nonzero(ground_truth_sample, as_tuple=True)[-1]
-            ground_truth_new = ground_truth_new.cpu().detach().numpy().tolist()
+            ground_truth_new = ground_truth[i].cpu().detach().numpy().tolist()
 
             print('ground_truth units', ground_truth_new) if debug else None
 
@@ -306,6 +336,15 @@ def get_selected_units_accuracy(ground_truth, predict, select_units_num, action_
 
 def get_target_unit_accuracy(ground_truth, predict, action_equal_mask, device, 
                              strict_comparsion=True, remove_none=True):
+    ground_truth = torch.nonzero(ground_truth, as_tuple=True)[-1]
+
+    return get_target_unit_accuracy_by_index(ground_truth, predict, action_equal_mask, device, 
+                                             strict_comparsion=strict_comparsion, remove_none=remove_none)
+
+
+def get_target_unit_accuracy_by_index(ground_truth, predict, action_equal_mask, device, 
+                                      strict_comparsion=True, remove_none=True):
+    # the ground truth is the target unit indexes, shape: [batch_size]
     right_num, all_num = 0, 0
 
     if strict_comparsion:
@@ -315,8 +354,7 @@ def get_target_unit_accuracy(ground_truth, predict, action_equal_mask, device,
 
     if ground_truth.shape[0] > 0:  
         print('ground_truth target_unit', ground_truth)
-        ground_truth_new = torch.nonzero(ground_truth, as_tuple=True)[-1]
-        ground_truth_new = ground_truth_new.to(device)
+        ground_truth_new = ground_truth.to(device)
         print('ground_truth_new target_unit', ground_truth_new) if debug else None
 
         predict_new = predict.reshape(-1)
@@ -336,6 +374,15 @@ def get_target_unit_accuracy(ground_truth, predict, action_equal_mask, device,
 
 
 def get_location_accuracy(ground_truth, predict, action_equal_mask, device, strict_comparsion=True):
+    ground_truth = ground_truth.reshape(ground_truth.shape[0], -1)
+    ground_truth = torch.nonzero(ground_truth, as_tuple=True)[-1]
+
+    return get_location_accuracy_by_index(ground_truth, predict, action_equal_mask, device, 
+                                          strict_comparsion=strict_comparsion)
+
+
+def get_location_accuracy_by_index(ground_truth, predict, action_equal_mask, device, strict_comparsion=True):
+    # the ground truth is the flatten index (y * world_size + x) of the location, shape: [batch_size]
     all_nums = ground_truth.shape[0]
 
     effect_nums = 0  # when the location argument applied both in ground_truth and predict
@@ -349,9 +396,7 @@ def get_location_accuracy(ground_truth, predict, action_equal_mask, device, stri
 
     if ground_truth.shape[0] > 0:    
 
-        ground_truth = ground_truth.reshape(ground_truth.shape[0], -1)
-        ground_truth_new = torch.nonzero(ground_truth, as_tuple=True)[-1]
-        ground_truth_new = ground_truth_new.to(device)
+        ground_truth_new = ground_truth.to(device)
         print('ground_truth location', ground_truth_new) if debug else None
 
         output_map_size = SCHP.world_size
@@ -391,10 +436,16 @@ def get_location_accuracy(ground_truth, predict, action_equal_mask, device, stri
 
 
 def get_accuracy(ground_truth, predict, device, return_important=False):
+    ground_truth_new = torch.nonzero(ground_truth, as_tuple=True)[-1]
+
+    return get_accuracy_by_index(ground_truth_new, predict, device, return_important=return_important)
+
+
+def get_accuracy_by_index(ground_truth, predict, device, return_important=False):
+    # the ground truth is the action type ids, not the one-hot embedding
     accuracy = 0.
 
-    ground_truth_new = torch.nonzero(ground_truth, as_tuple=True)[-1]
-    ground_truth_new = ground_truth_new.to(device)
+    ground_truth_new = ground_truth.to(device)
     print('ground_truth action_type', ground_truth_new) if debug else None
 
     predict_new = predict.reshape(-1)
@@ -71,6 +71,7 @@ flags.DEFINE_bool("disable_fog", False, "Whether tp disable fog of war.")
 flags.DEFINE_integer("observed_player", 1, "Which player to observe. For 2 player game, this can be 1 or 2.")
 
 flags.DEFINE_integer("save_type", 0, "0 is torch_tensor, 1 is python_pickle, 2 is numpy_array")
+flags.DEFINE_bool("compact_label", False, "save the compact (index) labels instead of the one-hot labels")
 flags.DEFINE_string("replay_version", "4.6.0", "the replays released by blizzard are all 3.16.1 version")
 
 # note, replay path should be absoulte path
@@ -139,7 +140,7 @@ def store_info(replay_info):
             game_duration_seconds]
 
 
-def getFeatureAndLabel_numpy(obs, func_call, delay=None):
+def getFeatureAndLabel_numpy(obs, func_call, delay=None, compact_label=False):
     print("begin s:") if debug else None
     s = Agent.get_state_and_action_from_pickle_numpy(obs)
     feature = Feature.state2feature_numpy(s)
@@ -153,6 +154,12 @@ def getFeatureAndLabel_numpy(obs, func_call, delay=None):
     print("action:", action) if debug else None
     action_array = action.toArray()
     print("action_array:", action_array) if debug else None
+
+    if compact_label:
+        label = Label.action2compact_numpy(action_array)
+        print("label:", label) if debug else None
+        return feature, label
+
     a = action_array.toLogits_numpy()
     print("a:", a) if debug else None
     label = Label.action2label_numpy(a)
@@ -488,6 +495,7 @@ def test(on_server=False):
                 step_dict = {}
 
                 # initial build order
+                player_tracker = U.BuildOrderTracker()
                 player_bo = []
                 player_ucb = []
 
@@ -497,13 +505,15 @@ def test(on_server=False):
                         obs = feat.transform_obs(o)
 
                         if prev_obs is not None:
+                            # calculate the unit counts of bag (of prev_obs, before the tracker steps to obs)
+                            player_ucb = player_tracker.unit_counts_list()
+                            print("player unit count of bow:", sum(player_ucb)) if debug else None
+
                             # calculate the build order
-                            player_bo = U.calculate_build_order(player_bo, prev_obs, obs)
+                            player_bo = player_tracker.update(obs)
                             print("player build order:", player_bo) if debug else None
-
-                            # calculate the unit counts of bag
-                            player_ucb = U.calculate_unit_counts_bow(prev_obs).reshape(-1).numpy().tolist()
-                            print("player unit count of bow:", sum(player_ucb)) if debug else None
+                        else:
+                            player_tracker.reset(obs)
 
                         try:
                             func_call = None
@@ -532,7 +542,7 @@ def test(on_server=False):
                                 record_i = i
 
                                 if SAVE_TYPE == SaveType.torch_tensor:
-                                    feature, label = getFeatureAndLabel_numpy(obs, func_call, delay)
+                                    feature, label = getFeatureAndLabel_numpy(obs, func_call, delay, FLAGS.compact_label)
                                     feature = torch.tensor(feature)
                                     label = torch.tensor(label)
                                     feature_list.append(feature)
@@ -543,7 +553,7 @@ def test(on_server=False):
                                     step_dict[i] = the_dict
 
                                 elif SAVE_TYPE == SaveType.numpy_array:
-                                    feature, label = getFeatureAndLabel_numpy(obs, func_call, delay)
+                                    feature, label = getFeatureAndLabel_numpy(obs, func_call, delay, FLAGS.compact_label)
                                     feature_list.append(feature)
                                     label_list.append(label)
 
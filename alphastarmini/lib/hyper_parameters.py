@@ -68,6 +68,22 @@ LabelSize = namedtuple('LabelSize', ['action_type_encoding', 'delay_encoding', '
                                      'target_location_encoding'])
 
 
+class CompactLabelIndex(enum.IntEnum):
+    """Indices for CompactLabelSize."""
+    action_type = 0
+    delay = 1
+    queue = 2
+    select_units_num = 3
+    select_units = 4
+    target_unit = 5
+    target_location = 6
+
+
+# for the compact label, which stores the argument indexes instead of the one-hot encodings
+CompactLabelSize = namedtuple('CompactLabelSize', ['action_type', 'delay', 'queue', 'select_units_num',
+                                                   'select_units', 'target_unit', 'target_location'])
+
+
 class ScalarFeature(enum.IntEnum):
     """Indices for ScalarFeatureSize."""
     agent_statistics = 0
@@ -251,7 +267,7 @@ RLTrainingHyperParameters = namedtuple('RLTrainingHyperParameters', ['learning_r
                                                                      'weight_decay', 'clip', 'seed'])
 
 RL_Training_Hyper_Parameters = RLTrainingHyperParameters(learning_rate=1e-5,  # AlphaStar: 3e-5
-                                                         beta1=0, 
+                                                         beta1=0., 
                                                          beta2=0.99, 
                                                          epsilon=1e-5,
                                                          weight_decay=1e-5,
@@ -302,6 +318,14 @@ Label_Size = LabelSize(action_type_encoding=Scalar_Feature_Size.available_action
                        target_unit_encoding=Arch_Hyper_Parameters.max_entities * 1,
                        target_location_encoding=StarCraft_Hyper_Parameters.world_size ** 2)
 
+Compact_Label_Size = CompactLabelSize(action_type=1,
+                                      delay=1,
+                                      queue=1,
+                                      select_units_num=1,
+                                      select_units=Arch_Hyper_Parameters.max_selected,
+                                      target_unit=1,
+                                      target_location=2)
+
 
 # for the params passed to the sc2_env creation
 AgentInterfaceFormatParams = namedtuple('AgentInterfaceFormatParams', ['feature_dimensions',
@@ -26,11 +26,97 @@ __author__ = "Ruo-Ze Liu"
 
 debug = False
 
+# the probe, drone, and SCV are not counted in build order
+WORKER_TYPE_LIST = [84, 104, 45]
+# the pylon, drone, and supplypot are not counted in build order
+SUPPLY_TYPE_LIST = [60, 106, 19]
+
+
+class UnitTypeRegistry(object):
+    '''
+    Dense lookup tables between the unit types in SC2 and the unit type indexes in mAS.
+    The index of a unit type is the same as the one found by get_unit_tpye_index, but the
+    tables are built once, so a lookup does not scan the race enums any more.
+    Unknown unit types are mapped to -1.
+    '''
+    races = (Neutral, Protoss, Terran, Zerg)
+
+    def __init__(self):
+        self.max_unit_type_id = max(e.value for race in self.races for e in race)
+        self.unit_type_size = sum(len(race) for race in self.races)
+
+        # raw unit type -> unit type index / race id
+        self.type_to_index = np.full(self.max_unit_type_id + 1, -1, dtype=np.int64)
+        self.type_to_race = np.full(self.max_unit_type_id + 1, -1, dtype=np.int64)
+
+        # unit type index -> raw unit type / race id
+        self.index_to_type = np.zeros(self.unit_type_size, dtype=np.int64)
+        self.index_to_race = np.zeros(self.unit_type_size, dtype=np.int64)
+
+        begin_index = 0
+        for race_id, race in enumerate(self.races):
+            for i, e in enumerate(list(race)):
+                self.index_to_type[begin_index + i] = e.value
+                self.index_to_race[begin_index + i] = race_id
+
+                # the same as get_unit_tpye_name_and_race, the first race which has the type wins
+                if self.type_to_index[e.value] < 0:
+                    self.type_to_index[e.value] = begin_index + i
+                    self.type_to_race[e.value] = race_id
+            begin_index += len(race)
+
+    def _lookup(self, table, unit_types):
+        unit_types = np.asarray(unit_types, dtype=np.int64)
+        valid = (unit_types >= 0) & (unit_types <= self.max_unit_type_id)
+        result = np.full(unit_types.shape, -1, dtype=np.int64)
+        result[valid] = table[unit_types[valid]]
+        return result
+
+    def index(self, unit_type):
+        unit_type = int(unit_type)
+        if unit_type < 0 or unit_type > self.max_unit_type_id:
+            return -1
+        return int(self.type_to_index[unit_type])
+
+    def indexes(self, unit_types):
+        return self._lookup(self.type_to_index, unit_types)
+
+    def unit_types(self, indexes):
+        return self.index_to_type[np.asarray(indexes, dtype=np.int64)]
+
+    def race_ids(self, unit_types):
+        return self._lookup(self.type_to_race, unit_types)
+
+    def race(self, unit_type):
+        race_id = self.race_ids(unit_type).item()
+        return self.races[race_id] if race_id >= 0 else None
+
+
+_unit_type_registry = None
+
+
+def get_unit_type_registry():
+    # the registry is built on first use
+    global _unit_type_registry
+    if _unit_type_registry is None:
+        _unit_type_registry = UnitTypeRegistry()
+    return _unit_type_registry
+
 
 def unit_tpye_to_unit_type_index(unit_type):
     ''' 
     transform unique unit type in SC2 to unit index in one hot represent in mAS.
     '''
+    unit_type_index = get_unit_type_registry().index(unit_type)
+    print('unit_type_index:', unit_type_index) if debug else None
+
+    return unit_type_index
+
+
+def unit_tpye_to_unit_type_index_by_scan(unit_type):
+    ''' 
+    the original version of unit_tpye_to_unit_type_index, which scans the race enums.
+    '''
     unit_tpye_name, race = get_unit_tpye_name_and_race(unit_type)
     print('unit_tpye_name, race:', unit_tpye_name, race) if debug else None   
 
@@ -75,48 +161,32 @@ def unpackbits_for_largenumber(x, num_bits):
 
 
 def calculate_unit_counts_bow(obs):
-    unit_counts = obs["unit_counts"] 
-    print('unit_counts:', unit_counts) if debug else None
-    unit_counts_bow = torch.zeros(1, SFS.unit_counts_bow)
-    for u_c in unit_counts:
-        unit_type = u_c[0]
-        unit_count = u_c[1]
-        assert unit_type >= 0
-        # the unit_count can not be negetive number
-        assert unit_count >= 0
-
-        # the unit_type should not be more than the SFS.unit_counts_bow
-        # if it is, make it to be 0 now. (0 means nothing now)
-        # the most impact one is ShieldBattery = 1910        
-        # find a better way to do it: transform it to unit_type_index!
-        unit_type_index = unit_tpye_to_unit_type_index(unit_type)
-        if unit_type_index >= SFS.unit_counts_bow:
-            unit_type_index = 0
-
-        unit_counts_bow[0, unit_type_index] = unit_count
-    return unit_counts_bow
+    unit_counts_bow = calculate_unit_counts_bow_numpy(obs, dtype=np.float32)
+    return torch.from_numpy(unit_counts_bow)
 
 
-def calculate_unit_counts_bow_numpy(obs):
-    unit_counts = obs["unit_counts"] 
+def calculate_unit_counts_bow_numpy(obs, dtype=np.float64, out=None):
+    unit_counts = np.asarray(obs["unit_counts"], dtype=np.int64).reshape(-1, 2)
     print('unit_counts:', unit_counts) if debug else None
-    unit_counts_bow = np.zeros((1, SFS.unit_counts_bow))
-    for u_c in unit_counts:
-        unit_type = u_c[0]
-        unit_count = u_c[1]
-        assert unit_type >= 0
-        # the unit_count can not be negetive number
-        assert unit_count >= 0
-
-        # the unit_type should not be more than the SFS.unit_counts_bow
-        # if it is, make it to be 0 now. (0 means nothing now)
-        # the most impact one is ShieldBattery = 1910        
-        # find a better way to do it: transform it to unit_type_index!
-        unit_type_index = unit_tpye_to_unit_type_index(unit_type)
-        if unit_type_index >= SFS.unit_counts_bow:
-            unit_type_index = 0
-
-        unit_counts_bow[0, unit_type_index] = unit_count
+
+    # out can be a (zeroed) [1 x SFS.unit_counts_bow] array to write the result in
+    unit_counts_bow = np.zeros((1, SFS.unit_counts_bow), dtype=dtype) if out is None else out
+
+    unit_type = unit_counts[:, 0]
+    unit_count = unit_counts[:, 1]
+    assert (unit_type >= 0).all()
+    # the unit_count can not be negetive number
+    assert (unit_count >= 0).all()
+
+    # transform the unit_type to unit_type_index
+    unit_type_index = get_unit_type_registry().indexes(unit_type)
+    assert (unit_type_index >= 0).all()
+
+    # the unit_type_index should not be more than the SFS.unit_counts_bow
+    # if it is, make it to be 0 now. (0 means nothing now)
+    unit_type_index[unit_type_index >= SFS.unit_counts_bow] = 0
+
+    unit_counts_bow[0, unit_type_index] = unit_count
     return unit_counts_bow
 
 
@@ -126,10 +196,8 @@ def calculate_build_order(previous_bo, obs, next_obs):
     next_ucb = calculate_unit_counts_bow(next_obs)
     diff = next_ucb - ucb
 
-    # the probe, drone, and SCV are not counted in build order
-    worker_type_list = [84, 104, 45] 
-    # the pylon, drone, and supplypot are not counted in build order
-    supply_type_list = [60, 106, 19] 
+    worker_type_list = WORKER_TYPE_LIST
+    supply_type_list = SUPPLY_TYPE_LIST
     diff[0, worker_type_list] = 0
     diff[0, supply_type_list] = 0
 
@@ -152,10 +220,8 @@ def calculate_build_order_numpy(previous_bo, obs, next_obs):
     next_ucb = calculate_unit_counts_bow_numpy(next_obs)
     diff = next_ucb - ucb
 
-    # the probe, drone, and SCV are not counted in build order
-    worker_type_list = [84, 104, 45] 
-    # the pylon, drone, and supplypot are not counted in build order
-    supply_type_list = [60, 106, 19] 
+    worker_type_list = WORKER_TYPE_LIST
+    supply_type_list = SUPPLY_TYPE_LIST
     diff[0, worker_type_list] = 0
     diff[0, supply_type_list] = 0
 
@@ -171,6 +237,137 @@ def calculate_build_order_numpy(previous_bo, obs, next_obs):
     return previous_bo
 
 
+class BuildOrderTracker(object):
+    '''
+    Keeps the unit counts (bag of words) and the build order of one player in an episode up to date.
+    The result is the same as calling calculate_unit_counts_bow and calculate_build_order each step,
+    but the bow of an observation is made only once, and only when the unit_counts of the observation
+    differ from the last ones (most frames build nothing).
+    '''
+
+    def __init__(self, obs=None):
+        super(BuildOrderTracker, self).__init__()
+        self.reset(obs)
+
+    def reset(self, obs=None):
+        # obs is the first observation of the episode
+        self.unit_counts = None
+        self.unit_counts_bow = np.zeros((1, SFS.unit_counts_bow), dtype=np.float32)
+        self.build_order = []
+
+        # statistics
+        self.update_num = 0
+        self.change_num = 0
+
+        if obs is not None:
+            self.set_unit_counts(obs)
+
+    def set_unit_counts(self, obs):
+        # returns the diff of the unit counts bow, or None if the unit_counts do not change
+        unit_counts = np.asarray(obs["unit_counts"], dtype=np.int64).reshape(-1, 2)
+        if self.unit_counts is not None and np.array_equal(unit_counts, self.unit_counts):
+            return None
+
+        # note: a new array, so the bow returned before is not changed
+        unit_counts_bow = calculate_unit_counts_bow_numpy({"unit_counts": unit_counts}, dtype=np.float32)
+        diff = unit_counts_bow - self.unit_counts_bow
+
+        self.unit_counts = unit_counts
+        self.unit_counts_bow = unit_counts_bow
+        self.change_num += 1
+
+        return diff
+
+    def update(self, next_obs):
+        """Updates by the next observation and returns the build order,
+        which is the same list appended in place, as calculate_build_order does."""
+        self.update_num += 1
+        first = self.unit_counts is None
+
+        diff = self.set_unit_counts(next_obs)
+        if diff is None or first:
+            return self.build_order
+
+        diff[0, WORKER_TYPE_LIST] = 0
+        diff[0, SUPPLY_TYPE_LIST] = 0
+
+        diff_count = diff.sum()
+        print("diff between unit_counts_bow", diff_count) if debug else None
+        if diff_count == 1.0:
+            index = np.flatnonzero(diff[0] >= 1.0)[0]
+            self.build_order.append(index)
+
+        return self.build_order
+
+    def unit_counts_list(self):
+        # the same as calculate_unit_counts_bow(obs).reshape(-1).numpy().tolist() of the last observation
+        return self.unit_counts_bow.reshape(-1).tolist()
+
+    def snapshot(self):
+        return (self.unit_counts, self.unit_counts_bow.copy(), list(self.build_order))
+
+    def restore(self, snapshot):
+        unit_counts, unit_counts_bow, build_order = snapshot
+        self.unit_counts = unit_counts
+        self.unit_counts_bow = unit_counts_bow.copy()
+        self.build_order = list(build_order)
+
+    def __str__(self):
+        return "updates: %d, changes: %d, build order: %s" % (self.update_num, self.change_num, self.build_order)
+
+
+def benchmark_build_order_tracker(frame_num=1000, seed=0):
+    import time
+
+    registry = get_unit_type_registry()
+    rng = np.random.RandomState(seed)
+
+    # the synthetic unit_counts of an episode: mostly unchanged, sometimes one or more units appear or die,
+    # including the workers and the supply buildings
+    type_index = list(rng.randint(0, min(registry.unit_type_size, SFS.unit_counts_bow), size=30)) + \
+        WORKER_TYPE_LIST + SUPPLY_TYPE_LIST
+    unit_types = registry.unit_types(type_index)
+    counts = dict.fromkeys(unit_types[:8], 1)
+    obs_list = []
+    for i in range(frame_num):
+        p = rng.rand()
+        if p < 0.1:
+            t = unit_types[rng.randint(len(unit_types))]
+            counts[t] = counts.get(t, 0) + 1
+        elif p < 0.13:
+            for t in unit_types[rng.randint(len(unit_types), size=2)]:
+                counts[t] = counts.get(t, 0) + 1
+        elif p < 0.16:
+            t = list(counts)[rng.randint(len(counts))]
+            counts[t] = max(counts[t] - 1, 0)
+        obs_list.append({"unit_counts": np.array([[t, c] for t, c in counts.items() if c > 0], dtype=np.int64)})
+
+    benchmark_start = time.time()
+    bo, bo_list, ucb_list = [], [], []
+    for obs, next_obs in zip(obs_list[:-1], obs_list[1:]):
+        bo = calculate_build_order(bo, obs, next_obs)
+        bo_list.append(list(bo))
+        ucb_list.append(calculate_unit_counts_bow(obs).reshape(-1).numpy().tolist())
+    stateless_time = time.time() - benchmark_start
+
+    benchmark_start = time.time()
+    tracker = BuildOrderTracker(obs_list[0])
+    for i, next_obs in enumerate(obs_list[1:]):
+        assert tracker.unit_counts_list() == ucb_list[i]
+        assert tracker.update(next_obs) == bo_list[i]
+        if i == frame_num // 2:
+            snapshot = tracker.snapshot()
+    tracker_time = time.time() - benchmark_start
+
+    tracker.restore(snapshot)
+    assert tracker.build_order == bo_list[frame_num // 2]
+    tracker.reset(obs_list[0])
+    assert tracker.build_order == [] and tracker.unit_counts_list() == ucb_list[0]
+
+    print("build order of {} frames, stateless: {:.6f}s/step, tracker: {:.6f}s/step (with the check), build order length: {}".format(
+        frame_num, stateless_time / frame_num, tracker_time / frame_num, len(bo_list[-1])))
+
+
 def load_latest_model(model_type, path):
     models = list(filter(lambda x: model_type in x, os.listdir(path)))
     if len(models) == 0:
@@ -615,8 +812,50 @@ def positional_encoding(max_position, embedding_size, add_batch_dim=False):
     return return_tensor
 
 
+def benchmark_unit_type_registry(unit_num=512, frame_num=20, seed=0):
+    import time
+
+    registry = get_unit_type_registry()
+    rng = np.random.RandomState(seed)
+    unit_types = registry.unit_types(rng.randint(0, registry.unit_type_size, size=(frame_num, unit_num)))
+
+    benchmark_start = time.time()
+    by_scan = [[unit_tpye_to_unit_type_index_by_scan(t) for t in frame] for frame in unit_types]
+    scan_time = time.time() - benchmark_start
+
+    benchmark_start = time.time()
+    by_registry = [registry.indexes(frame) for frame in unit_types]
+    registry_time = time.time() - benchmark_start
+
+    assert np.array_equal(np.array(by_scan), np.array(by_registry))
+    print("unit type index of {} frames x {} units, scan: {:.6f}s, registry: {:.6f}s, speedup: {:.1f}x".format(
+        frame_num, unit_num, scan_time, registry_time, scan_time / max(registry_time, 1e-9)))
+
+
 def test():
 
+    registry = get_unit_type_registry()
+
+    # the registry should give the same index as scanning the race enums
+    for race in registry.races:
+        for e in race:
+            index = unit_tpye_to_unit_type_index_by_scan(e.value)
+            assert registry.index(e.value) == index
+            assert registry.unit_types(index) == e.value
+            assert registry.race(e.value) == race
+    assert registry.index(0) == -1 and registry.index(100000) == -1
+    assert registry.race(0) is None
+
+    obs = {"unit_counts": np.array([[Protoss.Probe.value, 12], [Protoss.Nexus.value, 1], [Neutral.MineralField.value, 8]])}
+    unit_counts_bow = calculate_unit_counts_bow(obs)
+    assert unit_counts_bow.shape == (1, SFS.unit_counts_bow)
+    assert unit_counts_bow[0, registry.index(Protoss.Probe.value)] == 12
+    assert torch.sum(unit_counts_bow).item() == 21
+    assert calculate_unit_counts_bow({"unit_counts": []}).sum().item() == 0
+
+    benchmark_unit_type_registry()
+    benchmark_build_order_tracker()
+
     print("This is a test!") if debug else None
 
 
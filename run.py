@@ -62,6 +62,14 @@ if __name__ == '__main__':
     # from alphastarmini.core.sl import load_pickle
     # load_pickle.test(on_server=False)
 
+    # pack the tensor data to the memory-mapped shards, then set the path of sl_train_by_tensor to the shard path
+    # from alphastarmini.core.sl import dataset
+    # dataset.pack_tensor_to_shards("./data/replay_data_tensor_new/", "./data/replay_data_shard/")
+
+    # convert the tensor data with one-hot labels to the ones with compact labels
+    # from alphastarmini.core.sl import load_pickle
+    # load_pickle.from_tensor_to_compact(load_pickle.FLAGS.save_tensor_path, load_pickle.FLAGS.save_compact_tensor_path)
+
     # we can use pickle to do supervised learning
     # from alphastarmini.core.sl import sl_train_by_pickle
     # sl_train_by_pickle.test(on_server=P.on_server)
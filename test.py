@@ -1,6 +1,8 @@
 import alphastarmini
 import torch
 
+from alphastarmini.lib import utils
+
 from alphastarmini.core.arch import entity_encoder
 from alphastarmini.core.arch import scalar_encoder
 from alphastarmini.core.arch import spatial_encoder
@@ -15,19 +17,42 @@ from alphastarmini.core.arch import agent
 from alphastarmini.core.arch import baseline
 
 from alphastarmini.core.sl import load_pickle
+from alphastarmini.core.sl import dataset
+from alphastarmini.core.sl import dataset_pickle
+from alphastarmini.core.sl import label
+from alphastarmini.core.sl import sl_loss_multi_gpu
 
 from alphastarmini.core.rl import action
 from alphastarmini.core.rl import env_utils
 from alphastarmini.core.rl import actor
+from alphastarmini.core.rl import actor_inference
+from alphastarmini.core.rl import compact_state
+from alphastarmini.core.rl import trajectory_queue
+from alphastarmini.core.rl import trajectory_buffer
+from alphastarmini.core.rl import discounted_scan
+from alphastarmini.core.rl import z_library
+from alphastarmini.core.rl import synthetic_env
+from alphastarmini.core.rl import parameter_store
+from alphastarmini.core.rl import actor_pool
+from alphastarmini.core.rl import inference_service
+from alphastarmini.core.rl import learner
 from alphastarmini.core.rl import against_computer
 from alphastarmini.core.rl import pseudo_reward
 
+from alphastarmini.core.ma import payoff
+from alphastarmini.core.ma import player
+from alphastarmini.core.ma import snapshot_store
+from alphastarmini.core.ma import coordinator
+from alphastarmini.core.ma import league_store
+
 if __name__ == '__main__':
     # if we don't add this line, it may cause running time error while in Windows
     # torch.multiprocessing.freeze_support()
 
     print("test init")
 
+    utils.test()
+
     entity_encoder.test()
     scalar_encoder.test()
     spatial_encoder.test()
@@ -40,10 +65,31 @@ if __name__ == '__main__':
     location_head.test()
 
     action.test()
+    label.test()
+    dataset.test()
+    load_pickle.test_parallel()
+    dataset_pickle.test()
+    sl_loss_multi_gpu.test()
     pseudo_reward.test()
+    trajectory_queue.test()
+    trajectory_buffer.test()
+    discounted_scan.test()
+    z_library.test()
+    parameter_store.test()
+    payoff.test()
+    player.test()
+    snapshot_store.test()
+    coordinator.test()
+    league_store.test()
+    synthetic_env.test()
+    actor_pool.test()
+    learner.test()
     baseline.test()
 
     arch_model.test()
     agent.test()
+    actor_inference.test()
+    inference_service.test()
+    compact_state.test()
 
     print('test over')